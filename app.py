@@ -4,20 +4,29 @@ import os
 import re
 import gc
 import pandas as pd
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import json
 import pickle
 import fcntl        # exclusive /process lock — see _process_lock() below
 import contextlib
-import requests  # customer_registry lookups (via Supabase PostgREST)
+import functools
+import threading    # /process jobs run on a background thread — see _start_process_job()
+import uuid
+import requests  # RequestException — Supabase calls themselves go through supabase_client
 from datetime import datetime, timedelta
-import pdfplumber  # For PDF extraction
-import supabase_writer  # Dual-write mirror to Supabase — no-op unless WRITE_TO_SUPABASE is set
+from typing import NamedTuple
+import pdf_stream  # For PDF extraction (page-at-a-time pdfplumber)
+import excel_stream  # Single-pass openpyxl / xlrd statement reader
+import sms_rescue_engine  # Bulk SMS rescue shared by /api/sms-rescue/batch and the retry sweeps
+import mirror_outbox  # Durable queue in front of the Supabase mirror — no-op unless WRITE_TO_SUPABASE is set
+import audit_queue  # Background batched writer for record_edits / sms_events
 import iliyopata_writer  # Mirror rescued rows into ILIYOPATA tab on the bank sheet
+import sheets_client  # One lazily-built, thread-safe Google Sheets client per process
+import ref_index  # Local SQLite ref/message index — get_existing_refs() reads only the sheet tail
+import supabase_client  # Pooled keep-alive sessions (with retry) for the main + registry Supabase projects
+import pipeline_metrics  # Stage / operation timers and outcome counters for /process runs → /metrics
 from auth import login_manager
-from ui_blueprint import ui as ui_blueprint
+from ui_blueprint import add_registry_change_hook, ui as ui_blueprint
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
@@ -29,6 +38,14 @@ app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['TEMP_FOLDER'] = 'temp_reviews'
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB — handles large NMB/CRDB Excel files
 
+# Every Supabase call made while a /process run is open counts against it.
+supabase_client.add_timing_hook(pipeline_metrics.supabase_hook)
+
+# Per-row diagnostics (classifier + the extractors it calls) — silent unless
+# PIPELINE_LOG_LEVEL=debug. A 10k-row statement used to write tens of
+# thousands of lines to the Render log pipe.
+_row_log = pipeline_metrics.row_log
+
 # Ensure folders exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['TEMP_FOLDER'], exist_ok=True)
@@ -61,8 +78,7 @@ CUSTOMER_SOURCE            = os.environ.get('CUSTOMER_SOURCE', 'sheet').lower()
 SUPABASE_URL_REGISTRY      = os.environ.get('SUPABASE_URL_REGISTRY', '').rstrip('/')
 SUPABASE_KEY_REGISTRY      = os.environ.get('SUPABASE_SERVICE_KEY_REGISTRY', '')
 
-# Google Sheets configuration
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+# Google Sheets configuration (client + scopes: sheets_client.py)
 PASSED_SHEET_ID   = '1rdSRNLdZPT5xXLRgV7wSn1beYwWZp41ZpYoLkbGmt0o'
 PIKIPIKI_SHEET_ID = '1XFwPITQgZmzZ8lbg8MKD9S4rwHyk2cDOKrcxO7SAjHA'
 
@@ -100,6 +116,151 @@ def _resolve_sheet(sheet_name):
         return PASSED_SHEET_ID, sheet_name
 
 
+# ── Parsed description ───────────────────────────────────────────────────────
+# Every extractor below used to re-uppercase the row's text, re-strip the same
+# NMB noise and re-find the Description boundary on its own, with inline regex
+# strings. parse_description() wraps one row's text once; the derived pieces
+# (upper-cased text, Description scope, ref, Trx ID, noise-stripped search
+# text, ...) are computed on first use and reused by every extractor that
+# asks. Extractors still accept a plain string too — they parse it themselves.
+#
+# The cleaned variants are deliberately NOT shared between extractors: each
+# one keeps the exact noise list / order / flags it always had (e.g.
+# _rescue_find_plates strips the REF hex before finding Description, the
+# fuzzy matcher doesn't), so outputs are byte-for-byte what they were.
+
+# `\bDESCRIPTION\b … (FROM | !! | end)` — plate, rescue and fuzzy extractors
+_DESC_SCOPE_RX = re.compile(r'\bDESCRIPTION\b\s+(.+?)(?:\s+FROM\b|!!|$)',
+                            re.IGNORECASE | re.DOTALL)
+# extract_phone_number's older, looser variant (no \b, single line)
+_PHONE_DESC_SCOPE_RX = re.compile(r'DESCRIPTION\s+(.+?)(?:FROM|!!|\Z)', re.IGNORECASE)
+_REF_NUMBER_RX = re.compile(r'REF[:\s]\s*([A-Fa-f0-9]{10,})', re.IGNORECASE)
+_REF_HEX_NOISE_RX = re.compile(r'\bREF\s*:?\s*[A-Fa-f0-9]{8,}')
+_IPHONE_RX = re.compile(r'\biphone\b', re.IGNORECASE)
+_WS_RX = re.compile(r'\s')
+
+# Full-text noise for the rescue / fuzzy search text (already upper-cased)
+_SEARCH_NOISE_RXS = (
+    re.compile(r'\d{3}\s*-?\s*NMB\s*(HEAD\s*OFFICE|BANK)?'),
+    re.compile(r'TER\s+ID\s+\d+'),
+    re.compile(r'TRX\s+ID\s+\w+'),
+    re.compile(r'AGENCY\s+@\d+@'),
+)
+# _clean_nmb_message() noise, in its own order / flags
+_NMB_NOISE_RXS = (
+    _REF_HEX_NOISE_RX,
+    re.compile(r'\d{3}\s*-?\s*NMB\s+(HEAD\s+OFFICE|BANK)?', re.IGNORECASE),
+    re.compile(r'TER\s+ID\s+\d+', re.IGNORECASE),
+    re.compile(r'AGENCY\s+@\d+@', re.IGNORECASE),
+    re.compile(r'TRX\s+ID\s+\w+', re.IGNORECASE),
+)
+# extract_phone_for_iphone() scrub list
+_IPHONE_PHONE_NOISE_RXS = (
+    re.compile(r'AGENCY\s*@\d+@', re.IGNORECASE),
+    re.compile(r'TER\s+ID\s+\d+', re.IGNORECASE),
+    re.compile(r'TRX\s+ID\s+\w+', re.IGNORECASE),
+    re.compile(r'REF:\s*\S+', re.IGNORECASE),
+)
+
+
+def _strip_all(rxs, text):
+    for rx in rxs:
+        text = rx.sub('', text)
+    return text
+
+
+class ParsedDescription:
+    """One transaction description, parsed once per row.
+
+    `raw` is str(text) exactly as the extractors always saw it; `empty`
+    mirrors their `not text or pd.isna(text)` guard. Everything else is
+    computed lazily and cached on the instance."""
+
+    def __init__(self, text):
+        self.empty = bool(not text or pd.isna(text))
+        self.raw = str(text) if text is not None else ''
+
+    def __str__(self):
+        return self.raw
+
+    @functools.cached_property
+    def upper(self):
+        return self.raw.upper()
+
+    @functools.cached_property
+    def ref(self):
+        m = _REF_NUMBER_RX.search(self.raw)
+        return m.group(1) if m else None
+
+    @functools.cached_property
+    def trx_id(self):
+        m = _TRX_ID_RX.search(self.raw)
+        return m.group(1).upper() if m else None
+
+    @functools.cached_property
+    def is_iphone(self):
+        return bool(_IPHONE_RX.search(self.raw))
+
+    @functools.cached_property
+    def desc_scope(self):
+        """Text after 'Description' (stripped, original case), or None when
+        the keyword isn't there. '' is a real (empty) scope, not a miss."""
+        m = _DESC_SCOPE_RX.search(self.raw)
+        return m.group(1).strip() if m else None
+
+    @functools.cached_property
+    def phone_desc_scope(self):
+        m = _PHONE_DESC_SCOPE_RX.search(self.raw)
+        return m.group(1).strip() if m else None
+
+    @functools.cached_property
+    def nmb_clean_upper(self):
+        """Upper-cased full text through _clean_nmb_message()."""
+        return _strip_all(_NMB_NOISE_RXS, self.upper)
+
+    @functools.cached_property
+    def loose_search_text(self):
+        """Fuzzy matcher's search text: upper-cased Description scope, else
+        the noise-stripped upper-cased full text."""
+        if self.desc_scope is not None:
+            return self.desc_scope.upper()
+        return _strip_all(_SEARCH_NOISE_RXS, self.upper)
+
+    @functools.cached_property
+    def rescue_search(self):
+        """(search_text, scoped) for _rescue_find_plates — same as
+        loose_search_text but computed after the REF hex is stripped."""
+        no_ref = _REF_HEX_NOISE_RX.sub('', self.raw)
+        m = _DESC_SCOPE_RX.search(no_ref)
+        if m:
+            return m.group(1).strip().upper(), True
+        return _strip_all(_SEARCH_NOISE_RXS, no_ref.upper()), False
+
+    @functools.cached_property
+    def iphone_phone(self):
+        return _extract_phone_from_clean_text(
+            _strip_all(_IPHONE_PHONE_NOISE_RXS, self.raw))
+
+
+def parse_description(text):
+    """ParsedDescription for `text` (returned as-is if it already is one)."""
+    if isinstance(text, ParsedDescription):
+        return text
+    return ParsedDescription(text)
+
+
+# extract_nmb_datetime() shapes, strictest first — see its docstring
+_NMB_DT_DOTTED_RX = re.compile(
+    r'\b(\d{2})\.(\d{2})\.(\d{4})\s+(\d{2})\s+(\d{2})\s+(\d{2})\b')
+_NMB_DT_SPACED_YEAR_RX = re.compile(
+    r'\b(\d{2})\s+(\d{2})\s+(20\d{2})\s+(\d{2})\s+(\d{2})\s+(\d{2})\b')
+_NMB_DT_FIVE_RX = re.compile(
+    r'\b(\d{2})\s+(\d{2})\s+(\d{2})\s+(\d{2})\s+(\d{2})\b(?!\.\d)')
+_NMB_DT_LEGACY_RX = re.compile(r'\b(\d{2})(\d{2})\s+(\d{2})\s+(\d{2})\s+(\d{2})\b')
+_NMB_DT_PDF_RX = re.compile(r'\b(\d{2})(\d{2})\s+(\d{2}):(\d{2}):(\d{2})\b')
+_YEAR_RX = re.compile(r'\b(20\d{2})\b')
+
+
 def extract_nmb_datetime(description, fallback_date_str):
     """
     Extract date and time embedded inside an NMB description.
@@ -124,11 +285,10 @@ def extract_nmb_datetime(description, fallback_date_str):
 
     Returns: 'DD.MM.YYYY HH:MM:SS'.
     """
-    if not description:
+    desc = parse_description(description).raw
+    if not desc:
         return None
 
-    desc = str(description)
-
     def _valid(d_str, m_str):
         try:
             d, m = int(d_str), int(m_str)
@@ -137,16 +297,12 @@ def extract_nmb_datetime(description, fallback_date_str):
             return False
 
     # 1. DD.MM.YYYY HH MM SS — the "received payment on 01.06.2026 08 22 15" form
-    m1 = re.search(
-        r'\b(\d{2})\.(\d{2})\.(\d{4})\s+(\d{2})\s+(\d{2})\s+(\d{2})\b', desc,
-    )
+    m1 = _NMB_DT_DOTTED_RX.search(desc)
     if m1 and _valid(m1.group(1), m1.group(2)):
         return f"{m1.group(1)}.{m1.group(2)}.{m1.group(3)} {m1.group(4)}:{m1.group(5)}:{m1.group(6)}"
 
     # 4. DD MM YYYY HH MM SS — same as 1 but space-separated date
-    m4 = re.search(
-        r'\b(\d{2})\s+(\d{2})\s+(20\d{2})\s+(\d{2})\s+(\d{2})\s+(\d{2})\b', desc,
-    )
+    m4 = _NMB_DT_SPACED_YEAR_RX.search(desc)
     if m4 and _valid(m4.group(1), m4.group(2)):
         return f"{m4.group(1)}.{m4.group(2)}.{m4.group(3)} {m4.group(4)}:{m4.group(5)}:{m4.group(6)}"
 
@@ -154,163 +310,201 @@ def extract_nmb_datetime(description, fallback_date_str):
     # statement's Posting Date or, last resort, the current year.
     year = None
     if fallback_date_str:
-        year_match = re.search(r'\b(20\d{2})\b', str(fallback_date_str))
+        year_match = _YEAR_RX.search(str(fallback_date_str))
         if year_match:
             year = year_match.group(1)
     if not year:
         year = str(datetime.now().year)
 
     # 2. DD MM HH MM SS — five space-separated 2-digit groups
-    m2 = re.search(
-        r'\b(\d{2})\s+(\d{2})\s+(\d{2})\s+(\d{2})\s+(\d{2})\b(?!\.\d)', desc,
-    )
+    m2 = _NMB_DT_FIVE_RX.search(desc)
     if m2 and _valid(m2.group(1), m2.group(2)):
         return f"{m2.group(1)}.{m2.group(2)}.{year} {m2.group(3)}:{m2.group(4)}:{m2.group(5)}"
 
     # 3. DDMM HH MM SS — original legacy form. Validate DD/MM so we
     #    never write back a "20.26.YYYY" cell again.
-    m3 = re.search(r'\b(\d{2})(\d{2})\s+(\d{2})\s+(\d{2})\s+(\d{2})\b', desc)
+    m3 = _NMB_DT_LEGACY_RX.search(desc)
     if m3 and _valid(m3.group(1), m3.group(2)):
         return f"{m3.group(1)}.{m3.group(2)}.{year} {m3.group(3)}:{m3.group(4)}:{m3.group(5)}"
 
     # 5. DDMM HH:MM:SS — PDF form. Time is colon-separated; the date is
     #    always the leading 4-digit DDMM, never the year. DD/MM validation
     #    blocks bogus year-as-date matches (e.g. '2026 23:59:51').
-    m5 = re.search(r'\b(\d{2})(\d{2})\s+(\d{2}):(\d{2}):(\d{2})\b', desc)
+    m5 = _NMB_DT_PDF_RX.search(desc)
     if m5 and _valid(m5.group(1), m5.group(2)):
         return f"{m5.group(1)}.{m5.group(2)}.{year} {m5.group(3)}:{m5.group(4)}:{m5.group(5)}"
 
     return None
 
 
+# ── Statement rows ────────────────────────────────────────────────────────────
+# Every reader (CRDB PDF / Excel, NMB Excel / CSV / PDF) returns
+# transactions_list as a list of BankTxn: a 4-field tuple instead of the
+# per-row dict the readers used to build (one hash table per row, keyed by
+# column-header strings), ~5x smaller per row on 10k-row statements. The
+# classifiers read fields by name. Text fields are already str() — missing
+# cells read 'nan', exactly what str(row.get(...)) made of them before.
+class BankTxn(NamedTuple):
+    date: str           # CRDB Posting Date / NMB Date (or Book Date)
+    description: str    # CRDB Details / NMB Description (Narration)
+    credit: float
+    ref: str = ''       # NMB Reference Number; CRDB's REF lives in the description
+
+    @classmethod
+    def of(cls, date, description, credit, ref=None):
+        return cls(str(date), str(description), float(credit),
+                   str(ref).strip() if ref is not None and pd.notna(ref) else '')
+
+
+def _excel_amount(value, strip_tzs=False):
+    """Statement amount cell → float, or None for empty / unparseable —
+    what pd.to_numeric(..., errors='coerce') made of the same cell, with
+    thousands commas (and, for NMB, 'TZS') stripped first."""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return None if value != value else float(value)
+    text = str(value).replace(',', '')
+    if strip_tzs:
+        text = text.replace('TZS', '')
+    try:
+        amount = float(text.strip())
+    except ValueError:
+        return None
+    return None if amount != amount else amount
+
+
+def _crdb_excel_header(row):
+    """CRDB account-statement export header row ('Posting Date' + 'Details')."""
+    row_vals = [str(v).strip() for v in row if v is not None]
+    return 'Posting Date' in row_vals and 'Details' in row_vals
+
+
+def _crdb_pdf_header(row):
+    """CRDB statement column-header row (learned-layout anchor for pdf_stream)."""
+    return any(cell and ('TRANS DATE' in str(cell).upper() or
+                         'DETAILS' in str(cell).upper()) for cell in row)
+
+
 def extract_data_from_pdf(filepath):
     """
     🔥 NEW: Extract transaction data from PDF bank statement
     PDF format: SN | TRANS DATE | DETAILS | CHANNEL ID | VALUE DATE | DEBIT | CREDIT | BOOK BALANCE
-    Returns DataFrame with columns: Posting Date, Details, Credit
+    Returns a list of BankTxn (None when nothing was found)
     """
     try:
         print(f"📄 Opening PDF: {filepath}")
         transactions = []
         
-        with pdfplumber.open(filepath) as pdf:
-            for page_num, page in enumerate(pdf.pages, 1):
-                print(f"📖 Processing page {page_num}...")
+        for page_num, tables in pdf_stream.iter_page_tables(
+                filepath, header_match=_crdb_pdf_header):
+            _row_log(f"📖 Processing page {page_num}...")
                 
-                # Extract tables from the page
-                tables = page.extract_tables()
+            if not tables:
+                print(f"⚠️ No tables found on page {page_num}")
+                continue
                 
-                if not tables:
-                    print(f"⚠️ No tables found on page {page_num}")
+            for table_idx, table in enumerate(tables):
+                if not table:
                     continue
-                
-                for table_idx, table in enumerate(tables):
-                    if not table:
-                        continue
                     
-                    print(f"  📊 Table {table_idx + 1}: {len(table)} rows")
+                _row_log(f"  📊 Table {table_idx + 1}: {len(table)} rows")
                     
-                    # Find header row (contains "TRANS DATE" or "SN")
-                    header_row_idx = None
-                    for idx, row in enumerate(table):
-                        if row and any(cell and ('TRANS DATE' in str(cell).upper() or 
-                                                   'SN' in str(cell).upper() or 
-                                                   'DETAILS' in str(cell).upper()) for cell in row):
-                            header_row_idx = idx
-                            print(f"  ✓ Found header at row {idx}: {row}")
-                            break
+                # Find header row (contains "TRANS DATE" or "SN")
+                header_row_idx = None
+                for idx, row in enumerate(table):
+                    if row and any(cell and ('TRANS DATE' in str(cell).upper() or 
+                                               'SN' in str(cell).upper() or 
+                                               'DETAILS' in str(cell).upper()) for cell in row):
+                        header_row_idx = idx
+                        _row_log(f"  ✓ Found header at row {idx}: {row}")
+                        break
                     
-                    if header_row_idx is None:
-                        print(f"  ⚠️ No header found in table {table_idx + 1}")
-                        continue
+                if header_row_idx is None:
+                    print(f"  ⚠️ No header found in table {table_idx + 1}")
+                    continue
                     
-                    headers = table[header_row_idx]
+                headers = table[header_row_idx]
                     
-                    # Map column indices (handle variations in header names)
-                    col_map = {}
-                    for idx, header in enumerate(headers):
-                        if not header:
-                            continue
-                        header_upper = str(header).upper().strip()
+                # Map column indices (handle variations in header names)
+                col_map = {}
+                for idx, header in enumerate(headers):
+                    if not header:
+                        continue
+                    header_upper = str(header).upper().strip()
                         
-                        if 'TRANS DATE' in header_upper or 'DATE' in header_upper:
-                            col_map['trans_date'] = idx
-                        elif 'DETAILS' in header_upper:
-                            col_map['details'] = idx
-                        elif 'CREDIT' in header_upper:
-                            col_map['credit'] = idx
-                        elif 'DEBIT' in header_upper:
-                            col_map['debit'] = idx
+                    if 'TRANS DATE' in header_upper or 'DATE' in header_upper:
+                        col_map['trans_date'] = idx
+                    elif 'DETAILS' in header_upper:
+                        col_map['details'] = idx
+                    elif 'CREDIT' in header_upper:
+                        col_map['credit'] = idx
+                    elif 'DEBIT' in header_upper:
+                        col_map['debit'] = idx
                     
-                    print(f"  📍 Column mapping: {col_map}")
+                _row_log(f"  📍 Column mapping: {col_map}")
                     
-                    if 'trans_date' not in col_map or 'details' not in col_map or 'credit' not in col_map:
-                        print(f"  ⚠️ Missing required columns in table {table_idx + 1}")
-                        continue
+                if 'trans_date' not in col_map or 'details' not in col_map or 'credit' not in col_map:
+                    print(f"  ⚠️ Missing required columns in table {table_idx + 1}")
+                    continue
                     
-                    # Process data rows
-                    for row_idx in range(header_row_idx + 1, len(table)):
-                        row = table[row_idx]
+                # Process data rows
+                for row_idx in range(header_row_idx + 1, len(table)):
+                    row = table[row_idx]
                         
-                        if not row or len(row) <= max(col_map.values()):
-                            continue
+                    if not row or len(row) <= max(col_map.values()):
+                        continue
                         
-                        # Skip empty rows
-                        if all(not cell or str(cell).strip() == '' for cell in row):
-                            continue
+                    # Skip empty rows
+                    if all(not cell or str(cell).strip() == '' for cell in row):
+                        continue
                         
-                        trans_date = row[col_map['trans_date']] if 'trans_date' in col_map else ''
-                        details = row[col_map['details']] if 'details' in col_map else ''
-                        credit = row[col_map['credit']] if 'credit' in col_map else ''
-                        debit = row[col_map.get('debit', -1)] if 'debit' in col_map else ''
+                    trans_date = row[col_map['trans_date']] if 'trans_date' in col_map else ''
+                    details = row[col_map['details']] if 'details' in col_map else ''
+                    credit = row[col_map['credit']] if 'credit' in col_map else ''
+                    debit = row[col_map.get('debit', -1)] if 'debit' in col_map else ''
                         
-                        # Clean up values
-                        trans_date = str(trans_date).strip() if trans_date else ''
-                        details = str(details).strip() if details else ''
-                        credit_str = str(credit).strip() if credit else ''
-                        debit_str = str(debit).strip() if debit else ''
+                    # Clean up values
+                    trans_date = str(trans_date).strip() if trans_date else ''
+                    details = str(details).strip() if details else ''
+                    credit_str = str(credit).strip() if credit else ''
+                    debit_str = str(debit).strip() if debit else ''
                         
-                        # Skip if no details or date
-                        if not details or not trans_date:
-                            continue
+                    # Skip if no details or date
+                    if not details or not trans_date:
+                        continue
                         
-                        # Skip header repetitions
-                        if 'DETAILS' in details.upper() or 'TRANS DATE' in trans_date.upper():
-                            continue
+                    # Skip header repetitions
+                    if 'DETAILS' in details.upper() or 'TRANS DATE' in trans_date.upper():
+                        continue
                         
-                        # Parse credit amount
-                        credit_val = 0.0
-                        if credit_str:
-                            try:
-                                credit_val = float(credit_str.replace(',', '').replace(' ', ''))
-                            except ValueError:
-                                credit_val = 0.0
+                    # Parse credit amount
+                    credit_val = 0.0
+                    if credit_str:
+                        try:
+                            credit_val = float(credit_str.replace(',', '').replace(' ', ''))
+                        except ValueError:
+                            credit_val = 0.0
                         
-                        # Parse debit amount
-                        debit_val = 0.0
-                        if debit_str:
-                            try:
-                                debit_val = float(debit_str.replace(',', '').replace(' ', ''))
-                            except ValueError:
-                                debit_val = 0.0
+                    # Parse debit amount
+                    debit_val = 0.0
+                    if debit_str:
+                        try:
+                            debit_val = float(debit_str.replace(',', '').replace(' ', ''))
+                        except ValueError:
+                            debit_val = 0.0
                         
-                        # Only include credit transactions (credit > 0 and debit is 0 or empty)
-                        if credit_val > 0 and debit_val == 0:
-                            transactions.append({
-                                'Posting Date': trans_date,
-                                'Details': details,
-                                'Credit': credit_val,
-                                'Debit': debit_val
-                            })
-                            print(f"  ✓ Transaction: {trans_date} | {details[:50]}... | Credit: {credit_val}")
+                    # Only include credit transactions (credit > 0 and debit is 0 or empty)
+                    if credit_val > 0 and debit_val == 0:
+                        transactions.append(BankTxn.of(trans_date, details, credit_val))
+                        _row_log(f"  ✓ Transaction: {trans_date} | {details[:50]}... | Credit: {credit_val}")
         
         if not transactions:
             print("❌ No transactions found in PDF")
             return None
         
-        df = pd.DataFrame(transactions)
-        print(f"✅ Extracted {len(df)} credit transactions from PDF")
-        return df
+        print(f"✅ Extracted {len(transactions)} credit transactions from PDF")
+        return transactions
     
     except Exception as e:
         print(f"❌ Error extracting PDF data: {e}")
@@ -320,34 +514,11 @@ def extract_data_from_pdf(filepath):
 
 
 def get_google_service():
-    """Create Google Sheets service using Service Account"""
+    """Google Sheets service (Service Account) — the process-wide client from
+    sheets_client.py. Credentials and the discovery doc are built once per
+    process; each thread reuses its own keep-alive client after that."""
     try:
-        GOOGLE_CREDS = os.environ.get('GOOGLE_CREDENTIALS_JSON')
-        if not GOOGLE_CREDS:
-            raise ValueError("GOOGLE_CREDENTIALS_JSON not found")
-        
-        # 🔍 DEBUG: Check what we're getting
-        print(f"📏 Raw env var length: {len(GOOGLE_CREDS)} characters")
-        
-        creds_dict = json.loads(GOOGLE_CREDS)
-        
-        # 🔍 DEBUG: Check the private key
-        pk = creds_dict.get('private_key', '')
-        print(f"🔑 Private key length: {len(pk)} characters")
-        print(f"🔑 First 60 chars: {pk[:60]}")
-        print(f"🔑 Last 60 chars: {pk[-60:]}")
-        print(f"🔑 Contains \\n (literal): {'\\n' in pk}")
-        print(f"🔑 Contains actual newlines: {chr(10) in pk}")
-        
-        # Load credentials
-        credentials = service_account.Credentials.from_service_account_info(
-            creds_dict,
-            scopes=SCOPES
-        )
-        
-        service = build('sheets', 'v4', credentials=credentials)
-        return service
-        
+        return sheets_client.get_service()
     except Exception as e:
         print(f"❌ Error creating service: {e}")
         import traceback
@@ -364,28 +535,28 @@ def extract_phone_number(text):
     - This ensures we get the customer's phone, NOT the agent's phone
     - If agency pattern exists but no phone in Description, return None to force plate lookup
     """
-    if not text or pd.isna(text):
+    parsed = parse_description(text)
+    if parsed.empty:
         return None
     
-    original_text = str(text)
+    original_text = parsed.raw
     
     # 🔥 CRITICAL FIX: For NMB messages with "agency @", extract ONLY from Description section
-    if 'AGENCY' in original_text.upper() and '@' in original_text:
+    if 'AGENCY' in parsed.upper and '@' in original_text:
         # Find the Description section
-        description_match = re.search(r'DESCRIPTION\s+(.+?)(?:FROM|!!|\Z)', original_text, re.IGNORECASE)
-        if description_match:
-            description_text = description_match.group(1).strip()
-            print(f"  🔍 Searching for phone in Description: {description_text[:60]}...")
+        description_text = parsed.phone_desc_scope
+        if description_text is not None:
+            _row_log(f"  🔍 Searching for phone in Description: {description_text[:60]}...")
             
             # Extract phone from Description section ONLY
             phone = _extract_phone_from_clean_text(description_text.replace(' ', '').replace('-', ''))
             if phone:
-                print(f"  ✅ Found customer phone in Description: {phone}")
+                _row_log(f"  ✅ Found customer phone in Description: {phone}")
                 return phone
             else:
-                print(f"  ⚠️ No phone found in Description section")
+                _row_log(f"  ⚠️ No phone found in Description section")
         else:
-            print(f"  ⚠️ No Description section found in message")
+            _row_log(f"  ⚠️ No Description section found in message")
         
         # 🔥 KEY FIX: If we have an agency number pattern, do NOT extract from the full text
         # Return None to force plate lookup instead of using the agency number
@@ -399,8 +570,8 @@ def extract_phone_number(text):
     text_cleaned = original_text
     
     # 🔥 IMPROVED: Exclude account numbers
-    if 'FRANKAB' in text_cleaned.upper() or 'TOFRANKAB' in text_cleaned.upper():
-        parts = re.split(r'[:\s]+', text_cleaned)
+    if 'FRANKAB' in parsed.upper or 'TOFRANKAB' in parsed.upper:
+        parts = _PHONE_SPLIT_RX.split(text_cleaned)
         for part in parts:
             if 'FRANKAB' not in part.upper() and 'FRANK' not in part.upper():
                 phone = _extract_phone_from_clean_text(part)
@@ -410,17 +581,21 @@ def extract_phone_number(text):
     
     return _extract_phone_from_clean_text(text_cleaned)
 
+_PHONE_SPLIT_RX = re.compile(r'[:\s]+')
+# 255 + 9 digits / 07|06 + 8 digits, never part of a longer number
+_PHONE_255_RX = re.compile(r'(?<!\d)255(\d{9})(?!\d)')
+_PHONE_07_06_RX = re.compile(r'(?<!\d)0([67])(\d{8})(?!\d)')
+
+
 def _extract_phone_from_clean_text(text):
     """Helper to extract phone from text without account numbers"""
     # Pattern for 255 followed by 9 digits (must not be part of longer number)
-    pattern_255 = r'(?<!\d)255(\d{9})(?!\d)'
-    match = re.search(pattern_255, text)
+    match = _PHONE_255_RX.search(text)
     if match:
         return f"255{match.group(1)}"
     
     # Pattern for 07 or 06 followed by 8 digits (must not be part of longer number)
-    pattern_07_06 = r'(?<!\d)0([67])(\d{8})(?!\d)'
-    match = re.search(pattern_07_06, text)
+    match = _PHONE_07_06_RX.search(text)
     if match:
         return f"0{match.group(1)}{match.group(2)}"
     
@@ -443,29 +618,25 @@ def extract_plate_number(text):
 
     Returns normalised plate "MC###XXX" or None.
     """
-    if not text or pd.isna(text):
+    parsed = parse_description(text)
+    if parsed.empty:
         return None
 
-    original_text = str(text)
-
     # ── Description boundary present → search ONLY after it ──────────────────
-    desc_m = re.search(r'\bDESCRIPTION\b\s+(.+?)(?:\s+FROM\b|!!|$)',
-                       original_text, re.IGNORECASE | re.DOTALL)
-    if desc_m:
-        desc_text = desc_m.group(1).strip()
-        print(f"  🔍 Description section: {desc_text[:80]}...")
+    desc_text = parsed.desc_scope
+    if desc_text is not None:
+        _row_log(f"  🔍 Description section: {desc_text[:80]}...")
         plate = _extract_plate_from_text(desc_text)
         if plate:
-            print(f"  ✅ Plate from Description: {plate}")
+            _row_log(f"  ✅ Plate from Description: {plate}")
         else:
-            print(f"  ⚠️ No plate in Description — not falling back to full text")
+            _row_log(f"  ⚠️ No plate in Description — not falling back to full text")
         return plate  # None or found — STOP here, never search before Description
 
     # ── No Description → full cleaned message, rightmost match wins ───────────
-    cleaned = _clean_nmb_message(original_text.upper())
-    plate = _extract_plate_from_text_rightmost(cleaned)
+    plate = _extract_plate_from_text_rightmost(parsed.nmb_clean_upper)
     if plate:
-        print(f"  ✅ Plate from full text (rightmost): {plate}")
+        _row_log(f"  ✅ Plate from full text (rightmost): {plate}")
     return plate
 
 
@@ -489,22 +660,19 @@ def _clean_nmb_message(text):
     """
     # 🔥 Strip REF hex FIRST — must happen before any regex that could match
     # inside a 16-char hex string. Catches `REF:<hex>`, `REF: <hex>`,
-    # `REF <hex>` variants.
-    text = re.sub(r'\bREF\s*:?\s*[A-Fa-f0-9]{8,}', '', text)
-
-    # Remove NMB bank identifier
-    text = re.sub(r'\d{3}\s*-?\s*NMB\s+(HEAD\s+OFFICE|BANK)?', '', text, flags=re.IGNORECASE)
-
-    # 🔥 Remove "Ter ID" followed by any numbers (these create false XXX### patterns)
-    text = re.sub(r'TER\s+ID\s+\d+', '', text, flags=re.IGNORECASE)
-
-    # 🔥 Remove "agency @" patterns (these create false phone numbers)
-    text = re.sub(r'AGENCY\s+@\d+@', '', text, flags=re.IGNORECASE)
+    # `REF <hex>` variants. Then the NMB bank identifier, "Ter ID ###"
+    # (false XXX### plates), "agency @###@" (false phones) and "Trx ID".
+    # Compiled once in _NMB_NOISE_RXS, in that order.
+    return _strip_all(_NMB_NOISE_RXS, text)
 
-    # 🔥 Remove "Trx ID" patterns
-    text = re.sub(r'TRX\s+ID\s+\w+', '', text, flags=re.IGNORECASE)
 
-    return text
+# Plate shapes shared by _extract_plate_from_text / _rightmost
+_PLATE_INVALID = frozenset({'NMB', 'TER', 'TRX', 'AGD', 'TPS', 'ACC', 'FRO', 'LTD', 'HEAD', 'OFF'})
+_PLATE_MC_DL_RX = re.compile(r'MC[ ]?(\d[ ]?\d[ ]?\d)[ ]?([A-Z]{3})')
+_PLATE_MC_LD_RX = re.compile(r'MC[ ]?([A-Z]{3})[ ]?(\d[ ]?\d[ ]?\d)')
+_PLATE_BARE_DL_RX = re.compile(r'(\d{3})[ ]?([A-Z]{3})(?![A-Z])')
+_PLATE_BARE_LD_RX = re.compile(r'(?<![A-Z])([A-Z]{3})[ ]?(\d{3})(?!\d)')
+_PLATE_MC_D2L_RX = re.compile(r'MC[ ]?(\d{3})[ ]?([A-Z]{2})(?![A-Z])')
 
 
 def _extract_plate_from_text(text):
@@ -523,50 +691,50 @@ def _extract_plate_from_text(text):
     if not text or pd.isna(text):
         return None
     tu = str(text).upper()
-    INVALID = {'NMB', 'TER', 'TRX', 'AGD', 'TPS', 'ACC', 'FRO', 'LTD', 'HEAD', 'OFF'}
+    INVALID = _PLATE_INVALID
 
     # P1: MC + 3 digits + 3 letters (plate may be mid-word or followed by more letters)
-    m = re.search(r'MC[ ]?(\d[ ]?\d[ ]?\d)[ ]?([A-Z]{3})', tu)
+    m = _PLATE_MC_DL_RX.search(tu)
     if m:
-        d = re.sub(r'\s', '', m.group(1))
+        d = _WS_RX.sub('', m.group(1))
         l = m.group(2)
         if l not in INVALID:
-            print(f"  ✓ P1 MC###XXX: MC{d}{l}")
+            _row_log(f"  ✓ P1 MC###XXX: MC{d}{l}")
             return f"MC{d}{l}"
 
     # P2: MC + 3 letters + 3 digits
-    m = re.search(r'MC[ ]?([A-Z]{3})[ ]?(\d[ ]?\d[ ]?\d)', tu)
+    m = _PLATE_MC_LD_RX.search(tu)
     if m:
         l = m.group(1)
-        d = re.sub(r'\s', '', m.group(2))
+        d = _WS_RX.sub('', m.group(2))
         if l not in INVALID:
-            print(f"  ✓ P2 MCXXX###: MC{d}{l}")
+            _row_log(f"  ✓ P2 MCXXX###: MC{d}{l}")
             return f"MC{d}{l}"
 
     # P3: bare 3digits + 3letters (no lookbehind — catches CN607FLW, etc.)
-    for m in re.finditer(r'(\d{3})[ ]?([A-Z]{3})(?![A-Z])', tu):
+    for m in _PLATE_BARE_DL_RX.finditer(tu):
         pos = m.start()
         if pos >= 2 and tu[pos-2:pos] == 'MC':
             continue  # already covered by P1
         l = m.group(2)
         if l not in INVALID:
-            print(f"  ✓ P3 ###XXX: MC{m.group(1)}{l}")
+            _row_log(f"  ✓ P3 ###XXX: MC{m.group(1)}{l}")
             return f"MC{m.group(1)}{l}"
 
     # P4: bare 3letters + 3digits
-    for m in re.finditer(r'(?<![A-Z])([A-Z]{3})[ ]?(\d{3})(?!\d)', tu):
+    for m in _PLATE_BARE_LD_RX.finditer(tu):
         l = m.group(1)
         pos = m.start()
         if pos >= 2 and tu[pos-2:pos] == 'MC':
             continue
         if l not in INVALID:
-            print(f"  ✓ P4 XXX###: MC{m.group(2)}{l}")
+            _row_log(f"  ✓ P4 XXX###: MC{m.group(2)}{l}")
             return f"MC{m.group(2)}{l}"
 
     # P5: MC + 3digits + 2letters fallback (truncated plates like mc266ey, mc628vj)
-    m = re.search(r'MC[ ]?(\d{3})[ ]?([A-Z]{2})(?![A-Z])', tu)
+    m = _PLATE_MC_D2L_RX.search(tu)
     if m:
-        print(f"  ✓ P5 MC###XX (2-letter fallback): MC{m.group(1)}{m.group(2)}")
+        _row_log(f"  ✓ P5 MC###XX (2-letter fallback): MC{m.group(1)}{m.group(2)}")
         return f"MC{m.group(1)}{m.group(2)}"
 
     return None
@@ -583,24 +751,24 @@ def _extract_plate_from_text_rightmost(text):
         return None
 
     tu = str(text).upper()
-    INVALID = {'NMB', 'TER', 'TRX', 'AGD', 'TPS', 'ACC', 'FRO', 'LTD', 'HEAD', 'OFF'}
+    INVALID = _PLATE_INVALID
     all_matches = []  # (position, plate, priority)
 
     # MC-prefixed — priority 1
-    for m in re.finditer(r'MC[ ]?(\d[ ]?\d[ ]?\d)[ ]?([A-Z]{3})', tu):
+    for m in _PLATE_MC_DL_RX.finditer(tu):
         l = m.group(2)
         if l not in INVALID:
-            d = re.sub(r'\s', '', m.group(1))
+            d = _WS_RX.sub('', m.group(1))
             all_matches.append((m.start(), f"MC{d}{l}", 1))
 
-    for m in re.finditer(r'MC[ ]?([A-Z]{3})[ ]?(\d[ ]?\d[ ]?\d)', tu):
+    for m in _PLATE_MC_LD_RX.finditer(tu):
         l = m.group(1)
         if l not in INVALID:
-            d = re.sub(r'\s', '', m.group(2))
+            d = _WS_RX.sub('', m.group(2))
             all_matches.append((m.start(), f"MC{d}{l}", 1))
 
     # Bare ###XXX — priority 1
-    for m in re.finditer(r'(\d{3})[ ]?([A-Z]{3})(?![A-Z])', tu):
+    for m in _PLATE_BARE_DL_RX.finditer(tu):
         pos = m.start()
         if pos >= 2 and tu[pos-2:pos] == 'MC':
             continue
@@ -609,7 +777,7 @@ def _extract_plate_from_text_rightmost(text):
             all_matches.append((pos, f"MC{m.group(1)}{l}", 1))
 
     # Bare XXX### — priority 2
-    for m in re.finditer(r'(?<![A-Z])([A-Z]{3})[ ]?(\d{3})(?!\d)', tu):
+    for m in _PLATE_BARE_LD_RX.finditer(tu):
         l = m.group(1)
         pos = m.start()
         if pos >= 2 and tu[pos-2:pos] == 'MC':
@@ -623,31 +791,36 @@ def _extract_plate_from_text_rightmost(text):
     # Sort: priority 1 before 2, then rightmost (largest position) first
     all_matches.sort(key=lambda x: (x[2], -x[0]))
     plate = all_matches[0][1]
-    print(f"  ✓ rightmost match: {plate}")
+    _row_log(f"  ✓ rightmost match: {plate}")
     return plate
 
 
+_PLATE_MESSY_RX = re.compile(
+    r'MC[\s\.\-]*([A-Z]{3,4})[\s\.\-]*(\d{2,4})|([A-Z]{3,4})[\s\.\-]*(\d{2,4})[\s\.\-]*(?:MC)?')
+_DIGIT_RX = re.compile(r'\d')
+_LETTER_RX = re.compile(r'[A-Z]')
+
+
 def extract_plate_suggestions(text):
     """
     🔥 NEW: Extract potential plate numbers that need confirmation
     Returns list of (original_text, suggested_plate, confidence)
     """
-    if not text or pd.isna(text):
+    parsed = parse_description(text)
+    if parsed.empty:
         return []
     
-    text_upper = str(text).upper()
     suggestions = []
     
     # Look for patterns that might be plates but need cleanup
-    pattern_messy = r'MC[\s\.\-]*([A-Z]{3,4})[\s\.\-]*(\d{2,4})|([A-Z]{3,4})[\s\.\-]*(\d{2,4})[\s\.\-]*(?:MC)?'
-    matches = re.finditer(pattern_messy, text_upper)
+    matches = _PLATE_MESSY_RX.finditer(parsed.upper)
     
     for match in matches:
         original = match.group(0)
         
         # Extract numbers and letters
-        numbers = ''.join(re.findall(r'\d', original))
-        letters = ''.join(re.findall(r'[A-Z]', original.replace('MC', '')))
+        numbers = ''.join(_DIGIT_RX.findall(original))
+        letters = ''.join(_LETTER_RX.findall(original.replace('MC', '')))
         
         # Must have exactly 3 numbers and 3 letters to be valid
         if len(numbers) == 3 and len(letters) == 3:
@@ -675,20 +848,34 @@ _RESCUE_TIERS = [
 _RESCUE_SINGLE_LETTER = {'M', 'N', 'T', 'C'}
 
 
+def _rescue_prefix_patterns(prefix):
+    lb  = r'(?<![A-Z])' if prefix in _RESCUE_SINGLE_LETTER else ''
+    esc = re.escape(prefix)
+    return (
+        (re.compile(rf'{lb}{esc}[ ]?(\d[ ]?\d[ ]?\d)[ ]*([A-Z][ ]?[A-Z][ ]?[A-Z])'), False),
+        (re.compile(rf'{lb}{esc}[ ]?([A-Z][ ]?[A-Z][ ]?[A-Z])[ ]*(\d[ ]?\d[ ]?\d)'), True),
+    )
+
+
+_RESCUE_PREFIX_RXS = {prefix: _rescue_prefix_patterns(prefix)
+                      for tier in _RESCUE_TIERS for prefix in tier}
+# Bare 3+3 fallback: numbers-first (priority 1), letters-first (priority 2)
+_RESCUE_BARE_RXS = (
+    re.compile(r'(?<![A-Z\d])(\d[ ]?\d[ ]?\d)[ ]*([A-Z][ ]?[A-Z][ ]?[A-Z])(?![A-Z])'),
+    re.compile(r'(?<![A-Z])([A-Z][ ]?[A-Z][ ]?[A-Z])[ ]*(\d[ ]?\d[ ]?\d)(?!\d)'),
+)
+
+
 def _rescue_extract_after_prefix(prefix, text):
     """Find prefix in text, grab next 3-digits+3-letters or reverse.
     Multi-letter prefixes: match anywhere (including mid-word).
     Single-letter prefixes: require non-letter before them."""
     found, seen = [], set()
-    lb  = r'(?<![A-Z])' if prefix in _RESCUE_SINGLE_LETTER else ''
-    esc = re.escape(prefix)
-    for pat, rev in (
-        (rf'{lb}{esc}[ ]?(\d[ ]?\d[ ]?\d)[ ]*([A-Z][ ]?[A-Z][ ]?[A-Z])', False),
-        (rf'{lb}{esc}[ ]?([A-Z][ ]?[A-Z][ ]?[A-Z])[ ]*(\d[ ]?\d[ ]?\d)', True),
-    ):
-        for m in re.finditer(pat, text):
-            g1 = re.sub(r'\s', '', m.group(1))
-            g2 = re.sub(r'\s', '', m.group(2))
+    patterns = _RESCUE_PREFIX_RXS.get(prefix) or _rescue_prefix_patterns(prefix)
+    for rx, rev in patterns:
+        for m in rx.finditer(text):
+            g1 = _WS_RX.sub('', m.group(1))
+            g2 = _WS_RX.sub('', m.group(2))
             digits, letters = (g2, g1) if rev else (g1, g2)
             if not digits.isdigit() or not letters.isalpha():
                 continue
@@ -712,11 +899,10 @@ def _rescue_find_plates(text):
     Returns [] (nothing found), [plate] (single result → auto-route),
     or [p1, p2, ...] (multiple → ask user to pick).
     """
-    if not text or pd.isna(text):
+    parsed = parse_description(text)
+    if parsed.empty:
         return []
 
-    original = str(text)
-
     # 🔥 Strip the CRDB REF hex BEFORE anything else — same reason as
     # _clean_nmb_message(): a 16-char hex ref is near-guaranteed to contain a
     # \d{3}[A-F]{3} run that the bare-3+3 fallback below mints into a fake
@@ -730,23 +916,15 @@ def _rescue_find_plates(text):
     # the depositor-name fallback in the else-branch never ran. Frank flagged
     # it 2026-07-29 (sheet row 27477, 37,500 TZS).
     #
-    # Applied to `original` so BOTH the Description-scoped and full-text
-    # branches below are covered.
-    original = re.sub(r'\bREF\s*:?\s*[A-Fa-f0-9]{8,}', '', original)
-
+    # Applied before the Description search so BOTH the Description-scoped
+    # and full-text branches are covered (ParsedDescription.rescue_search).
+    #
     # ── Respect Description boundary ─────────────────────────────────────────
-    desc_m = re.search(r'\bDESCRIPTION\b\s+(.+?)(?:\s+FROM\b|!!|$)',
-                       original, re.IGNORECASE | re.DOTALL)
-    if desc_m:
-        search_text = desc_m.group(1).strip().upper()
-        print(f"  🔍 RESCUE: searching Description section only: {search_text[:60]}...")
-    else:
-        search_text = original.upper()
-        # Clean noise only when searching full text
-        search_text = re.sub(r'\d{3}\s*-?\s*NMB\s*(HEAD\s*OFFICE|BANK)?', '', search_text)
-        search_text = re.sub(r'TER\s+ID\s+\d+', '', search_text)
-        search_text = re.sub(r'TRX\s+ID\s+\w+', '', search_text)
-        search_text = re.sub(r'AGENCY\s+@\d+@', '', search_text)
+    # Description present → only the text after it. Otherwise the full text
+    # with NMB / Ter ID / Trx ID / agency noise cleaned out.
+    search_text, scoped = parsed.rescue_search
+    if scoped:
+        _row_log(f"  🔍 RESCUE: searching Description section only: {search_text[:60]}...")
 
     # ── Tier-based prefix search ──────────────────────────────────────────────
     for tier in _RESCUE_TIERS:
@@ -757,20 +935,17 @@ def _rescue_find_plates(text):
                     tier_seen.add(plate)
                     tier_found.append(plate)
         if tier_found:
-            print(f"  🔍 RESCUE tier hit: {tier_found}")
+            _row_log(f"  🔍 RESCUE tier hit: {tier_found}")
             return tier_found
 
     # ── Bare fallback (3+3 without prefix) ───────────────────────────────────
     # Collect ALL matches, sort rightmost + numbers-first for priority
     all_found = []
     seen = set()
-    for i, pat in enumerate([
-        r'(?<![A-Z\d])(\d[ ]?\d[ ]?\d)[ ]*([A-Z][ ]?[A-Z][ ]?[A-Z])(?![A-Z])',
-        r'(?<![A-Z])([A-Z][ ]?[A-Z][ ]?[A-Z])[ ]*(\d[ ]?\d[ ]?\d)(?!\d)',
-    ]):
-        for m in re.finditer(pat, search_text):
-            g1 = re.sub(r'\s', '', m.group(1))
-            g2 = re.sub(r'\s', '', m.group(2))
+    for i, rx in enumerate(_RESCUE_BARE_RXS):
+        for m in rx.finditer(search_text):
+            g1 = _WS_RX.sub('', m.group(1))
+            g2 = _WS_RX.sub('', m.group(2))
             digits, letters = (g1, g2) if i == 0 else (g2, g1)
             if not digits.isdigit() or not letters.isalpha():
                 continue
@@ -784,7 +959,7 @@ def _rescue_find_plates(text):
         # Sort: priority 1 before 2, then rightmost position first
         all_found.sort(key=lambda x: (x[2], -x[0]))
         plates = [p for _, p, _ in all_found]
-        print(f"  🔍 RESCUE bare fallback: {plates}")
+        _row_log(f"  🔍 RESCUE bare fallback: {plates}")
         return plates
 
     return []
@@ -802,6 +977,10 @@ def _rescue_find_plates(text):
 #   MC968EZW → MC969EZW  (1-digit number typo)
 # ═══════════════════════════════════════════════════════════════════════════════
 
+_FUZZY_CAND_DL_RX = re.compile(r'MC\s*(\d(?:\s*\d){0,2})\s*([A-Z](?:\s*[A-Z]){1,2})(?![A-Z])')
+_FUZZY_CAND_LD_RX = re.compile(r'MC\s*([A-Z](?:\s*[A-Z]){1,2})\s*(\d(?:\s*\d){0,2})(?!\d)')
+
+
 def _fuzzy_extract_candidate(text):
     """
     Loose plate extraction used ONLY by the fuzzy matcher.
@@ -811,43 +990,95 @@ def _fuzzy_extract_candidate(text):
     'Description' keyword if present, same as extract_plate_number.
     Returns (number_str, suffix_str) or None.
     """
-    if not text or pd.isna(text):
+    parsed = parse_description(text)
+    if parsed.empty:
         return None
 
-    original = str(text)
-
-    # Respect Description boundary — same as extract_plate_number
-    desc_m = re.search(r'\bDESCRIPTION\b\s+(.+?)(?:\s+FROM\b|!!|$)',
-                       original, re.IGNORECASE | re.DOTALL)
-    if desc_m:
-        search_text = desc_m.group(1).strip().upper()
-    else:
-        # Clean known noise when searching full text
-        search_text = original.upper()
-        search_text = re.sub(r'\d{3}\s*-?\s*NMB\s*(HEAD\s*OFFICE|BANK)?', '', search_text)
-        search_text = re.sub(r'TER\s+ID\s+\d+', '', search_text)
-        search_text = re.sub(r'TRX\s+ID\s+\w+', '', search_text)
-        search_text = re.sub(r'AGENCY\s+@\d+@', '', search_text)
+    # Respect Description boundary — same as extract_plate_number. Known
+    # noise is cleaned when searching the full text.
+    search_text = parsed.loose_search_text
 
     # Pattern A: MC + digits + letters (digits-first)
-    m = re.search(r'MC\s*(\d(?:\s*\d){0,2})\s*([A-Z](?:\s*[A-Z]){1,2})(?![A-Z])', search_text)
+    m = _FUZZY_CAND_DL_RX.search(search_text)
     if m:
-        num = re.sub(r'\s', '', m.group(1))
-        suf = re.sub(r'\s', '', m.group(2))
+        num = _WS_RX.sub('', m.group(1))
+        suf = _WS_RX.sub('', m.group(2))
         if 1 <= len(num) <= 3 and 2 <= len(suf) <= 3:
             return (num, suf)
 
     # Pattern B: MC + letters + digits (letters-first, catches MC895PFJ type)
-    m = re.search(r'MC\s*([A-Z](?:\s*[A-Z]){1,2})\s*(\d(?:\s*\d){0,2})(?!\d)', search_text)
+    m = _FUZZY_CAND_LD_RX.search(search_text)
     if m:
-        suf = re.sub(r'\s', '', m.group(1))
-        num = re.sub(r'\s', '', m.group(2))
+        suf = _WS_RX.sub('', m.group(1))
+        num = _WS_RX.sub('', m.group(2))
         if 1 <= len(num) <= 3 and 2 <= len(suf) <= 3:
             return (num, suf)
 
     return None
 
 
+_FUZZY_PLATE_RX = re.compile(r'^MC(\d{3})([A-Z]{3})$')
+
+
+def build_fuzzy_plate_index(plate_lookup, plate_lookup_sav, id_lookup_sav):
+    """Precompute the buckets _find_fuzzy_plate_matches() reads, once per
+    customer load instead of a regex pass over every plate per failing row.
+
+      plates                 plate → {'name', 'source', 'customer_id'}
+                             (records1 wins on collision, as before)
+      by_num_sorted_suffix   (number, sorted suffix letters) → plates   rule B
+      by_num_suffix_prefix   (number, first 2 suffix letters) → plates  rule C
+      by_suffix              suffix → plates                            rule E
+    """
+    plates = {}
+    for plate, name in plate_lookup.items():
+        if plate and plate not in plates:
+            plates[plate] = {'name': name, 'source': 'records', 'customer_id': ''}
+    for plate, name in plate_lookup_sav.items():
+        if plate and plate not in plates:
+            cid = (id_lookup_sav or {}).get(plate, '')
+            plates[plate] = {'name': name, 'source': 'records2', 'customer_id': cid}
+
+    by_num_sorted_suffix, by_num_suffix_prefix, by_suffix = {}, {}, {}
+    for plate in plates:
+        m = _FUZZY_PLATE_RX.match(plate)
+        if not m:
+            continue
+        pnum, psuf = m.group(1), m.group(2)
+        by_num_sorted_suffix.setdefault((pnum, ''.join(sorted(psuf))), []).append(plate)
+        by_num_suffix_prefix.setdefault((pnum, psuf[:2]), []).append(plate)
+        by_suffix.setdefault(psuf, []).append(plate)
+
+    return {
+        'plates':               plates,
+        'by_num_sorted_suffix': by_num_sorted_suffix,
+        'by_num_suffix_prefix': by_num_suffix_prefix,
+        'by_suffix':            by_suffix,
+    }
+
+
+# Last built index + the exact dict objects it was built from. Holding the
+# dicts themselves (not their id()s) means a later load can never be mistaken
+# for this one; a new customer load hands in new dicts → one rebuild.
+_FUZZY_INDEX_CACHE = {'sources': None, 'sizes': None, 'index': None}
+_FUZZY_INDEX_LOCK = threading.Lock()
+
+
+def _fuzzy_index_for(plate_lookup, plate_lookup_sav, id_lookup_sav):
+    sizes = (len(plate_lookup), len(plate_lookup_sav), len(id_lookup_sav or {}))
+    with _FUZZY_INDEX_LOCK:
+        src = _FUZZY_INDEX_CACHE['sources']
+        if (src is not None and src[0] is plate_lookup and src[1] is plate_lookup_sav
+                and src[2] is id_lookup_sav and _FUZZY_INDEX_CACHE['sizes'] == sizes):
+            return _FUZZY_INDEX_CACHE['index']
+        index = build_fuzzy_plate_index(plate_lookup, plate_lookup_sav, id_lookup_sav)
+        _FUZZY_INDEX_CACHE.update(sources=(plate_lookup, plate_lookup_sav, id_lookup_sav),
+                                  sizes=sizes, index=index)
+        print(f"🗂️ fuzzy plate index built: {len(index['plates'])} plates, "
+              f"{len(index['by_suffix'])} suffixes")
+        return index
+
+
 def _find_fuzzy_plate_matches(number, suffix, plate_lookup, plate_lookup_sav,
                                id_lookup_sav, max_candidates=15):
     """
@@ -866,67 +1097,47 @@ def _find_fuzzy_plate_matches(number, suffix, plate_lookup, plate_lookup_sav,
     Returns [] (triggers fallback to FAILED) if:
       - no candidates found
       - total candidates exceed max_candidates (too ambiguous to auto-rescue)
+
+    Candidate search goes through build_fuzzy_plate_index() — built once per
+    customer load and reused for every failing row of the run.
     """
     if not number or not suffix:
         return []
 
-    # Merge both plate lookups — records1 wins on collision
-    all_plates = {}
-    for plate, name in plate_lookup.items():
-        if plate and plate not in all_plates:
-            all_plates[plate] = {'name': name, 'source': 'records', 'customer_id': ''}
-    for plate, name in plate_lookup_sav.items():
-        if plate and plate not in all_plates:
-            cid = (id_lookup_sav or {}).get(plate, '')
-            all_plates[plate] = {'name': name, 'source': 'records2', 'customer_id': cid}
-
-    candidates = {}
-
-    def _letter_diff(s1, s2):
-        if len(s1) != len(s2):
-            return 99
-        return sum(1 for a, b in zip(s1, s2) if a != b)
-
-    for plate, info in all_plates.items():
-        m = re.match(r'^MC(\d{3})([A-Z]{3})$', plate)
-        if not m:
-            continue
-        pnum, psuf = m.group(1), m.group(2)
-        matched = False
-
-        if len(number) == 3 and len(suffix) == 3:
-            if pnum == number and psuf != suffix:
-                # Rule A (Levenshtein-1 suffix typo) — KILLED Frank 2026-06-09.
-                # 1-edit fuzzy was producing wrong-customer matches in PASSED.
-                # if _letter_diff(suffix, psuf) == 1:
-                #     matched = True
-                # Rule B: suffix anagram (letter swap) — kept (NOT strict Levenshtein)
-                if sorted(suffix) == sorted(psuf):
-                    matched = True
-            elif psuf == suffix and pnum != number:
-                # Rule D (Levenshtein-1 number typo) — KILLED Frank 2026-06-09.
-                # if _letter_diff(number, pnum) == 1:
-                #     matched = True
-                pass
-
-        # Rule C: truncated suffix (2 letters instead of 3)
-        elif len(suffix) == 2 and len(number) == 3:
-            if pnum == number and psuf.startswith(suffix):
-                matched = True
+    index = _fuzzy_index_for(plate_lookup, plate_lookup_sav, id_lookup_sav)
+    plates = index['plates']
+
+    # Each rule reads one bucket instead of regex-scanning the whole fleet.
+    # The bucket keys are the rule's equality conditions; the leftover
+    # conditions are checked on the (few) plates in the bucket, exactly as
+    # the old full scan did.
+    if len(number) == 3 and len(suffix) == 3:
+        # Rule A (Levenshtein-1 suffix typo) — KILLED Frank 2026-06-09.
+        # 1-edit fuzzy was producing wrong-customer matches in PASSED.
+        # Rule D (Levenshtein-1 number typo) — KILLED Frank 2026-06-09.
+        # Rule B: suffix anagram (letter swap) — kept (NOT strict Levenshtein)
+        hits = [p for p in index['by_num_sorted_suffix'].get((number, ''.join(sorted(suffix))), ())
+                if p[5:8] != suffix]
+
+    # Rule C: truncated suffix (2 letters instead of 3)
+    elif len(suffix) == 2 and len(number) == 3:
+        hits = index['by_num_suffix_prefix'].get((number, suffix), ())
+
+    # Rule E: truncated number (1 or 2 digits instead of 3)
+    elif len(number) != 3 and len(suffix) == 3:
+        hits = [p for p in index['by_suffix'].get(suffix, ())
+                if p[2:5].startswith(number) or number.startswith(p[2:5])]
 
-        # Rule E: truncated number (1 or 2 digits instead of 3)
-        elif len(number) != 3 and len(suffix) == 3:
-            if psuf == suffix and (pnum.startswith(number) or number.startswith(pnum)):
-                matched = True
+    else:
+        hits = ()
 
-        if matched:
-            candidates[plate] = info
+    candidates = {p: plates[p] for p in hits}
 
     # Too ambiguous — don't auto-rescue
     if len(candidates) == 0:
         return []
     if len(candidates) > max_candidates:
-        print(f"  🔍 FUZZY: {len(candidates)} candidates exceeds max ({max_candidates}) — skipping rescue")
+        _row_log(f"  🔍 FUZZY: {len(candidates)} candidates exceeds max ({max_candidates}) — skipping rescue")
         return []
 
     result = [{'plate': p, **info} for p, info in candidates.items()]
@@ -998,6 +1209,7 @@ def fuzzy_multi_to_failed_row(last_failed_id, posting_date, bank, details,
     ]
 
 
+@pipeline_metrics.traced('highlight', tab_arg='sheet_name')
 def apply_green_highlight(service, sheet_name, row_indices):
     """
     Apply bright green background (#00ff00) to specified 1-indexed row numbers
@@ -1079,14 +1291,14 @@ def try_fuzzy_rescue(details, plate_lookup, plate_lookup_sav, id_lookup_sav):
     # Don't "rescue" a plate that already exists exactly — means something
     # upstream is broken, not a fuzzy case
     if full_plate in plate_lookup or full_plate in plate_lookup_sav:
-        print(f"  ⚠️ FUZZY: MC{number}{suffix} already in DB — not a fuzzy case")
+        _row_log(f"  ⚠️ FUZZY: MC{number}{suffix} already in DB — not a fuzzy case")
         return []
 
-    print(f"  🔎 FUZZY: trying to rescue MC{number}{suffix} (from: {str(details)[:60]})")
+    _row_log(f"  🔎 FUZZY: trying to rescue MC{number}{suffix} (from: {str(details)[:60]})")
     cands = _find_fuzzy_plate_matches(number, suffix, plate_lookup,
                                        plate_lookup_sav, id_lookup_sav)
     if cands:
-        print(f"  🟢 FUZZY RESCUE ({len(cands)} candidates): {[c['plate'] for c in cands]}")
+        _row_log(f"  🟢 FUZZY RESCUE ({len(cands)} candidates): {[c['plate'] for c in cands]}")
     return cands
 
 
@@ -1097,18 +1309,12 @@ def try_fuzzy_rescue(details, plate_lookup, plate_lookup_sav, id_lookup_sav):
 
 def extract_ref_number(text):
     """Extract reference number from message (format: REF:XXXXX or REF XXXXX)"""
-    if not text or pd.isna(text):
+    parsed = parse_description(text)
+    if parsed.empty:
         return None
-
-    text = str(text)
     # 🔥 FIXED: match both REF: and REF (with or without colon)
-    # Ref numbers are hex strings of 10+ chars
-    pattern = r'REF[:\s]\s*([A-Fa-f0-9]{10,})'
-    match = re.search(pattern, text, re.IGNORECASE)
-    if match:
-        return match.group(1)
-
-    return None
+    # Ref numbers are hex strings of 10+ chars (_REF_NUMBER_RX)
+    return parsed.ref
 
 
 def _noref_fingerprint(txn_date, details, credit_amount):
@@ -1139,9 +1345,10 @@ def is_iphone_transaction(details):
     in any capitalisation: iphone, iPhone, IPHONE, Iphone, etc.
     Returns True if it's an iPhone transaction (should bypass normal flow).
     """
-    if not details or pd.isna(details):
+    parsed = parse_description(details)
+    if parsed.empty:
         return False
-    return bool(re.search(r'\biphone\b', str(details), re.IGNORECASE))
+    return parsed.is_iphone
 
 
 def normalize_phone_iphone(phone):
@@ -1240,23 +1447,15 @@ def extract_phone_for_iphone(details):
 
     Returns the raw matched phone string or None.
     """
-    if not details or pd.isna(details):
+    parsed = parse_description(details)
+    if parsed.empty:
         return None
 
-    cleaned = str(details)
-
-    # ── Scrub known non-phone patterns ────────────────────────────────────────
-    # Remove "agency @XXXXXXX@" style agency numbers
-    cleaned = re.sub(r'AGENCY\s*@\d+@', '', cleaned, flags=re.IGNORECASE)
-    # Remove "Ter ID XXXXXXXX" (long numeric IDs that can look like phones)
-    cleaned = re.sub(r'TER\s+ID\s+\d+', '', cleaned, flags=re.IGNORECASE)
-    # Remove "Trx ID XXXXXXX"
-    cleaned = re.sub(r'TRX\s+ID\s+\w+', '', cleaned, flags=re.IGNORECASE)
-    # Remove REF: XXXXXXX (hex ref numbers often start with digits)
-    cleaned = re.sub(r'REF:\s*\S+', '', cleaned, flags=re.IGNORECASE)
-
-    # ── Delegate to the shared token-based extractor ───────────────────────────
-    return _extract_phone_from_clean_text(cleaned)
+    # ── Scrub known non-phone patterns, then delegate ─────────────────────────
+    # _IPHONE_PHONE_NOISE_RXS: "agency @XXXXXXX@" agency numbers, "Ter ID
+    # XXXXXXXX" (long numeric IDs that can look like phones), "Trx ID XXXXXXX"
+    # and REF: XXXXXXX (hex ref numbers often start with digits).
+    return parsed.iphone_phone
 
 
 def lookup_iphone_customer(details, iphone_lookup):
@@ -1268,20 +1467,20 @@ def lookup_iphone_customer(details, iphone_lookup):
     """
     raw_phone = extract_phone_for_iphone(details)
     if not raw_phone:
-        print(f"  📵 iPhone: No phone found in: {details[:80]}")
+        _row_log(f"  📵 iPhone: No phone found in: {str(details)[:80]}")
         return None, None
 
     normalized = normalize_phone_iphone(raw_phone)
     if not normalized:
-        print(f"  📵 iPhone: Could not normalize phone '{raw_phone}'")
+        _row_log(f"  📵 iPhone: Could not normalize phone '{raw_phone}'")
         return None, None
 
     customer_name = iphone_lookup.get(normalized)
     if customer_name:
-        print(f"  ✅ iPhone match: {normalized} → {customer_name}")
+        _row_log(f"  ✅ iPhone match: {normalized} → {customer_name}")
         return customer_name, raw_phone
     else:
-        print(f"  ❌ iPhone: No match for normalized phone '{normalized}' (raw: {raw_phone})")
+        _row_log(f"  ❌ iPhone: No match for normalized phone '{normalized}' (raw: {raw_phone})")
         return None, raw_phone
 
 
@@ -1320,9 +1519,10 @@ def _extract_depositor_name(desc: str) -> str | None:
     'REF:… SIMUSSD FT FROM DENIS RAYMOND TESHA TO FRANK N/A'. Returns the
     UPPERCASED name for direct lookup in depositor_lookup, or None if the
     pattern isn't there."""
+    desc = parse_description(desc).raw
     if not desc:
         return None
-    m = _DEPOSITOR_RX.search(str(desc))
+    m = _DEPOSITOR_RX.search(desc)
     if not m:
         return None
     name = re.sub(r'\s+', ' ', m.group(1)).strip().upper()
@@ -1549,70 +1749,144 @@ def _apply_registry_row(row,
                 iphone_lookup[form] = name
 
 
+# Registry pages are fetched concurrently (bounded) over one keep-alive
+# session, then applied strictly in page order — _apply_registry_row() is
+# last-write-wins on collisions, so applying pages as they complete would
+# change which duplicate plate/phone wins compared to the serial walk.
+REGISTRY_PAGE_SIZE    = 1000
+REGISTRY_LOAD_WORKERS = int(os.environ.get('REGISTRY_LOAD_WORKERS', '6'))
+REGISTRY_PAGE_RETRIES = 3
+_REGISTRY_SELECT = ('customer_name,plate,phone,phones,'
+                    'bank_account_name,customer_type,'
+                    'sav_customer_id')
+def _fetch_registry_page(lower):
+    """One Range page with retry. Returns (rows, None) or (None, reason).
+    The loop here is the only retry layer — the session's own is off."""
+    import time as _time
+    reason = None
+    for attempt in range(1, REGISTRY_PAGE_RETRIES + 1):
+        try:
+            r = supabase_client.registry(retries=False).get(
+                f'{SUPABASE_URL_REGISTRY}/rest/v1/customer_registry',
+                params={'select': _REGISTRY_SELECT, 'order': 'id.asc'},
+                headers={'Range-Unit': 'items',
+                         'Range':      f'{lower}-{lower + REGISTRY_PAGE_SIZE - 1}'},
+                timeout=30,
+            )
+            if r.status_code in (200, 206):
+                return r.json() or [], None
+            if r.status_code == 416:          # offset past the end — empty page
+                return [], None
+            reason = f'HTTP {r.status_code} at offset {lower}'
+            print(f"⚠️ registry: {reason} (attempt {attempt}): {r.text[:200]}")
+        except requests.RequestException as e:
+            reason = f'fetch failed at offset {lower}: {e}'
+            print(f"⚠️ registry: {reason} (attempt {attempt})")
+        if attempt < REGISTRY_PAGE_RETRIES:
+            _time.sleep(attempt)
+    return None, reason
+
+
+def _registry_row_count():
+    """Exact customer_registry row count (Prefer: count=exact), or None."""
+    import time as _time
+    for attempt in range(1, REGISTRY_PAGE_RETRIES + 1):
+        try:
+            r = supabase_client.registry(retries=False).get(
+                f'{SUPABASE_URL_REGISTRY}/rest/v1/customer_registry',
+                params={'select': 'id'},
+                headers={'Range-Unit': 'items', 'Range': '0-0',
+                         'Prefer': 'count=exact'},
+                timeout=30,
+            )
+            cr = r.headers.get('content-range', '')
+            if r.status_code in (200, 206, 416) and '/' in cr:
+                return int(cr.split('/')[-1])
+            print(f"⚠️ registry: count HTTP {r.status_code} (attempt {attempt})")
+        except (requests.RequestException, ValueError) as e:
+            print(f"⚠️ registry: count failed (attempt {attempt}): {e}")
+        if attempt < REGISTRY_PAGE_RETRIES:
+            _time.sleep(attempt)
+    return None
+
+
 def load_customers_from_registry():
     """Load every customer_registry row (paginated) from the SUPABASE_URL_REGISTRY
     project and return the 7-tuple the pipeline consumes.
 
+    Gets the exact row count first, fetches every page concurrently
+    (REGISTRY_LOAD_WORKERS at a time, each page retried), and applies pages
+    in order as soon as the next one in sequence has arrived. Any page that
+    still fails after its retries marks the load truncated.
+
     Returns (phone_lookup, plate_lookup, depositor_lookup,
              phone_lookup_sav, plate_lookup_sav, id_lookup_sav,
              iphone_lookup)."""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
     empty = ({}, {}, {}, {}, {}, {}, {})
     if not (SUPABASE_URL_REGISTRY and SUPABASE_KEY_REGISTRY):
         print("⚠️ registry: SUPABASE_URL_REGISTRY / SUPABASE_SERVICE_KEY_REGISTRY not set")
         return empty
-    h = {'apikey': SUPABASE_KEY_REGISTRY,
-         'Authorization': f'Bearer {SUPABASE_KEY_REGISTRY}'}
+    lookups = ({}, {}, {}, {}, {}, {}, {})
     (phone_lookup, plate_lookup, depositor_lookup,
      phone_lookup_sav, plate_lookup_sav, id_lookup_sav,
-     iphone_lookup) = ({}, {}, {}, {}, {}, {}, {})
+     iphone_lookup) = lookups
 
-    step  = 1000
-    lower = 0
+    step  = REGISTRY_PAGE_SIZE
     total = 0
-    while True:
-        try:
-            r = requests.get(
-                f'{SUPABASE_URL_REGISTRY}/rest/v1/customer_registry',
-                params={
-                    'select': ('customer_name,plate,phone,phones,'
-                               'bank_account_name,customer_type,'
-                               'sav_customer_id'),
-                    'order':  'id.asc',
-                },
-                headers={**h,
-                         'Range-Unit': 'items',
-                         'Range':      f'{lower}-{lower + step - 1}'},
-                timeout=30,
-            )
-        except requests.RequestException as e:
-            print(f"❌ registry: fetch failed at offset {lower}: {e}")
-            _REGISTRY_LOAD_TRUNCATED.append(f'fetch failed at offset {lower}: {e}')
-            break
-        if r.status_code not in (200, 206):
-            print(f"❌ registry: HTTP {r.status_code}: {r.text[:200]}")
-            _REGISTRY_LOAD_TRUNCATED.append(f'HTTP {r.status_code} at offset {lower}')
+    count = _registry_row_count()
+    if count is None:
+        _REGISTRY_LOAD_TRUNCATED.append('could not read customer_registry row count')
+        print("❌ registry: row count unavailable — load marked truncated")
+        return lookups
+
+    offsets = list(range(0, count, step)) or [0]
+    pending = {}            # page offset → rows, waiting for earlier pages
+    next_i  = 0
+    last_page_len = 0
+    with ThreadPoolExecutor(max_workers=max(1, REGISTRY_LOAD_WORKERS)) as pool:
+        fetch = pipeline_metrics.carry(_fetch_registry_page)
+        futures = {pool.submit(fetch, off): off for off in offsets}
+        for fut in as_completed(futures):
+            off = futures[fut]
+            rows, reason = fut.result()
+            if rows is None:
+                print(f"❌ registry: {reason}")
+                _REGISTRY_LOAD_TRUNCATED.append(reason)
+                continue
+            pending[off] = rows
+            # Drain every page that is now contiguous with what's applied.
+            while next_i < len(offsets) and offsets[next_i] in pending:
+                page = pending.pop(offsets[next_i])
+                for row in page:
+                    _apply_registry_row(row, *lookups)
+                total += len(page)
+                last_page_len = len(page)
+                next_i += 1
+
+    # Rows inserted between the count and the fetch: the last planned page
+    # came back full, so keep walking serially like the old loop did.
+    lower = offsets[-1] + step
+    while not _REGISTRY_LOAD_TRUNCATED and last_page_len == step:
+        rows, reason = _fetch_registry_page(lower)
+        if rows is None:
+            print(f"❌ registry: {reason}")
+            _REGISTRY_LOAD_TRUNCATED.append(reason)
             break
-        rows = r.json() or []
         for row in rows:
-            _apply_registry_row(row,
-                                phone_lookup, plate_lookup, depositor_lookup,
-                                phone_lookup_sav, plate_lookup_sav, id_lookup_sav,
-                                iphone_lookup)
+            _apply_registry_row(row, *lookups)
         total += len(rows)
-        if len(rows) < step:
-            break
+        last_page_len = len(rows)
         lower += step
 
     ok = not _REGISTRY_LOAD_TRUNCATED
-    print(f"{'✅' if ok else '❌'} registry: {total} rows → "
+    print(f"{'✅' if ok else '❌'} registry: {total} rows (count {count}) → "
           f"boda(plate={len(plate_lookup)}, phone={len(phone_lookup)}, "
           f"dep={len(depositor_lookup)}), "
           f"sav(plate={len(plate_lookup_sav)}, phone={len(phone_lookup_sav)}), "
           f"iphone(phone={len(iphone_lookup)})"
           f"{'' if ok else '  ← TRUNCATED, run will abort'}")
-    return (phone_lookup, plate_lookup, depositor_lookup,
-            phone_lookup_sav, plate_lookup_sav, id_lookup_sav,
-            iphone_lookup)
+    return lookups
 
 
 # ── Customer-load sanity guard ──────────────────────────────────────────────
@@ -1667,6 +1941,14 @@ def _write_highwater(n):
         print(f"⚠️ could not persist customer high-water mark: {e}")
 
 
+def _lookup_key_total(lookups):
+    """Distinct lookup keys across the 7-tuple (depositor + id maps excluded —
+    they are keyed off the same plates/phones)."""
+    phone_l, plate_l, dep_l, phone_s, plate_s, _ids, iphone_l = lookups
+    return (len(phone_l) + len(plate_l) + len(phone_s)
+            + len(plate_s) + len(iphone_l))
+
+
 def _assert_customer_load_sane(lookups):
     """Raise CustomerLoadError unless the cache looks usable.
 
@@ -1674,9 +1956,7 @@ def _assert_customer_load_sane(lookups):
     count — a load can return rows whose plates/phones all fail to index, and
     that is just as unusable as returning nothing.
     """
-    phone_l, plate_l, dep_l, phone_s, plate_s, _ids, iphone_l = lookups
-    total = (len(phone_l) + len(plate_l) + len(phone_s)
-             + len(plate_s) + len(iphone_l))
+    total = _lookup_key_total(lookups)
 
     if _REGISTRY_LOAD_TRUNCATED:
         why = '; '.join(_REGISTRY_LOAD_TRUNCATED)
@@ -1698,7 +1978,150 @@ def _assert_customer_load_sane(lookups):
           f"(last good {hw or 'n/a'}, floor {MIN_LOAD_RATIO:.0%})")
 
 
+# ── Process-wide customer cache ─────────────────────────────────────────────
+# The puller fires /process hundreds of times a day and every run used to
+# re-download the whole registry + pikipiki sheets + IPHONE_RECORDS. The
+# 7-tuple is read-only once built, so it is kept between runs and only
+# reloaded when:
+#   - customer_registry changed (row count or max(updated_at) moved — the
+#     touch trigger from migration 002 bumps updated_at on every UPDATE,
+#     inserts carry now(), deletes drop the count), or
+#   - the entry is older than CUSTOMER_CACHE_TTL seconds. The sheets have no
+#     cheap change signal, so for CUSTOMER_SOURCE=sheet|both the TTL is what
+#     bounds how stale a sheet-side edit can be.
+# Every reload still goes through _assert_customer_load_sane(); a load that
+# fails the guard is never cached. The entry is also pickled next to app.py
+# so a worker recycled by max_requests starts warm instead of cold.
+# Registry edits made through the UI (ui_blueprint) also drop the cache in
+# every worker right away via invalidate_customer_cache(), which touches
+# _CUSTOMER_CACHE_STALE; entries loaded before its mtime are not used.
+# CUSTOMER_CACHE_TTL=0 turns the cache off.
+CUSTOMER_CACHE_TTL = int(os.environ.get('CUSTOMER_CACHE_TTL', '900'))
+_CUSTOMER_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '.customer_cache.pickle')
+_CUSTOMER_CACHE_STALE = _CUSTOMER_CACHE_PATH + '.stale'
+_CUSTOMER_CACHE = {'entry': None}
+_CUSTOMER_CACHE_LOCK = threading.Lock()
+
+
+def _registry_fingerprint():
+    """(row count, max updated_at) of customer_registry, or None if it can't
+    be read. Two tiny requests' worth of work: one row, count in the header."""
+    if not (SUPABASE_URL_REGISTRY and SUPABASE_KEY_REGISTRY):
+        return None
+    try:
+        r = supabase_client.registry().get(
+            f'{SUPABASE_URL_REGISTRY}/rest/v1/customer_registry',
+            params={'select': 'updated_at', 'order': 'updated_at.desc.nullslast',
+                    'limit': '1'},
+            headers={'apikey': SUPABASE_KEY_REGISTRY,
+                     'Authorization': f'Bearer {SUPABASE_KEY_REGISTRY}',
+                     'Prefer': 'count=exact'},
+            timeout=10,
+        )
+        if r.status_code not in (200, 206):
+            return None
+        cr = r.headers.get('content-range', '')
+        count = int(cr.split('/')[-1]) if '/' in cr else None
+        rows = r.json() or []
+        return (count, rows[0].get('updated_at') if rows else None)
+    except Exception as e:
+        print(f"⚠️ customer cache: registry fingerprint failed: {e}")
+        return None
+
+
+def _read_customer_snapshot():
+    try:
+        with open(_CUSTOMER_CACHE_PATH, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def _write_customer_snapshot(entry):
+    try:
+        tmp = f'{_CUSTOMER_CACHE_PATH}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, _CUSTOMER_CACHE_PATH)
+    except Exception as e:
+        print(f"⚠️ could not persist customer cache snapshot: {e}")
+
+
+def _customer_cache_usable(entry, fingerprint):
+    import time as _time
+    if not entry or entry.get('source') != CUSTOMER_SOURCE:
+        return False
+    if _time.time() - entry['loaded_at'] > CUSTOMER_CACHE_TTL:
+        return False
+    try:
+        if os.stat(_CUSTOMER_CACHE_STALE).st_mtime >= entry['loaded_at']:
+            return False
+    except OSError:
+        pass
+    if CUSTOMER_SOURCE in ('registry', 'both'):
+        # Can't prove the registry is unchanged → reload.
+        return fingerprint is not None and fingerprint == entry.get('fingerprint')
+    return True
+
+
+def invalidate_customer_cache():
+    """Drop the customer cache in every worker (next load is a full one).
+    Registered as ui_blueprint's registry change hook."""
+    with _CUSTOMER_CACHE_LOCK:
+        _CUSTOMER_CACHE['entry'] = None
+        try:
+            os.remove(_CUSTOMER_CACHE_PATH)
+        except OSError:
+            pass
+        try:
+            with open(_CUSTOMER_CACHE_STALE, 'a'):
+                pass
+            os.utime(_CUSTOMER_CACHE_STALE)
+        except OSError as e:
+            print(f"⚠️ customer cache: could not mark stale: {e}")
+
+
+add_registry_change_hook(invalidate_customer_cache)
+
+
+@pipeline_metrics.traced('customer_load')
 def load_customers_dispatch(service):
+    """Cached front of _load_customers_uncached() — same 7-tuple contract.
+    See the cache notes above for when it reloads."""
+    import time as _time
+    if CUSTOMER_CACHE_TTL <= 0:
+        return _load_customers_uncached(service)
+
+    fingerprint = (_registry_fingerprint()
+                   if CUSTOMER_SOURCE in ('registry', 'both') else None)
+    with _CUSTOMER_CACHE_LOCK:
+        entry = _CUSTOMER_CACHE['entry']
+        if not _customer_cache_usable(entry, fingerprint):
+            disk = _read_customer_snapshot()
+            if _customer_cache_usable(disk, fingerprint):
+                entry = _CUSTOMER_CACHE['entry'] = disk
+                print("💾 customer cache: warm start from on-disk snapshot")
+        if _customer_cache_usable(entry, fingerprint):
+            age = int(_time.time() - entry['loaded_at'])
+            print(f"⚡ customer cache HIT (source={CUSTOMER_SOURCE}, age {age}s, "
+                  f"{_lookup_key_total(entry['lookups'])} lookup keys)")
+            return entry['lookups']
+
+        print(f"🔄 customer cache MISS (source={CUSTOMER_SOURCE}) — full load")
+        # Raises CustomerLoadError on a bad load → nothing gets cached.
+        # loaded_at is when the read started, so an edit made during the
+        # load still marks this entry stale.
+        started = _time.time()
+        lookups = _load_customers_uncached(service)
+        entry = {'lookups': lookups, 'fingerprint': fingerprint,
+                 'source': CUSTOMER_SOURCE, 'loaded_at': started}
+        _CUSTOMER_CACHE['entry'] = entry
+        _write_customer_snapshot(entry)
+        return lookups
+
+
+def _load_customers_uncached(service):
     """Feature-flag router. Chooses between the sheet-based loaders and the
     customer_registry DB loader based on CUSTOMER_SOURCE.
     Returns the same 7-tuple regardless of source.
@@ -1802,11 +2225,279 @@ def lookup_customer_id_from_cache(identifier, lookup_type, id_lookup_sav):
 _REF_COUNT_FLOOR: dict = {}
 
 
+def _ref_column_for(sheet_name):
+    """Sheet column holding REFNUMBER for a logical tab (CRDB FAILED has the
+    extra fail-reason column, so its ref sits one column further right)."""
+    if sheet_name == 'FAILED':
+        return 'I'
+    elif sheet_name in ('FAILED_NMB', 'FAILED_NMB_OLD'):
+        return 'H'
+    else:
+        return 'H'
+
+
+_MSG_REF_RX = re.compile(r'REF[:\s]\s*([A-Fa-f0-9]{10,})', re.IGNORECASE)
+
+
+def _collect_refs(message_cells, ref_cells):
+    """Split raw column-D / ref-column cell values into the three sets the
+    dedup index stores: refs from the ref column, refs only found inside a
+    message ('REF: xxxx'), and the messages themselves. Same filtering as
+    the full get_existing_refs() read."""
+    refs, msg_refs, messages = set(), set(), set()
+    for cell in ref_cells:
+        if cell not in (None, ''):
+            ref = str(cell).strip()
+            if ref and ref.lower() != 'refnumber':
+                refs.add(ref)
+    for cell in message_cells:
+        if cell:
+            message = str(cell).strip()
+            messages.add(message)
+            match = _MSG_REF_RX.search(message)
+            if match and match.group(1) not in refs:
+                msg_refs.add(match.group(1))
+    return refs, msg_refs, messages
+
+
+# ── Per-run sheet snapshot ──────────────────────────────────────────────────
+# A CRDB run used to make ~5 get_existing_refs, ~5 get_last_id and one
+# get_last_row_number per append_to_sheet — each its own round trip to the
+# same two or three spreadsheets. load_sheet_snapshot() front-loads them:
+#   1. one values().batchGet per spreadsheet for column A of every tab the
+#      run touches (UNFORMATTED_VALUE — serves get_last_id AND
+#      get_last_row_number, the row count doesn't depend on render option);
+#   2. one more batchGet per spreadsheet for the D + ref-column rows the ref
+#      index needs (tail since last sync, or the whole column on a rebuild).
+#      Each tab's index is synced once per run (snap['synced']); the NMB
+#      trx-id dedup reads its column-D messages from the index too.
+# The snapshot is thread-local and only lives for the duration of one
+# pipeline call (@_sheet_snapshot_scope). It serves the dedup and last-id
+# reads only: append_to_sheet() re-reads column A right before each write
+# (other writers append to these tabs without _process_lock), swaps that
+# in as the cached column and extends it with the rows it wrote.
+_SHEET_SNAPSHOT = threading.local()
+
+_CRDB_SNAPSHOT_TABS = ('PASSED', 'PASSED_SAV', 'FAILED', 'BANK_PASSED', 'BANK_FAILED')
+_NMB_SNAPSHOT_TABS = ('PASSED', 'PASSED_NMB', 'PASSED_SAV_NMB_OLD', 'PASSED_SAV_NMB',
+                      'FAILED_NMB_OLD', 'FAILED_NMB', 'BANK_PASSED', 'BANK_FAILED')
+
+
+def _sheet_snapshot():
+    return getattr(_SHEET_SNAPSHOT, 'snap', None)
+
+
+def _sheet_snapshot_scope(fn):
+    """Drop the run's snapshot when the pipeline returns, however it returns."""
+    import functools
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _SHEET_SNAPSHOT.snap = None
+    return wrapper
+
+
+def _batch_get_by_sheet(service, wanted, **kwargs):
+    """wanted: {spreadsheet_id: [(key, a1_range), ...]} → {key: values}.
+    One values().batchGet per spreadsheet. A failed spreadsheet just leaves
+    its keys out — callers fall back to their own direct reads."""
+    out = {}
+    for sheet_id, items in wanted.items():
+        try:
+            result = service.spreadsheets().values().batchGet(
+                spreadsheetId=sheet_id,
+                ranges=[rng for _key, rng in items],
+                **kwargs,
+            ).execute()
+        except Exception as e:
+            print(f"⚠️ sheet snapshot: batchGet on {sheet_id} failed: {e}")
+            continue
+        value_ranges = result.get('valueRanges', [])
+        for (key, _rng), vr in zip(items, value_ranges):
+            out[key] = vr.get('values', [])
+    return out
+
+
+@pipeline_metrics.traced('sheet_snapshot')
+def load_sheet_snapshot(service, tabs):
+    """Prefetch column A + the ref-index rows for `tabs` (logical names) and
+    install them as this thread's snapshot. Best-effort: anything missing is
+    read directly by the usual helpers."""
+    snap = {'col_a': {}, 'tails': {}, 'synced': set()}
+    wanted = {}
+    for tab in tabs:
+        sheet_id, actual_tab = _resolve_sheet(tab)
+        wanted.setdefault(sheet_id, []).append((tab, f'{actual_tab}!A:A'))
+    snap['col_a'] = _batch_get_by_sheet(service, wanted,
+                                        valueRenderOption='UNFORMATTED_VALUE')
+
+    if ref_index.ENABLED:
+        wanted, spans = {}, {}
+        for tab in tabs:
+            col_a = snap['col_a'].get(tab)
+            tab_state = ref_index.state(tab)
+            if not col_a or tab_state is None:
+                continue
+            last_row = len(col_a)
+            # A tail starts at the last synced row, which _refs_from_index
+            # checks against the index's tail_key.
+            first_row = (1 if ref_index.needs_full_sync(tab_state, last_row)
+                         else tab_state[0])
+            sheet_id, actual_tab = _resolve_sheet(tab)
+            ref_column = _ref_column_for(tab)
+            wanted.setdefault(sheet_id, []).extend([
+                ((tab, 'D'), f'{actual_tab}!D{first_row}:D{last_row}'),
+                ((tab, 'REF'), f'{actual_tab}!{ref_column}{first_row}:{ref_column}{last_row}'),
+            ])
+            spans[tab] = (first_row, last_row)
+        # Same render option as the refs_only full read, so numeric refs
+        # come back as the values the index holds, not display strings.
+        got = _batch_get_by_sheet(service, wanted,
+                                  valueRenderOption='UNFORMATTED_VALUE')
+        for tab, (first_row, last_row) in spans.items():
+            if (tab, 'D') in got and (tab, 'REF') in got:
+                snap['tails'][tab] = (first_row, last_row,
+                                      got[(tab, 'D')], got[(tab, 'REF')])
+
+    _SHEET_SNAPSHOT.snap = snap
+    print(f"📸 sheet snapshot: column A for {len(snap['col_a'])}/{len(tabs)} tabs, "
+          f"ref rows for {len(snap['tails'])} tabs")
+    return snap
+
+
+def _index_rows(service, sheet_name, first_row, last_row):
+    """(column-D rows, ref-column rows) for first_row..last_row — from the
+    run's snapshot when load_sheet_snapshot() already fetched exactly that
+    span, else one batchGet. None when the read fails."""
+    snap = _sheet_snapshot()
+    tail = snap['tails'].get(sheet_name) if snap else None
+    if tail is not None and tail[:2] == (first_row, last_row):
+        return tail[2], tail[3]
+    ref_column = _ref_column_for(sheet_name)
+    target_sheet_id, actual_tab = _resolve_sheet(sheet_name)
+    try:
+        result = service.spreadsheets().values().batchGet(
+            spreadsheetId=target_sheet_id,
+            ranges=[
+                f'{actual_tab}!D{first_row}:D{last_row}',
+                f'{actual_tab}!{ref_column}{first_row}:{ref_column}{last_row}',
+            ],
+            valueRenderOption='UNFORMATTED_VALUE',
+        ).execute()
+    except Exception as e:
+        print(f"⚠️ {sheet_name}: ref index tail read failed ({e}) — full read")
+        return None
+    value_ranges = result.get('valueRanges', [])
+    msg_rows = value_ranges[0].get('values', []) if len(value_ranges) > 0 else []
+    ref_rows = value_ranges[1].get('values', []) if len(value_ranges) > 1 else []
+    return msg_rows, ref_rows
+
+
+def _row_key(msg_rows, i):
+    # Sheets leaves trailing empty rows out of a range.
+    row = msg_rows[i] if i < len(msg_rows) else []
+    return ref_index.tail_key(row[0] if row else '')
+
+
+def _sync_ref_index(service, sheet_name):
+    """Bring the local ref index for a tab up to the sheet, fetching only the
+    rows added since the last sync. False whenever the index can't be
+    trusted; the caller then does the original full-column read.
+
+    get_last_row_number() (len of column A) is the reconciliation point:
+    rows synced_rows+1..last_row are new. The tail read starts one row
+    earlier, at synced_rows, and that row's message must still match the
+    index's tail_key — a row deleted and another appended leaves the count
+    unchanged but moves the rows. A full re-read from row 1 happens on first
+    use, when the tab shrank, on a tail_key mismatch, or every
+    REF_INDEX_FULL_RESYNC_HOURS.
+    """
+    tab_state = ref_index.state(sheet_name)
+    if tab_state is None:
+        return False
+    last_row = get_last_row_number(service, sheet_name)
+    if last_row <= 0:
+        # Read failed (get_last_row_number returns 0 on error) or the tab is
+        # empty — nothing to reconcile against, let the full path handle it.
+        return False
+
+    full = ref_index.needs_full_sync(tab_state, last_row)
+    first_row = 1 if full else tab_state[0]
+    rows = _index_rows(service, sheet_name, first_row, last_row)
+    if rows is None:
+        return False
+    msg_rows, ref_rows = rows
+    if not full and _row_key(msg_rows, 0) != tab_state[2]:
+        print(f"⚠️ {sheet_name}: row {first_row} no longer matches the ref index "
+              f"(rows deleted or moved) — rebuilding")
+        full, first_row = True, 1
+        rows = _index_rows(service, sheet_name, first_row, last_row)
+        if rows is None:
+            return False
+        msg_rows, ref_rows = rows
+    if not full and first_row == last_row:
+        return True
+    key = _row_key(msg_rows, last_row - first_row)
+    # Row 1 is the header on a full read; on a tail read it is the
+    # already-indexed check row.
+    msg_rows, ref_rows = msg_rows[1:], ref_rows[1:]
+    refs, msg_refs, messages = _collect_refs(
+        [r[0] for r in msg_rows if r], [r[0] for r in ref_rows if r])
+
+    # Same truncation guard as the direct read — a full re-read that
+    # comes back well under the known count is not allowed to replace
+    # a good index.
+    floor = _REF_COUNT_FLOOR.get(sheet_name, 0)
+    if full and floor and len(refs) < floor * 0.9:
+        print(f"⚠️ {sheet_name}: ref index re-read returned {len(refs)} refs "
+              f"(known floor {floor}) — full read")
+        return False
+    if ref_index.add(sheet_name, refs, msg_refs, messages,
+                     synced_rows=last_row, key=key, full=full) is None:
+        return False
+    print(f"📇 {sheet_name}: ref index {'rebuilt' if full else 'synced'} "
+          f"rows {first_row}-{last_row} (+{len(refs)} refs)")
+    return True
+
+
+def _refs_from_index(service, sheet_name, refs_only):
+    """Serve get_existing_refs() from the local ref index (see
+    _sync_ref_index). A tab is synced once per run: later reads in the same
+    run (load_nmb_existing_trx_ids after get_existing_refs) load straight
+    from the index, which append_to_sheet() keeps up with our own writes.
+    Returns None when the caller must do the full-column read."""
+    if not ref_index.ENABLED:
+        return None
+    snap = _sheet_snapshot()
+    if snap is None or sheet_name not in snap['synced']:
+        if not _sync_ref_index(service, sheet_name):
+            return None
+        if snap is not None:
+            snap['synced'].add(sheet_name)
+
+    loaded = ref_index.load(sheet_name, refs_only=refs_only)
+    if loaded is None:
+        return None
+    refs, messages = loaded
+    _REF_COUNT_FLOOR[sheet_name] = max(_REF_COUNT_FLOOR.get(sheet_name, 0), len(refs))
+    print(f"✅ {sheet_name}: Found {len(refs)} unique REFs, {len(messages)} unique messages "
+          f"(ref index)")
+    return refs, messages
+
+
+@pipeline_metrics.traced('existing_refs', tab_arg='sheet_name')
 def get_existing_refs(service, sheet_name='PASSED', refs_only=False):
     """
     Get existing reference numbers AND messages for duplicate detection.
     refs_only=True: skip loading message column entirely (saves memory for large sheets).
 
+    Served from the local ref index (ref_index.py) when possible — only the
+    rows appended since the last sync are read from Sheets. Everything below
+    the index lookup is the original full-column read, used as the fallback.
+
     Retries up to 4x with exponential backoff on exception. Once a stable
     row count is known for a tab, refuses to accept a subsequent read that
     dropped below _LAST_KNOWN_REF_COUNT * 0.9 — that catches Google Sheets'
@@ -1814,12 +2505,11 @@ def get_existing_refs(service, sheet_name='PASSED', refs_only=False):
     (dedup missed recent refs → CSV re-upload appended existing rows).
     """
     import time as _time
-    if sheet_name == 'FAILED':
-        ref_column = 'I'
-    elif sheet_name in ('FAILED_NMB', 'FAILED_NMB_OLD'):
-        ref_column = 'H'
-    else:
-        ref_column = 'H'
+    indexed = _refs_from_index(service, sheet_name, refs_only)
+    if indexed is not None:
+        return indexed
+
+    ref_column = _ref_column_for(sheet_name)
 
     target_sheet_id, actual_tab = _resolve_sheet(sheet_name)
     last_err = None
@@ -1928,15 +2618,19 @@ def get_last_id(service, sheet_name):
     that also displays as a date, cascading forever).
     """
     try:
-        target_sheet_id, actual_tab = _resolve_sheet(sheet_name)
-        sheet = service.spreadsheets()
-        result = sheet.values().get(
-            spreadsheetId=target_sheet_id,
-            range=f'{actual_tab}!A:A',
-            valueRenderOption='UNFORMATTED_VALUE',
-        ).execute()
+        snap = _sheet_snapshot()
+        if snap and sheet_name in snap['col_a']:
+            values = snap['col_a'][sheet_name]
+        else:
+            target_sheet_id, actual_tab = _resolve_sheet(sheet_name)
+            sheet = service.spreadsheets()
+            result = sheet.values().get(
+                spreadsheetId=target_sheet_id,
+                range=f'{actual_tab}!A:A',
+                valueRenderOption='UNFORMATTED_VALUE',
+            ).execute()
 
-        values = result.get('values', [])
+            values = result.get('values', [])
 
         if len(values) > 1:
             for row in reversed(values[1:]):
@@ -1956,52 +2650,85 @@ def get_last_id(service, sheet_name):
         print(f"Error getting last ID: {e}")
         return 0
 
-def get_last_row_number(service, sheet_name):
-    """Get the actual last row number (works even with filters)"""
+def get_last_row_number(service, sheet_name, fresh=False):
+    """Get the actual last row number (works even with filters)
+
+    fresh=True always reads column A from the sheet, for a write position:
+    SMS rescues, /confirm-reviews and manual edits append to the same tabs
+    without taking _process_lock, so the run snapshot can be behind. The
+    fresh column then replaces the snapshot's copy, keeping get_last_id()
+    in step with rows other writers added."""
+    snap = _sheet_snapshot()
+    if not fresh and snap and sheet_name in snap['col_a']:
+        return len(snap['col_a'][sheet_name])
     try:
         target_sheet_id, actual_tab = _resolve_sheet(sheet_name)
         result = service.spreadsheets().values().get(
             spreadsheetId=target_sheet_id,
-            range=f'{actual_tab}!A:A'
+            range=f'{actual_tab}!A:A',
+            valueRenderOption='UNFORMATTED_VALUE',
         ).execute()
         
         values = result.get('values', [])
+        if snap and sheet_name in snap['col_a']:
+            snap['col_a'][sheet_name] = values
         return len(values)
     except Exception as e:
         print(f"Error getting last row: {e}")
         return 0
 
 def append_to_sheet(service, sheet_name, data):
-    """Append data to Google Sheet - WORKS WITH FILTERS"""
+    """Append data to Google Sheet - WORKS WITH FILTERS
+
+    Returns the 1-based row the data was written from (truthy), or False on
+    failure — callers that format the new rows take their position from
+    here rather than reading the row count themselves."""
     try:
         target_sheet_id, actual_tab = _resolve_sheet(sheet_name)
-        last_row = get_last_row_number(service, sheet_name)
+        # Never position a write from the snapshot — see get_last_row_number.
+        last_row = get_last_row_number(service, sheet_name, fresh=True)
         start_row = last_row + 1
         range_name = f'{actual_tab}!A{start_row}'
 
         print(f"Attempting to append to {sheet_name} (tab:{actual_tab}) starting at row {start_row}")
         print(f"Adding {len(data)} rows")
 
-        result = service.spreadsheets().values().update(
-            spreadsheetId=target_sheet_id,
-            range=range_name,
-            valueInputOption='USER_ENTERED',
-            body={'values': data}
-        ).execute()
+        with pipeline_metrics.timed('sheet_write', sheet_name):
+            result = service.spreadsheets().values().update(
+                spreadsheetId=target_sheet_id,
+                range=range_name,
+                valueInputOption='USER_ENTERED',
+                body={'values': data}
+            ).execute()
 
         print(f"Update result: {result.get('updatedRows', 0)} rows added")
+        _job_rows_written(sheet_name, len(data))
+        pipeline_metrics.rows_written(sheet_name, len(data))
+
+        snap = _sheet_snapshot()
+        if snap and sheet_name in snap['col_a']:
+            snap['col_a'][sheet_name].extend([row[0] if row else ''] for row in data)
+
+        # Keep the local dedup index in step with what we just wrote so the
+        # next get_existing_refs() doesn't have to read these rows back.
+        if ref_index.ENABLED:
+            ref_idx = ord(_ref_column_for(sheet_name)) - ord('A')
+            refs, msg_refs, messages = _collect_refs(
+                [row[3] if len(row) > 3 else '' for row in data],
+                [row[ref_idx] if len(row) > ref_idx else '' for row in data])
+            ref_index.record_append(sheet_name, start_row, len(data),
+                                    refs, msg_refs, messages,
+                                    ref_index.tail_key(data[-1][3] if len(data[-1]) > 3 else ''))
 
         # Mirror into Supabase (no-op unless WRITE_TO_SUPABASE is truthy). This
         # is the single dual-write point — every callsite in the app is covered
-        # automatically because they all go through append_to_sheet(). Never
-        # raises: a Supabase outage cannot break the sheet write path.
-        supabase_writer.append(sheet_name, {
-            'PASSED': PASSED_SHEET_ID,
-            'NMB':    NMB_SHEET_ID,
-            'IPHONE': IPHONE_SHEET_ID,
-        }, data)
+        # automatically because they all go through append_to_sheet(). The rows
+        # go into the local outbox and its flusher thread sends them, so a slow
+        # or down Supabase neither delays this write nor loses the mirror.
+        with pipeline_metrics.timed('mirror_enqueue', sheet_name):
+            mirror_outbox.enqueue(sheet_name, data)
 
-        return True
+        return start_row
         
     except HttpError as e:
         print(f"❌ Google Sheets API Error: {e}")
@@ -2080,12 +2807,16 @@ _PROCESS_LOCK_PATH = os.environ.get(
 
 
 @contextlib.contextmanager
-def _process_lock():
+def _process_lock(blocking=False):
     """Yields (True, fd) if the lock was acquired non-blocking, (False, None)
     if another /process invocation is already holding it. The fd stays open
     for the whole `with` body and closes automatically on exit — that release
     is guaranteed even if the wrapped code raises.
 
+    blocking=True waits for the current holder instead of giving up — that
+    is how queued /process jobs line up behind each other (one consumer at a
+    time across every worker, see _run_process_job()).
+
     Root cause we're plugging: three quick /process fires on 26.07.2026 each
     read get_existing_refs() from the PASSED sheet BEFORE any of them wrote,
     so all three saw the same "before" state, filtered the same input as
@@ -2103,7 +2834,7 @@ def _process_lock():
         yield True, None
         return
     try:
-        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
     except BlockingIOError:
         # Someone else is processing. Give up cleanly.
         os.close(fd)
@@ -2128,8 +2859,210 @@ def _process_lock():
             pass
 
 
+# ── /process job queue ───────────────────────────────────────────────────────
+# /process used to run the whole CRDB/NMB pipeline inside one sync gunicorn
+# request — hence timeout=300, and big NMB files still dying mid-response
+# with "Unexpected end of JSON input" on the frontend. Now /process only
+# enqueues: it writes a job file and starts a background thread, then returns
+# the job id straight away. The thread waits on _process_lock(blocking=True),
+# so the flock is the single-consumer guarantee: jobs fired from any worker
+# run one after another, never side by side (the 26.07.2026 triple-append
+# race stays closed).
+#
+# Job state lives in one JSON file per job under PROCESS_JOBS_DIR rather
+# than in memory, because the /process/status poll can land on any of the
+# gunicorn workers, not just the one running the job.
+_PROCESS_JOBS_DIR = os.environ.get(
+    'PROCESS_JOBS_DIR', '/tmp/transaction_processor_jobs'
+)
+_PROCESS_JOB_TTL_SECONDS = 24 * 3600
+_JOB_ID_RX = re.compile(r'^[0-9a-f]{32}$')
+
+# The job the current thread is running (if any). The pipeline functions call
+# _job_progress() unconditionally; outside a job thread it's a no-op.
+_JOB_CTX = threading.local()
+_JOB_THREADS = []
+_JOB_THREADS_LOCK = threading.Lock()
+
+
+def _job_path(job_id):
+    return os.path.join(_PROCESS_JOBS_DIR, f'{job_id}.json')
+
+
+def _job_write(job):
+    """Atomic write — a poll never sees a half-written file."""
+    try:
+        os.makedirs(_PROCESS_JOBS_DIR, exist_ok=True)
+        tmp = _job_path(job['id']) + f'.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(job, f, default=str)
+        os.replace(tmp, _job_path(job['id']))
+    except Exception as e:
+        print(f"⚠️ process job {job.get('id')}: could not persist state: {e}")
+
+
+def _job_read(job_id):
+    try:
+        with open(_job_path(job_id)) as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _prune_old_jobs():
+    import time as _time
+    try:
+        cutoff = _time.time() - _PROCESS_JOB_TTL_SECONDS
+        for name in os.listdir(_PROCESS_JOBS_DIR):
+            path = os.path.join(_PROCESS_JOBS_DIR, name)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+    except OSError:
+        pass
+
+
+def _job_progress(**fields):
+    """Merge progress fields into the running job's state and persist it.
+    Called from the pipeline at each stage boundary. No-op outside a job,
+    except that stage transitions always reach pipeline_metrics."""
+    if 'stage' in fields:
+        pipeline_metrics.stage(fields['stage'])
+    job = getattr(_JOB_CTX, 'job', None)
+    if job is None:
+        return
+    job['progress'].update(fields)
+    job['updated_at'] = datetime.now().isoformat()
+    _job_write(job)
+
+
+def _job_row_tick(row_no, total):
+    """Per-row classify progress. Persisted every 200 rows (and on the last
+    one) so the loop doesn't turn into a file write per transaction."""
+    if getattr(_JOB_CTX, 'job', None) is not None and (row_no % 200 == 0 or row_no == total):
+        _job_progress(rows_classified=row_no)
+
+
+def _job_rows_written(sheet_name, n):
+    job = getattr(_JOB_CTX, 'job', None)
+    if job is None:
+        return
+    written = job['progress'].setdefault('rows_written', {})
+    written[sheet_name] = written.get(sheet_name, 0) + n
+    _job_progress()
+
+
+def _run_process_job(job):
+    """Background-thread body for one /process job."""
+    _JOB_CTX.job = job
+    try:
+        with _process_lock(blocking=True) as (got_lock, _fd):
+            job['status'] = 'running'
+            job['started_at'] = datetime.now().isoformat()
+            _job_progress(stage='reading')
+            print(f"🏦 Job {job['id']}: processing {job['bank_type']} statement...")
+            # The pipeline builds its responses with jsonify(), which needs an
+            # app context — there's no request here, the route has returned.
+            with app.app_context():
+                # 🔥 NEW: Route to appropriate processing function.
+                # For CRDB-flavoured banks (CRDB, HIGHERP — the second CRDB
+                # account uses a different label so the sheet's Bank column
+                # can tell the two accounts apart), the pipeline is identical;
+                # only the label written into the Bank column changes.
+                if job['bank_type'] == 'NMB':
+                    resp = process_nmb_transactions(job['filepath'])
+                else:
+                    resp = process_crdb_transactions(job['filepath'],
+                                                     bank_label=job['bank_type'])
+                code = 200
+                if isinstance(resp, tuple):
+                    resp, code = resp[0], resp[1]
+                body = resp.get_json(silent=True) if hasattr(resp, 'get_json') else resp
+        job['http_status'] = code
+        job['result'] = body
+        job['metrics'] = pipeline_metrics.last_summary()
+        job['status'] = 'done' if code < 400 else 'failed'
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        job['http_status'] = 500
+        job['result'] = {'error': str(e)}
+        job['status'] = 'failed'
+    finally:
+        job['finished_at'] = datetime.now().isoformat()
+        _job_progress(stage='finished')
+        _JOB_CTX.job = None
+        print(f"🏁 Job {job['id']}: {job['status']} (HTTP {job.get('http_status')})")
+
+
+def _start_process_job(filepath, bank_type):
+    _prune_old_jobs()
+    now = datetime.now().isoformat()
+    job = {
+        'id':          uuid.uuid4().hex,
+        'status':      'queued',
+        'bank_type':   bank_type,
+        'filepath':    filepath,
+        'pid':         os.getpid(),
+        'created_at':  now,
+        'updated_at':  now,
+        'started_at':  None,
+        'finished_at': None,
+        'progress':    {'stage': 'queued', 'rows_read': None,
+                        'customers_loaded': None, 'rows_classified': 0,
+                        'rows_written': {}},
+        'http_status': None,
+        'result':      None,
+    }
+    _job_write(job)
+    t = threading.Thread(target=_run_process_job, args=(job,), daemon=True)
+    with _JOB_THREADS_LOCK:
+        _JOB_THREADS[:] = [x for x in _JOB_THREADS if x.is_alive()]
+        _JOB_THREADS.append(t)
+    t.start()
+    return job
+
+
+def wait_for_process_jobs(timeout=None):
+    """Block until this worker's job threads finish, for at most `timeout`
+    seconds in total. Called from gunicorn's worker_exit hook so a
+    max_requests recycle doesn't kill a run half-way through its sheet
+    writes (job threads are daemons). Returns True if every job finished."""
+    import time as _time
+    deadline = None if timeout is None else _time.time() + timeout
+    with _JOB_THREADS_LOCK:
+        threads = [t for t in _JOB_THREADS if t.is_alive()]
+    for t in threads:
+        print("⏳ worker exiting — waiting for in-flight /process job to finish")
+        t.join(None if deadline is None else max(0, deadline - _time.time()))
+    if any(t.is_alive() for t in threads):
+        print(f"⚠️ worker exiting with a /process job still running after {timeout}s")
+        return False
+    return True
+
+
 @app.route('/process', methods=['POST'])
 def process_transactions():
+    """Enqueue the uploaded statement and return its job id (202).
+
+    ?wait=1 keeps the old synchronous contract for scripted callers: the
+    pipeline runs inside this request and the 409 'already_processing'
+    rejection still applies.
+    """
+    filepath = session.get('filepath')
+    bank_type = session.get('bank_type', 'CRDB')  # 🔥 NEW: Get bank type
+
+    if not filepath or not os.path.exists(filepath):
+        return jsonify({'error': 'No file uploaded'}), 400
+
+    if request.args.get('wait') != '1':
+        job = _start_process_job(filepath, bank_type)
+        print(f"📥 /process: queued job {job['id']} ({bank_type}, {filepath})")
+        return jsonify({
+            'job_id':     job['id'],
+            'status':     job['status'],
+            'status_url': f"/process/status/{job['id']}",
+        }), 202
+
     with _process_lock() as (got_lock, _fd):
         if not got_lock:
             # Another /process is already running. 409 Conflict is the
@@ -2142,19 +3075,7 @@ def process_transactions():
                            'Wait for it to finish before retrying.',
             }), 409
         try:
-            filepath = session.get('filepath')
-            bank_type = session.get('bank_type', 'CRDB')  # 🔥 NEW: Get bank type
-
-            if not filepath or not os.path.exists(filepath):
-                return jsonify({'error': 'No file uploaded'}), 400
-
             print(f"🏦 Processing {bank_type} statement...")
-
-            # 🔥 NEW: Route to appropriate processing function.
-            # For CRDB-flavoured banks (CRDB, HIGHERP — the second CRDB
-            # account uses a different label so the sheet's Bank column
-            # can tell the two accounts apart), the pipeline is identical;
-            # only the label written into the Bank column changes.
             if bank_type == 'NMB':
                 return process_nmb_transactions(filepath)
             else:
@@ -2166,6 +3087,723 @@ def process_transactions():
             return jsonify({'error': str(e)}), 500
 
 
+@app.route('/process/status/<job_id>', methods=['GET'])
+def process_status(job_id):
+    """Poll a /process job. `progress` carries the stage plus rows_read,
+    customers_loaded, rows_classified and per-tab rows_written; `result` is
+    the pipeline's usual JSON response once status is done/failed."""
+    if not _JOB_ID_RX.match(job_id):
+        return jsonify({'error': 'invalid job id'}), 400
+    job = _job_read(job_id)
+    if job is None:
+        return jsonify({'error': 'job not found', 'job_id': job_id}), 404
+    if job['status'] in ('queued', 'running'):
+        # Job thread's worker died (OOM, hard kill) — the file would say
+        # "running" forever otherwise.
+        try:
+            os.kill(job['pid'], 0)
+        except ProcessLookupError:
+            job['status'] = 'lost'
+            job['result'] = {'error': 'worker running this job exited before it finished'}
+            _job_write(job)
+        except OSError:
+            pass
+    job.pop('filepath', None)
+    return jsonify(job)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Token-gated Prometheus scrape of the /process pipeline counters and
+    stage / operation timings (pipeline_metrics.py), plus the Supabase mirror
+    outbox backlog (mirror_outbox.py) and the audit queue (audit_queue.py).
+    Pipeline totals live on disk, so whichever gunicorn worker answers
+    returns the same numbers; the audit_*_total counters are per worker.
+    Scrape with ?token= or X-Migration-Token."""
+    if not _migration_token_ok():
+        return jsonify({'error': 'unauthorized'}), 401
+    return (pipeline_metrics.render() + mirror_outbox.render() + audit_queue.render(), 200,
+            {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+@app.route('/metrics/runs', methods=['GET'])
+def metrics_runs():
+    """Token-gated: the newest per-run JSON summaries (?limit=, default 10)."""
+    if not _migration_token_ok():
+        return jsonify({'error': 'unauthorized'}), 401
+    try:
+        limit = min(int(request.args.get('limit', 10)), 100)
+    except ValueError:
+        limit = 10
+    return jsonify({'runs': pipeline_metrics.recent_runs(limit)})
+
+
+@app.route('/metrics/mirror-outbox', methods=['GET'])
+def metrics_mirror_outbox():
+    """Token-gated: rows still waiting for the Supabase mirror, how many
+    batches are in retry, the oldest one's age and the last send error, plus
+    the batches parked after SUPABASE_OUTBOX_MAX_ATTEMPTS failed sends."""
+    if not _migration_token_ok():
+        return jsonify({'error': 'unauthorized'}), 401
+    backlog = mirror_outbox.backlog()
+    if backlog is None:
+        return jsonify({'error': 'outbox unreadable'}), 500
+    return jsonify(backlog)
+
+
+# ── Row classification: pure per-row function + ordered merge ───────────────
+# The CRDB / NMB loops used to classify AND number rows in the same pass, so a
+# 10k-row statement ran on one core for minutes. Classification is now
+# _classify_crdb_row / _classify_nmb_row — a pure function of (row, ctx), ctx
+# holding the customer lookups and existing-ref sets — returning a _RowResult
+# with the row's ID left as None. _classify_rows() runs it over the batch, in
+# a process pool for big batches when CLASSIFY_WORKERS > 1; each worker gets
+# (fn, ctx) once via the pool initializer and only its own chunks' rows as
+# task arguments. _merge_row_results() then walks
+# the results IN ROW ORDER, assigning IDs (last_passed_id += 1 ...) and doing
+# the in-batch no-REF dedup exactly as the single loop did, so IDs and output
+# order are deterministic whichever way the rows were classified.
+#
+# The pool uses the forkserver start method, not fork: this gunicorn worker
+# runs other threads (the /process job, the mirror outbox flusher, the audit
+# writer) and a forked child could inherit a lock one of them holds —
+# SQLite, the requests pool, stdout — and hang on it. Forkserver children
+# come from a clean single-threaded server that has imported this module
+# (set_forkserver_preload below), which is why importing app must not
+# start threads (see post_worker_init in the gunicorn configs).
+#
+# Memory: forkserver children share nothing with this process, so every
+# worker holds its own unpickled copy of ctx — the seven customer lookups
+# and every existing-ref / message set. Peak memory grows by roughly that
+# much per worker, which on the 512MB plan matters more than the CPU saved
+# on a classification loop that is mostly dict lookups. The pool is
+# therefore opt-in, like PDF_WORKERS: CLASSIFY_WORKERS defaults to 1
+# (serial); raise it only where RAM allows. Batches under
+# CLASSIFY_PARALLEL_MIN_ROWS stay serial either way.
+CLASSIFY_WORKERS = int(os.environ.get('CLASSIFY_WORKERS', '1'))
+CLASSIFY_PARALLEL_MIN_ROWS = int(os.environ.get('CLASSIFY_PARALLEL_MIN_ROWS', '2000'))
+_CLASSIFY_JOB = {}   # (fn, ctx), set in each pool worker by _classify_init
+if __name__ != '__main__':
+    import multiprocessing as _mp
+    _mp.get_context('forkserver').set_forkserver_preload([__name__])
+
+
+class _RowResult:
+    """Where one row goes. Picklable — it crosses the process pool."""
+    __slots__ = ('bucket', 'row', 'review', 'stats', 'noref_fp')
+
+    def __init__(self):
+        self.bucket = None     # key into _merge_row_results' buckets
+        self.row = None        # sheet row, row[0] (ID) filled in by the merge
+        self.review = None     # needs_review_data entry instead of a row
+        self.stats = []        # stats keys to bump
+        self.noref_fp = None   # _noref_fingerprint for no-REF rows
+
+    def put(self, bucket, row):
+        self.bucket, self.row = bucket, row
+
+    def send_to_review(self, entry):
+        self.review = entry
+
+    def bump(self, key):
+        self.stats.append(key)
+
+
+def _classify_init(fn, ctx):
+    _CLASSIFY_JOB['job'] = (fn, ctx)
+    # The lookups arrived pickled, so the parent's fuzzy index isn't ours.
+    lookups = ctx['lookups']
+    _fuzzy_index_for(lookups[1], lookups[4], lookups[5])
+
+
+def _classify_chunk(rows):
+    fn, ctx = _CLASSIFY_JOB['job']
+    return [fn(row, ctx) for row in rows]
+
+
+def _classify_rows(fn, rows, ctx):
+    """[fn(row, ctx) for row in rows], in row order. Batches of at least
+    CLASSIFY_PARALLEL_MIN_ROWS are split into chunks across CLASSIFY_WORKERS
+    forkserver processes (each holding its own copy of ctx — see above); a
+    pool that can't start or dies falls back to serial."""
+    n = len(rows)
+    workers = min(CLASSIFY_WORKERS, max(1, n // 500))
+    if workers > 1 and n >= CLASSIFY_PARALLEL_MIN_ROWS:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        from concurrent.futures.process import BrokenProcessPool
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            chunk = max(100, -(-n // (workers * 4)))
+            chunks = [rows[lo:lo + chunk] for lo in range(0, n, chunk)]
+            try:
+                results = []
+                with ProcessPoolExecutor(max_workers=workers,
+                                         mp_context=multiprocessing.get_context('forkserver'),
+                                         initializer=_classify_init,
+                                         initargs=(fn, ctx)) as pool:
+                    for part in pool.map(_classify_chunk, chunks):
+                        results.extend(part)
+                        _job_progress(rows_classified=len(results))
+                print(f"⚡ Classified {n} rows on {workers} processes")
+                return results
+            except (BrokenProcessPool, OSError) as e:
+                print(f"⚠️ classify pool failed ({e}) — classifying serially")
+    results = []
+    for row_no, row in enumerate(rows, 1):
+        _job_row_tick(row_no, n)
+        results.append(fn(row, ctx))
+    return results
+
+
+def _merge_row_results(results, stats, needs_review_data, last_ids, buckets):
+    """Sequential half of classification. Walks results in row order,
+    numbers every row from last_ids (updated in place — bucket → (list,
+    id key), fuzzy rows share PASSED's counter) and holds each no-REF row
+    only once per batch."""
+    noref_seen = set()
+    for res in results:
+        if res.noref_fp is not None:
+            details, credit_amount = res.row[3], res.row[4]
+            if res.noref_fp in noref_seen:
+                stats['skipped'] += 1
+                _row_log(f"⏭️ SKIP (no REF, already held): {details[:70]}")
+                continue
+            noref_seen.add(res.noref_fp)
+            _row_log(f"🚫 HELD (no bank REF): {details[:70]} — {credit_amount}")
+        for key in res.stats:
+            stats[key] += 1
+        if res.review is not None:
+            needs_review_data.append(res.review)
+        elif res.bucket is not None:
+            data, id_key = buckets[res.bucket]
+            last_ids[id_key] += 1
+            res.row[0] = last_ids[id_key]
+            data.append(res.row)
+
+
+def _classify_crdb_row(row, ctx):
+    """One CRDB statement row → _RowResult. This is the body of the old
+    per-row loop in process_crdb_transactions; it reads only `row` and
+    `ctx`, and IDs are assigned afterwards by _merge_row_results()."""
+    BANK = ctx['bank']
+    (phone_lookup, plate_lookup, depositor_lookup,
+     phone_lookup_sav, plate_lookup_sav, id_lookup_sav,
+     iphone_lookup) = ctx['lookups']
+    all_existing_refs            = ctx['all_existing_refs']
+    all_existing_messages        = ctx['all_existing_messages']
+    all_iphone_existing_refs     = ctx['all_iphone_existing_refs']
+    all_iphone_existing_messages = ctx['all_iphone_existing_messages']
+    res = _RowResult()
+
+    posting_date  = row.date
+    details       = row.description
+    parsed        = parse_description(details)   # shared by every extractor below
+    credit_amount = row.credit
+    ref_number    = extract_ref_number(parsed)
+
+    # ── No bank REF → never becomes a payment ────────────────────────
+    # This used to mint a synthetic ref (NAME+TIMESTAMP, previously
+    # syn:<hash>) so the ref-based dedup had a key. That was wrong and
+    # it duplicated real money: the bank re-sends the same transaction
+    # later WITH its real REF, the two rows carry different refs, dedup
+    # sees two payments and Frappe/QB gets both. Confirmed on
+    # 31.07 22:13 MC461FXX 12,500 — pushed once as
+    # DENISRAYMONDTESHA31072026221300 and again as 19fb9983d24b3a42.
+    # Systematic 29.07 → 05.08.
+    #
+    # Frank 2026-08-06: "i dont want transactions without ref anymore."
+    # A row the bank sent without a REF is now HELD in FAILED. It is
+    # never routed to PASSED, never pushed, and is never given an
+    # invented identity that could later collide with the real one.
+    # When the bank resends it with its REF it resolves normally.
+    #
+    # It is deduped by content fingerprint instead of a ref, so it does
+    # not re-append every cycle — the fingerprint stays internal to
+    # FAILED and never travels as a payment key.
+    if not ref_number:
+        fp = _noref_fingerprint(posting_date, details, credit_amount)
+        # already held on a previous run (message set covers FAILED).
+        # "Already seen earlier in THIS batch" depends on the rows before
+        # this one, so _merge_row_results() checks res.noref_fp in order
+        # and prints the HELD / SKIP line.
+        msg_key = re.sub(r'\s+', ' ', str(details or '')).strip()
+        if msg_key and msg_key in all_existing_messages:
+            res.bump('skipped')
+            _row_log(f"⏭️ SKIP (no REF, already held): {details[:70]}")
+            return res
+        res.noref_fp = fp
+        res.put('failed', [
+            None, posting_date, BANK, details, credit_amount,
+            'No REF', 'Bank sent no REF — held, not pushed', '',
+        ])
+        res.bump('failed')
+        return res
+
+    # ══════════════════════════════════════════════════════════════════
+    # 🔥 NEW: iPhone Channel — intercept BEFORE normal processing
+    # ══════════════════════════════════════════════════════════════════
+    if is_iphone_transaction(parsed):
+        _row_log(f"\n📱 iPhone transaction detected: {details[:80]}")
+
+        # Duplicate check within iPhone sheets
+        iphone_is_dup = False
+        if ref_number and ref_number in all_iphone_existing_refs:
+            iphone_is_dup = True
+        elif details in all_iphone_existing_messages:
+            iphone_is_dup = True
+
+        if iphone_is_dup:
+            res.bump('iphone_skipped')
+            res.bump('skipped')
+            _row_log(f"  ⏭️ iPhone duplicate — skipped")
+            return res  # Do NOT fall through to normal flow
+
+        # Look up customer in IPHONE_RECORDS
+        customer_name, raw_phone = lookup_iphone_customer(parsed, iphone_lookup)
+
+        # Determine display identifier (prefer 255-prefix format)
+        if raw_phone:
+            norm = normalize_phone_iphone(raw_phone)
+            display_phone = f"255{norm}" if norm else raw_phone
+        else:
+            display_phone = 'No phone'
+
+        if customer_name:
+            # ✅ Match found → BANK_PASSED
+            bank_passed_row = [
+                None,
+                posting_date,
+                BANK,
+                details,
+                credit_amount,
+                display_phone,
+                customer_name,
+                ref_number or '',
+                ''          # No separate customer_id in IPHONE_RECORDS
+            ]
+            res.put('bank_passed', bank_passed_row)
+            res.bump('iphone_passed')
+            _row_log(f"  ✅ BANK_PASSED: {customer_name} — {display_phone} — {credit_amount}")
+        else:
+            # ❌ No match → BANK_FAILED
+            reason = f"PHONE({display_phone}) not found in IPHONE_RECORDS"
+            bank_failed_row = [
+                None,
+                posting_date,
+                BANK,
+                details,
+                credit_amount,
+                display_phone,
+                reason,
+                ref_number or ''
+            ]
+            res.put('bank_failed', bank_failed_row)
+            res.bump('iphone_failed')
+            _row_log(f"  ❌ BANK_FAILED: {reason}")
+
+        # ⚠️ CRITICAL: continue — do NOT run normal pikipiki logic
+        return res
+    # ══════════════════════════════════════════════════════════════════
+    # End iPhone Channel
+    # ══════════════════════════════════════════════════════════════════
+
+    # ── Normal duplicate check ─────────────────────────────────────────
+    # Same empty-description guard as NMB: description-based dedup only
+    # fires when details is non-empty, otherwise all no-description rows
+    # collide on the empty string and silently drop.
+    is_duplicate = False
+
+    if ref_number and ref_number in all_existing_refs:
+        is_duplicate = True
+        res.bump('skipped')
+    elif details and details in all_existing_messages:
+        is_duplicate = True
+        res.bump('skipped')
+
+    if is_duplicate:
+        return res
+
+    # ── No-description CRDB row → straight to FAILED with UNKNOWN
+    # placeholders. Symmetric to the NMB path — a customer SMS with the
+    # ref + plate can rescue it later.
+    if not details.strip():
+        res.put('failed', [
+            None,
+            posting_date,
+            BANK,
+            'UNKNOWN',
+            credit_amount,
+            'UNKNOWN',
+            'UNKNOWN',
+            ref_number,
+        ])
+        res.bump('failed')
+        _row_log(f"⚠️ FAILED (no description, CRDB) — ref={ref_number} amt={credit_amount} → SMS-rescue candidate")
+        return res
+
+    # ── Resolution priority order: FROM → PHONE → PLATE ────────────────
+    # Frank 2026-07-27: the bank explicitly labels the sender in
+    # "FROM <NAME> TO FRANK" phrasing — that's the highest-signal field
+    # in the description. Try it BEFORE phone/plate extraction so a
+    # false-positive plate hit (e.g. MC320ADE picked out of a REF hex
+    # substring c7320ade) can't shadow a real depositor match. The
+    # phone/plate cascade runs only when FROM misses.
+
+    # ── Step 1: FROM depositor name ───────────────────────────────────
+    dep_hit = _lookup_depositor(parsed, depositor_lookup)
+    if dep_hit:
+        dep_plate, dep_customer, dep_name = dep_hit
+        res.put('passed', [
+            None,
+            posting_date,
+            BANK,
+            details,
+            credit_amount,
+            dep_plate,
+            dep_customer,
+            ref_number or '',
+            ''
+        ])
+        res.bump('passed')
+        _row_log(f"✅ PASSED (via FROM {dep_name!r}): {dep_customer} - {dep_plate} - {credit_amount}")
+        return res  # FROM won → skip phone/plate
+
+    # ── Step 2 + 3: Phone extraction → Plate extraction ───────────────
+    phone = extract_phone_number(parsed)
+    plate = extract_plate_number(parsed)
+
+    identifier  = None
+    lookup_type = None
+
+    if phone:
+        identifier  = phone
+        lookup_type = 'phone'
+        _row_log(f"Found phone: {phone} in: {details[:80]}")
+    elif plate:
+        identifier  = plate
+        lookup_type = 'plate'
+        _row_log(f"Found plate: {plate} in: {details[:80]}")
+
+    if identifier and lookup_type:
+        # Check pikipiki records first
+        customer_name = lookup_customer_from_cache(identifier, lookup_type, phone_lookup, plate_lookup)
+
+        if customer_name:
+            # Add to PASSED
+            passed_row = [
+                None,
+                posting_date,
+                BANK,
+                details,
+                credit_amount,
+                identifier,
+                customer_name,
+                ref_number or '',
+                ''  # Empty customer_id for PASSED
+            ]
+            res.put('passed', passed_row)
+            res.bump('passed')
+            _row_log(f"✅ PASSED: {customer_name} - {identifier} - {credit_amount}")
+        else:
+            # Check pikipiki records2 (SAV)
+            customer_name_sav = lookup_customer_from_cache(identifier, lookup_type, phone_lookup_sav, plate_lookup_sav)
+
+            if customer_name_sav:
+                # Get customer ID for PASSED_SAV records
+                customer_id = lookup_customer_id_from_cache(identifier, lookup_type, id_lookup_sav)
+
+                passed_sav_row = [
+                    None,
+                    posting_date,
+                    BANK,
+                    details,
+                    credit_amount,
+                    identifier,
+                    customer_name_sav,
+                    ref_number or '',
+                    customer_id
+                ]
+                res.put('passed_sav', passed_sav_row)
+                res.bump('passed_sav')
+                _row_log(f"✅ PASSED_SAV: {customer_name_sav} - {identifier} - {credit_amount} - ID: {customer_id}")
+            else:
+                # 🔥 Tier 3: Not in pikipiki records1 or records2.
+                # If we have a phone, try IPHONE_RECORDS before giving up.
+                iphone_matched = False
+                if lookup_type == 'phone':
+                    norm = normalize_phone_iphone(identifier)
+                    iphone_customer = iphone_lookup.get(norm) if norm else None
+                    if iphone_customer:
+                        # Found in IPHONE_RECORDS → BANK_PASSED
+                        # Duplicate check first
+                        iphone_is_dup = (
+                            (ref_number and ref_number in all_iphone_existing_refs)
+                            or details in all_iphone_existing_messages
+                        )
+                        if not iphone_is_dup:
+                            norm_phone = identifier if identifier.startswith('255') else f"255{norm}"
+                            bank_passed_row = [
+                                None,
+                                posting_date,
+                                BANK,
+                                details,
+                                credit_amount,
+                                norm_phone,
+                                iphone_customer,
+                                ref_number or '',
+                                ''
+                            ]
+                            res.put('bank_passed', bank_passed_row)
+                            res.bump('iphone_passed')
+                            iphone_matched = True
+                            _row_log(f"  ✅ BANK_PASSED (via phone fallback): {iphone_customer} — {norm_phone} — {credit_amount}")
+
+                if not iphone_matched:
+                    # ── FUZZY RESCUE attempt before giving up ─────────
+                    # Only for plate failures, not phone failures
+                    fuzzy_cands = []
+                    if lookup_type == 'plate':
+                        fuzzy_cands = try_fuzzy_rescue(parsed, plate_lookup,
+                                                       plate_lookup_sav, id_lookup_sav)
+
+                    if fuzzy_cands:
+                        if len(fuzzy_cands) == 1:
+                            fuzzy_row = fuzzy_rescue_to_passed_row(
+                                None, posting_date, BANK, details,
+                                credit_amount, ref_number, fuzzy_cands
+                            )
+                            res.put('fuzzy_passed', fuzzy_row)
+                            res.bump('fuzzy_rescued')
+                            _row_log(f"  🟢 FUZZY→PASSED: 1 candidate, written clean (no '=')")
+                        else:
+                            # Frank 2026-06-09: multi-candidate fuzzy → FAILED with '=' suggestions visible
+                            failed_row = fuzzy_multi_to_failed_row(
+                                None, posting_date, BANK, details,
+                                credit_amount, ref_number, fuzzy_cands
+                            )
+                            res.put('failed', failed_row)
+                            res.bump('failed')
+                            _row_log(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands) → FAILED: {[c['plate'] for c in fuzzy_cands]}")
+                        return res  # move to next transaction
+
+                    # Truly not found anywhere — add to FAILED
+                    reason = f"{lookup_type.upper()}({identifier}) not found"
+
+                    final_identifier = identifier
+                    if lookup_type == 'phone':
+                        if not identifier.startswith('255'):
+                            if identifier.startswith('0'):
+                                final_identifier = '255' + identifier[1:]
+                            else:
+                                final_identifier = '255' + identifier
+
+                    failed_row = [
+                        None,
+                        posting_date,
+                        BANK,
+                        details,
+                        credit_amount,
+                        final_identifier,
+                        reason,
+                        ref_number or ''
+                    ]
+                    res.put('failed', failed_row)
+                    res.bump('failed')
+                    _row_log(f"❌ FAILED: Customer not found for {final_identifier} (REF: {ref_number})")
+    else:
+        # Check for plate suggestions (original logic)
+        plate_suggestions = extract_plate_suggestions(parsed)
+
+        if plate_suggestions:
+            # AUTOMATION GUARD: no human review anymore. If the description
+            # produced more than one plate candidate we can't safely pick
+            # one — push to FAILED with the candidate list visible.
+            if len(plate_suggestions) > 1:
+                suggested_list = ', '.join(s['suggested'] for s in plate_suggestions)
+                res.put('failed', [
+                    None, posting_date, BANK, details, credit_amount,
+                    suggested_list,
+                    f'Multiple plate suggestions ({len(plate_suggestions)})',
+                    ref_number or '',
+                ])
+                res.bump('failed')
+                _row_log(f"❌ FAILED (CRDB): multiple plate suggestions ({len(plate_suggestions)}) — {suggested_list}")
+                return res
+            for suggestion in plate_suggestions:
+                suggested_plate = suggestion['suggested']
+
+                customer_name = lookup_customer_from_cache(suggested_plate, 'plate', phone_lookup, plate_lookup)
+                customer_name_sav = None
+                customer_id = ''
+
+                if not customer_name:
+                    customer_name_sav = lookup_customer_from_cache(suggested_plate, 'plate', phone_lookup_sav, plate_lookup_sav)
+                    if customer_name_sav:
+                        customer_id = lookup_customer_id_from_cache(suggested_plate, 'plate', id_lookup_sav)
+
+                if customer_name or customer_name_sav:
+                    res.send_to_review({
+                        'posting_date': posting_date,
+                        'details': details,
+                        'credit_amount': credit_amount,
+                        'ref_number': ref_number or '',
+                        'original_text': suggestion['original'],
+                        'suggested_plate': suggested_plate,
+                        'customer_name': customer_name or customer_name_sav,
+                        'customer_id': customer_id,
+                        'target_sheet': 'PASSED' if customer_name else 'PASSED_SAV',
+                        'confidence': suggestion['confidence'],
+                        'reason': suggestion['reason'],
+                        'bank': BANK
+                    })
+                    res.bump('needs_review')
+                    _row_log(f"🔍 NEEDS REVIEW: {suggestion['original']} -> {suggested_plate} -> {customer_name or customer_name_sav}")
+                    break
+
+            if res.review is None:
+                # ── RESCUE before FAILED ──────────────────────────────
+                rescue_plates = _rescue_find_plates(parsed)
+                candidate_details = []
+                if rescue_plates:
+                    for rp in rescue_plates:
+                        cn = lookup_customer_from_cache(rp, 'plate', phone_lookup, plate_lookup)
+                        cn_sav, cid = None, ''
+                        if not cn:
+                            cn_sav = lookup_customer_from_cache(rp, 'plate', phone_lookup_sav, plate_lookup_sav)
+                            if cn_sav:
+                                cid = lookup_customer_id_from_cache(rp, 'plate', id_lookup_sav)
+                        candidate_details.append({'plate': rp, 'customer_name': cn or cn_sav or '', 'customer_id': cid, 'target_sheet': 'PASSED' if cn else ('PASSED_SAV' if cn_sav else None)})
+                if 1 <= len(candidate_details) <= MAX_REVIEW_CANDIDATES:
+                    res.send_to_review({'posting_date': posting_date, 'details': details, 'credit_amount': credit_amount, 'ref_number': ref_number or '', 'review_type': 'choose_plate', 'candidates': candidate_details, 'bank': BANK})
+                    res.bump('needs_review')
+                    _row_log(f"🔍 RESCUE REVIEW (CRDB): {[c['plate'] for c in candidate_details]}")
+                else:
+                    if len(candidate_details) > MAX_REVIEW_CANDIDATES:
+                        _row_log(f"⏭️ Skipping {len(candidate_details)}-candidate review (too ambiguous): {[c['plate'] for c in candidate_details]}")
+                    # ── FUZZY RESCUE before FAILED ─────────────────────
+                    fuzzy_cands = try_fuzzy_rescue(parsed, plate_lookup,
+                                                   plate_lookup_sav, id_lookup_sav)
+                    if fuzzy_cands:
+                        if len(fuzzy_cands) == 1:
+                            fuzzy_row = fuzzy_rescue_to_passed_row(
+                                None, posting_date, BANK, details,
+                                credit_amount, ref_number, fuzzy_cands
+                            )
+                            res.put('fuzzy_passed', fuzzy_row)
+                            res.bump('fuzzy_rescued')
+                            _row_log(f"  🟢 FUZZY→PASSED: 1 candidate, written clean (no '=')")
+                        else:
+                            # Frank 2026-06-09: multi-candidate fuzzy → FAILED with '=' suggestions visible
+                            failed_row = fuzzy_multi_to_failed_row(
+                                None, posting_date, BANK, details,
+                                credit_amount, ref_number, fuzzy_cands
+                            )
+                            res.put('failed', failed_row)
+                            res.bump('failed')
+                            _row_log(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands) → FAILED: {[c['plate'] for c in fuzzy_cands]}")
+                    else:
+                        # ── Depositor-name fallback (CRDB) ──
+                        # For descriptions like 'REF:… SIMUSSD FT FROM
+                        # DENIS RAYMOND TESHA TO FRANK N/A' where no
+                        # plate/phone was extractable, try matching
+                        # the depositor name against col D of pikipiki
+                        # records. If a row is found, resolve to that
+                        # row's (plate, customer_name) and route to
+                        # CRDB PASSED — normal BODA layout with
+                        # customer_name in col G, empty col I.
+                        dep_hit = _lookup_depositor(parsed, depositor_lookup)
+                        if dep_hit:
+                            dep_plate, dep_customer, dep_name = dep_hit
+                            res.put('passed', [
+                                None,
+                                posting_date,
+                                BANK,
+                                details,
+                                credit_amount,
+                                dep_plate,
+                                dep_customer,
+                                ref_number or '',
+                                ''
+                            ])
+                            res.bump('passed')
+                            _row_log(f"✅ PASSED (via depositor {dep_name!r}): {dep_customer} - {dep_plate} - {credit_amount}")
+                        else:
+                            res.put('failed', [None, posting_date, BANK, details, credit_amount, 'No phone/plate', 'No identifier', ref_number or ''])
+                            res.bump('failed')
+        else:
+            # ── RESCUE before FAILED ──────────────────────────────────
+            rescue_plates = _rescue_find_plates(parsed)
+            candidate_details = []
+            if rescue_plates:
+                for rp in rescue_plates:
+                    cn = lookup_customer_from_cache(rp, 'plate', phone_lookup, plate_lookup)
+                    cn_sav, cid = None, ''
+                    if not cn:
+                        cn_sav = lookup_customer_from_cache(rp, 'plate', phone_lookup_sav, plate_lookup_sav)
+                        if cn_sav:
+                            cid = lookup_customer_id_from_cache(rp, 'plate', id_lookup_sav)
+                    candidate_details.append({'plate': rp, 'customer_name': cn or cn_sav or '', 'customer_id': cid, 'target_sheet': 'PASSED' if cn else ('PASSED_SAV' if cn_sav else None)})
+            if 1 <= len(candidate_details) <= MAX_REVIEW_CANDIDATES:
+                res.send_to_review({'posting_date': posting_date, 'details': details, 'credit_amount': credit_amount, 'ref_number': ref_number or '', 'review_type': 'choose_plate', 'candidates': candidate_details, 'bank': BANK})
+                res.bump('needs_review')
+                _row_log(f"🔍 RESCUE REVIEW (CRDB): {[c['plate'] for c in candidate_details]}")
+            else:
+                if len(candidate_details) > MAX_REVIEW_CANDIDATES:
+                    _row_log(f"⏭️ Skipping {len(candidate_details)}-candidate review (too ambiguous): {[c['plate'] for c in candidate_details]}")
+                # ── FUZZY RESCUE before FAILED ─────────────────────────
+                fuzzy_cands = try_fuzzy_rescue(parsed, plate_lookup,
+                                               plate_lookup_sav, id_lookup_sav)
+                if fuzzy_cands:
+                    if len(fuzzy_cands) == 1:
+                        fuzzy_row = fuzzy_rescue_to_passed_row(
+                            None, posting_date, BANK, details,
+                            credit_amount, ref_number, fuzzy_cands
+                        )
+                        res.put('fuzzy_passed', fuzzy_row)
+                        res.bump('fuzzy_rescued')
+                        _row_log(f"  🟢 FUZZY→PASSED: 1 candidate, written clean (no '=')")
+                    else:
+                        # Frank 2026-06-09: multi-candidate fuzzy → FAILED with '=' suggestions visible
+                        failed_row = fuzzy_multi_to_failed_row(
+                            None, posting_date, BANK, details,
+                            credit_amount, ref_number, fuzzy_cands
+                        )
+                        res.put('failed', failed_row)
+                        res.bump('failed')
+                        _row_log(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands) → FAILED: {[c['plate'] for c in fuzzy_cands]}")
+                else:
+                    # ── Depositor-name fallback (CRDB) ──
+                    # Same lookup as the identifier-not-found path:
+                    # 'REF:… SIMUSSD FT FROM DENIS RAYMOND TESHA TO
+                    # FRANK N/A' has no extractable plate/phone but
+                    # the depositor name may be registered against
+                    # a customer's plate on pikipiki records col D.
+                    dep_hit = _lookup_depositor(parsed, depositor_lookup)
+                    if dep_hit:
+                        dep_plate, dep_customer, dep_name = dep_hit
+                        res.put('passed', [
+                            None,
+                            posting_date,
+                            BANK,
+                            details,
+                            credit_amount,
+                            dep_plate,
+                            dep_customer,
+                            ref_number or '',
+                            ''
+                        ])
+                        res.bump('passed')
+                        _row_log(f"✅ PASSED (via depositor {dep_name!r}): {dep_customer} - {dep_plate} - {credit_amount}")
+                    else:
+                        res.put('failed', [None, posting_date, BANK, details, credit_amount, 'No phone/plate', 'No identifier', ref_number or ''])
+                        res.bump('failed')
+                        _row_log(f"❌ FAILED: No phone/plate found in: {details[:80]} (REF: {ref_number})")
+    return res
+
+
+
+@pipeline_metrics.instrument('crdb')
+@_sheet_snapshot_scope
 def process_crdb_transactions(filepath, bank_label='CRDB'):
     """Process a CRDB-flavoured bank statement (both the original CRDB
     account and the second one — labelled HIGHERP by its puller —
@@ -2179,12 +3817,12 @@ def process_crdb_transactions(filepath, bank_label='CRDB'):
         # Determine file type and read accordingly
         if filepath.endswith('.pdf'):
             print("📄 Processing CRDB PDF file...")
-            credit_df = extract_data_from_pdf(filepath)
+            transactions_list = extract_data_from_pdf(filepath)
             
-            if credit_df is None or credit_df.empty:
+            if not transactions_list:
                 return jsonify({'error': 'Failed to extract data from PDF or no credit transactions found'}), 400
             
-            print(f"✅ PDF: Found {len(credit_df)} credit transactions")
+            print(f"✅ PDF: Found {len(transactions_list)} credit transactions")
         
         elif filepath.endswith('.xlsx') or filepath.endswith('.xls'):
             print("📊 Processing CRDB Excel file...")
@@ -2200,60 +3838,47 @@ def process_crdb_transactions(filepath, bank_label='CRDB'):
             # Same approach the NMB reader already uses below: scan for the
             # header row instead of trusting a fixed offset, so the next
             # metadata line CRDB adds doesn't take the pipeline down again.
-            CRDB_HEADER_ROW = None
-            raw = pd.read_excel(filepath, header=None)
-            for idx in range(min(60, len(raw))):
-                row_vals = [str(v).strip() for v in raw.iloc[idx].tolist()]
-                if 'Posting Date' in row_vals and 'Details' in row_vals:
-                    CRDB_HEADER_ROW = idx
-                    print(f"✅ CRDB header row auto-detected at row {idx} (0-based)")
-                    break
-
-            if CRDB_HEADER_ROW is None:
-                del raw
-                gc.collect()
+            #
+            # Streamed through excel_stream (one pass, no DataFrame): only the
+            # four columns below are kept, and only for credit rows.
+            try:
+                with excel_stream.open_table(filepath, _crdb_excel_header) as (
+                        CRDB_HEADER_ROW, header, rows):
+                    print(f"✅ CRDB header row auto-detected at row {CRDB_HEADER_ROW} (0-based)")
+                    columns = [v.strip() for v in header]
+                    print(f"Columns found: {columns}")
+
+                    required_columns = ['Posting Date', 'Details', 'Credit']
+                    missing = [col for col in required_columns if col not in columns]
+
+                    if missing:
+                        return jsonify({
+                            'error': f'Missing required columns: {missing}. Found: {columns}'
+                        }), 400
+
+                    # Filter only CREDIT transactions
+                    transactions_list = []
+                    for rec in excel_stream.project(
+                            rows, columns, ['Posting Date', 'Details', 'Credit', 'Debit']):
+                        credit = _excel_amount(rec['Credit'])
+                        debit = _excel_amount(rec.get('Debit'))
+                        if credit is None or credit <= 0 or (debit is not None and debit != 0):
+                            continue
+                        transactions_list.append(
+                            BankTxn.of(rec['Posting Date'], rec['Details'], credit))
+            except excel_stream.HeaderNotFound:
                 return jsonify({
                     'error': "Could not find the CRDB header row ('Posting Date' + "
                              "'Details') in the first 60 rows. Is this a CRDB "
                              "account statement export?"
                 }), 400
 
-            df = raw.iloc[CRDB_HEADER_ROW + 1:].reset_index(drop=True)
-            df.columns = [str(v).strip() for v in raw.iloc[CRDB_HEADER_ROW].tolist()]
-            del raw
-            gc.collect()
-
-            print(f"Columns found: {list(df.columns)}")
-
-            required_columns = ['Posting Date', 'Details', 'Credit']
-            missing = [col for col in required_columns if col not in df.columns]
-            
-            if missing:
-                return jsonify({
-                    'error': f'Missing required columns: {missing}. Found: {list(df.columns)}'
-                }), 400
-            
-            # Filter only CREDIT transactions — use .loc to avoid pandas FutureWarning
-            df.loc[:, 'Credit'] = pd.to_numeric(df['Credit'].astype(str).str.replace(',', ''), errors='coerce')
-            df.loc[:, 'Debit']  = pd.to_numeric(df['Debit'].astype(str).str.replace(',', ''), errors='coerce')
-
-            credit_df = df[(df['Credit'].notna()) & (df['Credit'] > 0) &
-                           ((df['Debit'].isna()) | (df['Debit'] == 0))].copy()
-            
-            # 🔥 Free full df immediately
-            del df
-            gc.collect()
-            
-            print(f"✅ Excel: Found {len(credit_df)} credit transactions")
+            print(f"✅ Excel: Found {len(transactions_list)} credit transactions")
         
         else:
             return jsonify({'error': 'Unsupported file format'}), 400
         
-        # Convert to list of dicts so pandas DataFrame can be freed early
-        transactions_list = credit_df.to_dict('records')
-        del credit_df
-        gc.collect()
-        print(f"✅ Converted {len(transactions_list)} transactions to list, freed DataFrame")
+        _job_progress(stage='loading_customers', rows_read=len(transactions_list))
 
         # Initialize Google Sheets service
         service = get_google_service()
@@ -2266,6 +3891,9 @@ def process_crdb_transactions(filepath, bank_label='CRDB'):
             (phone_lookup, plate_lookup, depositor_lookup,
              phone_lookup_sav, plate_lookup_sav, id_lookup_sav,
              iphone_lookup) = load_customers_dispatch(service)
+            _job_progress(stage='dedup', customers_loaded=_lookup_key_total(
+                (phone_lookup, plate_lookup, depositor_lookup, phone_lookup_sav,
+                 plate_lookup_sav, id_lookup_sav, iphone_lookup)))
         except CustomerLoadError as e:
             # Abort BEFORE any row is classified. The uploaded file is left in
             # place, nothing is appended to PASSED/FAILED, and the next puller
@@ -2278,6 +3906,10 @@ def process_crdb_transactions(filepath, bank_label='CRDB'):
                 'retryable': True,
             }), 503
 
+        # One batchGet per spreadsheet for every column A / ref-index range
+        # the reads below need — see load_sheet_snapshot().
+        load_sheet_snapshot(service, _CRDB_SNAPSHOT_TABS)
+
         # ── Load existing refs (duplicate guard) ──────────────────────────────
         print("Loading existing references from PASSED sheet...")
         existing_passed_refs, existing_passed_messages = get_existing_refs(service, 'PASSED')
@@ -2366,531 +3998,35 @@ def process_crdb_transactions(filepath, bank_label='CRDB'):
             # 🔥 NEW: Fuzzy stats
             'fuzzy_rescued': 0,
         }
-        noref_seen = set()   # in-run dedup for rows the bank sent with no REF
         
-        for row in transactions_list:
-            posting_date  = str(row.get('Posting Date', ''))
-            details       = str(row.get('Details', ''))
-            credit_amount = row.get('Credit', 0)
-            ref_number    = extract_ref_number(details)
-
-            # ── No bank REF → never becomes a payment ────────────────────────
-            # This used to mint a synthetic ref (NAME+TIMESTAMP, previously
-            # syn:<hash>) so the ref-based dedup had a key. That was wrong and
-            # it duplicated real money: the bank re-sends the same transaction
-            # later WITH its real REF, the two rows carry different refs, dedup
-            # sees two payments and Frappe/QB gets both. Confirmed on
-            # 31.07 22:13 MC461FXX 12,500 — pushed once as
-            # DENISRAYMONDTESHA31072026221300 and again as 19fb9983d24b3a42.
-            # Systematic 29.07 → 05.08.
-            #
-            # Frank 2026-08-06: "i dont want transactions without ref anymore."
-            # A row the bank sent without a REF is now HELD in FAILED. It is
-            # never routed to PASSED, never pushed, and is never given an
-            # invented identity that could later collide with the real one.
-            # When the bank resends it with its REF it resolves normally.
-            #
-            # It is deduped by content fingerprint instead of a ref, so it does
-            # not re-append every cycle — the fingerprint stays internal to
-            # FAILED and never travels as a payment key.
-            if not ref_number:
-                fp = _noref_fingerprint(posting_date, details, credit_amount)
-                # already held on a previous run (message set covers FAILED),
-                # or already seen earlier in THIS batch
-                msg_key = re.sub(r'\s+', ' ', str(details or '')).strip()
-                if fp in noref_seen or (msg_key and msg_key in all_existing_messages):
-                    stats['skipped'] += 1
-                    print(f"⏭️ SKIP (no REF, already held): {details[:70]}")
-                    continue
-                noref_seen.add(fp)
-                last_failed_id += 1
-                failed_data.append([
-                    last_failed_id, posting_date, BANK, details, credit_amount,
-                    'No REF', 'Bank sent no REF — held, not pushed', '',
-                ])
-                stats['failed'] += 1
-                print(f"🚫 HELD (no bank REF): {details[:70]} — {credit_amount}")
-                continue
-
-            # ══════════════════════════════════════════════════════════════════
-            # 🔥 NEW: iPhone Channel — intercept BEFORE normal processing
-            # ══════════════════════════════════════════════════════════════════
-            if is_iphone_transaction(details):
-                print(f"\n📱 iPhone transaction detected: {details[:80]}")
-
-                # Duplicate check within iPhone sheets
-                iphone_is_dup = False
-                if ref_number and ref_number in all_iphone_existing_refs:
-                    iphone_is_dup = True
-                elif details in all_iphone_existing_messages:
-                    iphone_is_dup = True
-
-                if iphone_is_dup:
-                    stats['iphone_skipped'] += 1
-                    stats['skipped'] += 1
-                    print(f"  ⏭️ iPhone duplicate — skipped")
-                    continue  # Do NOT fall through to normal flow
-
-                # Look up customer in IPHONE_RECORDS
-                customer_name, raw_phone = lookup_iphone_customer(details, iphone_lookup)
-
-                # Determine display identifier (prefer 255-prefix format)
-                if raw_phone:
-                    norm = normalize_phone_iphone(raw_phone)
-                    display_phone = f"255{norm}" if norm else raw_phone
-                else:
-                    display_phone = 'No phone'
-
-                if customer_name:
-                    # ✅ Match found → BANK_PASSED
-                    last_bank_passed_id += 1
-                    bank_passed_row = [
-                        last_bank_passed_id,
-                        posting_date,
-                        BANK,
-                        details,
-                        credit_amount,
-                        display_phone,
-                        customer_name,
-                        ref_number or '',
-                        ''          # No separate customer_id in IPHONE_RECORDS
-                    ]
-                    bank_passed_data.append(bank_passed_row)
-                    stats['iphone_passed'] += 1
-                    print(f"  ✅ BANK_PASSED: {customer_name} — {display_phone} — {credit_amount}")
-                else:
-                    # ❌ No match → BANK_FAILED
-                    last_bank_failed_id += 1
-                    reason = f"PHONE({display_phone}) not found in IPHONE_RECORDS"
-                    bank_failed_row = [
-                        last_bank_failed_id,
-                        posting_date,
-                        BANK,
-                        details,
-                        credit_amount,
-                        display_phone,
-                        reason,
-                        ref_number or ''
-                    ]
-                    bank_failed_data.append(bank_failed_row)
-                    stats['iphone_failed'] += 1
-                    print(f"  ❌ BANK_FAILED: {reason}")
-
-                # ⚠️ CRITICAL: continue — do NOT run normal pikipiki logic
-                continue
-            # ══════════════════════════════════════════════════════════════════
-            # End iPhone Channel
-            # ══════════════════════════════════════════════════════════════════
-
-            # ── Normal duplicate check ─────────────────────────────────────────
-            # Same empty-description guard as NMB: description-based dedup only
-            # fires when details is non-empty, otherwise all no-description rows
-            # collide on the empty string and silently drop.
-            is_duplicate = False
-
-            if ref_number and ref_number in all_existing_refs:
-                is_duplicate = True
-                stats['skipped'] += 1
-            elif details and details in all_existing_messages:
-                is_duplicate = True
-                stats['skipped'] += 1
-
-            if is_duplicate:
-                continue
-
-            # ── No-description CRDB row → straight to FAILED with UNKNOWN
-            # placeholders. Symmetric to the NMB path — a customer SMS with the
-            # ref + plate can rescue it later.
-            if not details.strip():
-                last_failed_id += 1
-                failed_data.append([
-                    last_failed_id,
-                    date,
-                    BANK,
-                    'UNKNOWN',
-                    credit_amount,
-                    'UNKNOWN',
-                    'UNKNOWN',
-                    ref_number,
-                ])
-                stats['failed'] += 1
-                print(f"⚠️ FAILED (no description, CRDB) — ref={ref_number} amt={credit_amount} → SMS-rescue candidate")
-                continue
-
-            # ── Resolution priority order: FROM → PHONE → PLATE ────────────────
-            # Frank 2026-07-27: the bank explicitly labels the sender in
-            # "FROM <NAME> TO FRANK" phrasing — that's the highest-signal field
-            # in the description. Try it BEFORE phone/plate extraction so a
-            # false-positive plate hit (e.g. MC320ADE picked out of a REF hex
-            # substring c7320ade) can't shadow a real depositor match. The
-            # phone/plate cascade runs only when FROM misses.
-
-            # ── Step 1: FROM depositor name ───────────────────────────────────
-            dep_hit = _lookup_depositor(details, depositor_lookup)
-            if dep_hit:
-                dep_plate, dep_customer, dep_name = dep_hit
-                last_passed_id += 1
-                passed_data.append([
-                    last_passed_id,
-                    posting_date,
-                    BANK,
-                    details,
-                    credit_amount,
-                    dep_plate,
-                    dep_customer,
-                    ref_number or '',
-                    ''
-                ])
-                stats['passed'] += 1
-                print(f"✅ PASSED (via FROM {dep_name!r}): {dep_customer} - {dep_plate} - {credit_amount}")
-                continue  # FROM won → skip phone/plate
-
-            # ── Step 2 + 3: Phone extraction → Plate extraction ───────────────
-            phone = extract_phone_number(details)
-            plate = extract_plate_number(details)
-
-            identifier  = None
-            lookup_type = None
+        _job_progress(stage='classifying', rows_classified=0)
+        _fuzzy_index_for(plate_lookup, plate_lookup_sav, id_lookup_sav)   # built once for the serial path
+        results = _classify_rows(_classify_crdb_row, transactions_list, {
+            'bank': BANK,
+            'lookups': (phone_lookup, plate_lookup, depositor_lookup,
+                        phone_lookup_sav, plate_lookup_sav, id_lookup_sav,
+                        iphone_lookup),
+            'all_existing_refs': all_existing_refs,
+            'all_existing_messages': all_existing_messages,
+            'all_iphone_existing_refs': all_iphone_existing_refs,
+            'all_iphone_existing_messages': all_iphone_existing_messages,
+        })
+        last_ids = {'passed': last_passed_id, 'passed_sav': last_passed_sav_id,
+                    'failed': last_failed_id, 'bank_passed': last_bank_passed_id,
+                    'bank_failed': last_bank_failed_id}
+        _merge_row_results(results, stats, needs_review_data, last_ids, {
+            'passed':       (passed_data, 'passed'),
+            'fuzzy_passed': (fuzzy_passed_data, 'passed'),
+            'passed_sav':   (passed_sav_data, 'passed_sav'),
+            'failed':       (failed_data, 'failed'),
+            'bank_passed':  (bank_passed_data, 'bank_passed'),
+            'bank_failed':  (bank_failed_data, 'bank_failed'),
+        })
+        last_failed_id = last_ids['failed']
+        del results
 
-            if phone:
-                identifier  = phone
-                lookup_type = 'phone'
-                print(f"Found phone: {phone} in: {details[:80]}")
-            elif plate:
-                identifier  = plate
-                lookup_type = 'plate'
-                print(f"Found plate: {plate} in: {details[:80]}")
-            
-            if identifier and lookup_type:
-                # Check pikipiki records first
-                customer_name = lookup_customer_from_cache(identifier, lookup_type, phone_lookup, plate_lookup)
-                
-                if customer_name:
-                    # Add to PASSED
-                    last_passed_id += 1
-                    passed_row = [
-                        last_passed_id,
-                        posting_date,
-                        BANK,
-                        details,
-                        credit_amount,
-                        identifier,
-                        customer_name,
-                        ref_number or '',
-                        ''  # Empty customer_id for PASSED
-                    ]
-                    passed_data.append(passed_row)
-                    stats['passed'] += 1
-                    print(f"✅ PASSED: {customer_name} - {identifier} - {credit_amount}")
-                else:
-                    # Check pikipiki records2 (SAV)
-                    customer_name_sav = lookup_customer_from_cache(identifier, lookup_type, phone_lookup_sav, plate_lookup_sav)
-                    
-                    if customer_name_sav:
-                        # Get customer ID for PASSED_SAV records
-                        customer_id = lookup_customer_id_from_cache(identifier, lookup_type, id_lookup_sav)
-                        
-                        last_passed_sav_id += 1
-                        passed_sav_row = [
-                            last_passed_sav_id,
-                            posting_date,
-                            BANK,
-                            details,
-                            credit_amount,
-                            identifier,
-                            customer_name_sav,
-                            ref_number or '',
-                            customer_id
-                        ]
-                        passed_sav_data.append(passed_sav_row)
-                        stats['passed_sav'] += 1
-                        print(f"✅ PASSED_SAV: {customer_name_sav} - {identifier} - {credit_amount} - ID: {customer_id}")
-                    else:
-                        # 🔥 Tier 3: Not in pikipiki records1 or records2.
-                        # If we have a phone, try IPHONE_RECORDS before giving up.
-                        iphone_matched = False
-                        if lookup_type == 'phone':
-                            norm = normalize_phone_iphone(identifier)
-                            iphone_customer = iphone_lookup.get(norm) if norm else None
-                            if iphone_customer:
-                                # Found in IPHONE_RECORDS → BANK_PASSED
-                                # Duplicate check first
-                                iphone_is_dup = (
-                                    (ref_number and ref_number in all_iphone_existing_refs)
-                                    or details in all_iphone_existing_messages
-                                )
-                                if not iphone_is_dup:
-                                    norm_phone = identifier if identifier.startswith('255') else f"255{norm}"
-                                    last_bank_passed_id += 1
-                                    bank_passed_row = [
-                                        last_bank_passed_id,
-                                        posting_date,
-                                        BANK,
-                                        details,
-                                        credit_amount,
-                                        norm_phone,
-                                        iphone_customer,
-                                        ref_number or '',
-                                        ''
-                                    ]
-                                    bank_passed_data.append(bank_passed_row)
-                                    stats['iphone_passed'] += 1
-                                    iphone_matched = True
-                                    print(f"  ✅ BANK_PASSED (via phone fallback): {iphone_customer} — {norm_phone} — {credit_amount}")
-
-                        if not iphone_matched:
-                            # ── FUZZY RESCUE attempt before giving up ─────────
-                            # Only for plate failures, not phone failures
-                            fuzzy_cands = []
-                            if lookup_type == 'plate':
-                                fuzzy_cands = try_fuzzy_rescue(details, plate_lookup,
-                                                               plate_lookup_sav, id_lookup_sav)
-
-                            if fuzzy_cands:
-                                if len(fuzzy_cands) == 1:
-                                    last_passed_id += 1
-                                    fuzzy_row = fuzzy_rescue_to_passed_row(
-                                        last_passed_id, posting_date, BANK, details,
-                                        credit_amount, ref_number, fuzzy_cands
-                                    )
-                                    fuzzy_passed_data.append(fuzzy_row)
-                                    stats['fuzzy_rescued'] += 1
-                                    print(f"  🟢 FUZZY→PASSED: 1 candidate, written clean (no '=')")
-                                else:
-                                    # Frank 2026-06-09: multi-candidate fuzzy → FAILED with '=' suggestions visible
-                                    last_failed_id += 1
-                                    failed_row = fuzzy_multi_to_failed_row(
-                                        last_failed_id, posting_date, BANK, details,
-                                        credit_amount, ref_number, fuzzy_cands
-                                    )
-                                    failed_data.append(failed_row)
-                                    stats['failed'] += 1
-                                    print(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands) → FAILED: {[c['plate'] for c in fuzzy_cands]}")
-                                continue  # move to next transaction
-
-                            # Truly not found anywhere — add to FAILED
-                            last_failed_id += 1
-                            reason = f"{lookup_type.upper()}({identifier}) not found"
-
-                            final_identifier = identifier
-                            if lookup_type == 'phone':
-                                if not identifier.startswith('255'):
-                                    if identifier.startswith('0'):
-                                        final_identifier = '255' + identifier[1:]
-                                    else:
-                                        final_identifier = '255' + identifier
-
-                            failed_row = [
-                                last_failed_id,
-                                posting_date,
-                                BANK,
-                                details,
-                                credit_amount,
-                                final_identifier,
-                                reason,
-                                ref_number or ''
-                            ]
-                            failed_data.append(failed_row)
-                            stats['failed'] += 1
-                            print(f"❌ FAILED: Customer not found for {final_identifier} (REF: {ref_number})")
-            else:
-                # Check for plate suggestions (original logic)
-                plate_suggestions = extract_plate_suggestions(details)
-
-                if plate_suggestions:
-                    # AUTOMATION GUARD: no human review anymore. If the description
-                    # produced more than one plate candidate we can't safely pick
-                    # one — push to FAILED with the candidate list visible.
-                    if len(plate_suggestions) > 1:
-                        last_failed_id += 1
-                        suggested_list = ', '.join(s['suggested'] for s in plate_suggestions)
-                        failed_data.append([
-                            last_failed_id, posting_date, BANK, details, credit_amount,
-                            suggested_list,
-                            f'Multiple plate suggestions ({len(plate_suggestions)})',
-                            ref_number or '',
-                        ])
-                        stats['failed'] += 1
-                        print(f"❌ FAILED (CRDB): multiple plate suggestions ({len(plate_suggestions)}) — {suggested_list}")
-                        continue
-                    for suggestion in plate_suggestions:
-                        suggested_plate = suggestion['suggested']
+        _job_progress(stage='writing')
 
-                        customer_name = lookup_customer_from_cache(suggested_plate, 'plate', phone_lookup, plate_lookup)
-                        customer_name_sav = None
-                        customer_id = ''
-                        
-                        if not customer_name:
-                            customer_name_sav = lookup_customer_from_cache(suggested_plate, 'plate', phone_lookup_sav, plate_lookup_sav)
-                            if customer_name_sav:
-                                customer_id = lookup_customer_id_from_cache(suggested_plate, 'plate', id_lookup_sav)
-                        
-                        if customer_name or customer_name_sav:
-                            needs_review_data.append({
-                                'posting_date': posting_date,
-                                'details': details,
-                                'credit_amount': credit_amount,
-                                'ref_number': ref_number or '',
-                                'original_text': suggestion['original'],
-                                'suggested_plate': suggested_plate,
-                                'customer_name': customer_name or customer_name_sav,
-                                'customer_id': customer_id,
-                                'target_sheet': 'PASSED' if customer_name else 'PASSED_SAV',
-                                'confidence': suggestion['confidence'],
-                                'reason': suggestion['reason'],
-                                'bank': BANK
-                            })
-                            stats['needs_review'] += 1
-                            print(f"🔍 NEEDS REVIEW: {suggestion['original']} -> {suggested_plate} -> {customer_name or customer_name_sav}")
-                            break
-                    
-                    if not needs_review_data or needs_review_data[-1]['details'] != details:
-                        # ── RESCUE before FAILED ──────────────────────────────
-                        rescue_plates = _rescue_find_plates(details)
-                        candidate_details = []
-                        if rescue_plates:
-                            for rp in rescue_plates:
-                                cn = lookup_customer_from_cache(rp, 'plate', phone_lookup, plate_lookup)
-                                cn_sav, cid = None, ''
-                                if not cn:
-                                    cn_sav = lookup_customer_from_cache(rp, 'plate', phone_lookup_sav, plate_lookup_sav)
-                                    if cn_sav:
-                                        cid = lookup_customer_id_from_cache(rp, 'plate', id_lookup_sav)
-                                candidate_details.append({'plate': rp, 'customer_name': cn or cn_sav or '', 'customer_id': cid, 'target_sheet': 'PASSED' if cn else ('PASSED_SAV' if cn_sav else None)})
-                        if 1 <= len(candidate_details) <= MAX_REVIEW_CANDIDATES:
-                            needs_review_data.append({'posting_date': posting_date, 'details': details, 'credit_amount': credit_amount, 'ref_number': ref_number or '', 'review_type': 'choose_plate', 'candidates': candidate_details, 'bank': BANK})
-                            stats['needs_review'] += 1
-                            print(f"🔍 RESCUE REVIEW (CRDB): {[c['plate'] for c in candidate_details]}")
-                        else:
-                            if len(candidate_details) > MAX_REVIEW_CANDIDATES:
-                                print(f"⏭️ Skipping {len(candidate_details)}-candidate review (too ambiguous): {[c['plate'] for c in candidate_details]}")
-                            # ── FUZZY RESCUE before FAILED ─────────────────────
-                            fuzzy_cands = try_fuzzy_rescue(details, plate_lookup,
-                                                           plate_lookup_sav, id_lookup_sav)
-                            if fuzzy_cands:
-                                if len(fuzzy_cands) == 1:
-                                    last_passed_id += 1
-                                    fuzzy_row = fuzzy_rescue_to_passed_row(
-                                        last_passed_id, posting_date, BANK, details,
-                                        credit_amount, ref_number, fuzzy_cands
-                                    )
-                                    fuzzy_passed_data.append(fuzzy_row)
-                                    stats['fuzzy_rescued'] += 1
-                                    print(f"  🟢 FUZZY→PASSED: 1 candidate, written clean (no '=')")
-                                else:
-                                    # Frank 2026-06-09: multi-candidate fuzzy → FAILED with '=' suggestions visible
-                                    last_failed_id += 1
-                                    failed_row = fuzzy_multi_to_failed_row(
-                                        last_failed_id, posting_date, BANK, details,
-                                        credit_amount, ref_number, fuzzy_cands
-                                    )
-                                    failed_data.append(failed_row)
-                                    stats['failed'] += 1
-                                    print(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands) → FAILED: {[c['plate'] for c in fuzzy_cands]}")
-                            else:
-                                # ── Depositor-name fallback (CRDB) ──
-                                # For descriptions like 'REF:… SIMUSSD FT FROM
-                                # DENIS RAYMOND TESHA TO FRANK N/A' where no
-                                # plate/phone was extractable, try matching
-                                # the depositor name against col D of pikipiki
-                                # records. If a row is found, resolve to that
-                                # row's (plate, customer_name) and route to
-                                # CRDB PASSED — normal BODA layout with
-                                # customer_name in col G, empty col I.
-                                dep_hit = _lookup_depositor(details, depositor_lookup)
-                                if dep_hit:
-                                    dep_plate, dep_customer, dep_name = dep_hit
-                                    last_passed_id += 1
-                                    passed_data.append([
-                                        last_passed_id,
-                                        posting_date,
-                                        BANK,
-                                        details,
-                                        credit_amount,
-                                        dep_plate,
-                                        dep_customer,
-                                        ref_number or '',
-                                        ''
-                                    ])
-                                    stats['passed'] += 1
-                                    print(f"✅ PASSED (via depositor {dep_name!r}): {dep_customer} - {dep_plate} - {credit_amount}")
-                                else:
-                                    last_failed_id += 1
-                                    failed_data.append([last_failed_id, posting_date, BANK, details, credit_amount, 'No phone/plate', 'No identifier', ref_number or ''])
-                                    stats['failed'] += 1
-                else:
-                    # ── RESCUE before FAILED ──────────────────────────────────
-                    rescue_plates = _rescue_find_plates(details)
-                    candidate_details = []
-                    if rescue_plates:
-                        for rp in rescue_plates:
-                            cn = lookup_customer_from_cache(rp, 'plate', phone_lookup, plate_lookup)
-                            cn_sav, cid = None, ''
-                            if not cn:
-                                cn_sav = lookup_customer_from_cache(rp, 'plate', phone_lookup_sav, plate_lookup_sav)
-                                if cn_sav:
-                                    cid = lookup_customer_id_from_cache(rp, 'plate', id_lookup_sav)
-                            candidate_details.append({'plate': rp, 'customer_name': cn or cn_sav or '', 'customer_id': cid, 'target_sheet': 'PASSED' if cn else ('PASSED_SAV' if cn_sav else None)})
-                    if 1 <= len(candidate_details) <= MAX_REVIEW_CANDIDATES:
-                        needs_review_data.append({'posting_date': posting_date, 'details': details, 'credit_amount': credit_amount, 'ref_number': ref_number or '', 'review_type': 'choose_plate', 'candidates': candidate_details, 'bank': BANK})
-                        stats['needs_review'] += 1
-                        print(f"🔍 RESCUE REVIEW (CRDB): {[c['plate'] for c in candidate_details]}")
-                    else:
-                        if len(candidate_details) > MAX_REVIEW_CANDIDATES:
-                            print(f"⏭️ Skipping {len(candidate_details)}-candidate review (too ambiguous): {[c['plate'] for c in candidate_details]}")
-                        # ── FUZZY RESCUE before FAILED ─────────────────────────
-                        fuzzy_cands = try_fuzzy_rescue(details, plate_lookup,
-                                                       plate_lookup_sav, id_lookup_sav)
-                        if fuzzy_cands:
-                            if len(fuzzy_cands) == 1:
-                                last_passed_id += 1
-                                fuzzy_row = fuzzy_rescue_to_passed_row(
-                                    last_passed_id, posting_date, BANK, details,
-                                    credit_amount, ref_number, fuzzy_cands
-                                )
-                                fuzzy_passed_data.append(fuzzy_row)
-                                stats['fuzzy_rescued'] += 1
-                                print(f"  🟢 FUZZY→PASSED: 1 candidate, written clean (no '=')")
-                            else:
-                                # Frank 2026-06-09: multi-candidate fuzzy → FAILED with '=' suggestions visible
-                                last_failed_id += 1
-                                failed_row = fuzzy_multi_to_failed_row(
-                                    last_failed_id, posting_date, BANK, details,
-                                    credit_amount, ref_number, fuzzy_cands
-                                )
-                                failed_data.append(failed_row)
-                                stats['failed'] += 1
-                                print(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands) → FAILED: {[c['plate'] for c in fuzzy_cands]}")
-                        else:
-                            # ── Depositor-name fallback (CRDB) ──
-                            # Same lookup as the identifier-not-found path:
-                            # 'REF:… SIMUSSD FT FROM DENIS RAYMOND TESHA TO
-                            # FRANK N/A' has no extractable plate/phone but
-                            # the depositor name may be registered against
-                            # a customer's plate on pikipiki records col D.
-                            dep_hit = _lookup_depositor(details, depositor_lookup)
-                            if dep_hit:
-                                dep_plate, dep_customer, dep_name = dep_hit
-                                last_passed_id += 1
-                                passed_data.append([
-                                    last_passed_id,
-                                    posting_date,
-                                    BANK,
-                                    details,
-                                    credit_amount,
-                                    dep_plate,
-                                    dep_customer,
-                                    ref_number or '',
-                                    ''
-                                ])
-                                stats['passed'] += 1
-                                print(f"✅ PASSED (via depositor {dep_name!r}): {dep_customer} - {dep_plate} - {credit_amount}")
-                            else:
-                                last_failed_id += 1
-                                failed_data.append([last_failed_id, posting_date, BANK, details, credit_amount, 'No phone/plate', 'No identifier', ref_number or ''])
-                                stats['failed'] += 1
-                                print(f"❌ FAILED: No phone/plate found in: {details[:80]} (REF: {ref_number})")
-        
         # ── Flush iPhone buckets immediately (no review flow needed) ──────────
         if bank_passed_data:
             print(f"\n📱 Writing {len(bank_passed_data)} rows to BANK_PASSED...")
@@ -2903,9 +4039,8 @@ def process_crdb_transactions(filepath, bank_label='CRDB'):
         # ── Flush fuzzy-rescued bucket → PASSED + green highlight ─────────────
         if fuzzy_passed_data:
             print(f"\n🟢 Writing {len(fuzzy_passed_data)} fuzzy-rescued rows to PASSED...")
-            # Capture next row number BEFORE appending so we can compute which rows to highlight
-            start_row = get_last_row_number(service, 'PASSED') + 1
-            if append_to_sheet(service, 'PASSED', fuzzy_passed_data):
+            start_row = append_to_sheet(service, 'PASSED', fuzzy_passed_data)
+            if start_row:
                 highlight_rows = list(range(start_row, start_row + len(fuzzy_passed_data)))
                 apply_green_highlight(service, 'PASSED', highlight_rows)
 
@@ -2971,111 +4106,70 @@ def process_crdb_transactions(filepath, bank_label='CRDB'):
         return jsonify({'error': str(e)}), 500
 
 
+def _nmb_excel_header(row):
+    """NMB Excel statement header row — the one carrying 'Description'."""
+    row_vals = [str(v).strip() for v in row if v is not None]
+    return 'Description' in row_vals or 'DESCRIPTION' in row_vals
+
+
 def read_nmb_excel(filepath):
     """
     Read an NMB statement in Excel (.xls/.xlsx) format and return
-    transactions_list — a list of dicts with keys:
-        Date, Description, Reference Number, Credit
-    Logic moved verbatim from process_nmb_transactions so the Excel
-    handling is unchanged. Returns a jsonify(...) error tuple on failure.
+    transactions_list — a list of BankTxn.
+    Logic moved from process_nmb_transactions; since 2026-10 the file is
+    streamed once through excel_stream instead of two pd.read_excel calls,
+    with the same values out. Returns a jsonify(...) error tuple on failure.
     """
     print("📊 Processing NMB Excel file...")
 
-    # ── Detect engine: xlrd for .xls, openpyxl for .xlsx ──────────────────
-    filepath_lower = filepath.lower()
-    if filepath_lower.endswith('.xls'):
-        engine = 'xlrd'
-    else:
-        engine = 'openpyxl'
-
-    print(f"📂 Reading with engine: {engine}")
-
     # ── Auto-detect header row ─────────────────────────────────────────────
     # NMB statements have variable metadata before the data table.
-    # We scan each row for the word 'Description' which always appears
-    # in the column header row. This works for both .xls and .xlsx.
-    HEADER_ROW = None
-    try:
-        scan_df = pd.read_excel(filepath, engine=engine, header=None, nrows=60)
-        for idx, row in scan_df.iterrows():
-            row_vals = [str(v).strip() for v in row if v is not None and str(v).strip() != 'nan']
-            if 'Description' in row_vals or 'DESCRIPTION' in row_vals:
-                HEADER_ROW = idx
-                print(f"✅ NMB header row auto-detected at row {idx} (0-based)")
-                break
-        del scan_df
-        gc.collect()
-    except Exception as scan_err:
-        print(f"⚠️ Header scan failed: {scan_err} — falling back to row 23")
-
-    if HEADER_ROW is None:
-        HEADER_ROW = 23
-        print(f"⚠️ Header not found in first 60 rows, using default row {HEADER_ROW}")
-
-    # ── Read only the data we need ─────────────────────────────────────────
-    # skiprows skips the metadata; header=0 uses the first row after skipping
-    # as column names. We keep only the 4 columns the processing loop reads.
-    try:
-        df = pd.read_excel(
-            filepath,
-            engine=engine,
-            skiprows=HEADER_ROW,
-            header=0,
-            dtype=str
-        )
-    except Exception as read_err:
-        return jsonify({'error': f'Failed to read NMB file: {str(read_err)}'}), 400
-
-    print(f"Columns found: {list(df.columns)}")
-
-    # NMB columns: Date, Value Date, Cheque Number/Control Number,
-    #              Description, Reference Number, Credit, Debit, Balance
-    required_columns = ['Date', 'Description', 'Credit']
-    missing = [col for col in required_columns if col not in df.columns]
-
-    if missing:
-        return jsonify({
-            'error': f'Missing required columns: {missing}. Found: {list(df.columns)}'
-        }), 400
-
-    # ── Convert Credit/Debit in-place, filter to credit rows only ─────────
-    df.loc[:, 'Credit'] = pd.to_numeric(
-        df['Credit'].str.replace(',', '', regex=False)
-                    .str.replace('TZS', '', regex=False)
-                    .str.strip(),
-        errors='coerce'
-    )
-
-    if 'Debit' in df.columns:
-        df.loc[:, 'Debit'] = pd.to_numeric(
-            df['Debit'].str.replace(',', '', regex=False)
-                       .str.replace('TZS', '', regex=False)
-                       .str.strip(),
-            errors='coerce'
-        )
-        mask = ((df['Credit'].notna()) & (df['Credit'] > 0) &
-                ((df['Debit'].isna()) | (df['Debit'] == 0)))
-    else:
-        mask = (df['Credit'].notna()) & (df['Credit'] > 0)
+    # We scan each row for the word 'Description' which always appears
+    # in the column header row. This works for both .xls and .xlsx
+    # (excel_stream picks openpyxl / xlrd from the file itself), and the
+    # data rows come from the same single pass — the file used to be read
+    # twice, once for this scan and again with skiprows.
+    try:
+        with excel_stream.open_table(filepath, _nmb_excel_header,
+                                     default_header=23) as (HEADER_ROW, columns, rows):
+            if _nmb_excel_header(columns):
+                print(f"✅ NMB header row auto-detected at row {HEADER_ROW} (0-based)")
+            else:
+                print(f"⚠️ Header not found in first 60 rows, using default row {HEADER_ROW}")
+            print(f"Columns found: {columns}")
 
-    # Keep only the 4 columns the loop actually uses before converting to dicts
-    keep_cols = [c for c in ['Date', 'Description', 'Reference Number', 'Credit'] if c in df.columns]
-    transactions_list = df.loc[mask, keep_cols].to_dict('records')
+            # NMB columns: Date, Value Date, Cheque Number/Control Number,
+            #              Description, Reference Number, Credit, Debit, Balance
+            required_columns = ['Date', 'Description', 'Credit']
+            missing = [col for col in required_columns if col not in columns]
 
-    # 🔥 Free full df and mask immediately — list-of-dicts is all we need
-    del df, mask
-    gc.collect()
+            if missing:
+                return jsonify({
+                    'error': f'Missing required columns: {missing}. Found: {columns}'
+                }), 400
+
+            # ── Convert Credit/Debit, keep credit rows only ────────────────
+            transactions_list = []
+            for rec in excel_stream.project(
+                    rows, columns, ['Date', 'Description', 'Reference Number', 'Credit', 'Debit']):
+                credit = _excel_amount(rec['Credit'], strip_tzs=True)
+                debit = _excel_amount(rec.get('Debit'), strip_tzs=True)
+                if credit is None or credit <= 0 or (debit is not None and debit != 0):
+                    continue
+                transactions_list.append(BankTxn.of(
+                    rec['Date'], rec['Description'], credit, rec.get('Reference Number')))
+    except Exception as read_err:
+        return jsonify({'error': f'Failed to read NMB file: {str(read_err)}'}), 400
 
-    print(f"✅ NMB Excel: Found {len(transactions_list)} credit transactions, DataFrame freed")
+    print(f"✅ NMB Excel: Found {len(transactions_list)} credit transactions")
     return transactions_list
 
 
 def read_nmb_csv(filepath):
     """
     🔥 NEW: Read an NMB statement in CSV format and return transactions_list —
-    the SAME structure read_nmb_excel returns (list of dicts with keys:
-    Date, Description, Reference Number, Credit) so the identical NMB
-    processing pipeline is reused unchanged.
+    the SAME structure read_nmb_excel returns (list of BankTxn) so the
+    identical NMB processing pipeline is reused unchanged.
 
     NMB CSV layout (downloaded from NMB online banking):
         row 0: <account number>, <account holder name>
@@ -3214,21 +4308,33 @@ def read_nmb_csv(filepath):
     else:
         mask = (df['Credit'].notna()) & (df['Credit'] > 0)
 
-    keep_cols = [c for c in ['Date', 'Description', 'Reference Number', 'Credit'] if c in df.columns]
-    transactions_list = df.loc[mask, keep_cols].to_dict('records')
+    credit_rows = df.loc[mask]
+    refs = (credit_rows['Reference Number'].tolist()
+            if 'Reference Number' in credit_rows.columns else [None] * len(credit_rows))
+    transactions_list = [
+        BankTxn.of(d, desc, cr, ref)
+        for d, desc, cr, ref in zip(credit_rows['Date'].tolist(),
+                                    credit_rows['Description'].tolist(),
+                                    credit_rows['Credit'].tolist(), refs)
+    ]
 
-    del df, mask
+    del df, mask, credit_rows, refs
     gc.collect()
 
     print(f"✅ NMB CSV: Found {len(transactions_list)} credit transactions, DataFrame freed")
     return transactions_list
 
 
+def _nmb_pdf_header(row):
+    """NMB 9-column header row — page 1 only (learned-layout anchor)."""
+    return len(row) == 9 and (row[0] or '').strip().lower() == 'book date'
+
+
 def read_nmb_pdf(filepath):
     """
     🔥 NEW: Read an NMB statement in PDF format and return transactions_list —
-    the SAME structure read_nmb_csv / read_nmb_excel return (list of dicts with
-    keys: Date, Description, Reference Number, Credit) so the identical NMB
+    the SAME structure read_nmb_csv / read_nmb_excel return (list of BankTxn)
+    so the identical NMB
     processing pipeline (duplicate guards, pikipiki/iPhone lookups, rescue,
     fuzzy, review flow) is reused unchanged.
 
@@ -3255,71 +4361,66 @@ def read_nmb_pdf(filepath):
     transactions_list = []
 
     try:
-        with pdfplumber.open(filepath) as pdf:
-            print(f"  📖 {len(pdf.pages)} page(s)")
-            for page in pdf.pages:
-                for table in page.extract_tables() or []:
-                    # Only the 9-column transaction table interests us.
-                    if not table or len(table[0]) != 9:
+        print(f"  📖 {pdf_stream.page_count(filepath)} page(s)")
+        for _page_num, tables in pdf_stream.iter_page_tables(
+                filepath, header_match=_nmb_pdf_header):
+            for table in tables:
+                # Only the 9-column transaction table interests us.
+                if not table or len(table[0]) != 9:
+                    continue
+
+                for row in table:
+                    if not row or len(row) != 9:
                         continue
 
-                    for row in table:
-                        if not row or len(row) != 9:
-                            continue
+                    book_date = (row[0] or '').strip()
+                    narration = (row[3] or '').strip()
+                    xref      = (row[4] or '').strip()
+                    debit_s   = (row[6] or '').strip()
+                    credit_s  = (row[7] or '').strip()
 
-                        book_date = (row[0] or '').strip()
-                        narration = (row[3] or '').strip()
-                        xref      = (row[4] or '').strip()
-                        debit_s   = (row[6] or '').strip()
-                        credit_s  = (row[7] or '').strip()
+                    # Skip the column header (only on page 1)
+                    if book_date.lower() == 'book date':
+                        continue
+                    # Skip OPENING / CLOSING BALANCE rows
+                    if 'BALANCE' in narration.upper():
+                        continue
+                    # No strict date filter — NMB occasionally writes
+                    # dates like '9-Jul-26' (unpadded day, 2-digit year)
+                    # that don't match the standard dd/mm/yyyy pattern.
+                    # We accept whatever's there; downstream parsers
+                    # handle the format variations.
+
+                    # Normalise Book Date to match the CSV reader's output
+                    # (DD-Mon-YYYY, e.g. '10-Jun-2026'). The shared NMB
+                    # pipeline now sees an identical fallback-date format
+                    # regardless of input source.
+                    try:
+                        book_date = datetime.strptime(
+                            book_date, '%d/%m/%Y'
+                        ).strftime('%d-%b-%Y')
+                    except ValueError:
+                        pass  # leave unchanged if format unexpected
 
-                        # Skip the column header (only on page 1)
-                        if book_date.lower() == 'book date':
-                            continue
-                        # Skip OPENING / CLOSING BALANCE rows
-                        if 'BALANCE' in narration.upper():
-                            continue
-                        # No strict date filter — NMB occasionally writes
-                        # dates like '9-Jul-26' (unpadded day, 2-digit year)
-                        # that don't match the standard dd/mm/yyyy pattern.
-                        # We accept whatever's there; downstream parsers
-                        # handle the format variations.
-
-                        # Normalise Book Date to match the CSV reader's output
-                        # (DD-Mon-YYYY, e.g. '10-Jun-2026'). The shared NMB
-                        # pipeline now sees an identical fallback-date format
-                        # regardless of input source.
-                        try:
-                            book_date = datetime.strptime(
-                                book_date, '%d/%m/%Y'
-                            ).strftime('%d-%b-%Y')
-                        except ValueError:
-                            pass  # leave unchanged if format unexpected
+                    try:
+                        credit = float(credit_s.replace(',', '').replace(' ', ''))
+                    except ValueError:
+                        credit = 0.0
+                    try:
+                        debit = float(debit_s.replace(',', '').replace(' ', ''))
+                    except ValueError:
+                        debit = 0.0
 
-                        try:
-                            credit = float(credit_s.replace(',', '').replace(' ', ''))
-                        except ValueError:
-                            credit = 0.0
-                        try:
-                            debit = float(debit_s.replace(',', '').replace(' ', ''))
-                        except ValueError:
-                            debit = 0.0
+                    # Same credit-only filter as the Excel/CSV readers
+                    if credit <= 0 or debit > 0:
+                        continue
 
-                        # Same credit-only filter as the Excel/CSV readers
-                        if credit <= 0 or debit > 0:
-                            continue
+                    # Flatten newlines: Narration uses spaces, Xref joins
+                    # tightly (the break sits inside a 16-char ref string).
+                    desc = re.sub(r'\s*\n\s*', ' ', narration)
+                    ref  = re.sub(r'\s*\n\s*', '', xref)
 
-                        # Flatten newlines: Narration uses spaces, Xref joins
-                        # tightly (the break sits inside a 16-char ref string).
-                        desc = re.sub(r'\s*\n\s*', ' ', narration)
-                        ref  = re.sub(r'\s*\n\s*', '', xref)
-
-                        transactions_list.append({
-                            'Date': book_date,
-                            'Description': desc,
-                            'Reference Number': ref,
-                            'Credit': credit,
-                        })
+                    transactions_list.append(BankTxn.of(book_date, desc, credit, ref))
     except Exception as read_err:
         import traceback
         traceback.print_exc()
@@ -3342,21 +4443,31 @@ _TRX_ID_RX = re.compile(r'Trx\s*ID\s*(PS\d+)', re.IGNORECASE)
 def extract_trx_id(text):
     """Stable 'PS…' agency Trx ID from an NMB description, or None (transfers/
     TIPS carry none — those keep deduping on ref + description as before)."""
-    if not text or pd.isna(text):
+    parsed = parse_description(text)
+    if parsed.empty:
         return None
-    m = _TRX_ID_RX.search(str(text))
-    return m.group(1).upper() if m else None
+    return parsed.trx_id
 
 
+@pipeline_metrics.traced('existing_trx_ids')
 def load_nmb_existing_trx_ids(service):
-    """Trx IDs already present in the NMB money tabs, read from the description
-    column (D). These tabs are NMB-only (NOT the 30k-row CRDB PASSED), so this is
-    cheap. On a read error we print and skip that tab, leaving the ref-based
-    dedup as the floor — we never silently drop the guard."""
+    """Trx IDs already present in the NMB money tabs, from the description
+    column (D) — served from the ref index's messages when it is usable, else
+    read from the sheet. On a read error we print and skip that tab, leaving
+    the ref-based dedup as the floor — we never silently drop the guard."""
     tabs = ['PASSED_NMB', 'PASSED_SAV_NMB', 'FAILED_NMB',
             'PASSED_SAV_NMB_OLD', 'FAILED_NMB_OLD', 'BANK_PASSED', 'BANK_FAILED']
     trx = set()
     for logical in tabs:
+        # The ref index holds every column-D message of the tab and was
+        # synced by this run's get_existing_refs() — no Sheets read at all.
+        indexed = _refs_from_index(service, logical, refs_only=False)
+        if indexed is not None:
+            for message in indexed[1]:
+                t = extract_trx_id(message)
+                if t:
+                    trx.add(t)
+            continue
         try:
             sid, tab = _resolve_sheet(logical)
             res = service.spreadsheets().values().get(
@@ -3373,6 +4484,422 @@ def load_nmb_existing_trx_ids(service):
     return trx
 
 
+def _classify_nmb_row(row, ctx):
+    """One NMB statement row → _RowResult. Body of the old per-row loop in
+    process_nmb_transactions — see _classify_crdb_row."""
+    (phone_lookup, plate_lookup, depositor_lookup,
+     phone_lookup_sav, plate_lookup_sav, id_lookup_sav,
+     iphone_lookup) = ctx['lookups']
+    all_existing_refs            = ctx['all_existing_refs']
+    all_existing_messages        = ctx['all_existing_messages']
+    all_existing_trx_ids         = ctx['all_existing_trx_ids']
+    all_iphone_existing_refs     = ctx['all_iphone_existing_refs']
+    all_iphone_existing_messages = ctx['all_iphone_existing_messages']
+    res = _RowResult()
+
+    date_col    = row.date
+    description = row.description
+    parsed      = parse_description(description)   # shared by every extractor below
+    credit_amount = row.credit
+
+    # 🔥 Extract date+time from within the description message.
+    # Fallback to the Date column (date only, no time) if not found.
+    extracted_dt = extract_nmb_datetime(parsed, date_col)
+    date = extracted_dt if extracted_dt else date_col
+
+    # NMB has a dedicated Reference Number column
+    ref_number = row.ref
+
+    # 🔥 Stable Trx ID — invariant across NMB ref-format changes.
+    trx_id = extract_trx_id(parsed)
+
+    # ── Duplicate check ────────────────────────────────────────────────
+    # description-based dedup only runs when description is non-empty,
+    # otherwise every no-description row would collide on the empty
+    # string with any prior no-description row and get silently
+    # dropped. Ref-based dedup still guards those rows.
+    is_duplicate = False
+    if ref_number and ref_number in all_existing_refs:
+        is_duplicate = True
+        res.bump('skipped')
+    elif trx_id and trx_id in all_existing_trx_ids:
+        # Same agency transaction under a re-formatted reference — skip.
+        is_duplicate = True
+        res.bump('skipped')
+    elif description and description in all_existing_messages:
+        is_duplicate = True
+        res.bump('skipped')
+
+    if is_duplicate:
+        return res
+
+    # ── No-description NMB row → straight to FAILED_NMB with UNKNOWN
+    # placeholders. Value Date, Transaction Reference and Credit Amount
+    # are still present on the CSV row; SMS rescue can pick this up when
+    # the customer texts the ref + plate. Without this branch these
+    # rows would fall through the whole extractor stack and land in
+    # FAILED with 'No identifier', which reads as an ingestion error
+    # rather than an SMS-rescue candidate.
+    if not description.strip():
+        res.put('failed_nmb', [
+            None,
+            date,
+            'NMB',
+            'UNKNOWN',
+            credit_amount,
+            'UNKNOWN',
+            'UNKNOWN',
+            ref_number,
+        ])
+        res.bump('failed_nmb')
+        _row_log(f"⚠️ FAILED_NMB (no description) — ref={ref_number} amt={credit_amount} → SMS-rescue candidate")
+        return res
+
+    # ══════════════════════════════════════════════════════════════════
+    # 🔥 NEW: NMB iPhone Channel — intercept BEFORE normal processing
+    # Same logic as CRDB iPhone but with 'NMB' in bank column
+    # ══════════════════════════════════════════════════════════════════
+    if is_iphone_transaction(parsed):
+        _row_log(f"\n📱 NMB iPhone transaction detected: {description[:80]}")
+
+        # Duplicate check within iPhone sheets
+        iphone_is_dup = False
+        if ref_number and ref_number in all_iphone_existing_refs:
+            iphone_is_dup = True
+        elif description in all_iphone_existing_messages:
+            iphone_is_dup = True
+
+        if iphone_is_dup:
+            res.bump('iphone_skipped')
+            res.bump('skipped')
+            _row_log(f"  ⏭️ NMB iPhone duplicate — skipped")
+            return res  # Do NOT fall through to normal flow
+
+        # Look up customer in IPHONE_RECORDS
+        customer_name, raw_phone = lookup_iphone_customer(parsed, iphone_lookup)
+
+        # Determine display identifier (0XX format, matching IPHONE_RECORDS)
+        if raw_phone:
+            norm = normalize_phone_iphone(raw_phone)
+            display_phone = f"0{norm}" if norm else raw_phone
+        else:
+            display_phone = 'No phone'
+
+        if customer_name:
+            # ✅ Match found → BANK_PASSED
+            bank_passed_row = [
+                None,
+                date,
+                'NMB',          # 🔥 NMB not CRDB
+                description,
+                credit_amount,
+                display_phone,
+                customer_name,
+                ref_number or '',
+                ''
+            ]
+            res.put('bank_passed', bank_passed_row)
+            res.bump('iphone_passed')
+            _row_log(f"  ✅ BANK_PASSED (NMB): {customer_name} — {display_phone} — {credit_amount}")
+        else:
+            # ❌ No match → BANK_FAILED
+            reason = f"PHONE({display_phone}) not found in IPHONE_RECORDS"
+            bank_failed_row = [
+                None,
+                date,
+                'NMB',          # 🔥 NMB not CRDB
+                description,
+                credit_amount,
+                display_phone,
+                reason,
+                ref_number or ''
+            ]
+            res.put('bank_failed', bank_failed_row)
+            res.bump('iphone_failed')
+            _row_log(f"  ❌ BANK_FAILED (NMB): {reason}")
+
+        # ⚠️ CRITICAL: continue — do NOT run normal pikipiki logic
+        return res
+    # ══════════════════════════════════════════════════════════════════
+    # End NMB iPhone Channel
+    # ══════════════════════════════════════════════════════════════════
+
+    # ── Extract identifiers ────────────────────────────────────────────
+    phone = extract_phone_number(parsed)
+    plate = extract_plate_number(parsed)
+
+    identifier  = None
+    lookup_type = None
+
+    if phone:
+        identifier  = phone
+        lookup_type = 'phone'
+        _row_log(f"Found phone: {phone} in: {description[:80]}")
+    elif plate:
+        identifier  = plate
+        lookup_type = 'plate'
+        _row_log(f"Found plate: {plate} in: {description[:80]}")
+
+    if identifier and lookup_type:
+        # ── Tier 1: pikipiki records → PASSED ─────────────────────────
+        customer_name = lookup_customer_from_cache(
+            identifier, lookup_type, phone_lookup, plate_lookup
+        )
+
+        if customer_name:
+            passed_row = [
+                None,
+                date,
+                'NMB',          # bank column
+                description,
+                credit_amount,
+                identifier,
+                customer_name,
+                ref_number,
+                ''              # no customer_id for records-1 customers
+            ]
+            res.put('passed', passed_row)
+            res.bump('passed')
+            _row_log(f"✅ PASSED (NMB): {customer_name} - {identifier} - {credit_amount}")
+
+        else:
+            # ── Tier 2: pikipiki records2 → PASSED_SAV_NMB ────────────
+            customer_name_sav = lookup_customer_from_cache(
+                identifier, lookup_type, phone_lookup_sav, plate_lookup_sav
+            )
+
+            if customer_name_sav:
+                customer_id = lookup_customer_id_from_cache(
+                    identifier, lookup_type, id_lookup_sav
+                )
+                passed_nmb_row = [
+                    None,
+                    date,
+                    'NMB',
+                    description,
+                    credit_amount,
+                    identifier,
+                    customer_name_sav,
+                    ref_number,
+                    customer_id
+                ]
+                res.put('passed_nmb', passed_nmb_row)
+                res.bump('passed_sav_nmb')
+                _row_log(f"✅ PASSED_SAV_NMB: {customer_name_sav} - {identifier} - {credit_amount} - ID: {customer_id}")
+
+            else:
+                # ── Tier 3: not in pikipiki records1 or records2 ──────
+                # If we have a phone, try IPHONE_RECORDS before giving up
+                iphone_matched = False
+                if lookup_type == 'phone':
+                    norm = normalize_phone_iphone(identifier)
+                    iphone_customer = iphone_lookup.get(norm) if norm else None
+                    if iphone_customer:
+                        iphone_is_dup = (
+                            (ref_number and ref_number in all_iphone_existing_refs)
+                            or description in all_iphone_existing_messages
+                        )
+                        if not iphone_is_dup:
+                            display_phone = f"0{norm}"
+                            bank_passed_row = [
+                                None,
+                                date,
+                                'NMB',
+                                description,
+                                credit_amount,
+                                display_phone,
+                                iphone_customer,
+                                ref_number or '',
+                                ''
+                            ]
+                            res.put('bank_passed', bank_passed_row)
+                            res.bump('iphone_passed')
+                            iphone_matched = True
+                            _row_log(f"  ✅ BANK_PASSED (NMB phone fallback): {iphone_customer} — {display_phone} — {credit_amount}")
+
+                if not iphone_matched:
+                    # ── FUZZY RESCUE attempt before giving up ─────────
+                    # Only for plate failures, not phone failures
+                    fuzzy_cands = []
+                    if lookup_type == 'plate':
+                        fuzzy_cands = try_fuzzy_rescue(parsed, plate_lookup,
+                                                       plate_lookup_sav, id_lookup_sav)
+
+                    if fuzzy_cands:
+                        if len(fuzzy_cands) == 1:
+                            fuzzy_row = fuzzy_rescue_to_passed_row(
+                                None, date, 'NMB', description,
+                                credit_amount, ref_number, fuzzy_cands
+                            )
+                            res.put('fuzzy_passed', fuzzy_row)
+                            res.bump('fuzzy_rescued')
+                            _row_log(f"  🟢 FUZZY→PASSED (NMB): 1 candidate, written clean (no '=')")
+                        else:
+                            # Frank 2026-06-09: multi-candidate fuzzy → FAILED_NMB with '=' suggestions visible
+                            failed_row = fuzzy_multi_to_failed_row(
+                                None, date, 'NMB', description,
+                                credit_amount, ref_number, fuzzy_cands
+                            )
+                            res.put('failed_nmb', failed_row)
+                            res.bump('failed_nmb')
+                            _row_log(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands, NMB) → FAILED_NMB: {[c['plate'] for c in fuzzy_cands]}")
+                        return res  # move to next transaction
+
+                    # Truly not found anywhere → FAILED_NMB
+                    reason = f"{lookup_type.upper()}({identifier}) not found"
+
+                    final_identifier = identifier
+                    if lookup_type == 'phone' and not identifier.startswith('255'):
+                        if identifier.startswith('0'):
+                            final_identifier = '255' + identifier[1:]
+                        else:
+                            final_identifier = '255' + identifier
+
+                    failed_nmb_row = [
+                        None,
+                        date,
+                        'NMB',
+                        description,
+                        credit_amount,
+                        final_identifier,
+                        reason,
+                        ref_number
+                    ]
+                    res.put('failed_nmb', failed_nmb_row)
+                    res.bump('failed_nmb')
+                    _row_log(f"❌ FAILED_NMB: Customer not found for {final_identifier} (REF: {ref_number})")
+
+    else:
+        # ── No clean identifier — try plate suggestions (review flow) ──
+        plate_suggestions = extract_plate_suggestions(parsed)
+
+        if plate_suggestions:
+            # AUTOMATION GUARD: no human review anymore. Multiple plate
+            # candidates → push to FAILED_NMB with the candidate list.
+            if len(plate_suggestions) > 1:
+                suggested_list = ', '.join(s['suggested'] for s in plate_suggestions)
+                res.put('failed_nmb', [
+                    None, date, 'NMB', description, credit_amount,
+                    suggested_list,
+                    f'Multiple plate suggestions ({len(plate_suggestions)})',
+                    ref_number,
+                ])
+                res.bump('failed_nmb')
+                _row_log(f"❌ FAILED_NMB: multiple plate suggestions ({len(plate_suggestions)}) — {suggested_list}")
+                return res
+            added_to_review = False
+            for suggestion in plate_suggestions:
+                suggested_plate = suggestion['suggested']
+                customer_name = lookup_customer_from_cache(suggested_plate, 'plate', phone_lookup, plate_lookup)
+                customer_name_sav = None
+                customer_id = ''
+                if not customer_name:
+                    customer_name_sav = lookup_customer_from_cache(suggested_plate, 'plate', phone_lookup_sav, plate_lookup_sav)
+                    if customer_name_sav:
+                        customer_id = lookup_customer_id_from_cache(suggested_plate, 'plate', id_lookup_sav)
+                if customer_name or customer_name_sav:
+                    target_sheet = 'PASSED' if customer_name else 'PASSED_SAV_NMB'
+                    res.send_to_review({'posting_date': date, 'details': description, 'credit_amount': credit_amount, 'ref_number': ref_number, 'original_text': suggestion['original'], 'suggested_plate': suggested_plate, 'customer_name': customer_name or customer_name_sav, 'customer_id': customer_id, 'target_sheet': target_sheet, 'confidence': suggestion['confidence'], 'reason': suggestion['reason'], 'bank': 'NMB'})
+                    res.bump('needs_review')
+                    added_to_review = True
+                    _row_log(f"🔍 NMB NEEDS REVIEW: {suggestion['original']} -> {suggested_plate} -> {customer_name or customer_name_sav}")
+                    break
+
+            if not added_to_review:
+                # ── RESCUE before FAILED ──────────────────────────────
+                rescue_plates = _rescue_find_plates(parsed)
+                candidate_details = []
+                if rescue_plates:
+                    for rp in rescue_plates:
+                        cn = lookup_customer_from_cache(rp, 'plate', phone_lookup, plate_lookup)
+                        cn_sav, cid = None, ''
+                        if not cn:
+                            cn_sav = lookup_customer_from_cache(rp, 'plate', phone_lookup_sav, plate_lookup_sav)
+                            if cn_sav:
+                                cid = lookup_customer_id_from_cache(rp, 'plate', id_lookup_sav)
+                        candidate_details.append({'plate': rp, 'customer_name': cn or cn_sav or '', 'customer_id': cid, 'target_sheet': 'PASSED' if cn else ('PASSED_SAV_NMB' if cn_sav else None)})
+                if 1 <= len(candidate_details) <= MAX_REVIEW_CANDIDATES:
+                    res.send_to_review({'posting_date': date, 'details': description, 'credit_amount': credit_amount, 'ref_number': ref_number, 'review_type': 'choose_plate', 'candidates': candidate_details, 'bank': 'NMB'})
+                    res.bump('needs_review')
+                    _row_log(f"🔍 RESCUE REVIEW (NMB): {[c['plate'] for c in candidate_details]}")
+                else:
+                    if len(candidate_details) > MAX_REVIEW_CANDIDATES:
+                        _row_log(f"⏭️ Skipping {len(candidate_details)}-candidate review (NMB, too ambiguous): {[c['plate'] for c in candidate_details]}")
+                    # ── FUZZY RESCUE before FAILED ─────────────────────
+                    fuzzy_cands = try_fuzzy_rescue(parsed, plate_lookup,
+                                                   plate_lookup_sav, id_lookup_sav)
+                    if fuzzy_cands:
+                        if len(fuzzy_cands) == 1:
+                            fuzzy_row = fuzzy_rescue_to_passed_row(
+                                None, date, 'NMB', description,
+                                credit_amount, ref_number, fuzzy_cands
+                            )
+                            res.put('fuzzy_passed', fuzzy_row)
+                            res.bump('fuzzy_rescued')
+                            _row_log(f"  🟢 FUZZY→PASSED (NMB): 1 candidate, written clean (no '=')")
+                        else:
+                            # Frank 2026-06-09: multi-candidate fuzzy → FAILED_NMB with '=' suggestions visible
+                            failed_row = fuzzy_multi_to_failed_row(
+                                None, date, 'NMB', description,
+                                credit_amount, ref_number, fuzzy_cands
+                            )
+                            res.put('failed_nmb', failed_row)
+                            res.bump('failed_nmb')
+                            _row_log(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands, NMB) → FAILED_NMB: {[c['plate'] for c in fuzzy_cands]}")
+                    else:
+                        res.put('failed_nmb', [None, date, 'NMB', description, credit_amount, 'No phone/plate', 'No identifier', ref_number])
+                        res.bump('failed_nmb')
+        else:
+            # ── RESCUE before FAILED ──────────────────────────────────
+            rescue_plates = _rescue_find_plates(parsed)
+            candidate_details = []
+            if rescue_plates:
+                for rp in rescue_plates:
+                    cn = lookup_customer_from_cache(rp, 'plate', phone_lookup, plate_lookup)
+                    cn_sav, cid = None, ''
+                    if not cn:
+                        cn_sav = lookup_customer_from_cache(rp, 'plate', phone_lookup_sav, plate_lookup_sav)
+                        if cn_sav:
+                            cid = lookup_customer_id_from_cache(rp, 'plate', id_lookup_sav)
+                    candidate_details.append({'plate': rp, 'customer_name': cn or cn_sav or '', 'customer_id': cid, 'target_sheet': 'PASSED' if cn else ('PASSED_SAV_NMB' if cn_sav else None)})
+            if 1 <= len(candidate_details) <= MAX_REVIEW_CANDIDATES:
+                res.send_to_review({'posting_date': date, 'details': description, 'credit_amount': credit_amount, 'ref_number': ref_number, 'review_type': 'choose_plate', 'candidates': candidate_details, 'bank': 'NMB'})
+                res.bump('needs_review')
+                _row_log(f"🔍 RESCUE REVIEW (NMB): {[c['plate'] for c in candidate_details]}")
+            else:
+                if len(candidate_details) > MAX_REVIEW_CANDIDATES:
+                    _row_log(f"⏭️ Skipping {len(candidate_details)}-candidate review (NMB, too ambiguous): {[c['plate'] for c in candidate_details]}")
+                # ── FUZZY RESCUE before FAILED ─────────────────────────
+                fuzzy_cands = try_fuzzy_rescue(parsed, plate_lookup,
+                                               plate_lookup_sav, id_lookup_sav)
+                if fuzzy_cands:
+                    if len(fuzzy_cands) == 1:
+                        fuzzy_row = fuzzy_rescue_to_passed_row(
+                            None, date, 'NMB', description,
+                            credit_amount, ref_number, fuzzy_cands
+                        )
+                        res.put('fuzzy_passed', fuzzy_row)
+                        res.bump('fuzzy_rescued')
+                        _row_log(f"  🟢 FUZZY→PASSED (NMB): 1 candidate, written clean (no '=')")
+                    else:
+                        # Frank 2026-06-09: multi-candidate fuzzy → FAILED_NMB with '=' suggestions visible
+                        failed_row = fuzzy_multi_to_failed_row(
+                            None, date, 'NMB', description,
+                            credit_amount, ref_number, fuzzy_cands
+                        )
+                        res.put('failed_nmb', failed_row)
+                        res.bump('failed_nmb')
+                        _row_log(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands, NMB) → FAILED_NMB: {[c['plate'] for c in fuzzy_cands]}")
+                else:
+                    res.put('failed_nmb', [None, date, 'NMB', description, credit_amount, 'No phone/plate', 'No identifier', ref_number])
+                    res.bump('failed_nmb')
+                    _row_log(f"❌ FAILED_NMB: No phone/plate found in: {description[:80]} (REF: {ref_number})")
+    return res
+
+
+
+@pipeline_metrics.instrument('nmb')
+@_sheet_snapshot_scope
 def process_nmb_transactions(filepath):
     """
     🔥 UPDATED: Process NMB bank statement with 3-tier routing:
@@ -3384,10 +4911,9 @@ def process_nmb_transactions(filepath):
     try:
         # 🔥 NEW: Dispatch by file type. CSV → read_nmb_csv(), PDF → read_nmb_pdf(),
         #         Excel → read_nmb_excel(); ALL THREE return the same
-        #         transactions_list of dicts (keys: Date, Description,
-        #         Reference Number, Credit) so the identical processing pipeline
-        #         below — duplicate guards, lookups, rescue, fuzzy, review — is
-        #         reused unchanged.
+        #         transactions_list of BankTxn so the identical processing
+        #         pipeline below — duplicate guards, lookups, rescue, fuzzy,
+        #         review — is reused unchanged.
         fp_lower = filepath.lower()
         if fp_lower.endswith('.csv'):
             transactions_list = read_nmb_csv(filepath)
@@ -3399,6 +4925,7 @@ def process_nmb_transactions(filepath):
         # read_* helpers return a jsonify(...) error tuple on failure — propagate it
         if not isinstance(transactions_list, list):
             return transactions_list
+        _job_progress(stage='loading_customers', rows_read=len(transactions_list))
 
         # Initialize Google Sheets service
         service = get_google_service()
@@ -3411,6 +4938,9 @@ def process_nmb_transactions(filepath):
             (phone_lookup, plate_lookup, depositor_lookup,
              phone_lookup_sav, plate_lookup_sav, id_lookup_sav,
              iphone_lookup) = load_customers_dispatch(service)
+            _job_progress(stage='dedup', customers_loaded=_lookup_key_total(
+                (phone_lookup, plate_lookup, depositor_lookup, phone_lookup_sav,
+                 plate_lookup_sav, id_lookup_sav, iphone_lookup)))
         except CustomerLoadError as e:
             # Abort BEFORE any row is classified. The uploaded file is left in
             # place, nothing is appended to PASSED/FAILED, and the next puller
@@ -3423,6 +4953,8 @@ def process_nmb_transactions(filepath):
                 'retryable': True,
             }), 503
 
+        load_sheet_snapshot(service, _NMB_SNAPSHOT_TABS)
+
         # ── Duplicate-check refs across ALL relevant tabs ──────────────────────
         # Check BOTH old sheet (PASSED_SHEET_ID) AND new NMB sheet to cover
         # all existing records — old data stays on old sheet.
@@ -3523,423 +5055,31 @@ def process_nmb_transactions(filepath):
             'fuzzy_rescued': 0,    # 🔥 NEW
         }
 
-        for row in transactions_list:
-            date_col    = str(row.get('Date', ''))
-            description = str(row.get('Description', ''))
-            credit_amount = row.get('Credit', 0)
-
-            # 🔥 Extract date+time from within the description message.
-            # Fallback to the Date column (date only, no time) if not found.
-            extracted_dt = extract_nmb_datetime(description, date_col)
-            date = extracted_dt if extracted_dt else date_col
-
-            # NMB has a dedicated Reference Number column
-            ref_number = (
-                str(row.get('Reference Number', '')).strip()
-                if 'Reference Number' in row and pd.notna(row.get('Reference Number'))
-                else ''
-            )
-
-            # 🔥 Stable Trx ID — invariant across NMB ref-format changes.
-            trx_id = extract_trx_id(description)
-
-            # ── Duplicate check ────────────────────────────────────────────────
-            # description-based dedup only runs when description is non-empty,
-            # otherwise every no-description row would collide on the empty
-            # string with any prior no-description row and get silently
-            # dropped. Ref-based dedup still guards those rows.
-            is_duplicate = False
-            if ref_number and ref_number in all_existing_refs:
-                is_duplicate = True
-                stats['skipped'] += 1
-            elif trx_id and trx_id in all_existing_trx_ids:
-                # Same agency transaction under a re-formatted reference — skip.
-                is_duplicate = True
-                stats['skipped'] += 1
-            elif description and description in all_existing_messages:
-                is_duplicate = True
-                stats['skipped'] += 1
-
-            if is_duplicate:
-                continue
-
-            # ── No-description NMB row → straight to FAILED_NMB with UNKNOWN
-            # placeholders. Value Date, Transaction Reference and Credit Amount
-            # are still present on the CSV row; SMS rescue can pick this up when
-            # the customer texts the ref + plate. Without this branch these
-            # rows would fall through the whole extractor stack and land in
-            # FAILED with 'No identifier', which reads as an ingestion error
-            # rather than an SMS-rescue candidate.
-            if not description.strip():
-                last_failed_nmb_id += 1
-                failed_nmb_data.append([
-                    last_failed_nmb_id,
-                    date,
-                    'NMB',
-                    'UNKNOWN',
-                    credit_amount,
-                    'UNKNOWN',
-                    'UNKNOWN',
-                    ref_number,
-                ])
-                stats['failed_nmb'] += 1
-                print(f"⚠️ FAILED_NMB (no description) — ref={ref_number} amt={credit_amount} → SMS-rescue candidate")
-                continue
-
-            # ══════════════════════════════════════════════════════════════════
-            # 🔥 NEW: NMB iPhone Channel — intercept BEFORE normal processing
-            # Same logic as CRDB iPhone but with 'NMB' in bank column
-            # ══════════════════════════════════════════════════════════════════
-            if is_iphone_transaction(description):
-                print(f"\n📱 NMB iPhone transaction detected: {description[:80]}")
-
-                # Duplicate check within iPhone sheets
-                iphone_is_dup = False
-                if ref_number and ref_number in all_iphone_existing_refs:
-                    iphone_is_dup = True
-                elif description in all_iphone_existing_messages:
-                    iphone_is_dup = True
-
-                if iphone_is_dup:
-                    stats['iphone_skipped'] += 1
-                    stats['skipped'] += 1
-                    print(f"  ⏭️ NMB iPhone duplicate — skipped")
-                    continue  # Do NOT fall through to normal flow
-
-                # Look up customer in IPHONE_RECORDS
-                customer_name, raw_phone = lookup_iphone_customer(description, iphone_lookup)
-
-                # Determine display identifier (0XX format, matching IPHONE_RECORDS)
-                if raw_phone:
-                    norm = normalize_phone_iphone(raw_phone)
-                    display_phone = f"0{norm}" if norm else raw_phone
-                else:
-                    display_phone = 'No phone'
-
-                if customer_name:
-                    # ✅ Match found → BANK_PASSED
-                    last_bank_passed_id += 1
-                    bank_passed_row = [
-                        last_bank_passed_id,
-                        date,
-                        'NMB',          # 🔥 NMB not CRDB
-                        description,
-                        credit_amount,
-                        display_phone,
-                        customer_name,
-                        ref_number or '',
-                        ''
-                    ]
-                    bank_passed_data.append(bank_passed_row)
-                    stats['iphone_passed'] += 1
-                    print(f"  ✅ BANK_PASSED (NMB): {customer_name} — {display_phone} — {credit_amount}")
-                else:
-                    # ❌ No match → BANK_FAILED
-                    last_bank_failed_id += 1
-                    reason = f"PHONE({display_phone}) not found in IPHONE_RECORDS"
-                    bank_failed_row = [
-                        last_bank_failed_id,
-                        date,
-                        'NMB',          # 🔥 NMB not CRDB
-                        description,
-                        credit_amount,
-                        display_phone,
-                        reason,
-                        ref_number or ''
-                    ]
-                    bank_failed_data.append(bank_failed_row)
-                    stats['iphone_failed'] += 1
-                    print(f"  ❌ BANK_FAILED (NMB): {reason}")
-
-                # ⚠️ CRITICAL: continue — do NOT run normal pikipiki logic
-                continue
-            # ══════════════════════════════════════════════════════════════════
-            # End NMB iPhone Channel
-            # ══════════════════════════════════════════════════════════════════
-
-            # ── Extract identifiers ────────────────────────────────────────────
-            phone = extract_phone_number(description)
-            plate = extract_plate_number(description)
-
-            identifier  = None
-            lookup_type = None
-
-            if phone:
-                identifier  = phone
-                lookup_type = 'phone'
-                print(f"Found phone: {phone} in: {description[:80]}")
-            elif plate:
-                identifier  = plate
-                lookup_type = 'plate'
-                print(f"Found plate: {plate} in: {description[:80]}")
-
-            if identifier and lookup_type:
-                # ── Tier 1: pikipiki records → PASSED ─────────────────────────
-                customer_name = lookup_customer_from_cache(
-                    identifier, lookup_type, phone_lookup, plate_lookup
-                )
-
-                if customer_name:
-                    last_passed_id += 1
-                    passed_row = [
-                        last_passed_id,
-                        date,
-                        'NMB',          # bank column
-                        description,
-                        credit_amount,
-                        identifier,
-                        customer_name,
-                        ref_number,
-                        ''              # no customer_id for records-1 customers
-                    ]
-                    passed_data.append(passed_row)
-                    stats['passed'] += 1
-                    print(f"✅ PASSED (NMB): {customer_name} - {identifier} - {credit_amount}")
-
-                else:
-                    # ── Tier 2: pikipiki records2 → PASSED_SAV_NMB ────────────
-                    customer_name_sav = lookup_customer_from_cache(
-                        identifier, lookup_type, phone_lookup_sav, plate_lookup_sav
-                    )
-
-                    if customer_name_sav:
-                        customer_id = lookup_customer_id_from_cache(
-                            identifier, lookup_type, id_lookup_sav
-                        )
-                        last_passed_nmb_id += 1
-                        passed_nmb_row = [
-                            last_passed_nmb_id,
-                            date,
-                            'NMB',
-                            description,
-                            credit_amount,
-                            identifier,
-                            customer_name_sav,
-                            ref_number,
-                            customer_id
-                        ]
-                        passed_nmb_data.append(passed_nmb_row)
-                        stats['passed_sav_nmb'] += 1
-                        print(f"✅ PASSED_SAV_NMB: {customer_name_sav} - {identifier} - {credit_amount} - ID: {customer_id}")
-
-                    else:
-                        # ── Tier 3: not in pikipiki records1 or records2 ──────
-                        # If we have a phone, try IPHONE_RECORDS before giving up
-                        iphone_matched = False
-                        if lookup_type == 'phone':
-                            norm = normalize_phone_iphone(identifier)
-                            iphone_customer = iphone_lookup.get(norm) if norm else None
-                            if iphone_customer:
-                                iphone_is_dup = (
-                                    (ref_number and ref_number in all_iphone_existing_refs)
-                                    or description in all_iphone_existing_messages
-                                )
-                                if not iphone_is_dup:
-                                    display_phone = f"0{norm}"
-                                    last_bank_passed_id += 1
-                                    bank_passed_row = [
-                                        last_bank_passed_id,
-                                        date,
-                                        'NMB',
-                                        description,
-                                        credit_amount,
-                                        display_phone,
-                                        iphone_customer,
-                                        ref_number or '',
-                                        ''
-                                    ]
-                                    bank_passed_data.append(bank_passed_row)
-                                    stats['iphone_passed'] += 1
-                                    iphone_matched = True
-                                    print(f"  ✅ BANK_PASSED (NMB phone fallback): {iphone_customer} — {display_phone} — {credit_amount}")
-
-                        if not iphone_matched:
-                            # ── FUZZY RESCUE attempt before giving up ─────────
-                            # Only for plate failures, not phone failures
-                            fuzzy_cands = []
-                            if lookup_type == 'plate':
-                                fuzzy_cands = try_fuzzy_rescue(description, plate_lookup,
-                                                               plate_lookup_sav, id_lookup_sav)
-
-                            if fuzzy_cands:
-                                if len(fuzzy_cands) == 1:
-                                    last_passed_id += 1
-                                    fuzzy_row = fuzzy_rescue_to_passed_row(
-                                        last_passed_id, date, 'NMB', description,
-                                        credit_amount, ref_number, fuzzy_cands
-                                    )
-                                    fuzzy_passed_data.append(fuzzy_row)
-                                    stats['fuzzy_rescued'] += 1
-                                    print(f"  🟢 FUZZY→PASSED (NMB): 1 candidate, written clean (no '=')")
-                                else:
-                                    # Frank 2026-06-09: multi-candidate fuzzy → FAILED_NMB with '=' suggestions visible
-                                    last_failed_nmb_id += 1
-                                    failed_row = fuzzy_multi_to_failed_row(
-                                        last_failed_nmb_id, date, 'NMB', description,
-                                        credit_amount, ref_number, fuzzy_cands
-                                    )
-                                    failed_nmb_data.append(failed_row)
-                                    stats['failed_nmb'] += 1
-                                    print(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands, NMB) → FAILED_NMB: {[c['plate'] for c in fuzzy_cands]}")
-                                continue  # move to next transaction
-
-                            # Truly not found anywhere → FAILED_NMB
-                            last_failed_nmb_id += 1
-                            reason = f"{lookup_type.upper()}({identifier}) not found"
-
-                            final_identifier = identifier
-                            if lookup_type == 'phone' and not identifier.startswith('255'):
-                                if identifier.startswith('0'):
-                                    final_identifier = '255' + identifier[1:]
-                                else:
-                                    final_identifier = '255' + identifier
-
-                            failed_nmb_row = [
-                                last_failed_nmb_id,
-                                date,
-                                'NMB',
-                                description,
-                                credit_amount,
-                                final_identifier,
-                                reason,
-                                ref_number
-                            ]
-                            failed_nmb_data.append(failed_nmb_row)
-                            stats['failed_nmb'] += 1
-                            print(f"❌ FAILED_NMB: Customer not found for {final_identifier} (REF: {ref_number})")
-
-            else:
-                # ── No clean identifier — try plate suggestions (review flow) ──
-                plate_suggestions = extract_plate_suggestions(description)
-
-                if plate_suggestions:
-                    # AUTOMATION GUARD: no human review anymore. Multiple plate
-                    # candidates → push to FAILED_NMB with the candidate list.
-                    if len(plate_suggestions) > 1:
-                        last_failed_nmb_id += 1
-                        suggested_list = ', '.join(s['suggested'] for s in plate_suggestions)
-                        failed_nmb_data.append([
-                            last_failed_nmb_id, date, 'NMB', description, credit_amount,
-                            suggested_list,
-                            f'Multiple plate suggestions ({len(plate_suggestions)})',
-                            ref_number,
-                        ])
-                        stats['failed_nmb'] += 1
-                        print(f"❌ FAILED_NMB: multiple plate suggestions ({len(plate_suggestions)}) — {suggested_list}")
-                        continue
-                    added_to_review = False
-                    for suggestion in plate_suggestions:
-                        suggested_plate = suggestion['suggested']
-                        customer_name = lookup_customer_from_cache(suggested_plate, 'plate', phone_lookup, plate_lookup)
-                        customer_name_sav = None
-                        customer_id = ''
-                        if not customer_name:
-                            customer_name_sav = lookup_customer_from_cache(suggested_plate, 'plate', phone_lookup_sav, plate_lookup_sav)
-                            if customer_name_sav:
-                                customer_id = lookup_customer_id_from_cache(suggested_plate, 'plate', id_lookup_sav)
-                        if customer_name or customer_name_sav:
-                            target_sheet = 'PASSED' if customer_name else 'PASSED_SAV_NMB'
-                            needs_review_data.append({'posting_date': date, 'details': description, 'credit_amount': credit_amount, 'ref_number': ref_number, 'original_text': suggestion['original'], 'suggested_plate': suggested_plate, 'customer_name': customer_name or customer_name_sav, 'customer_id': customer_id, 'target_sheet': target_sheet, 'confidence': suggestion['confidence'], 'reason': suggestion['reason'], 'bank': 'NMB'})
-                            stats['needs_review'] += 1
-                            added_to_review = True
-                            print(f"🔍 NMB NEEDS REVIEW: {suggestion['original']} -> {suggested_plate} -> {customer_name or customer_name_sav}")
-                            break
-
-                    if not added_to_review:
-                        # ── RESCUE before FAILED ──────────────────────────────
-                        rescue_plates = _rescue_find_plates(description)
-                        candidate_details = []
-                        if rescue_plates:
-                            for rp in rescue_plates:
-                                cn = lookup_customer_from_cache(rp, 'plate', phone_lookup, plate_lookup)
-                                cn_sav, cid = None, ''
-                                if not cn:
-                                    cn_sav = lookup_customer_from_cache(rp, 'plate', phone_lookup_sav, plate_lookup_sav)
-                                    if cn_sav:
-                                        cid = lookup_customer_id_from_cache(rp, 'plate', id_lookup_sav)
-                                candidate_details.append({'plate': rp, 'customer_name': cn or cn_sav or '', 'customer_id': cid, 'target_sheet': 'PASSED' if cn else ('PASSED_SAV_NMB' if cn_sav else None)})
-                        if 1 <= len(candidate_details) <= MAX_REVIEW_CANDIDATES:
-                            needs_review_data.append({'posting_date': date, 'details': description, 'credit_amount': credit_amount, 'ref_number': ref_number, 'review_type': 'choose_plate', 'candidates': candidate_details, 'bank': 'NMB'})
-                            stats['needs_review'] += 1
-                            print(f"🔍 RESCUE REVIEW (NMB): {[c['plate'] for c in candidate_details]}")
-                        else:
-                            if len(candidate_details) > MAX_REVIEW_CANDIDATES:
-                                print(f"⏭️ Skipping {len(candidate_details)}-candidate review (NMB, too ambiguous): {[c['plate'] for c in candidate_details]}")
-                            # ── FUZZY RESCUE before FAILED ─────────────────────
-                            fuzzy_cands = try_fuzzy_rescue(description, plate_lookup,
-                                                           plate_lookup_sav, id_lookup_sav)
-                            if fuzzy_cands:
-                                if len(fuzzy_cands) == 1:
-                                    last_passed_id += 1
-                                    fuzzy_row = fuzzy_rescue_to_passed_row(
-                                        last_passed_id, date, 'NMB', description,
-                                        credit_amount, ref_number, fuzzy_cands
-                                    )
-                                    fuzzy_passed_data.append(fuzzy_row)
-                                    stats['fuzzy_rescued'] += 1
-                                    print(f"  🟢 FUZZY→PASSED (NMB): 1 candidate, written clean (no '=')")
-                                else:
-                                    # Frank 2026-06-09: multi-candidate fuzzy → FAILED_NMB with '=' suggestions visible
-                                    last_failed_nmb_id += 1
-                                    failed_row = fuzzy_multi_to_failed_row(
-                                        last_failed_nmb_id, date, 'NMB', description,
-                                        credit_amount, ref_number, fuzzy_cands
-                                    )
-                                    failed_nmb_data.append(failed_row)
-                                    stats['failed_nmb'] += 1
-                                    print(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands, NMB) → FAILED_NMB: {[c['plate'] for c in fuzzy_cands]}")
-                            else:
-                                last_failed_nmb_id += 1
-                                failed_nmb_data.append([last_failed_nmb_id, date, 'NMB', description, credit_amount, 'No phone/plate', 'No identifier', ref_number])
-                                stats['failed_nmb'] += 1
-                else:
-                    # ── RESCUE before FAILED ──────────────────────────────────
-                    rescue_plates = _rescue_find_plates(description)
-                    candidate_details = []
-                    if rescue_plates:
-                        for rp in rescue_plates:
-                            cn = lookup_customer_from_cache(rp, 'plate', phone_lookup, plate_lookup)
-                            cn_sav, cid = None, ''
-                            if not cn:
-                                cn_sav = lookup_customer_from_cache(rp, 'plate', phone_lookup_sav, plate_lookup_sav)
-                                if cn_sav:
-                                    cid = lookup_customer_id_from_cache(rp, 'plate', id_lookup_sav)
-                            candidate_details.append({'plate': rp, 'customer_name': cn or cn_sav or '', 'customer_id': cid, 'target_sheet': 'PASSED' if cn else ('PASSED_SAV_NMB' if cn_sav else None)})
-                    if 1 <= len(candidate_details) <= MAX_REVIEW_CANDIDATES:
-                        needs_review_data.append({'posting_date': date, 'details': description, 'credit_amount': credit_amount, 'ref_number': ref_number, 'review_type': 'choose_plate', 'candidates': candidate_details, 'bank': 'NMB'})
-                        stats['needs_review'] += 1
-                        print(f"🔍 RESCUE REVIEW (NMB): {[c['plate'] for c in candidate_details]}")
-                    else:
-                        if len(candidate_details) > MAX_REVIEW_CANDIDATES:
-                            print(f"⏭️ Skipping {len(candidate_details)}-candidate review (NMB, too ambiguous): {[c['plate'] for c in candidate_details]}")
-                        # ── FUZZY RESCUE before FAILED ─────────────────────────
-                        fuzzy_cands = try_fuzzy_rescue(description, plate_lookup,
-                                                       plate_lookup_sav, id_lookup_sav)
-                        if fuzzy_cands:
-                            if len(fuzzy_cands) == 1:
-                                last_passed_id += 1
-                                fuzzy_row = fuzzy_rescue_to_passed_row(
-                                    last_passed_id, date, 'NMB', description,
-                                    credit_amount, ref_number, fuzzy_cands
-                                )
-                                fuzzy_passed_data.append(fuzzy_row)
-                                stats['fuzzy_rescued'] += 1
-                                print(f"  🟢 FUZZY→PASSED (NMB): 1 candidate, written clean (no '=')")
-                            else:
-                                # Frank 2026-06-09: multi-candidate fuzzy → FAILED_NMB with '=' suggestions visible
-                                last_failed_nmb_id += 1
-                                failed_row = fuzzy_multi_to_failed_row(
-                                    last_failed_nmb_id, date, 'NMB', description,
-                                    credit_amount, ref_number, fuzzy_cands
-                                )
-                                failed_nmb_data.append(failed_row)
-                                stats['failed_nmb'] += 1
-                                print(f"  ⚠️ FUZZY MULTI ({len(fuzzy_cands)} cands, NMB) → FAILED_NMB: {[c['plate'] for c in fuzzy_cands]}")
-                        else:
-                            last_failed_nmb_id += 1
-                            failed_nmb_data.append([last_failed_nmb_id, date, 'NMB', description, credit_amount, 'No phone/plate', 'No identifier', ref_number])
-                            stats['failed_nmb'] += 1
-                            print(f"❌ FAILED_NMB: No phone/plate found in: {description[:80]} (REF: {ref_number})")
+        _job_progress(stage='classifying', rows_classified=0)
+        _fuzzy_index_for(plate_lookup, plate_lookup_sav, id_lookup_sav)   # built once for the serial path
+        results = _classify_rows(_classify_nmb_row, transactions_list, {
+            'lookups': (phone_lookup, plate_lookup, depositor_lookup,
+                        phone_lookup_sav, plate_lookup_sav, id_lookup_sav,
+                        iphone_lookup),
+            'all_existing_refs': all_existing_refs,
+            'all_existing_messages': all_existing_messages,
+            'all_existing_trx_ids': all_existing_trx_ids,
+            'all_iphone_existing_refs': all_iphone_existing_refs,
+            'all_iphone_existing_messages': all_iphone_existing_messages,
+        })
+        last_ids = {'passed': last_passed_id, 'passed_nmb': last_passed_nmb_id,
+                    'failed_nmb': last_failed_nmb_id, 'bank_passed': last_bank_passed_id,
+                    'bank_failed': last_bank_failed_id}
+        _merge_row_results(results, stats, needs_review_data, last_ids, {
+            'passed':       (passed_data, 'passed'),
+            'fuzzy_passed': (fuzzy_passed_data, 'passed'),
+            'passed_nmb':   (passed_nmb_data, 'passed_nmb'),
+            'failed_nmb':   (failed_nmb_data, 'failed_nmb'),
+            'bank_passed':  (bank_passed_data, 'bank_passed'),
+            'bank_failed':  (bank_failed_data, 'bank_failed'),
+        })
+        last_failed_nmb_id = last_ids['failed_nmb']
+        del results
 
         # ── AUTOMATION 2026-05-31: convert review rows to FAILED_NMB and proceed.
         # See CRDB path comment above. Auto-converting prevents the entire
@@ -3967,6 +5107,7 @@ def process_nmb_transactions(filepath):
             needs_review_data = []
 
         # ── No reviews needed — write directly ─────────────────────────────
+        _job_progress(stage='writing')
 
         # 🔥 NEW: Flush iPhone buckets first (same sheets as CRDB)
         if bank_passed_data:
@@ -3980,8 +5121,8 @@ def process_nmb_transactions(filepath):
         # 🔥 NEW: Flush fuzzy-rescued bucket → PASSED_NMB + green highlight
         if fuzzy_passed_data:
             print(f"\n🟢 Writing {len(fuzzy_passed_data)} NMB fuzzy-rescued rows to PASSED_NMB...")
-            start_row = get_last_row_number(service, 'PASSED_NMB') + 1
-            if append_to_sheet(service, 'PASSED_NMB', fuzzy_passed_data):
+            start_row = append_to_sheet(service, 'PASSED_NMB', fuzzy_passed_data)
+            if start_row:
                 highlight_rows = list(range(start_row, start_row + len(fuzzy_passed_data)))
                 apply_green_highlight(service, 'PASSED_NMB', highlight_rows)
 
@@ -4367,7 +5508,7 @@ def _wipe_worker():
     try:
         while True:
             # Grab the next batch of ids to delete
-            r = requests.get(
+            r = supabase_client.main().get(
                 f'{url}/rest/v1/transactions?select=id&order=id.asc&limit=20000',
                 headers=headers, timeout=60,
             )
@@ -4376,7 +5517,7 @@ def _wipe_worker():
             if not batch:
                 break
             id_list = ','.join(str(i) for i in batch)
-            d = requests.delete(
+            d = supabase_client.main().delete(
                 f'{url}/rest/v1/transactions?id=in.({id_list})',
                 headers=headers, timeout=120,
             )
@@ -4541,23 +5682,59 @@ def admin_daily_totals():
     days = min(60, max(1, int(request.args.get('days', 10))))
     from_day = (datetime.utcnow() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
 
-    passed_tabs = (
-        'CRDBPASSED,CRDBSAVCOM,NMBPASSED,NMBSAVCOM,'
-        'IPHONEPASSED,BODAILIYOPATA,IPHONEILIYOPATA'
+    passed_tabs = ('CRDBPASSED', 'CRDBSAVCOM', 'NMBPASSED', 'NMBSAVCOM',
+                   'IPHONEPASSED', 'BODAILIYOPATA', 'IPHONEILIYOPATA')
+    # Bucket by source_tab (not bank) so PASSED vs SAVCOM stay separate.
+    # The GROUP BY runs in Postgres (scripts/004_daily_totals_rpc.sql) — one
+    # call, a few hundred rows back. Until that function is deployed the
+    # old client-side paged sum below still answers.
+    buckets: dict = {}
+    total_rows = 0
+    r = supabase_client.main().post(
+        f'{url}/rest/v1/rpc/daily_totals',
+        headers={'apikey': key, 'Authorization': f'Bearer {key}',
+                 'Content-Type': 'application/json'},
+        json={'from_day': from_day, 'tabs': list(passed_tabs)},
+        timeout=60,
     )
+    if r.status_code == 200:
+        for row in r.json():
+            st = row.get('source_tab') or 'UNKNOWN'
+            d  = row.get('transaction_day') or 'null'
+            buckets.setdefault(st, {}).setdefault(d, 0.0)
+            buckets[st][d] += float(row.get('total') or 0)
+            total_rows += int(row.get('row_count') or 0)
+        source = 'rpc'
+    elif r.status_code == 404:
+        print("⚠️ daily-totals: rpc/daily_totals missing — paging client-side")
+        buckets, total_rows, err = _daily_totals_paged(url, key, from_day, passed_tabs)
+        if err:
+            return jsonify({'error': err}), 500
+        source = 'paged'
+    else:
+        return jsonify({'error': r.text[:400]}), 500
+    for b in buckets:
+        for d in buckets[b]:
+            buckets[b][d] = round(buckets[b][d], 2)
+    return jsonify({'from': from_day, 'buckets': buckets, 'total_rows': total_rows,
+                    'source': source})
+
+
+def _daily_totals_paged(url, key, from_day, passed_tabs):
+    """Pre-RPC path: page every matching row and sum in Python.
+    Returns (buckets, total_rows, error_text_or_None)."""
     # PostgREST caps a single response at ~1000 rows, so page through with
     # Range headers until we've read every matching row for the window.
-    # Bucket by source_tab (not bank) so PASSED vs SAVCOM stay separate.
     buckets: dict = {}
     total_rows = 0
     page = 1000
     offset = 0
     while True:
-        r = requests.get(
+        r = supabase_client.main().get(
             f'{url}/rest/v1/transactions'
             f'?select=source_tab,transaction_day,credit_amount'
             f'&transaction_day=gte.{from_day}'
-            f'&source_tab=in.({passed_tabs})'
+            f'&source_tab=in.({",".join(passed_tabs)})'
             f'&order=id.asc',
             headers={'apikey': key, 'Authorization': f'Bearer {key}',
                      'Range-Unit': 'items',
@@ -4565,7 +5742,7 @@ def admin_daily_totals():
             timeout=60,
         )
         if r.status_code not in (200, 206):
-            return jsonify({'error': r.text[:400]}), 500
+            return buckets, total_rows, r.text[:400]
         chunk = r.json()
         if not chunk:
             break
@@ -4579,10 +5756,7 @@ def admin_daily_totals():
         if len(chunk) < page:
             break
         offset += page
-    for b in buckets:
-        for d in buckets[b]:
-            buckets[b][d] = round(buckets[b][d], 2)
-    return jsonify({'from': from_day, 'buckets': buckets, 'total_rows': total_rows})
+    return buckets, total_rows, None
 
 
 @app.route('/admin/tx-sample', methods=['GET'])
@@ -4594,7 +5768,7 @@ def admin_tx_sample():
     url = os.environ.get('SUPABASE_URL', '').rstrip('/')
     key = os.environ.get('SUPABASE_SERVICE_KEY', '')
     n = min(20, max(1, int(request.args.get('n', 5))))
-    r = requests.get(
+    r = supabase_client.main().get(
         f'{url}/rest/v1/transactions'
         f'?select=id,bank,source_tab,transaction_date,transaction_day,'
         f'ref_number,description,created_at'
@@ -4622,30 +5796,69 @@ def admin_count():
     out = {}
     for t in ('transactions', 'customers', 'dedup_alerts', 'sms_events'):
         try:
-            r = requests.get(f'{url}/rest/v1/{t}?select=id', headers=hdr, timeout=30)
+            r = supabase_client.main().get(f'{url}/rest/v1/{t}?select=id', headers=hdr, timeout=30)
             out[t] = int(r.headers.get('Content-Range', '0-0/0').split('/')[-1] or 0)
         except Exception as e:
             out[t] = f'error: {str(e)[:80]}'
     return jsonify(out)
 
 
+DUP_REFS_PAGE = 20000   # distinct refs per rpc/dup_refs call in ?full=1 mode
+
+
 @app.route('/admin/dup-refs', methods=['GET'])
 def admin_dup_refs():
     """Token-gated: find any ref_number that appears more than once in
     transactions. If the partial UNIQUE index is doing its job the count
-    should be 0; anything > 0 means the dedup leaked."""
+    should be 0; anything > 0 means the dedup leaked.
+
+    The GROUP BY runs in Postgres (scripts/005_dup_refs_rpc.sql).
+    ?full=1 scans the whole table history instead of the last N days, one
+    keyset page of refs per call: pass each response's `after_ref` back as
+    ?after_ref= until it is null (see _dup_refs_full_page)."""
     if not _migration_token_ok():
         return jsonify({'error': 'unauthorized'}), 401
     url = os.environ.get('SUPABASE_URL', '').rstrip('/')
     key = os.environ.get('SUPABASE_SERVICE_KEY', '')
-    # Page through the last day of transactions and tally client-side.
+    hdr = {'apikey': key, 'Authorization': f'Bearer {key}',
+           'Content-Type': 'application/json'}
+    if request.args.get('full') == '1':
+        return _dup_refs_full_page(url, hdr)
+
     days = min(30, max(1, int(request.args.get('days', 3))))
     from_day = (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d')
-    hdr = {'apikey': key, 'Authorization': f'Bearer {key}'}
+    r = supabase_client.main().post(
+        f'{url}/rest/v1/rpc/dup_refs', headers=hdr,
+        json={'from_day': from_day}, timeout=45,
+    )
+    if r.status_code == 200:
+        res = r.json() or {}
+        scanned = int(res.get('refs_scanned') or 0)
+        dupes = res.get('dupes') or {}
+    elif r.status_code == 404:
+        print("⚠️ dup-refs: rpc/dup_refs missing — tallying client-side")
+        scanned, dupes, err = _dup_refs_paged(url, hdr, from_day)
+        if err:
+            return jsonify({'error': err}), 500
+    else:
+        return jsonify({'error': r.text[:400]}), 500
+    total_rows_dupe = sum(len(rs) - 1 for rs in dupes.values())
+    return jsonify({
+        'from_day': from_day,
+        'unique_refs_scanned': scanned,
+        'refs_with_duplicates': len(dupes),
+        'extra_rows_from_dupes': total_rows_dupe,
+        'sample': dict(list(dupes.items())[:10]),
+    })
+
+
+def _dup_refs_paged(url, hdr, from_day):
+    """Pre-RPC path: page the window and tally client-side.
+    Returns (unique_refs_scanned, dupes, error_text_or_None)."""
     refs = {}
     offset = 0
     while True:
-        r = requests.get(
+        r = supabase_client.main().get(
             f'{url}/rest/v1/transactions'
             f'?select=id,ref_number,transaction_day,source_tab,credit_amount'
             f'&transaction_day=gte.{from_day}'
@@ -4655,7 +5868,7 @@ def admin_dup_refs():
             timeout=45,
         )
         if r.status_code not in (200, 206):
-            return jsonify({'error': r.text[:400]}), 500
+            return 0, {}, r.text[:400]
         chunk = r.json()
         if not chunk:
             break
@@ -4668,36 +5881,66 @@ def admin_dup_refs():
             break
         offset += 1000
     dupes = {ref: rows for ref, rows in refs.items() if len(rows) > 1}
-    total_rows_dupe = sum(len(rs) - 1 for rs in dupes.values())
+    return len(refs), dupes, None
+
+
+def _dup_refs_full_page(url, hdr):
+    """One page of the whole-history scan: rpc/dup_refs over the next
+    ?max_refs (default and cap DUP_REFS_PAGE) distinct refs after
+    ?after_ref. The client drives the walk — it passes the returned
+    `after_ref` back until that comes back null — so every request stays
+    one bounded RPC call, however big transactions gets. (Looping inside
+    one request got killed at gunicorn's 300s timeout on a big table.)"""
+    after = request.args.get('after_ref') or None
+    try:
+        max_refs = min(DUP_REFS_PAGE, max(1, int(request.args.get('max_refs', DUP_REFS_PAGE))))
+    except ValueError:
+        return jsonify({'error': 'max_refs must be an integer'}), 400
+    try:
+        r = supabase_client.main().post(
+            f'{url}/rest/v1/rpc/dup_refs', headers=hdr,
+            json={'after_ref': after, 'max_refs': max_refs},
+            timeout=120,
+        )
+    except requests.RequestException as e:
+        return jsonify({'error': str(e)[:400], 'after_ref': after}), 502
+    if r.status_code != 200:
+        return jsonify({'error': r.text[:400], 'after_ref': after}), 500
+    res = r.json() or {}
+    dupes = res.get('dupes') or {}
+    scanned = int(res.get('refs_scanned') or 0)
+    done = scanned < max_refs or not res.get('last_ref')
     return jsonify({
-        'from_day': from_day,
-        'unique_refs_scanned': len(refs),
+        'from_ref': after,
+        'unique_refs_scanned': scanned,
         'refs_with_duplicates': len(dupes),
-        'extra_rows_from_dupes': total_rows_dupe,
-        'sample': dict(list(dupes.items())[:10]),
+        'extra_rows_from_dupes': sum(len(rs) - 1 for rs in dupes.values()),
+        'dupes': dupes,
+        'after_ref': None if done else res['last_ref'],
     })
 
 
 @app.route('/admin/sms-retry-fails', methods=['POST'])
 def admin_sms_retry_fails():
-    """Token-gated: replay every sms_events row that ended in
-    ref_not_found through /api/sms-rescue internally. With the
-    ref_number lookup now case-insensitive, uppercase-typed refs
-    that missed before will match and rescue this time.
-
-    Returns a tally of what changed. The dedup guard on _sms_event_insert
-    keeps a re-tried row from stacking a second sms_events entry when
-    the outcome doesn't change; a successful rescue writes a fresh
-    row with outcome='rescued'."""
+    """Token-gated: retry every sms_events row that ended in
+    ref_not_found (and plate_not_in_records with
+    ?include_plate_unknown=1) — the customer's SMS often lands before
+    the puller has captured the transaction.
+
+    Runs in-process through sms_rescue_engine: the stored extracted_ref /
+    extracted_plate of every event (re-extracted from the body for rows
+    logged without them) are resolved against `transactions` in bulk, and
+    only the events whose ref now exists get per-event work. It used to
+    replay each event through the Flask test client (5+ HTTP calls each)
+    in one blocking request. Events whose ref is still missing aren't
+    logged again; a rescue writes a fresh row with outcome='rescued'.
+
+    Returns a tally of what changed."""
     if not _migration_token_ok():
         return jsonify({'error': 'unauthorized'}), 401
-    url = os.environ.get('SUPABASE_URL', '').rstrip('/')
-    key = os.environ.get('SUPABASE_SERVICE_KEY', '')
-    hdr = {'apikey': key, 'Authorization': f'Bearer {key}'}
     outcomes = ['ref_not_found']
     if request.args.get('include_plate_unknown') == '1':
         outcomes.append('plate_not_in_records')
-    filt = ','.join(outcomes)
 
     # Age-window filter: retry events aged min_age_min..max_age_min. Default
     # window is 5 min → 24 h: gives the puller time to catch up before we
@@ -4710,65 +5953,27 @@ def admin_sms_retry_fails():
         max_age_min = int(request.args.get('max_age_min', '1440'))
     except ValueError:
         return jsonify({'error': 'min_age_min/max_age_min must be integers'}), 400
-    now_utc = datetime.utcnow()
-    upper = (now_utc - timedelta(minutes=min_age_min)).isoformat() + 'Z'
-    lower = (now_utc - timedelta(minutes=max_age_min)).isoformat() + 'Z'
-
-    r = requests.get(
-        f'{url}/rest/v1/sms_events'
-        f'?select=id,sender,body,received_at,processed_at'
-        f'&outcome=in.({filt})'
-        f'&processed_at=gte.{lower}'
-        f'&processed_at=lte.{upper}'
-        f'&order=processed_at.asc',
-        headers={**hdr, 'Range-Unit': 'items', 'Range': '0-1999'},
-        timeout=45,
-    )
-    if r.status_code not in (200, 206):
-        return jsonify({'error': r.text[:400]}), 500
-    rows = r.json()
 
-    from flask import current_app
-    tally = {'checked': 0, 'rescued': 0, 'still_ref_not_found': 0,
-             'plate_unknown': 0, 'already_rescued': 0,
-             'ref_in_passed': 0, 'extract_failed': 0, 'other': 0}
-    samples = []
-    with current_app.test_client() as client:
-        for row in rows:
-            tally['checked'] += 1
-            resp = client.post(
-                '/api/sms-rescue',
-                headers={'X--Migration-Token': '',                          # not used
-                         'Content-Type': 'application/json'},
-                json={'message': row.get('body') or '',
-                      'sender':  row.get('sender'),
-                      'received_at': row.get('received_at')},
-                environ_overrides={'HTTP_X_MIGRATION_TOKEN':
-                                   os.environ.get('MIGRATION_TOKEN', '')},
-            )
-            try:
-                data = resp.get_json() or {}
-            except Exception:
-                data = {}
-            if resp.status_code == 200 and data.get('rescued'):
-                tally['rescued'] += 1
-                if len(samples) < 10:
-                    samples.append({'sms_id': row['id'],
-                                    'row_id': data.get('row_id'),
-                                    'plate': data.get('plate'),
-                                    'ref': data.get('ref')})
-            elif resp.status_code == 409 and data.get('error') == 'already_rescued':
-                tally['already_rescued'] += 1
-            elif resp.status_code == 409 and data.get('error') == 'ref_in_passed':
-                tally['ref_in_passed'] += 1
-            elif resp.status_code == 404 and data.get('error') == 'ref_not_found':
-                tally['still_ref_not_found'] += 1
-            elif resp.status_code == 404 and data.get('error') == 'plate_not_in_records':
-                tally['plate_unknown'] += 1
-            elif resp.status_code == 400:
-                tally['extract_failed'] += 1
-            else:
-                tally['other'] += 1
+    rows = sms_rescue_engine.fetch_retry_events(outcomes, min_age_min, max_age_min,
+                                                limit=2000, newest_first=False)
+    if rows is None:
+        return jsonify({'error': 'sms_events read failed'}), 500
+
+    items = []
+    for row in sms_rescue_engine.latest_per_message(rows):
+        body = row.get('body') or ''
+        plate = row.get('extracted_plate') or extract_plate_number(body)
+        ref = row.get('extracted_ref') or (_extract_ref_from_sms(body, plate) if plate else None)
+        items.append({'sms_id': row['id'], 'sender': row.get('sender'), 'body': body,
+                      'received_at': row.get('received_at'),
+                      'plate': plate, 'ref': ref})
+    results = sms_rescue_engine.rescue(items, log_misses=False) if items else []
+
+    tally = sms_rescue_engine.tally(results)
+    tally['events'] = len(rows)
+    samples = [{'sms_id': it['sms_id'], 'row_id': r.get('row_id'),
+                'plate': r.get('plate'), 'ref': r.get('ref')}
+               for it, r in zip(items, results) if r.get('rescued')][:10]
     return jsonify({'tally': tally, 'sample_rescued': samples})
 
 
@@ -4781,7 +5986,7 @@ def admin_sms_recent():
     url = os.environ.get('SUPABASE_URL', '').rstrip('/')
     key = os.environ.get('SUPABASE_SERVICE_KEY', '')
     n = min(5000, max(1, int(request.args.get('n', 15))))
-    r = requests.get(
+    r = supabase_client.main().get(
         f'{url}/rest/v1/sms_events'
         f'?select=id,sender,outcome,http_status,extracted_plate,extracted_ref,'
         f'rescued_row_id,processed_at,body'
@@ -4823,7 +6028,7 @@ def admin_sms_purge_dupes():
     }
     all_rows = []
     for offset in range(0, 20000, 1000):
-        r = requests.get(
+        r = supabase_client.main().get(
             f'{url}/rest/v1/sms_events'
             f'?select=id,sender,body,outcome,processed_at'
             f'&order=id.asc',
@@ -4869,7 +6074,7 @@ def admin_sms_purge_dupes():
     for i in range(0, len(delete_ids), 500):
         chunk = delete_ids[i:i+500]
         id_list = ','.join(str(x) for x in chunk)
-        dr = requests.delete(
+        dr = supabase_client.main().delete(
             f'{url}/rest/v1/sms_events?id=in.({id_list})',
             headers={**hdr, 'Prefer': 'return=minimal'},
             timeout=60,
@@ -5043,81 +6248,20 @@ def _extract_ref_from_sms(msg, plate=None):
     return None
 
 
-_ILIYOPATA_TARGET_FROM_CUSTOMER = {
-    'IPHONE_RECORDS': 'IPHONEILIYOPATA',
-    'BODA_RECORDS':   'BODAILIYOPATA',
-    'SAVCOM_RECORDS': 'BODAILIYOPATA',
-}
-_FAILED_SOURCE_TABS = {'CRDBFAILED', 'NMBFAILED', 'IPHONEFAILED'}
-
-
 def _sms_event_insert(sender, body, received_at, status, outcome, plate,
                        ref, row_id, source_tab, error_detail):
-    """Best-effort audit write to sms_events. Never raises — the server
-    response to the phone must succeed even if logging is down.
+    """Best-effort audit write to sms_events, queued for the background
+    writer (audit_queue.py). Never raises and never waits on Supabase — the
+    server response to the phone must succeed even if logging is down.
 
-    Deduplicates: if a matching (sender, body) row was already logged
+    Deduplicates: if the same (sender, body, outcome) was already logged
     in the last 60 seconds, skip. Kills duplicates from OkHttp
-    retry-on-slow-response and double-broadcast paths in one shot."""
-    try:
-        url = os.environ.get('SUPABASE_URL', '').rstrip('/')
-        key = os.environ.get('SUPABASE_SERVICE_KEY', '')
-        if not url or not key:
-            return
-        hdr = {
-            'apikey': key,
-            'Authorization': f'Bearer {key}',
-        }
-        # PostgREST doesn't let us URL-encode the body if it has odd chars,
-        # so query by processed_at cutoff + a hash-style eq on body via
-        # PostgREST's `body=eq.<value>`. For safety we send the check
-        # through the JSON POST as a Prefer merge? No — simpler: hit the
-        # regular listing endpoint with a body eq filter.
-        cutoff = (datetime.utcnow() - timedelta(seconds=60)).isoformat() + 'Z'
-        check = requests.get(
-            f'{url}/rest/v1/sms_events'
-            f'?select=id&limit=1'
-            f'&processed_at=gte.{cutoff}'
-            f'&outcome=eq.{outcome}',
-            headers=hdr,
-            params={'sender': f'eq.{sender or ""}', 'body': f'eq.{body}'},
-            timeout=4,
-        )
-        if check.ok and len(check.json() or []) > 0:
-            return  # duplicate within 60s — skip
-        requests.post(
-            f'{url}/rest/v1/sms_events',
-            headers={**hdr,
-                     'Content-Type': 'application/json',
-                     'Prefer': 'return=minimal'},
-            json={
-                'sender':             sender,
-                'body':               body,
-                'received_at':        received_at,
-                'http_status':        status,
-                'outcome':            outcome,
-                'extracted_plate':    plate,
-                'extracted_ref':      ref,
-                'rescued_row_id':     row_id,
-                'rescued_source_tab': source_tab,
-                'error_detail':       error_detail,
-            },
-            timeout=5,
-        )
-    except Exception:
-        pass  # audit is best-effort; never break the primary response
-
-
-# Map customer_type in customer_registry → the source_tab shape the rest
-# of the rescue pipeline (iliyopata_writer, _ILIYOPATA_TARGET_FROM_CUSTOMER)
-# expects. Registry types are lowercased ('boda'/'savcom'/'iphone');
-# downstream code speaks in the sheet's BODA_RECORDS / SAVCOM_RECORDS /
-# IPHONE_RECORDS enum.
-_REGISTRY_TYPE_TO_SOURCE_TAB = {
-    'boda':   'BODA_RECORDS',
-    'savcom': 'SAVCOM_RECORDS',
-    'iphone': 'IPHONE_RECORDS',
-}
+    retry-on-slow-response and double-broadcast paths in one shot. The
+    check is local (sms_event_dedup.py), not a body=eq.<SMS> read, with
+    the sms_events.body_hash unique index as the DB-side backstop."""
+    sms_rescue_engine.insert_events([sms_rescue_engine.event_row(
+        sender, body, received_at, status, outcome,
+        plate, ref, row_id, source_tab, error_detail)])
 
 
 def _lookup_customer_by_plate_registry_first(plate: str, _unused_hdr=None,
@@ -5146,7 +6290,7 @@ def _lookup_customer_by_plate_registry_first(plate: str, _unused_hdr=None,
     h = {'apikey':        SUPABASE_KEY_REGISTRY,
          'Authorization': f'Bearer {SUPABASE_KEY_REGISTRY}'}
     try:
-        r = requests.get(
+        r = supabase_client.registry().get(
             f'{SUPABASE_URL_REGISTRY}/rest/v1/customer_registry',
             params={
                 'plate':  f'eq.{plate}',
@@ -5166,14 +6310,7 @@ def _lookup_customer_by_plate_registry_first(plate: str, _unused_hdr=None,
     rows = r.json() or []
     if not rows:
         return None
-    row = rows[0]
-    ctype = (row.get('customer_type') or 'boda').lower()
-    return {
-        'name':        row.get('customer_name') or '',
-        'plate':       row.get('plate') or plate,
-        'customer_id': row.get('sav_customer_id') or '',
-        'source_tab':  _REGISTRY_TYPE_TO_SOURCE_TAB.get(ctype, 'BODA_RECORDS'),
-    }
+    return sms_rescue_engine.registry_row_to_customer(rows[0], plate)
 
 
 @app.route('/api/sms-rescue', methods=['POST'])
@@ -5229,7 +6366,7 @@ def sms_rescue():
     #    the lowercase hex '19f5c574bd2a0acf' the sheet stores. Bank refs
     #    are alphanumeric-only so ilike acts as a plain case-insensitive
     #    equality with no wildcard risk.
-    tx_r = requests.get(
+    tx_r = supabase_client.main().get(
         f'{url}/rest/v1/transactions?ref_number=ilike.{ref}'
         '&select=id,source_tab,transaction_date,customer_name,bank,'
         'description,credit_amount,identifier,ref_number,customer_id,'
@@ -5247,13 +6384,13 @@ def sms_rescue():
         return jsonify({'error': 'ref_not_found',
                         'ref': ref, 'plate': plate}), 404
     tx = tx_rows[0]
-    if tx.get('rescue_locked_at') or tx['source_tab'] in {'BODAILIYOPATA', 'IPHONEILIYOPATA'}:
+    if tx.get('rescue_locked_at') or tx['source_tab'] in sms_rescue_engine.RESCUED_SOURCE_TABS:
         _sms_event_insert(sender, msg, received_at, 409, 'already_rescued',
                           plate, ref, tx['id'], tx['source_tab'], None)
         return jsonify({'error': 'already_rescued',
                         'source_tab': tx['source_tab'],
                         'row_id': tx['id']}), 409
-    if tx['source_tab'] not in _FAILED_SOURCE_TABS:
+    if tx['source_tab'] not in sms_rescue_engine.FAILED_SOURCE_TABS:
         _sms_event_insert(sender, msg, received_at, 409, 'ref_in_passed',
                           plate, ref, tx['id'], tx['source_tab'], None)
         return jsonify({'error': 'ref_in_passed',
@@ -5271,7 +6408,7 @@ def sms_rescue():
                           plate, ref, None, None, None)
         return jsonify({'error': 'plate_not_in_records',
                         'plate': plate, 'ref': ref}), 404
-    target_tab = _ILIYOPATA_TARGET_FROM_CUSTOMER.get(cust['source_tab'])
+    target_tab = sms_rescue_engine.ILIYOPATA_TARGET_FROM_CUSTOMER.get(cust['source_tab'])
     if not target_tab:
         _sms_event_insert(sender, msg, received_at, 400, 'server_error',
                           plate, ref, None, None, f'unknown source {cust["source_tab"]}')
@@ -5283,29 +6420,7 @@ def sms_rescue():
     #    the row if it hasn't been locked yet, so simultaneous UI + SMS
     #    rescues on the same row can't both succeed. If the update
     #    matches zero rows, someone else locked it first.
-    # Timestamps: transaction_date/day are display fields — stamp them
-    # in EAT (Tanzania, UTC+3) so the UI shows local wall-clock. moved_at
-    # is a real timestamptz so keep it in UTC ISO.
-    now_utc = datetime.utcnow()
-    now_eat = now_utc + timedelta(hours=3)
-    update = {
-        'old_transaction_date': tx.get('transaction_date'),
-        'transaction_date':     now_eat.strftime('%d.%m.%Y %H:%M:%S'),
-        'transaction_day':      now_eat.strftime('%Y-%m-%d'),
-        'customer_name':        cust['name'],
-        'source_tab':           target_tab,
-        'moved_by_username':    'sms_rescue',
-        'moved_at':             now_utc.isoformat() + 'Z',
-        'rescue_locked_at':     now_utc.isoformat() + 'Z',
-    }
-    pr = requests.patch(
-        f'{url}/rest/v1/transactions?id=eq.{tx["id"]}'
-        '&rescue_locked_at=is.null',
-        headers={**hdr,
-                 'Content-Type': 'application/json',
-                 'Prefer': 'return=representation'},
-        json=update, timeout=15,
-    )
+    update, pr = sms_rescue_engine.lock(tx, cust, target_tab)
     if not pr.ok:
         _sms_event_insert(sender, msg, received_at, 500, 'server_error',
                           plate, ref, tx['id'], None, pr.text[:400])
@@ -5340,6 +6455,82 @@ def sms_rescue():
     })
 
 
+# Largest batch /api/sms-rescue/batch accepts in one call.
+SMS_RESCUE_BATCH_MAX = int(os.environ.get('SMS_RESCUE_BATCH_MAX', '500'))
+
+
+@app.route('/api/sms-rescue/batch', methods=['POST'])
+def sms_rescue_batch():
+    """POST { "messages": [ {message, sender, received_at}, ... ] } (or the
+    bare list) — token-gated like /api/sms-rescue. For the forwarder's
+    replay after an offline gap.
+
+    Every message gets the outcome /api/sms-rescue would have given it:
+    `results[i]` is that endpoint's JSON body plus `status`, the HTTP code
+    it would have returned, so the phone keeps its per-status handling.
+    The HTTP status of the batch call itself is 200 unless the request is
+    malformed (400) or unauthorized (401).
+
+    Plates/refs are extracted here; everything after that is
+    sms_rescue_engine.rescue() — bulk transaction / registry lookups, the
+    guarded PATCHes, sheet writes grouped per spreadsheet and one bulk
+    sms_events insert."""
+    if not _migration_token_ok():
+        return jsonify({'error': 'unauthorized'}), 401
+    payload = request.get_json(silent=True)
+    messages = payload.get('messages') if isinstance(payload, dict) else payload
+    if not isinstance(messages, list) or not messages:
+        return jsonify({'error': 'messages required'}), 400
+    if len(messages) > SMS_RESCUE_BATCH_MAX:
+        return jsonify({'error': 'batch_too_large',
+                        'max': SMS_RESCUE_BATCH_MAX}), 400
+
+    results = [None] * len(messages)
+    events = []
+    pending, pending_idx = [], []
+    for i, item in enumerate(messages):
+        item = item if isinstance(item, dict) else {}
+        msg         = str(item.get('message') or '').strip()
+        sender      = str(item.get('sender') or '').strip() or None
+        received_at = item.get('received_at') or None
+        if not msg:
+            results[i] = {'status': 400, 'outcome': 'extract_failed',
+                          'error': 'message required'}
+            continue
+        plate = extract_plate_number(msg)
+        if not plate:
+            results[i] = {'status': 400, 'outcome': 'extract_failed',
+                          'error': 'plate_extract_failed', 'message': msg[:200]}
+            events.append(sms_rescue_engine.event_row(
+                sender, msg, received_at, 400, 'extract_failed',
+                None, None, None, None, 'no plate matched'))
+            continue
+        ref = _extract_ref_from_sms(msg, plate)
+        if not ref:
+            results[i] = {'status': 400, 'outcome': 'extract_failed',
+                          'error': 'ref_extract_failed', 'plate': plate,
+                          'message': msg[:200]}
+            events.append(sms_rescue_engine.event_row(
+                sender, msg, received_at, 400, 'extract_failed',
+                plate, None, None, None, 'no ref matched'))
+            continue
+        pending.append({'sender': sender, 'body': msg, 'received_at': received_at,
+                        'plate': plate, 'ref': ref})
+        pending_idx.append(i)
+
+    if pending:
+        for i, result in zip(pending_idx,
+                             sms_rescue_engine.rescue(pending, extra_events=events)):
+            results[i] = result
+    else:
+        sms_rescue_engine.insert_events(events)
+
+    counts = {}
+    for r in results:
+        counts[r['outcome']] = counts.get(r['outcome'], 0) + 1
+    return jsonify({'results': results, 'counts': counts})
+
+
 @app.route('/smsapp', methods=['GET'])
 def smsapp_download():
     """Serve the signed SMS-rescue APK for easy sideload on the phone."""
@@ -5377,7 +6568,7 @@ def admin_sms_rename_outcome():
     key = os.environ.get('SUPABASE_SERVICE_KEY', '')
     hdr = {'apikey': key, 'Authorization': f'Bearer {key}',
            'Content-Type': 'application/json', 'Prefer': 'return=representation'}
-    r = requests.patch(
+    r = supabase_client.main().patch(
         f'{url}/rest/v1/sms_events?outcome=eq.not_a_failed_row',
         headers=hdr,
         json={'outcome': 'ref_in_passed'},
@@ -5399,7 +6590,7 @@ def admin_rescued_banks():
     url = os.environ.get('SUPABASE_URL', '').rstrip('/')
     key = os.environ.get('SUPABASE_SERVICE_KEY', '')
     hdr = {'apikey': key, 'Authorization': f'Bearer {key}'}
-    r = requests.get(
+    r = supabase_client.main().get(
         f'{url}/rest/v1/transactions'
         f'?select=id,bank,source_tab,ref_number,moved_at,moved_by_username'
         f'&source_tab=in.(BODAILIYOPATA,IPHONEILIYOPATA)'
@@ -5426,4 +6617,7 @@ def admin_rescued_banks():
 
 
 if __name__ == '__main__':
+    # Under gunicorn this runs from post_worker_init instead; importing app
+    # must not start threads (see the classify pool notes).
+    mirror_outbox.start()   # drain whatever an earlier run left in the outbox
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,350 @@
+"""
+audit_queue.py — background writer for the audit tables (record_edits,
+sms_events)
+
+Contract:
+  - ui_blueprint._audit() and sms_rescue_engine.insert_events() used to POST
+    their row inline with a 5-15s timeout. Every customer / registry / user
+    edit and every SMS rescue waited on that extra round trip just to log.
+    They now call submit(), which puts the row on a bounded in-process queue
+    and returns right away.
+  - A daemon writer thread (started on the first submit()) collects rows for
+    up to AUDIT_BATCH_MS, or until it has AUDIT_BATCH_ROWS, and hands them
+    to the writer registered for their table with register(): one
+    PostgREST insert per table per batch. The writer returns the insert's
+    HTTP status code.
+  - A 4xx that rejects the rows themselves (bad value, constraint) fails
+    the whole multi-row insert, and resending it would fail forever. The
+    chunk is split in half and each half sent again, down to single rows,
+    so the good rows land; a row that is still rejected on its own is
+    logged and dropped.
+  - Rows that can't be written for now (5xx, 401 / 403 / 404 — the key or
+    the table, not the rows — 408 / 429, writer raised, queue full, no
+    writer registered) are appended to a local JSONL spill file instead of
+    being lost. When the writer is idle it replays the spill every
+    AUDIT_SPILL_RETRY seconds.
+  - Spill appends and claims take an fcntl lock on AUDIT_SPILL_PATH +
+    '.lock', so no worker appends to a spill another worker has already
+    claimed (renamed to AUDIT_SPILL_PATH.<pid>.<n>) for replay. A claim
+    left behind by a worker that died mid-replay is picked up by the next
+    replay.
+  - flush() drains the queue and the spill synchronously. gunicorn's
+    worker_exit hook calls it, and so should a script that exits right
+    after logging.
+  - stats() / render() expose the queue depth, the spill size and the rows
+    dropped (render() is appended to /metrics). Nothing here raises into the caller.
+
+Env vars:
+  AUDIT_BATCH_MS      max wait before a partial batch is sent (default 250)
+  AUDIT_BATCH_ROWS    rows per insert (default 200)
+  AUDIT_QUEUE_MAX     queue bound; past it rows go straight to the spill
+                      (default 5000)
+  AUDIT_SPILL_PATH    spill file (default
+                      /tmp/transaction_processor_audit_spill.jsonl)
+  AUDIT_SPILL_RETRY   seconds between spill replays (default 60)
+"""
+
+import contextlib
+import fcntl
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+
+BATCH_SECONDS = float(os.environ.get('AUDIT_BATCH_MS', '250')) / 1000
+BATCH_ROWS = int(os.environ.get('AUDIT_BATCH_ROWS', '200'))
+QUEUE_MAX = int(os.environ.get('AUDIT_QUEUE_MAX', '5000'))
+SPILL_PATH = os.environ.get('AUDIT_SPILL_PATH',
+                            '/tmp/transaction_processor_audit_spill.jsonl')
+SPILL_RETRY = float(os.environ.get('AUDIT_SPILL_RETRY', '60'))
+
+# Statuses that say nothing about the rows: the insert may succeed as-is
+# later, so the rows are spilled rather than split up and dropped.
+_RETRYABLE_4XX = (401, 403, 404, 408, 429)
+
+_queue = queue.Queue(maxsize=QUEUE_MAX)
+_writers = {}        # table -> fn(rows) -> HTTP status
+_lock = threading.Lock()
+_send_lock = threading.Lock()
+_replay_lock = threading.Lock()
+_claims = itertools.count()
+_writer_thread = None
+_last_replay = 0.0
+_counts = {'written': 0, 'spilled': 0, 'replayed': 0, 'dropped': 0}
+
+
+def register(table, writer):
+    """Route rows submitted for `table` to writer(rows) -> HTTP status."""
+    _writers[table] = writer
+
+
+def submit(table, row):
+    """Queue one row for `table`. Returns False only if the row could be
+    neither queued nor spilled."""
+    start()
+    try:
+        _queue.put_nowait((table, row))
+        return True
+    except queue.Full:
+        print(f"⚠️ audit queue: full ({QUEUE_MAX}), spilling {table} row")
+        return _spill({table: [row]})
+
+
+@contextlib.contextmanager
+def _spill_lock():
+    # A separate file: SPILL_PATH itself is renamed away by a claim, so a
+    # lock on its inode wouldn't stop an append to the claimed file.
+    with open(SPILL_PATH + '.lock', 'a') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        yield
+
+
+def _spill(by_table):
+    """Append rows to the spill file. True on success."""
+    try:
+        with _spill_lock(), open(SPILL_PATH, 'a') as fh:
+            for table, rows in by_table.items():
+                for row in rows:
+                    fh.write(json.dumps({'table': table, 'row': row}, default=str) + '\n')
+        n = sum(len(rows) for rows in by_table.values())
+        with _lock:
+            _counts['spilled'] += n
+        return True
+    except Exception as e:
+        print(f"⚠️ audit queue: spill failed, {sum(len(r) for r in by_table.values())} rows lost: {e}")
+        return False
+
+
+def _write_chunk(table, writer, rows):
+    """Insert rows, splitting the chunk on a rejection. Returns the rows
+    to spill."""
+    try:
+        status = writer(rows)
+    except Exception as e:
+        print(f"⚠️ audit queue: {table} writer raised: {e}")
+        return rows
+    if 200 <= status < 300:
+        with _lock:
+            _counts['written'] += len(rows)
+        return []
+    if not 400 <= status < 500 or status in _RETRYABLE_4XX:
+        return rows
+    if len(rows) == 1:
+        print(f"❌ audit queue: {table} row rejected (HTTP {status}), dropped: "
+              f"{json.dumps(rows[0], default=str)[:500]}")
+        with _lock:
+            _counts['dropped'] += 1
+        return []
+    mid = len(rows) // 2
+    return _write_chunk(table, writer, rows[:mid]) + _write_chunk(table, writer, rows[mid:])
+
+
+def _write(by_table):
+    """Send each table's rows through its writer. Returns the rows to
+    spill, grouped the same way."""
+    failed = {}
+    for table, rows in by_table.items():
+        writer = _writers.get(table)
+        for i in range(0, len(rows), BATCH_ROWS):
+            chunk = rows[i:i + BATCH_ROWS]
+            retry = _write_chunk(table, writer, chunk) if writer is not None else chunk
+            if retry:
+                failed.setdefault(table, []).extend(retry)
+    return failed
+
+
+def _send(batch):
+    by_table = {}
+    for table, row in batch:
+        by_table.setdefault(table, []).append(row)
+    try:
+        with _send_lock:
+            failed = _write(by_table)
+        if failed:
+            _spill(failed)
+    finally:
+        for _ in batch:
+            _queue.task_done()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _claim_spill():
+    """Under the spill lock, rename the spill to a claim of our own and
+    collect the claims of dead processes (or an earlier, failed replay of
+    ours). Returns the claimed paths."""
+    folder, base = os.path.split(SPILL_PATH)
+    prefix = base + '.'
+    with _spill_lock():
+        claims = []
+        for name in os.listdir(folder or '.'):
+            pid = name[len(prefix):].split('.')[0]
+            if not name.startswith(prefix) or not pid.isdigit():
+                continue
+            if int(pid) == os.getpid() or not _pid_alive(int(pid)):
+                claims.append(os.path.join(folder, name))
+        if os.path.exists(SPILL_PATH) and os.path.getsize(SPILL_PATH) > 0:
+            claimed = f'{SPILL_PATH}.{os.getpid()}.{next(_claims)}'
+            os.replace(SPILL_PATH, claimed)
+            claims.append(claimed)
+    return claims
+
+
+def _replay_spill():
+    """Re-send the spill file. Rows that fail again are spilled again."""
+    global _last_replay
+    _last_replay = time.time()
+    if not _replay_lock.acquire(blocking=False):
+        return      # flush() and the writer thread both replay
+    try:
+        _replay_claims()
+    finally:
+        _replay_lock.release()
+
+
+def _replay_claims():
+    try:
+        claims = _claim_spill()
+        by_table = {}
+        for path in claims:
+            with open(path) as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    by_table.setdefault(entry['table'], []).append(entry['row'])
+    except Exception as e:
+        print(f"⚠️ audit queue: spill replay failed: {e}")
+        return
+    if not claims:
+        return
+    with _send_lock:
+        failed = _write(by_table)
+    n_failed = sum(len(rows) for rows in failed.values())
+    with _lock:
+        _counts['replayed'] += sum(len(rows) for rows in by_table.values()) - n_failed
+    # The claims go only once their rows have landed or are back in the
+    # spill — a crash before this replays them again rather than losing them.
+    if failed and not _spill(failed):
+        return
+    for path in claims:
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"⚠️ audit queue: could not remove replayed spill {path}: {e}")
+
+
+def _take(first_timeout):
+    """Block up to `first_timeout` for a row, then gather more until the
+    batch is full or BATCH_SECONDS have passed."""
+    try:
+        batch = [_queue.get(timeout=first_timeout)]
+    except queue.Empty:
+        return []
+    deadline = time.time() + BATCH_SECONDS
+    while len(batch) < BATCH_ROWS:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _run():
+    while True:
+        try:
+            batch = _take(SPILL_RETRY)
+            if batch:
+                _send(batch)
+            elif time.time() - _last_replay >= SPILL_RETRY:
+                _replay_spill()
+        except Exception as e:
+            print(f"⚠️ audit queue: writer loop: {e}")
+            time.sleep(1)
+
+
+def start():
+    """Start this process's writer thread (idempotent)."""
+    global _writer_thread, _last_replay
+    if _writer_thread is not None and _writer_thread.is_alive():
+        return
+    with _lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _last_replay = time.time()
+            _writer_thread = threading.Thread(target=_run, name='audit-queue', daemon=True)
+            _writer_thread.start()
+
+
+def flush(timeout=10):
+    """Write out everything queued, then replay the spill, within `timeout`
+    seconds. Whatever is still queued at the deadline is spilled."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        batch = []
+        while len(batch) < BATCH_ROWS:
+            try:
+                batch.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        if not batch:
+            break
+        _send(batch)
+    # A batch the writer thread already took off the queue is still in
+    # flight — wait for it too.
+    while _queue.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.05)
+    leftover = {}
+    while True:
+        try:
+            table, row = _queue.get_nowait()
+        except queue.Empty:
+            break
+        leftover.setdefault(table, []).append(row)
+        _queue.task_done()
+    if leftover:
+        _spill(leftover)
+    elif time.time() < deadline:
+        _replay_spill()
+
+
+def stats():
+    """{'queued', 'spilled_pending', 'written', 'spilled', 'replayed',
+    'dropped'} — spilled_pending is the spill file's current line count."""
+    try:
+        with open(SPILL_PATH) as fh:
+            pending = sum(1 for _ in fh)
+    except OSError:
+        pending = 0
+    with _lock:
+        return {'queued': _queue.qsize(), 'spilled_pending': pending, **_counts}
+
+
+def render():
+    """stats() as Prometheus metrics, for appending to /metrics."""
+    s = stats()
+    lines = []
+    for name, key, kind, text in (
+            ('audit_queue_rows', 'queued', 'gauge', 'Audit rows waiting in this worker'),
+            ('audit_spill_rows', 'spilled_pending', 'gauge', 'Audit rows in the local spill file'),
+            ('audit_written_rows_total', 'written', 'counter', 'Audit rows written by this worker'),
+            ('audit_spilled_rows_total', 'spilled', 'counter', 'Audit rows this worker spilled to disk'),
+            ('audit_replayed_rows_total', 'replayed', 'counter', 'Spilled audit rows this worker re-sent'),
+            ('audit_dropped_rows_total', 'dropped', 'counter', 'Audit rows the database rejected, dropped by this worker')):
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'{name} {s[key]}')
+    return '\n'.join(lines) + '\n'
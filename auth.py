@@ -6,16 +6,26 @@ Auth model:
   - Password check via bcrypt against the stored hash.
   - Roles: 'admin' | 'editor' | 'viewer'. Enforced via require_role().
   - login_required + role decorators used by ui_blueprint.py routes.
+  - load_user() runs on every authenticated request. It serves User objects
+    from a small per-worker LRU cache (USER_CACHE_TTL seconds, default 60,
+    0 = off) instead of a `users` GET each time. ui_blueprint's user PATCH /
+    DELETE call invalidate_user(), which also touches a stamp file every
+    gunicorn worker checks, so a role change or delete applies on the next
+    request everywhere.
 """
 
 import functools
 import os
+import threading
+import time
+from collections import OrderedDict
 
 import bcrypt
-import requests
 from flask import jsonify, redirect, request, url_for
 from flask_login import LoginManager, UserMixin, current_user
 
+import supabase_client
+
 SUPABASE_URL = os.environ.get('SUPABASE_URL', '').rstrip('/')
 SUPABASE_KEY = os.environ.get('SUPABASE_SERVICE_KEY', '')
 
@@ -25,9 +35,18 @@ _HEADERS = {
     'Content-Type':  'application/json',
 }
 
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '60'))
+USER_CACHE_MAX = 256
+USER_CACHE_STAMP = os.environ.get('USER_CACHE_STAMP',
+                                  '/tmp/transaction_processor_users.stamp')
+
 login_manager = LoginManager()
 login_manager.login_view = '/login'
 
+_user_cache = OrderedDict()   # id -> (User, cached_at)
+_user_cache_lock = threading.Lock()
+_user_cache_stamp = 0.0
+
 
 class User(UserMixin):
     """Wraps a single row from the Supabase `users` table."""
@@ -47,7 +66,7 @@ def _fetch_user(*, user_id: int | None = None, username: str | None = None):
         return None
     q = f'id=eq.{user_id}' if user_id is not None else f'username=eq.{username}'
     try:
-        r = requests.get(
+        r = supabase_client.main().get(
             f'{SUPABASE_URL}/rest/v1/users?select=id,username,full_name,role,password_hash&{q}&limit=1',
             headers=_HEADERS, timeout=10,
         )
@@ -59,13 +78,78 @@ def _fetch_user(*, user_id: int | None = None, username: str | None = None):
         return None
 
 
+def _stamp_mtime():
+    try:
+        return os.stat(USER_CACHE_STAMP).st_mtime
+    except OSError:
+        return 0.0
+
+
+def _cache_user(user, stamp):
+    """Cache a User fetched after reading `stamp` (_stamp_mtime()). If the
+    stamp has moved since, an invalidate_user() raced the fetch and the row
+    may predate it, so it isn't cached."""
+    if USER_CACHE_TTL <= 0:
+        return
+    with _user_cache_lock:
+        if _stamp_mtime() != stamp:
+            return
+        _user_cache[user.id] = (user, time.time())
+        _user_cache.move_to_end(user.id)
+        while len(_user_cache) > USER_CACHE_MAX:
+            _user_cache.popitem(last=False)
+
+
+def _cached_user(user_id: int):
+    global _user_cache_stamp
+    if USER_CACHE_TTL <= 0:
+        return None
+    stamp = _stamp_mtime()
+    with _user_cache_lock:
+        if stamp != _user_cache_stamp:
+            # Some worker changed a user since we last looked.
+            _user_cache.clear()
+            _user_cache_stamp = stamp
+            return None
+        hit = _user_cache.get(user_id)
+        if hit is None or time.time() - hit[1] > USER_CACHE_TTL:
+            return None
+        _user_cache.move_to_end(user_id)
+        return hit[0]
+
+
+def invalidate_user(user_id: int | None = None):
+    """Drop `user_id` (or everyone) from the load_user cache — in this
+    worker directly, in the others via the stamp file."""
+    with _user_cache_lock:
+        if user_id is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(user_id, None)
+    try:
+        with open(USER_CACHE_STAMP, 'a'):
+            pass
+        os.utime(USER_CACHE_STAMP)
+    except OSError as e:
+        print(f"⚠️ user cache stamp: {e}")
+
+
 @login_manager.user_loader
 def load_user(user_id: str):
     try:
-        row = _fetch_user(user_id=int(user_id))
+        uid = int(user_id)
     except (TypeError, ValueError):
         return None
-    return User(row) if row else None
+    user = _cached_user(uid)
+    if user is not None:
+        return user
+    stamp = _stamp_mtime()
+    row = _fetch_user(user_id=uid)
+    if not row:
+        return None
+    user = User(row)
+    _cache_user(user, stamp)
+    return user
 
 
 @login_manager.unauthorized_handler
@@ -78,6 +162,7 @@ def _unauth():
 
 def check_password(username: str, plain_password: str):
     """Return a User on success, None on any failure. Never leaks WHY."""
+    stamp = _stamp_mtime()
     row = _fetch_user(username=username)
     if not row:
         return None
@@ -87,7 +172,9 @@ def check_password(username: str, plain_password: str):
     try:
         if bcrypt.checkpw(plain_password.encode('utf-8'), stored):
             _mark_login(row['id'])
-            return User(row)
+            user = User(row)
+            _cache_user(user, stamp)
+            return user
     except (ValueError, TypeError):
         return None
     return None
@@ -95,7 +182,7 @@ def check_password(username: str, plain_password: str):
 
 def _mark_login(user_id: int):
     try:
-        requests.patch(
+        supabase_client.main().patch(
             f'{SUPABASE_URL}/rest/v1/users?id=eq.{user_id}',
             headers={**_HEADERS, 'Prefer': 'return=minimal'},
             json={'last_login_at': 'now()'}, timeout=5,
@@ -0,0 +1,157 @@
+"""
+excel_stream.py — row-at-a-time reading of bank statement workbooks
+
+Contract:
+  - open_table(filepath, header_match) is a context manager giving
+    (header_idx, header, rows): the first sheet's column-header row — the
+    first of the leading `scan_rows` rows where header_match(values) is True
+    — and an iterator over the data rows after it, each a list of cell
+    values. The CRDB reader used to pd.read_excel() the whole workbook into
+    an object DataFrame, copy the data block out of it and to_dict() it;
+    read_nmb_excel() read the file twice (header scan, then skiprows). This
+    reads the file once and never materialises more than the current row,
+    so the readers keep only the projected columns of credit rows.
+  - .xlsx goes through openpyxl read_only=True / iter_rows(values_only=True)
+    (streams the sheet XML). .xls goes through xlrd on_demand=True — only the
+    first sheet is loaded, though xlrd still parses that sheet whole. The
+    engine is picked from the file's magic bytes, as pandas does, so an
+    .xlsx saved with an .xls name still reads.
+  - Cell values match what pd.read_excel() puts in an object column: whole
+    floats become int, date cells datetime, empty / error cells None.
+    Fully empty rows are skipped (pandas drops them too) and don't count
+    towards header_idx.
+  - project(rows, header, columns) yields {column: value} for just the named
+    columns, empty cells as NaN — the same values the DataFrame path's
+    to_dict('records') produced, so str() of them downstream is unchanged.
+  - Raises HeaderNotFound when no row matches and no default_header index
+    was given; anything openpyxl / xlrd raise propagates.
+"""
+
+import contextlib
+
+NAN = float('nan')
+
+_ZIP_MAGIC = b'PK\x03\x04'
+_OLE_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+
+class HeaderNotFound(Exception):
+    pass
+
+
+def _engine(filepath):
+    with open(filepath, 'rb') as fh:
+        magic = fh.read(8)
+    if magic.startswith(_ZIP_MAGIC):
+        return 'openpyxl'
+    if magic.startswith(_OLE_MAGIC):
+        return 'xlrd'
+    return 'xlrd' if filepath.lower().endswith('.xls') else 'openpyxl'
+
+
+def _value(v):
+    if v is None or v == '':
+        return None
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    return v
+
+
+def _iter_openpyxl(filepath):
+    import openpyxl
+    wb = openpyxl.load_workbook(filepath, read_only=True, data_only=True,
+                                keep_links=False)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()   # read_only trusts the file's (often wrong) dimension tag
+        for row in ws.iter_rows(values_only=True):
+            yield [_value(v) for v in row]
+    finally:
+        wb.close()
+
+
+def _iter_xlrd(filepath):
+    import xlrd
+    from xlrd.xldate import xldate_as_datetime
+    book = xlrd.open_workbook(filepath, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        for i in range(sheet.nrows):
+            row = []
+            for cell in sheet.row(i):
+                if cell.ctype == xlrd.XL_CELL_DATE:
+                    try:
+                        row.append(xldate_as_datetime(cell.value, book.datemode))
+                    except (OverflowError, ValueError):
+                        row.append(cell.value)
+                elif cell.ctype == xlrd.XL_CELL_BOOLEAN:
+                    row.append(bool(cell.value))
+                elif cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK,
+                                    xlrd.XL_CELL_ERROR):
+                    row.append(None)
+                else:
+                    row.append(_value(cell.value))
+            yield row
+    finally:
+        book.release_resources()
+
+
+def iter_rows(filepath):
+    """Non-empty rows of the first sheet as lists of cell values."""
+    reader = _iter_openpyxl if _engine(filepath) == 'openpyxl' else _iter_xlrd
+    for row in reader(filepath):
+        if any(v is not None for v in row):
+            yield row
+
+
+@contextlib.contextmanager
+def open_table(filepath, header_match, scan_rows=60, default_header=None):
+    """(header_idx, header, rows) — see module docstring. With default_header
+    a sheet whose header isn't found in scan_rows uses that row instead."""
+    source = iter_rows(filepath)
+    try:
+        scanned = []
+        header_idx = None
+        for row in source:
+            if header_match(row):
+                header_idx = len(scanned)
+                break
+            scanned.append(row)
+            if len(scanned) >= scan_rows:
+                break
+
+        if header_idx is not None:
+            header, rows = row, source
+        elif default_header is not None and default_header < len(scanned):
+            header_idx = default_header
+            header = scanned[default_header]
+            rows = _chain(scanned[default_header + 1:], source)
+        else:
+            raise HeaderNotFound(f'no header row in the first {scan_rows} rows')
+        del scanned
+
+        header = ['' if v is None else str(v) for v in header]
+        yield header_idx, header, rows
+    finally:
+        source.close()
+
+
+def _chain(buffered, source):
+    yield from buffered
+    yield from source
+
+
+def project(rows, header, columns):
+    """{column: value} for each row, keeping only `columns` that are in the
+    header (first occurrence). Empty cells → NaN."""
+    index = {}
+    for i, name in enumerate(header):
+        index.setdefault(name, i)
+    picks = [(c, index[c]) for c in columns if c in index]
+    for row in rows:
+        n = len(row)
+        out = {}
+        for name, i in picks:
+            v = row[i] if i < n else None
+            out[name] = NAN if v is None else v
+        yield out
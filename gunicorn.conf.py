@@ -15,6 +15,16 @@ worker_class = 'sync'
 # The default gunicorn timeout is 30s, which is what causes mid-response kills.
 timeout = 300
 
+# Time a stopping worker gets before SIGKILL. worker_exit below waits for the
+# in-flight /process job and then drains the outbox and the audit queue, so
+# budget all three inside it (and under `timeout` — the worker stops
+# heartbeating while it waits). The gunicorn default of 30s killed a worker
+# mid-wait and the flushes never ran.
+graceful_timeout = 295
+_EXIT_OUTBOX_FLUSH = 20
+_EXIT_AUDIT_FLUSH = 5
+_EXIT_JOB_WAIT = graceful_timeout - _EXIT_OUTBOX_FLUSH - _EXIT_AUDIT_FLUSH - 10
+
 # How long a worker waits for the next request before it's recycled
 keepalive = 5
 
@@ -34,3 +44,30 @@ bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
 accesslog = '-'
 errorlog = '-'
 loglevel = 'info'
+
+
+def post_worker_init(worker):
+    # Background threads start here rather than when app is imported: the
+    # classify and PDF page pools' forkserver imports app too, and must stay
+    # single-threaded. Drain whatever an earlier worker left in the outbox.
+    import sys
+    outbox = sys.modules.get('mirror_outbox')
+    if outbox is not None:
+        outbox.start()
+
+
+# /process runs as a background job thread inside the worker — don't let a
+# max_requests recycle kill it mid-write (see _start_process_job in app.py).
+# Then drain the Supabase mirror outbox and the audit queue once more;
+# leftovers stay on disk. Each step is bounded (graceful_timeout above).
+def worker_exit(server, worker):
+    import sys
+    app_module = sys.modules.get('app')
+    if app_module is not None and hasattr(app_module, 'wait_for_process_jobs'):
+        app_module.wait_for_process_jobs(timeout=_EXIT_JOB_WAIT)
+    outbox = sys.modules.get('mirror_outbox')
+    if outbox is not None:
+        outbox.flush(timeout=_EXIT_OUTBOX_FLUSH)
+    audit = sys.modules.get('audit_queue')
+    if audit is not None:
+        audit.flush(timeout=_EXIT_AUDIT_FLUSH)
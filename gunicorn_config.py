@@ -16,7 +16,14 @@ threads = 1
 
 # Timeout settings
 timeout = 300  # 5 minutes for PDF processing
-graceful_timeout = 30
+# A worker stopping (SIGTERM, or a max_requests recycle) first lets its
+# in-flight /process job finish, then drains the outbox and the audit queue
+# — see worker_exit below. Budget all three inside graceful_timeout, and
+# under `timeout`, since the worker stops heartbeating while it waits.
+graceful_timeout = 295
+_EXIT_OUTBOX_FLUSH = 20
+_EXIT_AUDIT_FLUSH = 5
+_EXIT_JOB_WAIT = graceful_timeout - _EXIT_OUTBOX_FLUSH - _EXIT_AUDIT_FLUSH - 10
 keepalive = 5
 
 # Memory management
@@ -33,3 +40,33 @@ proc_name = 'transaction-processor'
 
 # Worker tmp directory (helps with memory)
 worker_tmp_dir = '/dev/shm' if os.path.exists('/dev/shm') else None
+
+
+def post_worker_init(worker):
+    # Background threads start here rather than when app is imported: the
+    # classify and PDF page pools' forkserver imports app too, and must stay
+    # single-threaded. Drain whatever an earlier worker left in the outbox.
+    import sys
+    outbox = sys.modules.get('mirror_outbox')
+    if outbox is not None:
+        outbox.start()
+
+
+def worker_exit(server, worker):
+    # /process runs as a background job thread inside the worker (see
+    # _start_process_job in app.py). A max_requests recycle must not kill it
+    # half-way through its sheet writes, so wait for it here (bounded, see
+    # graceful_timeout above). Then give the
+    # Supabase mirror outbox one last drain inside graceful_timeout — anything
+    # left stays queued on disk for the next worker. Same for the queued
+    # record_edits / sms_events rows (unsent ones go to the audit spill).
+    import sys
+    app_module = sys.modules.get('app')
+    if app_module is not None and hasattr(app_module, 'wait_for_process_jobs'):
+        app_module.wait_for_process_jobs(timeout=_EXIT_JOB_WAIT)
+    outbox = sys.modules.get('mirror_outbox')
+    if outbox is not None:
+        outbox.flush(timeout=_EXIT_OUTBOX_FLUSH)
+    audit = sys.modules.get('audit_queue')
+    if audit is not None:
+        audit.flush(timeout=_EXIT_AUDIT_FLUSH)
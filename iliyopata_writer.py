@@ -5,7 +5,9 @@ appropriate bank sheet (CRDB / NMB / iPhone).
 Contract:
   - Both `/api/sms-rescue` (app.py) and `/api/transactions/<id>/rescue`
     (ui_blueprint.py) call `append_iliyopata_row()` after they've PATCHed
-    the DB row. Sheet write is best-effort — a Google API failure is
+    the DB row; sms_rescue_engine.py (the batch endpoint and the retry
+    sweeps) calls `append_iliyopata_rows()`, which does the same writes
+    grouped per spreadsheet. Sheet write is best-effort — a Google API failure is
     logged but never raises, because the DB is already the source of
     truth for the rescue.
 
@@ -27,14 +29,9 @@ schema:
   I = customer_id           (SAV customer_id if any)
 """
 
-import json
-import os
 import traceback
 
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+import sheets_client
 
 # Same IDs as app.py's constants — kept in sync manually. If either
 # changes, both files need updating.
@@ -91,14 +88,8 @@ FAILED_MARKER_COL = 'I'
 
 
 def _service():
-    creds_raw = os.environ.get('GOOGLE_CREDENTIALS_JSON') or ''
-    if not creds_raw:
-        raise RuntimeError('GOOGLE_CREDENTIALS_JSON not set')
-    creds_dict = json.loads(creds_raw)
-    creds = service_account.Credentials.from_service_account_info(
-        creds_dict, scopes=SCOPES,
-    )
-    return build('sheets', 'v4', credentials=creds)
+    # Shared with app.py — see sheets_client.py.
+    return sheets_client.get_service()
 
 
 def _scan_tab(service, sheet_id):
@@ -204,6 +195,65 @@ def _passed_last_id(service, sheet_id, passed_tab):
     return biggest
 
 
+def _iliyopata_row(row_id, bank_label, tx, customer, new_date_text):
+    """ILIYOPATA 9-col row — with customer_id."""
+    return [
+        row_id,
+        new_date_text or '',
+        bank_label,
+        tx.get('description') or '',
+        tx.get('credit_amount') if tx.get('credit_amount') is not None else '',
+        tx.get('identifier') or customer.get('plate') or '',
+        customer.get('name') or '',
+        tx.get('ref_number') or '',
+        tx.get('customer_id') or customer.get('customer_id') or '',
+    ]
+
+
+def _passed_row(row_id, bank_label, tx, customer, new_date_text):
+    """PASSED 8-col row — same data as ILIYOPATA minus customer_id."""
+    # Use the ORIGINAL bank transaction date on the PASSED
+    # row — not the rescue timestamp. Accounting reads PASSED
+    # as the ledger of when customers actually paid, so it
+    # has to match the bank's record. The rescue timestamp
+    # still shows on ILIYOPATAAUTO (audit) and on the FAILED
+    # column-I marker.
+    #
+    # tx was fetched BEFORE the PATCH in the rescue flow, so
+    # tx.get('transaction_date') is the pre-rescue value =
+    # the original bank date. Fall back to new_date_text
+    # only when the original is somehow missing (defensive).
+    original_date = tx.get('transaction_date') or new_date_text or ''
+    description = tx.get('description') or ''
+
+    # Bank-specific format convention. CRDB and IPHONE
+    # pullers both write date and description with a leading
+    # space (' 15.07.2026 07:15:00', ' REF:...'). iPhone runs
+    # on CRDB rails so BANK_PASSED follows the same convention
+    # — verified live: 4253/4903 (87%) of BANK_PASSED rows
+    # have a leading space on the date, 3223/4892 on the
+    # description. The DB often strips the leading space from
+    # the date at ingest, so re-inject it here so rescue
+    # rows match puller-written rows in the PASSED tab.
+    # NMB uses no leading space; matched by doing nothing.
+    if bank_label in ('CRDB', 'IPHONE'):
+        if original_date and not original_date.startswith(' '):
+            original_date = ' ' + original_date
+        if description and not description.startswith(' '):
+            description = ' ' + description
+
+    return [
+        row_id,
+        original_date,
+        bank_label,
+        description,
+        tx.get('credit_amount') if tx.get('credit_amount') is not None else '',
+        tx.get('identifier') or customer.get('plate') or '',
+        customer.get('name') or '',
+        tx.get('ref_number') or '',
+    ]
+
+
 def append_iliyopata_row(*, origin_source_tab, tx, customer, new_date_text):
     """Mirror a rescued row into TWO tabs on the bank's Google Sheet:
 
@@ -246,18 +296,7 @@ def append_iliyopata_row(*, origin_source_tab, tx, customer, new_date_text):
         biggest_id, next_row = _scan_tab(service, sheet_id)
         next_id = biggest_id + 1
 
-        # ILIYOPATA 9-col row — with customer_id
-        ily_row = [
-            next_id,
-            new_date_text or '',
-            bank_label,
-            tx.get('description') or '',
-            tx.get('credit_amount') if tx.get('credit_amount') is not None else '',
-            tx.get('identifier') or customer.get('plate') or '',
-            customer.get('name') or '',
-            tx.get('ref_number') or '',
-            tx.get('customer_id') or customer.get('customer_id') or '',
-        ]
+        ily_row = _iliyopata_row(next_id, bank_label, tx, customer, new_date_text)
         # Explicit-range update — writes exactly at A{n}:I{n}, no table detection.
         service.spreadsheets().values().update(
             spreadsheetId=sheet_id,
@@ -303,46 +342,8 @@ def append_iliyopata_row(*, origin_source_tab, tx, customer, new_date_text):
         if passed_tab and not already_in_passed:
             try:
                 passed_id = _passed_last_id(service, sheet_id, passed_tab) + 1
-                # Use the ORIGINAL bank transaction date on the PASSED
-                # row — not the rescue timestamp. Accounting reads PASSED
-                # as the ledger of when customers actually paid, so it
-                # has to match the bank's record. The rescue timestamp
-                # still shows on ILIYOPATAAUTO (audit) and on the FAILED
-                # column-I marker.
-                #
-                # tx was fetched BEFORE the PATCH in the rescue flow, so
-                # tx.get('transaction_date') is the pre-rescue value =
-                # the original bank date. Fall back to new_date_text
-                # only when the original is somehow missing (defensive).
-                original_date = tx.get('transaction_date') or new_date_text or ''
-                description = tx.get('description') or ''
-
-                # Bank-specific format convention. CRDB and IPHONE
-                # pullers both write date and description with a leading
-                # space (' 15.07.2026 07:15:00', ' REF:...'). iPhone runs
-                # on CRDB rails so BANK_PASSED follows the same convention
-                # — verified live: 4253/4903 (87%) of BANK_PASSED rows
-                # have a leading space on the date, 3223/4892 on the
-                # description. The DB often strips the leading space from
-                # the date at ingest, so re-inject it here so rescue
-                # rows match puller-written rows in the PASSED tab.
-                # NMB uses no leading space; matched by doing nothing.
-                if bank_label in ('CRDB', 'IPHONE'):
-                    if original_date and not original_date.startswith(' '):
-                        original_date = ' ' + original_date
-                    if description and not description.startswith(' '):
-                        description = ' ' + description
-
-                passed_row = [
-                    passed_id,
-                    original_date,
-                    bank_label,
-                    description,
-                    tx.get('credit_amount') if tx.get('credit_amount') is not None else '',
-                    tx.get('identifier') or customer.get('plate') or '',
-                    customer.get('name') or '',
-                    tx.get('ref_number') or '',
-                ]
+                passed_row = _passed_row(passed_id, bank_label, tx, customer,
+                                         new_date_text)
                 # append() is fine on PASSED — those tabs have thousands of
                 # rows and Sheets' table detection works correctly on them.
                 service.spreadsheets().values().append(
@@ -383,3 +384,154 @@ def append_iliyopata_row(*, origin_source_tab, tx, customer, new_date_text):
     except Exception as e:
         traceback.print_exc()
         return {'ok': False, 'error': str(e)[:200]}
+
+
+def _read_refs(service, sheet_id, tab):
+    """Column H of `tab` as [(1-based row, lowercased ref)]."""
+    r = service.spreadsheets().values().get(
+        spreadsheetId=sheet_id,
+        range=f"'{tab}'!H:H",
+        valueRenderOption='UNFORMATTED_VALUE',
+    ).execute()
+    return [(i, str(row[0]).strip().lower())
+            for i, row in enumerate(r.get('values', []), start=1) if row]
+
+
+def append_iliyopata_rows(items):
+    """Batch form of append_iliyopata_row() for sms_rescue_engine.rescue().
+
+    items: list of dicts with the same keyword arguments
+           (origin_source_tab, tx, customer, new_date_text).
+
+    Rows are grouped per spreadsheet. Each sheet gets one ILIYOPATA scan and
+    one update covering all its rows. Each PASSED tab gets one ref read, one
+    last-id read and one append. The FAILED markers take one ref read and one
+    batchUpdate. A single rescue used to cost about six Sheets calls; N rescues
+    on the same sheet now cost about the same six. Dedup against PASSED also
+    covers refs repeated inside the batch.
+
+    Returns one result per item, in order, shaped like
+    append_iliyopata_row()'s. Never raises.
+    """
+    results = [None] * len(items)
+    by_sheet = {}
+    for i, item in enumerate(items):
+        binding = _ORIGIN_TO_SHEET.get(item['origin_source_tab'])
+        if not binding:
+            results[i] = {'ok': False,
+                          'error': f"unknown origin {item['origin_source_tab']}"}
+            continue
+        by_sheet.setdefault(binding, []).append(i)
+
+    for (bank_label, sheet_id), idxs in by_sheet.items():
+        try:
+            service = _service()
+            biggest_id, next_row = _scan_tab(service, sheet_id)
+            ily_rows = [_iliyopata_row(biggest_id + 1 + n, bank_label, items[i]['tx'],
+                                       items[i]['customer'], items[i]['new_date_text'])
+                        for n, i in enumerate(idxs)]
+            last_row = next_row + len(ily_rows) - 1
+            service.spreadsheets().values().update(
+                spreadsheetId=sheet_id,
+                range=f"'{ILIYOPATA_TAB}'!A{next_row}:I{last_row}",
+                valueInputOption='USER_ENTERED',
+                body={'values': ily_rows},
+            ).execute()
+        except Exception as e:
+            traceback.print_exc()
+            for i in idxs:
+                results[i] = {'ok': False, 'error': str(e)[:200]}
+            continue
+        for n, i in enumerate(idxs):
+            results[i] = {
+                'ok': True,
+                'sheet': bank_label,
+                'appended_id': biggest_id + 1 + n,
+                'passed_id': None,
+                'passed_err': None,
+                'passed_skipped_reason': None,
+                'failed_marker': None,
+            }
+
+        # PASSED mirror, one read + one append per tab.
+        by_passed = {}
+        for i in idxs:
+            tab = _passed_tab_for(bank_label, items[i]['customer'].get('source_tab'))
+            if tab:
+                by_passed.setdefault(tab, []).append(i)
+        for passed_tab, tab_idxs in by_passed.items():
+            existing = set()
+            try:
+                existing = {ref for _, ref in _read_refs(service, sheet_id, passed_tab)}
+            except Exception as e:
+                for i in tab_idxs:
+                    results[i]['passed_err'] = f'dedup_check_failed: {str(e)[:120]}'
+            to_write = []
+            for i in tab_idxs:
+                ref = (items[i]['tx'].get('ref_number') or '').strip().lower()
+                if ref and ref in existing:
+                    results[i]['passed_skipped_reason'] = 'ref_already_in_passed'
+                    continue
+                if ref:
+                    existing.add(ref)
+                to_write.append(i)
+            if not to_write:
+                continue
+            try:
+                first_id = _passed_last_id(service, sheet_id, passed_tab) + 1
+                rows = [_passed_row(first_id + n, bank_label, items[i]['tx'],
+                                    items[i]['customer'], items[i]['new_date_text'])
+                        for n, i in enumerate(to_write)]
+                service.spreadsheets().values().append(
+                    spreadsheetId=sheet_id,
+                    range=f"'{passed_tab}'!A:H",
+                    valueInputOption='USER_ENTERED',
+                    insertDataOption='INSERT_ROWS',
+                    body={'values': rows},
+                ).execute()
+                for n, i in enumerate(to_write):
+                    results[i]['passed_id'] = first_id + n
+            except Exception as e:
+                traceback.print_exc()
+                for i in to_write:
+                    results[i]['passed_err'] = str(e)[:200]
+
+        # FAILED-row markers, one read + one batchUpdate.
+        failed_tab = _FAILED_TAB.get(bank_label)
+        if not failed_tab:
+            continue
+        try:
+            row_of = {}
+            for row_no, ref in _read_refs(service, sheet_id, failed_tab):
+                row_of.setdefault(ref, row_no)
+        except Exception as e:
+            for i in idxs:
+                results[i]['failed_marker'] = {'ok': False,
+                                               'error': f'read_failed: {str(e)[:120]}'}
+            continue
+        data, marked = [], []
+        for i in idxs:
+            ref = (items[i]['tx'].get('ref_number') or '').strip().lower()
+            if not ref:
+                results[i]['failed_marker'] = {'ok': False, 'error': 'empty_ref'}
+            elif ref not in row_of:
+                results[i]['failed_marker'] = {'ok': False, 'error': 'ref_not_in_failed_tab'}
+            else:
+                marker_text = f"RESCUED @ {items[i]['new_date_text'] or ''}".strip()
+                data.append({'range': f"'{failed_tab}'!{FAILED_MARKER_COL}{row_of[ref]}",
+                             'values': [[marker_text]]})
+                marked.append((i, row_of[ref]))
+        if not data:
+            continue
+        try:
+            service.spreadsheets().values().batchUpdate(
+                spreadsheetId=sheet_id,
+                body={'valueInputOption': 'USER_ENTERED', 'data': data},
+            ).execute()
+            for i, row_no in marked:
+                results[i]['failed_marker'] = {'ok': True, 'row': row_no}
+        except Exception as e:
+            for i, _ in marked:
+                results[i]['failed_marker'] = {'ok': False,
+                                               'error': f'update_failed: {str(e)[:120]}'}
+    return results
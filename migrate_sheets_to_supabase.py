@@ -36,8 +36,8 @@ from collections import Counter
 from datetime import date, datetime
 
 import requests
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+
+import sheets_client
 
 # Big tabs (30k+ rows) can wedge the default 60s socket timeout.
 # 3 min per HTTP call is comfortable even at slow bandwidth.
@@ -229,11 +229,7 @@ def _classify_failed_cells(c6, c7, c8):
 
 # ── Google Sheets read ─────────────────────────────────────────────────────
 def get_sheets():
-    creds = service_account.Credentials.from_service_account_info(
-        json.loads(GOOGLE_CREDS),
-        scopes=['https://www.googleapis.com/auth/spreadsheets'],
-    )
-    return build('sheets', 'v4', credentials=creds)
+    return sheets_client.get_service(creds_json=GOOGLE_CREDS)
 
 
 def read_tab(service, sheet_id, tab_name):
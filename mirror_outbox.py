@@ -0,0 +1,364 @@
+"""
+mirror_outbox.py — durable local outbox between the sheet writes and the
+Supabase mirror
+
+Contract:
+  - append_to_sheet() in app.py used to call supabase_writer.append()
+    inline after every Sheets write, so a slow Supabase added its full
+    latency to /process and a Supabase outage lost the mirror rows for good
+    (they were only printed). It now calls enqueue(), which stores the rows
+    in a local SQLite file and returns; the sheet write path never waits on
+    Supabase.
+  - A daemon flusher thread (started on the first enqueue(), or by start())
+    drains the outbox: due entries that haven't failed yet are grouped by
+    tab into batches of up to SUPABASE_OUTBOX_BATCH_ROWS rows and handed to
+    supabase_writer.append(). An entry is deleted only once a batch comes
+    back with failed == 0. Otherwise every entry in it is retried on its own
+    with exponential backoff, capped at SUPABASE_OUTBOX_MAX_BACKOFF seconds,
+    so one bad entry can't hold back the entries queued after it.
+  - An entry that has failed SUPABASE_OUTBOX_MAX_ATTEMPTS times is moved to
+    the `parked` table of the same file instead of being retried forever.
+    Rows are never dropped: parked entries show in backlog() / render()
+    with their last_error, and unpark() queues them again once the cause
+    is fixed.
+  - Retries resend the whole entry. The rows that already landed are
+    skipped by supabase_writer's ref lookup and unique indexes, and their
+    dedup alerts are suppressed so a retry doesn't report them as
+    duplicates. A first try always records its alerts.
+  - gunicorn runs several workers, each with its own flusher. The drain
+    holds an fcntl lock on OUTBOX_PATH + '.lock', so only one worker sends
+    at a time and an entry is never in flight twice. The rows survive a
+    worker recycle or a restart. Whichever worker flushes next picks them
+    up, and the worker_exit hook calls flush() for a last drain.
+  - backlog() returns the outbox and parked sizes, render() the same as
+    Prometheus gauges (appended to /metrics). Neither raises.
+  - When the outbox itself is unusable (SQLite error), enqueue() falls back
+    to the old inline supabase_writer.append() call so nothing is lost.
+
+Env vars:
+  SUPABASE_OUTBOX_PATH         SQLite file (default .mirror_outbox.sqlite3
+                               next to app.py)
+  SUPABASE_OUTBOX_BATCH_ROWS   max rows per supabase_writer.append() call
+                               (default 5000)
+  SUPABASE_OUTBOX_INTERVAL     seconds between drains when idle (default 5)
+  SUPABASE_OUTBOX_MAX_BACKOFF  retry backoff cap in seconds (default 900)
+  SUPABASE_OUTBOX_MAX_ATTEMPTS failed sends before an entry is parked
+                               (default 20, about three hours of backoff)
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import supabase_writer
+
+OUTBOX_PATH = os.environ.get('SUPABASE_OUTBOX_PATH') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '.mirror_outbox.sqlite3')
+BATCH_ROWS = int(os.environ.get('SUPABASE_OUTBOX_BATCH_ROWS', '5000'))
+INTERVAL = float(os.environ.get('SUPABASE_OUTBOX_INTERVAL', '5'))
+MAX_BACKOFF = float(os.environ.get('SUPABASE_OUTBOX_MAX_BACKOFF', '900'))
+MAX_ATTEMPTS = int(os.environ.get('SUPABASE_OUTBOX_MAX_ATTEMPTS', '20'))
+_BASE_BACKOFF = 5.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    tab         TEXT    NOT NULL,
+    rows        TEXT    NOT NULL,
+    n_rows      INTEGER NOT NULL,
+    enqueued_at REAL    NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    next_try_at REAL    NOT NULL,
+    last_error  TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_try_at, id);
+CREATE TABLE IF NOT EXISTS parked (
+    id          INTEGER PRIMARY KEY,
+    tab         TEXT    NOT NULL,
+    rows        TEXT    NOT NULL,
+    n_rows      INTEGER NOT NULL,
+    enqueued_at REAL    NOT NULL,
+    attempts    INTEGER NOT NULL,
+    parked_at   REAL    NOT NULL,
+    last_error  TEXT
+);
+"""
+
+_lock = threading.Lock()
+_schema_ready = False
+_wake = threading.Event()
+_flusher = None
+
+
+def _connect():
+    global _schema_ready
+    conn = sqlite3.connect(OUTBOX_PATH, timeout=30)
+    if not _schema_ready:
+        conn.executescript(_SCHEMA)
+        _schema_ready = True
+    return conn
+
+
+def enabled():
+    """Same gate as supabase_writer.append() — nothing is queued for a
+    mirror that would be a no-op."""
+    return bool(supabase_writer.ENABLED and supabase_writer.SUPABASE_URL
+                and supabase_writer.SUPABASE_KEY)
+
+
+def enqueue(logical_tab, rows):
+    """Queue rows written to `logical_tab` for mirroring. Returns True when
+    queued, None when the mirror is off or the tab isn't mirrored. On a
+    SQLite error the rows are mirrored inline instead."""
+    if not rows or not enabled() or logical_tab not in supabase_writer._TAB_RENAME:
+        return None
+    try:
+        payload = json.dumps([list(r) for r in rows], default=str)
+        now = time.time()
+        with _lock:
+            conn = _connect()
+            try:
+                with conn:
+                    conn.execute(
+                        'INSERT INTO outbox (tab, rows, n_rows, enqueued_at, next_try_at) '
+                        'VALUES (?, ?, ?, ?, ?)',
+                        (logical_tab, payload, len(rows), now, now))
+            finally:
+                conn.close()
+    except Exception as e:
+        print(f"⚠️ mirror outbox: enqueue({logical_tab}) failed, mirroring inline: {e}")
+        supabase_writer.append(logical_tab, None, rows)
+        return None
+    start()
+    _wake.set()
+    return True
+
+
+@contextlib.contextmanager
+def _drain_lock():
+    fh = open(OUTBOX_PATH + '.lock', 'a')
+    try:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+    finally:
+        fh.close()
+
+
+def _due_batch(conn, now):
+    """The oldest due entry plus the due, never-failed entries after it for
+    the same tab, up to BATCH_ROWS rows (always at least one entry). An entry
+    that has already failed is retried alone."""
+    first = conn.execute(
+        'SELECT id, tab, rows, attempts, n_rows FROM outbox '
+        'WHERE next_try_at <= ? ORDER BY id LIMIT 1', (now,)).fetchone()
+    if not first:
+        return None, []
+    id_, tab, rows, attempts, n_rows = first
+    if attempts:
+        return tab, [(id_, rows, attempts, n_rows)]
+    batch, total = [], 0
+    for id_, rows, n_rows, attempts in conn.execute(
+            'SELECT id, rows, n_rows, attempts FROM outbox '
+            'WHERE tab = ? AND next_try_at <= ? AND attempts = 0 ORDER BY id',
+            (tab, now)):
+        if batch and total + n_rows > BATCH_ROWS:
+            break
+        batch.append((id_, rows, attempts, n_rows))
+        total += n_rows
+    return tab, batch
+
+
+def _send(tab, batch):
+    """One supabase_writer.append() call for a batch; returns the error
+    string, or None when every row went through."""
+    rows = []
+    for _, payload, _, _ in batch:
+        rows.extend(json.loads(payload))
+    first_try = all(b[2] == 0 for b in batch)
+    counts = supabase_writer.append(tab, None, rows, record_alerts=first_try)
+    if counts is None or not counts.get('failed'):
+        return None
+    return f"{counts['failed']}/{len(rows)} rows failed"
+
+
+def _drain(deadline=None):
+    """Send due batches until none are left (or `deadline` passes). Returns
+    the number of rows mirrored (0 if the outbox is unusable), or None if
+    another worker holds the drain lock."""
+    sent = 0
+    try:
+        with _drain_lock() as held:
+            if not held:
+                return None
+            while deadline is None or time.time() < deadline:
+                with _lock:
+                    conn = _connect()
+                    try:
+                        tab, batch = _due_batch(conn, time.time())
+                    finally:
+                        conn.close()
+                if not batch:
+                    break
+                try:
+                    error = _send(tab, batch)
+                except Exception as e:
+                    error = f'{type(e).__name__}: {e}'
+                ids = [(b[0],) for b in batch]
+                parked = False
+                with _lock:
+                    conn = _connect()
+                    try:
+                        with conn:
+                            if error is None:
+                                conn.executemany('DELETE FROM outbox WHERE id = ?', ids)
+                            else:
+                                attempts = max(b[2] for b in batch) + 1
+                                delay = min(MAX_BACKOFF, _BASE_BACKOFF * 2 ** (attempts - 1))
+                                conn.executemany(
+                                    'UPDATE outbox SET attempts = attempts + 1, '
+                                    'next_try_at = ?, last_error = ? WHERE id = ?',
+                                    [(time.time() + delay, error, i) for (i,) in ids])
+                                parked = attempts >= MAX_ATTEMPTS
+                                if parked:
+                                    _park(conn, ids[0][0])
+                    finally:
+                        conn.close()
+                if error is None:
+                    sent += sum(b[3] for b in batch)
+                elif parked:
+                    print(f"❌ mirror outbox: {tab} entry {ids[0][0]} ({batch[0][3]} rows) "
+                          f"parked after {attempts} failed sends: {error}")
+                else:
+                    print(f"⚠️ mirror outbox: {tab} batch of {len(batch)} entries "
+                          f"failed ({error}), retry #{attempts} in {delay:.0f}s")
+    except Exception as e:
+        print(f"⚠️ mirror outbox: drain failed: {e}")
+    return sent
+
+
+def _park(conn, id_):
+    """Move an outbox entry to `parked` (inside the caller's transaction)."""
+    conn.execute(
+        'INSERT INTO parked (id, tab, rows, n_rows, enqueued_at, attempts, parked_at, last_error) '
+        'SELECT id, tab, rows, n_rows, enqueued_at, attempts, ?, last_error '
+        'FROM outbox WHERE id = ?', (time.time(), id_))
+    conn.execute('DELETE FROM outbox WHERE id = ?', (id_,))
+
+
+def unpark(tab=None):
+    """Queue parked entries (all, or just `tab`'s) again as if new.
+    Returns how many were moved back, or None on a SQLite error."""
+    where, args = ('WHERE tab = ?', (tab,)) if tab else ('', ())
+    try:
+        with _lock:
+            conn = _connect()
+            try:
+                with conn:
+                    n = conn.execute(
+                        'INSERT INTO outbox (tab, rows, n_rows, enqueued_at, next_try_at, last_error) '
+                        f'SELECT tab, rows, n_rows, enqueued_at, ?, last_error FROM parked {where} '
+                        'ORDER BY id', (time.time(),) + args).rowcount
+                    conn.execute(f'DELETE FROM parked {where}', args)
+            finally:
+                conn.close()
+    except Exception as e:
+        print(f"⚠️ mirror outbox: unpark failed: {e}")
+        return None
+    if n:
+        _wake.set()
+    return n
+
+
+def _run():
+    while True:
+        _wake.wait(INTERVAL)
+        _wake.clear()
+        _drain()
+
+
+def start():
+    """Start this process's flusher thread (idempotent)."""
+    global _flusher
+    if not enabled():
+        return
+    with _lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_run, name='mirror-outbox', daemon=True)
+            _flusher.start()
+
+
+def flush(timeout=30):
+    """Drain whatever is due now, waiting up to `timeout` seconds for the
+    drain lock and the sends. Called from gunicorn's worker_exit hook;
+    whatever is left stays queued for the next worker."""
+    if not enabled():
+        return None
+    deadline = time.time() + timeout
+    while True:
+        sent = _drain(deadline=deadline)
+        if sent is not None or time.time() >= deadline:
+            return sent
+        time.sleep(0.5)
+
+
+def backlog():
+    """{'entries', 'rows', 'retrying', 'oldest_age_seconds', 'last_error',
+    'parked_entries', 'parked_rows', 'parked_last_error'} for what is still
+    queued or parked, or None if the outbox can't be read."""
+    try:
+        with _lock:
+            conn = _connect()
+            try:
+                entries, rows, retrying, oldest = conn.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(n_rows), 0), '
+                    'COALESCE(SUM(attempts > 0), 0), MIN(enqueued_at) FROM outbox'
+                ).fetchone()
+                last = conn.execute(
+                    'SELECT last_error FROM outbox WHERE last_error IS NOT NULL '
+                    'ORDER BY next_try_at DESC LIMIT 1').fetchone()
+                parked, parked_rows = conn.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(n_rows), 0) FROM parked').fetchone()
+                parked_last = conn.execute(
+                    'SELECT last_error FROM parked ORDER BY parked_at DESC LIMIT 1').fetchone()
+            finally:
+                conn.close()
+    except Exception as e:
+        print(f"⚠️ mirror outbox: backlog read failed: {e}")
+        return None
+    return {
+        'entries': entries,
+        'rows': rows,
+        'retrying': retrying,
+        'oldest_age_seconds': round(time.time() - oldest, 1) if oldest else 0.0,
+        'last_error': last[0] if last else None,
+        'parked_entries': parked,
+        'parked_rows': parked_rows,
+        'parked_last_error': parked_last[0] if parked_last else None,
+    }
+
+
+def render():
+    """backlog() as Prometheus gauges, for appending to /metrics."""
+    b = backlog()
+    if b is None:
+        return ''
+    lines = []
+    for name, key, text in (
+            ('mirror_outbox_entries', 'entries', 'Append batches waiting for the Supabase mirror'),
+            ('mirror_outbox_rows', 'rows', 'Rows waiting for the Supabase mirror'),
+            ('mirror_outbox_retrying_entries', 'retrying', 'Queued batches that have failed at least once'),
+            ('mirror_outbox_oldest_age_seconds', 'oldest_age_seconds', 'Age of the oldest queued batch'),
+            ('mirror_outbox_parked_entries', 'parked_entries', 'Batches parked after too many failed sends'),
+            ('mirror_outbox_parked_rows', 'parked_rows', 'Rows in parked batches')):
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {b[key]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,438 @@
+"""
+pipeline_metrics.py — stage timers, operation timers and outcome counters
+for /process runs
+
+Contract:
+  - instrument('crdb' | 'nmb') wraps process_crdb_transactions /
+    process_nmb_transactions. One wrapped call is one run: it opens in stage
+    'reading', and every stage(name) call (app.py's _job_progress forwards
+    its stage transitions here) closes the previous stage's wall time.
+    When the wrapped function returns, the response's status code and
+    `stats` dict become the run's outcome counters.
+  - timed(op, tab='') is a context manager, traced(op, tab_arg=None) the
+    decorator form — seconds per operation (sheet write, Supabase mirror,
+    highlight, customer load, dedup reads ...) with an optional tab label.
+    rows_written(tab, n) counts rows that reached a sheet. All of these are
+    no-ops outside a run, so the same helpers called from /api/sms-rescue
+    or the admin routes cost nothing and record nothing.
+  - supabase_hook is registered with supabase_client.add_timing_hook();
+    while a run is open every Supabase response made for it (registry
+    pages, dedup reads) is counted against it.
+  - The open run is per thread. The mirror outbox flusher, the audit writer
+    and other requests keep running beside a /process job, and their calls
+    must not land in its numbers. Work a run hands to a thread pool goes
+    through carry(fn), which opens the same run on the pool thread for the
+    length of the call.
+  - At the end of a run its summary (stages, operations, outcomes, rows,
+    Supabase calls) is written as JSON to METRICS_DIR/runs/ and folded into
+    METRICS_DIR/totals.json. gunicorn runs several workers and recycles
+    them every max_requests, so in-memory counters would be per-worker and
+    reset at random; the totals file gives every worker the same view. The
+    fold is a read-modify-write under an fcntl lock plus an atomic replace,
+    so a scrape never reads a half-written file. Runs are already
+    serialised by the /process lock — the lock here is a second fence.
+  - render() returns the totals in Prometheus text format (counters,
+    histograms with STAGE_BUCKETS, last-run gauges); recent_runs(n) the
+    newest summaries. Neither raises — a metrics failure is logged and
+    never breaks a run or a scrape.
+  - row_log() is print() behind PIPELINE_LOG_LEVEL. The classifier and the
+    extractors it calls used to print several lines per statement row; on
+    a 10k-row statement that was tens of thousands of writes to Render's
+    log pipe. They go through row_log() and stay silent unless the level
+    is 'debug'.
+
+Env vars:
+  PIPELINE_METRICS_DIR        where totals.json and runs/ live
+                              (default /tmp/transaction_processor_metrics)
+  PIPELINE_METRICS_KEEP_RUNS  per-run summaries kept on disk (default 50)
+  PIPELINE_LOG_LEVEL          'debug' → per-row lines on; 'info' (default)
+                              → stage / run level lines only
+"""
+
+import contextlib
+import fcntl
+import functools
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+METRICS_DIR = os.environ.get('PIPELINE_METRICS_DIR', '/tmp/transaction_processor_metrics')
+KEEP_RUNS = int(os.environ.get('PIPELINE_METRICS_KEEP_RUNS', '50'))
+LOG_LEVEL = os.environ.get('PIPELINE_LOG_LEVEL', 'info').lower()
+ROW_LOG = LOG_LEVEL == 'debug'
+
+# Seconds. Covers a 50 ms sheet write up to the 300 s gunicorn timeout.
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_HELP = {
+    'pipeline_runs_total':              ('counter', '/process pipeline runs by HTTP status class'),
+    'pipeline_stage_seconds':           ('histogram', 'Wall time per pipeline stage'),
+    'pipeline_operation_seconds':       ('histogram', 'Wall time per timed operation inside a run'),
+    'pipeline_rows_read_total':         ('counter', 'Credit rows read from uploaded statements'),
+    'pipeline_rows_total':              ('counter', 'Classified rows by outcome'),
+    'pipeline_rows_written_total':      ('counter', 'Rows appended to output sheet tabs'),
+    'pipeline_supabase_requests_total': ('counter', 'Supabase requests made during runs'),
+    'pipeline_supabase_errors_total':   ('counter', 'Supabase responses >= 400 during runs'),
+    'pipeline_supabase_seconds_total':  ('counter', 'Seconds spent in Supabase requests during runs'),
+    'pipeline_last_run_timestamp_seconds': ('gauge', 'Unix time the last run finished'),
+    'pipeline_last_run_seconds':        ('gauge', 'Wall time of the last run'),
+    'pipeline_last_run_http_status':    ('gauge', 'HTTP status of the last run'),
+}
+
+_lock = threading.Lock()
+_current = threading.local()     # .run — the run open on this thread
+
+
+def row_log(*args, **kwargs):
+    """print() for per-row diagnostics — silent unless PIPELINE_LOG_LEVEL=debug."""
+    if ROW_LOG:
+        print(*args, **kwargs)
+
+
+# ── series helpers ──────────────────────────────────────────────────────────
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _series(name, **labels):
+    if not labels:
+        return name
+    inner = ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return f'{name}{{{inner}}}'
+
+
+def _observe(hists, key, seconds):
+    h = hists.get(key)
+    if h is None:
+        h = hists[key] = {'buckets': [0] * len(STAGE_BUCKETS), 'sum': 0.0, 'count': 0}
+    for i, le in enumerate(STAGE_BUCKETS):
+        if seconds <= le:
+            h['buckets'][i] += 1
+    h['sum'] += seconds
+    h['count'] += 1
+
+
+# ── the run ─────────────────────────────────────────────────────────────────
+
+class _Run:
+    def __init__(self, pipeline, bank):
+        self.pipeline = pipeline
+        self.bank = bank
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.stage = 'reading'
+        self.stage_t = self.t0
+        self.stages = {}
+        self.ops = {}
+        self.written = {}
+        self.supabase = {}
+
+    def enter_stage(self, name):
+        now = time.perf_counter()
+        with _lock:
+            if self.stage is not None:
+                self.stages[self.stage] = self.stages.get(self.stage, 0.0) + (now - self.stage_t)
+            self.stage, self.stage_t = name, now
+
+    def add_op(self, op, tab, seconds):
+        with _lock:
+            s = self.ops.setdefault(op, {}).setdefault(tab, {'calls': 0, 'seconds': 0.0, 'samples': []})
+            s['calls'] += 1
+            s['seconds'] += seconds
+            s['samples'].append(seconds)
+
+    def summary(self, http_status, stats):
+        self.enter_stage(None)
+        outcomes = {k: v for k, v in (stats or {}).items() if k != 'total'}
+        return {
+            'pipeline': self.pipeline,
+            'bank': self.bank,
+            'pid': os.getpid(),
+            'started_at': datetime.fromtimestamp(self.started).isoformat(),
+            'finished_at': datetime.now().isoformat(),
+            'seconds': round(time.perf_counter() - self.t0, 3),
+            'http_status': http_status,
+            'rows_read': (stats or {}).get('total'),
+            'stages': {k: round(v, 3) for k, v in self.stages.items()},
+            'operations': {op: {tab or '-': {'calls': s['calls'], 'seconds': round(s['seconds'], 3)}
+                                for tab, s in tabs.items()}
+                           for op, tabs in self.ops.items()},
+            'outcomes': outcomes,
+            'rows_written': dict(self.written),
+            'supabase': {p: dict(s, seconds=round(s['seconds'], 3))
+                         for p, s in self.supabase.items()},
+        }
+
+
+def _active():
+    return getattr(_current, 'run', None)
+
+
+def carry(fn):
+    """Wrap fn so it runs inside this thread's open run wherever it is
+    called — for ThreadPoolExecutor work done on the run's behalf."""
+    run = _active()
+    if run is None:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        outer = _active()
+        _current.run = run
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.run = outer
+    return wrapper
+
+
+def stage(name):
+    """Stage transition for the open run (no-op without one)."""
+    run = _active()
+    if run is not None:
+        run.enter_stage(name)
+
+
+@contextlib.contextmanager
+def timed(op, tab=''):
+    run = _active()
+    if run is None:
+        yield
+        return
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        run.add_op(op, tab, time.perf_counter() - t)
+
+
+def traced(op, tab_arg=None):
+    """Decorator: time every call as `op`, labelled with the value of the
+    wrapped function's `tab_arg` parameter (by name) when given."""
+    def deco(fn):
+        import inspect
+        params = list(inspect.signature(fn).parameters)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _active() is None:
+                return fn(*args, **kwargs)
+            tab = ''
+            if tab_arg is not None:
+                if tab_arg in kwargs:
+                    tab = kwargs[tab_arg]
+                elif tab_arg in params and params.index(tab_arg) < len(args):
+                    tab = args[params.index(tab_arg)]
+            with timed(op, tab or ''):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def rows_written(tab, n):
+    run = _active()
+    if run is not None:
+        with _lock:
+            run.written[tab] = run.written.get(tab, 0) + n
+
+
+def supabase_hook(project, method, url, status, seconds):
+    run = _active()
+    if run is None:
+        return
+    with _lock:
+        s = run.supabase.setdefault(project, {'calls': 0, 'errors': 0, 'seconds': 0.0})
+        s['calls'] += 1
+        s['seconds'] += seconds
+        if status >= 400:
+            s['errors'] += 1
+
+
+_LAST = threading.local()
+
+
+def last_summary():
+    """Summary of the last run finished on this thread, or None."""
+    return getattr(_LAST, 'summary', None)
+
+
+def _response_parts(resp):
+    code = 200
+    if isinstance(resp, tuple):
+        resp, code = resp[0], resp[1]
+    body = resp.get_json(silent=True) if hasattr(resp, 'get_json') else resp
+    stats = body.get('stats') if isinstance(body, dict) else None
+    return code, stats
+
+
+def instrument(pipeline):
+    """Decorator for a pipeline entry point — see module docstring."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            run = _Run(pipeline, kwargs.get('bank_label', pipeline.upper()))
+            _current.run = run
+            _LAST.summary = None
+            resp = None
+            try:
+                resp = fn(*args, **kwargs)
+                return resp
+            finally:
+                _current.run = None
+                try:
+                    code, stats = _response_parts(resp) if resp is not None else (500, None)
+                    summary = run.summary(code, stats)
+                    _LAST.summary = summary
+                    _persist(run, summary)
+                    print(f"⏱️ {pipeline} run: {summary['seconds']:.1f}s — "
+                          + ', '.join(f'{k} {v:.1f}s' for k, v in summary['stages'].items()))
+                except Exception as e:
+                    print(f"⚠️ pipeline metrics: could not record run: {e}")
+        return wrapper
+    return deco
+
+
+# ── persistence ─────────────────────────────────────────────────────────────
+
+def _totals_path():
+    return os.path.join(METRICS_DIR, 'totals.json')
+
+
+def _runs_dir():
+    return os.path.join(METRICS_DIR, 'runs')
+
+
+def _read_totals():
+    try:
+        with open(_totals_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'counters': {}, 'histograms': {}, 'gauges': {}}
+
+
+def _write_json(path, data):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, default=str)
+    os.replace(tmp, path)
+
+
+def _fold(totals, run, summary):
+    p = run.pipeline
+    counters, hists, gauges = totals['counters'], totals['histograms'], totals['gauges']
+
+    def inc(key, n):
+        counters[key] = counters.get(key, 0) + n
+
+    status = summary['http_status'] or 0
+    inc(_series('pipeline_runs_total', pipeline=p, status=f'{status // 100}xx'), 1)
+    for name, seconds in summary['stages'].items():
+        _observe(hists, _series('pipeline_stage_seconds', pipeline=p, stage=name), seconds)
+    for op, tabs in run.ops.items():
+        for tab, s in tabs.items():
+            key = _series('pipeline_operation_seconds', pipeline=p, operation=op, tab=tab)
+            for seconds in s['samples']:
+                _observe(hists, key, seconds)
+    if summary['rows_read']:
+        inc(_series('pipeline_rows_read_total', pipeline=p), summary['rows_read'])
+    for outcome, n in summary['outcomes'].items():
+        if isinstance(n, (int, float)) and n:
+            # NMB's keys carry the bank (failed_nmb, passed_sav_nmb) — one
+            # outcome vocabulary across pipelines, the label says which.
+            name = outcome[:-4] if outcome.endswith('_nmb') else outcome
+            inc(_series('pipeline_rows_total', pipeline=p, outcome=name), n)
+    for tab, n in summary['rows_written'].items():
+        inc(_series('pipeline_rows_written_total', pipeline=p, tab=tab), n)
+    for project, s in summary['supabase'].items():
+        inc(_series('pipeline_supabase_requests_total', pipeline=p, project=project), s['calls'])
+        inc(_series('pipeline_supabase_errors_total', pipeline=p, project=project), s['errors'])
+        inc(_series('pipeline_supabase_seconds_total', pipeline=p, project=project), s['seconds'])
+    gauges[_series('pipeline_last_run_timestamp_seconds', pipeline=p)] = round(time.time(), 3)
+    gauges[_series('pipeline_last_run_seconds', pipeline=p)] = summary['seconds']
+    gauges[_series('pipeline_last_run_http_status', pipeline=p)] = status
+
+
+def _persist(run, summary):
+    os.makedirs(_runs_dir(), exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    _write_json(os.path.join(_runs_dir(), f'{stamp}-{run.pipeline}-{os.getpid()}.json'), summary)
+    with open(os.path.join(METRICS_DIR, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        totals = _read_totals()
+        _fold(totals, run, summary)
+        _write_json(_totals_path(), totals)
+    names = sorted(n for n in os.listdir(_runs_dir()) if n.endswith('.json'))
+    for name in names[:-KEEP_RUNS] if KEEP_RUNS > 0 else []:
+        try:
+            os.remove(os.path.join(_runs_dir(), name))
+        except OSError:
+            pass
+
+
+# ── exposition ──────────────────────────────────────────────────────────────
+
+def _metric_name(series):
+    return series.split('{', 1)[0]
+
+
+def _with_label(series, extra):
+    if '{' in series:
+        return series[:-1] + ',' + extra + '}'
+    return series + '{' + extra + '}'
+
+
+def render():
+    """Totals in Prometheus text exposition format (version 0.0.4)."""
+    try:
+        totals = _read_totals()
+    except Exception as e:
+        print(f"⚠️ pipeline metrics: could not read totals: {e}")
+        totals = {'counters': {}, 'histograms': {}, 'gauges': {}}
+    lines = []
+    seen = set()
+
+    def header(name):
+        if name not in seen:
+            seen.add(name)
+            kind, text = _HELP.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+    for series in sorted(totals.get('counters', {})):
+        header(_metric_name(series))
+        lines.append(f"{series} {totals['counters'][series]}")
+    for series in sorted(totals.get('histograms', {})):
+        name = _metric_name(series)
+        header(name)
+        h = totals['histograms'][series]
+        labels = series[len(name):]
+        bucket = name + '_bucket' + labels
+        for le, n in zip(STAGE_BUCKETS, h['buckets']):
+            lines.append('%s %d' % (_with_label(bucket, f'le="{le}"'), n))
+        lines.append('%s %d' % (_with_label(bucket, 'le="+Inf"'), h['count']))
+        lines.append(f'{name}_sum{labels} {round(h["sum"], 6)}')
+        lines.append(f'{name}_count{labels} {h["count"]}')
+    for series in sorted(totals.get('gauges', {})):
+        header(_metric_name(series))
+        lines.append(f"{series} {totals['gauges'][series]}")
+    return '\n'.join(lines) + '\n'
+
+
+def recent_runs(limit=10):
+    """Newest-first per-run summaries from METRICS_DIR/runs."""
+    try:
+        names = sorted((n for n in os.listdir(_runs_dir()) if n.endswith('.json')),
+                       reverse=True)[:max(0, limit)]
+    except OSError:
+        return []
+    out = []
+    for name in names:
+        try:
+            with open(os.path.join(_runs_dir(), name)) as f:
+                out.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return out
@@ -0,0 +1,195 @@
+"""
+ref_index.py — local persistent ref/message index for sheet dedup
+
+Contract:
+  - get_existing_refs() in app.py used to download the whole message (D) and
+    ref (H/I) columns of every output tab on every /process run — 30k+ rows
+    per tab and growing linearly with history. This module keeps those sets
+    in a local SQLite file keyed by logical tab, together with the sheet row
+    count they were read up to (`synced_rows`). A run then only fetches the
+    tail rows added since the last sync.
+  - The row count alone can't tell a sheet that grew from one where a row
+    was deleted and another appended since. The index also keeps the
+    column-D message of row `synced_rows` (`tail_key`). Every sync re-reads
+    that row with the tail, and a mismatch means rows moved: the tab is
+    re-read from row 1.
+  - append_to_sheet() calls record_append() after a successful write so the
+    rows we just wrote never have to be read back.
+  - Never raises. Every function returns None on a SQLite error and the
+    caller falls back to the original full-column Sheets read.
+
+Env vars:
+  REF_INDEX                    '0' / 'false' to disable (default on)
+  REF_INDEX_PATH               SQLite file (default .ref_index.sqlite3 next to app.py)
+  REF_INDEX_FULL_RESYNC_HOURS  force a full re-read of a tab after this long
+                               (default 24) — picks up hand edits / deletes
+                               in the middle of a tab that the tail sync
+                               can't see
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+ENABLED = os.environ.get('REF_INDEX', 'true').lower() in ('1', 'true', 'yes')
+INDEX_PATH = os.environ.get('REF_INDEX_PATH') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '.ref_index.sqlite3')
+FULL_RESYNC_SECONDS = float(os.environ.get('REF_INDEX_FULL_RESYNC_HOURS', '24')) * 3600
+
+# `from_msg` = 1 when the ref was only ever seen inside a message (the
+# 'REF: xxxx' pattern in column D), never in the ref column itself. The
+# refs_only read path has never included those, so load() filters them out.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tab_state (
+    tab          TEXT PRIMARY KEY,
+    synced_rows  INTEGER NOT NULL,
+    full_sync_at REAL    NOT NULL,
+    tail_key     TEXT
+);
+CREATE TABLE IF NOT EXISTS refs (
+    tab      TEXT    NOT NULL,
+    ref      TEXT    NOT NULL,
+    from_msg INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (tab, ref)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS messages (
+    tab     TEXT NOT NULL,
+    message TEXT NOT NULL,
+    PRIMARY KEY (tab, message)
+) WITHOUT ROWID;
+"""
+
+# gunicorn runs several worker processes, each with its own connection;
+# SQLite's file lock (+ busy timeout) serialises them. The thread lock only
+# covers threads inside one worker sharing this module.
+_lock = threading.Lock()
+_schema_ready = False
+
+
+def _connect():
+    global _schema_ready
+    conn = sqlite3.connect(INDEX_PATH, timeout=30)
+    if not _schema_ready:
+        conn.executescript(_SCHEMA)
+        # Index files from before tail_key: a NULL key forces one full sync.
+        try:
+            conn.execute('ALTER TABLE tab_state ADD COLUMN tail_key TEXT')
+        except sqlite3.OperationalError:
+            pass
+        _schema_ready = True
+    return conn
+
+
+def tail_key(message_cell):
+    """The fingerprint kept for a tab's last synced row: its column-D value
+    as _collect_refs() would read it ('' for an empty cell)."""
+    return str(message_cell).strip() if message_cell not in (None, '') else ''
+
+
+def state(tab):
+    """(synced_rows, full_sync_at, tail_key) for a tab — (0, 0.0, None) if
+    never synced, None if the index is unusable."""
+    try:
+        with _lock:
+            conn = _connect()
+            try:
+                row = conn.execute(
+                    'SELECT synced_rows, full_sync_at, tail_key FROM tab_state WHERE tab = ?',
+                    (tab,)).fetchone()
+            finally:
+                conn.close()
+        return (int(row[0]), float(row[1]), row[2]) if row else (0, 0.0, None)
+    except Exception as e:
+        print(f"⚠️ ref index: state({tab}) failed: {e}")
+        return None
+
+
+def needs_full_sync(tab_state, last_row):
+    """True when the tail sync can't be trusted and the tab must be re-read
+    from row 1: never synced, no tail_key yet, rows disappeared (sheet
+    sorted / rows deleted), or the last full read is older than
+    FULL_RESYNC_SECONDS. A tail sync still has to check tail_key against
+    row synced_rows (see module docstring)."""
+    synced, full_at, key = tab_state
+    return (synced == 0
+            or key is None
+            or last_row < synced
+            or time.time() - full_at > FULL_RESYNC_SECONDS)
+
+
+def add(tab, refs, msg_refs, messages, synced_rows, key, full=False):
+    """Merge one batch of rows read (or written) into the index and move the
+    tab's high-water row to `synced_rows`, whose tail_key() is `key`.
+    full=True replaces the tab's contents instead of merging. Returns True
+    on success, None on error."""
+    try:
+        with _lock:
+            conn = _connect()
+            try:
+                with conn:
+                    if full:
+                        conn.execute('DELETE FROM refs WHERE tab = ?', (tab,))
+                        conn.execute('DELETE FROM messages WHERE tab = ?', (tab,))
+                    conn.executemany(
+                        'INSERT INTO refs (tab, ref, from_msg) VALUES (?, ?, 0) '
+                        'ON CONFLICT (tab, ref) DO UPDATE SET from_msg = 0',
+                        [(tab, r) for r in refs])
+                    conn.executemany(
+                        'INSERT OR IGNORE INTO refs (tab, ref, from_msg) VALUES (?, ?, 1)',
+                        [(tab, r) for r in msg_refs])
+                    conn.executemany(
+                        'INSERT OR IGNORE INTO messages (tab, message) VALUES (?, ?)',
+                        [(tab, m) for m in messages])
+                    if full:
+                        conn.execute(
+                            'INSERT OR REPLACE INTO tab_state '
+                            '(tab, synced_rows, full_sync_at, tail_key) VALUES (?, ?, ?, ?)',
+                            (tab, int(synced_rows), time.time(), key))
+                    else:
+                        conn.execute(
+                            'UPDATE tab_state SET synced_rows = ?, tail_key = ? WHERE tab = ?',
+                            (int(synced_rows), key, tab))
+            finally:
+                conn.close()
+        return True
+    except Exception as e:
+        print(f"⚠️ ref index: add({tab}) failed: {e}")
+        return None
+
+
+def record_append(tab, start_row, n_rows, refs, msg_refs, messages, key):
+    """Called after append_to_sheet() wrote `n_rows` rows starting at
+    `start_row`, the last of them with tail_key() `key`.
+
+    Only advances the index when it was exactly in sync before the write
+    (synced_rows == start_row - 1). Otherwise someone else wrote rows we
+    haven't read yet and the next tail sync picks everything up in order.
+    """
+    st = state(tab)
+    if st is None or st[0] == 0 or st[0] != start_row - 1:
+        return None
+    return add(tab, refs, msg_refs, messages, synced_rows=start_row - 1 + n_rows, key=key)
+
+
+def load(tab, refs_only=False):
+    """(refs, messages) sets for a tab, shaped exactly like get_existing_refs()
+    returns them. refs_only → no message-derived refs and an empty messages set."""
+    try:
+        with _lock:
+            conn = _connect()
+            try:
+                if refs_only:
+                    refs = {r for (r,) in conn.execute(
+                        'SELECT ref FROM refs WHERE tab = ? AND from_msg = 0', (tab,))}
+                    return refs, set()
+                refs = {r for (r,) in conn.execute(
+                    'SELECT ref FROM refs WHERE tab = ?', (tab,))}
+                messages = {m for (m,) in conn.execute(
+                    'SELECT message FROM messages WHERE tab = ?', (tab,))}
+                return refs, messages
+            finally:
+                conn.close()
+    except Exception as e:
+        print(f"⚠️ ref index: load({tab}) failed: {e}")
+        return None
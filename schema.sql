@@ -84,6 +84,11 @@ CREATE INDEX IF NOT EXISTS idx_tx_ref
 CREATE INDEX IF NOT EXISTS idx_tx_audit
   ON transactions(bank, source_tab, transaction_day);
 
+-- daily_totals() RPC: source_tab = ANY(...) AND transaction_day >= ...
+-- (scripts/004_daily_totals_rpc.sql)
+CREATE INDEX IF NOT EXISTS idx_tx_daily_totals
+  ON transactions(source_tab, transaction_day) INCLUDE (credit_amount);
+
 -- Recent-activity queries in Supabase Studio
 CREATE INDEX IF NOT EXISTS idx_tx_created
   ON transactions(created_at DESC);
@@ -150,7 +155,9 @@ CREATE TABLE IF NOT EXISTS sms_events (
   extracted_ref   text,
   rescued_row_id  bigint,                -- transactions.id if we rescued
   rescued_source_tab text,               -- BODAILIYOPATA | IPHONEILIYOPATA
-  error_detail   text                    -- server error text, if any
+  error_detail   text,                   -- server error text, if any
+  body_hash      text                    -- sms_event_dedup.body_hash(), see
+                                         -- scripts/006_sms_events_body_hash.sql
 );
 
 CREATE INDEX IF NOT EXISTS idx_sms_events_processed
@@ -160,6 +167,8 @@ CREATE INDEX IF NOT EXISTS idx_sms_events_outcome
 CREATE INDEX IF NOT EXISTS idx_sms_events_ref
   ON sms_events(extracted_ref)
   WHERE extracted_ref IS NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS ux_sms_events_body_hash
+  ON sms_events(body_hash);
 
 
 -- ── dedup_alerts ───────────────────────────────────────────────────────────
@@ -0,0 +1,43 @@
+-- =============================================================================
+-- Migration 004: daily_totals() RPC for /admin/daily-totals
+--
+-- The endpoint used to page every PASSED-family transaction in the window
+-- through PostgREST 1000 rows at a time and sum credit_amount in Python —
+-- tens of thousands of rows over the wire to produce a few hundred numbers.
+-- This does the GROUP BY in the database and returns one row per
+-- (source_tab, transaction_day).
+--
+-- The filter is source_tab = ANY(tabs) plus a transaction_day range, with
+-- no condition on bank, so idx_tx_audit (bank, source_tab,
+-- transaction_day) can't serve it: its leading column is unconstrained.
+-- idx_tx_daily_totals below leads with exactly the filtered columns and
+-- carries credit_amount, so the sum is an index-only scan (once the table
+-- has been vacuumed). The app adds rows up per (source_tab, day), so bank
+-- is not grouped on.
+--
+-- Called as POST /rest/v1/rpc/daily_totals
+--   {"from_day": "2026-06-01", "tabs": ["CRDBPASSED", "NMBPASSED", ...]}
+--
+-- Run once via the Supabase SQL editor. Idempotent (CREATE OR REPLACE).
+-- The app falls back to the old paged read until this exists.
+-- =============================================================================
+
+CREATE OR REPLACE FUNCTION daily_totals(from_day date, tabs text[])
+RETURNS TABLE (source_tab text, transaction_day date,
+               total numeric, row_count bigint)
+LANGUAGE sql STABLE
+AS $$
+    SELECT t.source_tab, t.transaction_day,
+           sum(t.credit_amount) AS total, count(*) AS row_count
+      FROM transactions t
+     WHERE t.source_tab = ANY(tabs)
+       AND t.transaction_day >= from_day
+     GROUP BY t.source_tab, t.transaction_day
+     ORDER BY t.source_tab, t.transaction_day;
+$$;
+
+CREATE INDEX IF NOT EXISTS idx_tx_daily_totals
+  ON transactions(source_tab, transaction_day) INCLUDE (credit_amount);
+
+-- PostgREST caches the schema; make the new function callable right away.
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,70 @@
+-- =============================================================================
+-- Migration 005: dup_refs() RPC for /admin/dup-refs
+--
+-- The endpoint used to pull every transaction in the window into a Python
+-- dict just to count refs seen more than once, which made a full-history
+-- check impossible (memory + request timeout). This does the
+-- GROUP BY ref HAVING count(*) > 1 in the database and returns only the
+-- offending refs with their rows, as one jsonb document:
+--
+--   {"refs_scanned": 1234, "last_ref": "FT26...", "dupes": {"<ref>": [rows]}}
+--
+-- Refs are compared trimmed (same as the old Python tally) so a copy that
+-- slipped past ux_tx_ref_unique with stray whitespace still shows up.
+--
+-- Arguments (all optional):
+--   from_day   only rows with transaction_day >= from_day (NULL = all history)
+--   after_ref  keyset cursor — only refs sorting after this one
+--   max_refs   scan at most this many distinct refs (NULL = no limit)
+--
+-- /admin/dup-refs?full=1 walks the whole table with after_ref / max_refs,
+-- one bounded page per call, along idx_tx_ref_btrim below.
+--
+-- Run once via the Supabase SQL editor. Idempotent.
+-- =============================================================================
+
+CREATE INDEX IF NOT EXISTS idx_tx_ref_btrim
+    ON transactions (btrim(ref_number))
+    WHERE ref_number IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION dup_refs(from_day  date    DEFAULT NULL,
+                                    after_ref text    DEFAULT NULL,
+                                    max_refs  integer DEFAULT NULL)
+RETURNS jsonb
+LANGUAGE sql STABLE
+AS $$
+    WITH scanned AS (
+        SELECT btrim(t.ref_number) AS ref, count(*) AS copies
+          FROM transactions t
+         WHERE t.ref_number IS NOT NULL
+           AND btrim(t.ref_number) <> ''
+           AND (from_day  IS NULL OR t.transaction_day >= from_day)
+           AND (after_ref IS NULL OR btrim(t.ref_number) > after_ref)
+         GROUP BY btrim(t.ref_number)
+         ORDER BY btrim(t.ref_number)
+         LIMIT max_refs
+    ), dupes AS (
+        SELECT s.ref,
+               jsonb_agg(jsonb_build_object(
+                   'id',              t.id,
+                   'ref_number',      t.ref_number,
+                   'transaction_day', t.transaction_day,
+                   'source_tab',      t.source_tab,
+                   'credit_amount',   t.credit_amount) ORDER BY t.id) AS rows
+          FROM scanned s
+          JOIN transactions t
+            ON t.ref_number IS NOT NULL
+           AND btrim(t.ref_number) = s.ref
+           AND (from_day IS NULL OR t.transaction_day >= from_day)
+         WHERE s.copies > 1
+         GROUP BY s.ref
+    )
+    SELECT jsonb_build_object(
+        'refs_scanned', (SELECT count(*) FROM scanned),
+        'last_ref',     (SELECT max(ref) FROM scanned),
+        'dupes',        COALESCE((SELECT jsonb_object_agg(ref, rows) FROM dupes),
+                                 '{}'::jsonb));
+$$;
+
+-- PostgREST caches the schema; make the new function callable right away.
+NOTIFY pgrst, 'reload schema';
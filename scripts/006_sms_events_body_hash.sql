@@ -0,0 +1,30 @@
+-- =============================================================================
+-- Migration 006: sms_events.body_hash for duplicate suppression
+--
+-- _sms_event_insert() used to GET sms_events with body=eq.<full SMS body>
+-- before every insert to skip OkHttp retries and double broadcasts of the
+-- same message, an extra round trip per SMS plus an unindexed scan on a text
+-- column. The check is now local (sms_event_dedup.py), and this column is
+-- the DB-side backstop for whatever a worker restart or a race lets through.
+--
+-- body_hash = sha256 of (sender, body, outcome) plus the
+-- SMS_EVENT_DEDUP_SECONDS time bucket, so the same message can be logged
+-- again in a later window. Rows written before this migration keep NULL,
+-- and NULLs never conflict with each other.
+--
+-- The index is deliberately NOT partial (no WHERE body_hash IS NOT NULL):
+-- PostgREST's on_conflict=body_hash can only target a plain unique index,
+-- and leaving the NULLs in costs nothing.
+--
+-- Until this runs, the app notices the missing column on the first insert
+-- and falls back to plain inserts. Run once via the Supabase SQL editor.
+-- Idempotent.
+-- =============================================================================
+
+ALTER TABLE sms_events ADD COLUMN IF NOT EXISTS body_hash text;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_sms_events_body_hash
+    ON sms_events (body_hash);
+
+-- PostgREST caches the schema; make the new column visible right away.
+NOTIFY pgrst, 'reload schema';
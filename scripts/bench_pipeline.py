@@ -0,0 +1,837 @@
+#!/usr/bin/env python3
+"""
+bench_pipeline.py — end-to-end benchmark of the /process pipeline on
+synthetic bank statements.
+
+Generates CRDB Excel and NMB CSV / Excel / PDF statements plus a matching
+customer base (pikipiki records, records2, IPHONE_RECORDS and the same
+customers as customer_registry rows), then runs process_crdb_transactions /
+process_nmb_transactions from app.py against in-memory fakes of Google
+Sheets and Supabase, and reports wall time per pipeline stage, rows/sec and
+peak RSS against the production envelope (one 512MB instance, 300 s
+gunicorn timeout).
+
+Contract:
+
+  - Nothing leaves the machine. The Sheets service is an in-memory grid
+    that answers the values().get / batchGet / update / append and
+    spreadsheets().get / batchUpdate calls the pipeline makes. Supabase
+    requests still go through supabase_client's sessions (retries, timing
+    hooks) but hit a transport adapter that serves customer_registry pages
+    and accepts every write.
+
+  - Every scenario runs in a fresh interpreter, so peak RSS (ru_maxrss of
+    the run plus any pool workers it forked) is that scenario's alone. The
+    statement file and the customer/sheet "world" are generated in the
+    parent and only read by the child; the child's RSS includes the world
+    it serves, the same way production holds the API payloads.
+
+  - Rows are a seeded mix of the paths the classifier takes: exact plate,
+    phone, FROM depositor, SAV customer, iPhone, messy plate (rescue
+    tier), short plate (fuzzy), unknown customer, no REF / no description
+    and already-in-sheet duplicates. Same --seed → same files.
+
+  - Per-stage times come from the job progress the pipeline already
+    reports (_job_progress stage transitions: reading → loading_customers →
+    dedup → classifying → writing); the run's pipeline_metrics summary
+    (sheet writes, mirror, dedup reads per tab) lands in --json output.
+
+  - Writes REF_INDEX=0 and CUSTOMER_CACHE_TTL=0 into the child's
+    environment (cold-path numbers; pass --warm to keep the customer
+    cache) and points the highwater / cache files at a temp dir — a run
+    never touches the app's real state files.
+
+Usage:
+  python scripts/bench_pipeline.py --quick
+  python scripts/bench_pipeline.py --rows 1000,10000,50000 --customers 2000,20000
+  python scripts/bench_pipeline.py --formats nmb-pdf --rows 10000 --json out.json
+  python scripts/bench_pipeline.py --sheets-latency-ms 150 --source registry
+
+Formats: crdb-xlsx, nmb-csv, nmb-xlsx, nmb-pdf (nmb-pdf needs reportlab
+installed for generation; it is skipped with a note otherwise).
+
+Exit codes:
+  0 — every scenario finished inside --max-rss-mb and --max-seconds
+  1 — a scenario failed or exceeded the envelope
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+_APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _APP_ROOT not in sys.path:
+    sys.path.insert(0, _APP_ROOT)
+
+FORMATS = ('crdb-xlsx', 'nmb-csv', 'nmb-xlsx', 'nmb-pdf')
+STAGES = ('reading', 'loading_customers', 'dedup', 'classifying', 'writing')
+
+# Share of statement rows per classifier path (normalised at use).
+MIX = {
+    'plate':     0.34,
+    'phone':     0.14,
+    'depositor': 0.07,
+    'sav':       0.10,
+    'iphone':    0.05,
+    'rescue':    0.05,
+    'fuzzy':     0.05,
+    'unknown':   0.10,
+    'noref':     0.04,
+    'dup':       0.06,
+}
+
+# Sheet IDs as app.py has them — duplicated so the parent never imports app.
+PASSED_SHEET_ID   = '1rdSRNLdZPT5xXLRgV7wSn1beYwWZp41ZpYoLkbGmt0o'
+PIKIPIKI_SHEET_ID = '1XFwPITQgZmzZ8lbg8MKD9S4rwHyk2cDOKrcxO7SAjHA'
+IPHONE_SHEET_ID   = '1Y2cOyObQvP502kvEbC-uGDP-3Sf5X9JKnDDYmR0BPRQ'
+NMB_SHEET_ID      = '1YchOygtfVyVNgz37sGX_KKud_Wr9KQsIkQKn_tEdbek'
+
+_OUTPUT_TABS = {
+    (PASSED_SHEET_ID, 'PASSED'):         9,
+    (PASSED_SHEET_ID, 'PASSED_SAV'):     9,
+    (PASSED_SHEET_ID, 'FAILED'):         9,
+    (PASSED_SHEET_ID, 'PASSED_SAV_NMB'): 9,
+    (PASSED_SHEET_ID, 'FAILED_NMB'):     8,
+    (NMB_SHEET_ID,    'PASSED'):         9,
+    (NMB_SHEET_ID,    'PASSED_SAV_NMB'): 9,
+    (NMB_SHEET_ID,    'FAILED_NMB'):     8,
+    (IPHONE_SHEET_ID, 'BANK_PASSED'):    9,
+    (IPHONE_SHEET_ID, 'BANK_FAILED'):    8,
+}
+
+_FIRST = ('JOHN', 'ASHA', 'JUMA', 'NEEMA', 'SAIDI', 'HAMISI', 'REHEMA', 'BARAKA',
+          'DENIS', 'FATUMA', 'ISSA', 'MWAJUMA', 'PETER', 'HALIMA', 'ABDALLAH')
+_LAST = ('MUSHI', 'MOSHA', 'KIMARO', 'MREMA', 'SWAI', 'LYIMO', 'TESHA', 'MASSAWE',
+         'JIKA', 'NJAU', 'URIO', 'MALLYA', 'SHIRIMA', 'MINJA', 'KWEKA')
+
+
+# ── synthetic world ─────────────────────────────────────────────────────────
+
+def _name(rng):
+    return f'{rng.choice(_FIRST)} {rng.choice(_FIRST)} {rng.choice(_LAST)}'
+
+
+def _phone(rng, used):
+    while True:
+        p = f'07{rng.randint(10_000_000, 99_999_999)}'
+        if p not in used:
+            used.add(p)
+            return p
+
+
+def make_customers(n, rng):
+    """n customers: ~72% boda (pikipiki records), ~20% SAV (records2),
+    ~8% iPhone. Some boda rows carry a depositor name in col D instead of
+    a phone. Returns a list of dicts."""
+    plates, phones, customers = set(), set(), []
+    for i in range(n):
+        r = rng.random()
+        ctype = 'boda' if r < 0.72 else 'savcom' if r < 0.92 else 'iphone'
+        c = {'type': ctype, 'name': _name(rng), 'phone': _phone(rng, phones)}
+        if ctype != 'iphone':
+            while True:
+                plate = (f'MC{rng.randint(100, 999)}'
+                         f'{"".join(rng.choice("ABCDEFGHJKLMNPRSTUVWXYZ") for _ in range(3))}')
+                if plate not in plates:
+                    plates.add(plate)
+                    break
+            c['plate'] = plate
+        if ctype == 'boda' and rng.random() < 0.1:
+            c['depositor'] = f'{_name(rng)} {rng.choice(_LAST)}'
+        if ctype == 'savcom':
+            c['sav_id'] = f'SAV{10000 + i}'
+        customers.append(c)
+    return customers
+
+
+def customer_sheets(customers):
+    """(pikipiki records, pikipiki records2, IPHONE_RECORDS) value grids."""
+    boda = [['ID', 'PLATE', 'NAME', 'PHONE', 'NOTE']]
+    sav = [['ID', 'PLATE', 'NAME', 'PHONE', 'CUSTOMER ID']]
+    iphone = [['NAME', 'PHONE 1', 'PHONE 2']]
+    for i, c in enumerate(customers, start=1):
+        if c['type'] == 'boda':
+            boda.append([i, c['plate'], c['name'], c.get('depositor') or c['phone'], ''])
+        elif c['type'] == 'savcom':
+            sav.append([i, c['plate'], c['name'], c['phone'], c['sav_id']])
+        else:
+            iphone.append([c['name'], c['phone'] + ',', ''])
+    return boda, sav, iphone
+
+
+def registry_rows(customers):
+    rows = []
+    for i, c in enumerate(customers, start=1):
+        rows.append({
+            'id': i,
+            'customer_name': c['name'],
+            'plate': c.get('plate'),
+            'phone': None if c.get('depositor') else c['phone'],
+            'phones': [c['phone']] if c['type'] == 'iphone' else [],
+            'bank_account_name': c.get('depositor'),
+            'customer_type': c['type'],
+            'sav_customer_id': c.get('sav_id'),
+        })
+    return rows
+
+
+def _pick_kind(rng, bank):
+    kinds = list(MIX)
+    kind = rng.choices(kinds, weights=[MIX[k] for k in kinds])[0]
+    if bank == 'NMB' and kind == 'depositor':
+        kind = 'plate'     # FROM-depositor resolution is CRDB-only
+    return kind
+
+
+def _messy(plate):
+    # Every character spaced out — extract_plate_number misses it, the
+    # rescue tiers (_rescue_find_plates) rebuild MC<digits><letters>.
+    return 'MC ' + ' '.join(plate[2:])
+
+
+def make_transactions(n, customers, bank, rng):
+    """n statement rows for `bank` ('CRDB' / 'NMB'). Each is a dict with
+    kind, date, description, credit, ref (NMB ref column / CRDB REF hex)."""
+    by_type = {'boda': [], 'savcom': [], 'iphone': [], 'depositor': []}
+    for c in customers:
+        by_type[c['type']].append(c)
+        if c.get('depositor'):
+            by_type['depositor'].append(c)
+    for k in by_type:
+        if not by_type[k]:
+            by_type[k] = [c for c in customers if c.get('plate')] or customers
+
+    start = datetime(2026, 9, 1, 6, 0)
+    txns = []
+    for i in range(n):
+        kind = _pick_kind(rng, bank)
+        when = start + timedelta(minutes=7 * i + rng.randint(0, 6))
+        credit = rng.choice((5000, 10000, 12500, 15000, 20000, 25000, 30000, 50000))
+        hexref = '%016x' % rng.getrandbits(64)
+        trx = f'PS{rng.randint(10**9, 10**10 - 1)}'
+        agent = f'2557{rng.randint(10**7, 10**8 - 1)}'
+        boda = rng.choice(by_type['boda'])
+        if kind in ('plate', 'dup'):
+            what = boda['plate']
+        elif kind == 'phone':
+            what = boda['phone'] if not boda.get('depositor') else boda['plate']
+        elif kind == 'depositor':
+            what = None
+        elif kind == 'sav':
+            what = rng.choice(by_type['savcom'])['plate']
+        elif kind == 'iphone':
+            what = f"IPHONE {rng.choice(by_type['iphone'])['phone']}"
+        elif kind == 'rescue':
+            what = _messy(boda['plate'])
+        elif kind == 'fuzzy':
+            what = f"MC{boda['plate'][3:5]}{boda['plate'][5:]}"   # one digit dropped
+        elif kind == 'unknown':
+            what = f'MC{rng.randint(100, 999)}QQQ'
+        else:
+            what = ''
+
+        if bank == 'CRDB':
+            if kind == 'depositor':
+                dep = rng.choice(by_type['depositor'])
+                desc = f"REF:{hexref} SIMUSSD FT FROM {dep.get('depositor') or dep['name']} TO FRANK N/A"
+            elif kind == 'noref':
+                desc = f'CASH DEPOSIT BY {_name(rng)}'
+            else:
+                desc = f'REF:{hexref} TIPS TRANSFER DESCRIPTION {what}'
+            ref = hexref
+        else:
+            if kind == 'noref':
+                desc = ''
+            else:
+                desc = (f'{when:%d%m %H:%M:%S} TIPS Trx ID {trx} agency @{agent}@ '
+                        f'Description {what}')
+            ref = f'101AGD{rng.randint(10**9, 10**10 - 1)}'
+        txns.append({'kind': kind, 'date': when, 'description': desc,
+                     'credit': credit, 'ref': ref})
+    return txns
+
+
+def _id_row(i, txn, bank, width):
+    row = [i, txn['date'].strftime('%d/%m/%Y'), bank, txn['description'],
+           txn['credit'], 'SEED', 'SEED CUSTOMER', txn['ref'], '']
+    if width == 8:
+        row = row[:5] + ['SEED', 'seed reason', txn['ref']]
+    return row
+
+
+def output_tabs(txns, bank, existing, rng):
+    """Seeded output tabs: header + `existing` old rows in the main PASSED
+    tab (IDs for get_last_id, refs/messages for dedup), with every 'dup'
+    transaction already in it."""
+    tabs = {}
+    for (sid, tab), width in _OUTPUT_TABS.items():
+        tabs[(sid, tab)] = [['ID', 'DATE', 'BANK', 'MESSAGE', 'AMOUNT',
+                             'IDENTIFIER', 'NAME', 'REFNUMBER', 'CUSTOMER ID'][:width]]
+    main = (PASSED_SHEET_ID, 'PASSED') if bank == 'CRDB' else (NMB_SHEET_ID, 'PASSED')
+    rows = tabs[main]
+    old = make_transactions(existing, [{'type': 'boda', 'name': 'SEED', 'phone': '0700000000',
+                                        'plate': 'MC000AAA'}], bank, rng)
+    dups = [t for t in txns if t['kind'] == 'dup']
+    for t in old + dups:
+        rows.append(_id_row(len(rows), t, bank, 9))
+    for key, width in _OUTPUT_TABS.items():
+        if key != main:
+            t = old[0] if old else None
+            if t:
+                tabs[key].append(_id_row(1, t, bank, width))
+    return tabs
+
+
+# ── statement files ─────────────────────────────────────────────────────────
+
+def write_crdb_xlsx(path, txns, rng):
+    import openpyxl
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Statement')
+    for meta in (['CRDB BANK PLC'], ['ACCOUNT STATEMENT'], ['Account No', '0150000000'],
+                 ['Period', '01.09.2026 - 30.09.2026'], []):
+        ws.append(meta)
+    ws.append(['Posting Date', 'Details', 'Value Date', 'Debit', 'Credit', 'Book Balance'])
+    balance = 1_000_000
+    for t in txns:
+        if rng.random() < 0.15:   # debit rows the reader must drop
+            ws.append([t['date'], 'CHARGES SMS ALERT', t['date'], 1500, None, balance])
+        balance += t['credit']
+        ws.append([t['date'], t['description'], t['date'], None, t['credit'], balance])
+    wb.save(path)
+
+
+_NMB_HEADER = ['Date', 'Value Date', 'Cheque Number/Control Number', 'Description',
+               'Reference Number', 'Credit', 'Debit', 'Balance']
+
+
+def write_nmb_xlsx(path, txns, rng):
+    import openpyxl
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Statement')
+    for i in range(12):
+        ws.append([f'NMB statement line {i}', ''])
+    ws.append(_NMB_HEADER)
+    for t in txns:
+        if rng.random() < 0.15:
+            ws.append([t['date'], t['date'], '', 'SMS CHARGES', '', None, 300, 0])
+        ws.append([t['date'], t['date'], '', t['description'], t['ref'],
+                   f"{t['credit']:,}.00 TZS", None, 0])
+    wb.save(path)
+
+
+def write_nmb_csv(path, txns, rng):
+    with open(path, 'w', newline='') as fh:
+        w = csv.writer(fh)
+        w.writerow(['20110000000', 'ELEGANSKY BODA LTD'])
+        w.writerow(['Opening Balance', 'TZS 0.00'])
+        w.writerow(['Closing Balance', 'TZS 0.00'])
+        w.writerow(['Value Date', 'Narration/Description', 'Transaction Reference',
+                    'Debit Amount', 'Credit Amount', 'Balance'])
+        for t in txns:
+            day = t['date'].strftime('%d-%b-%y')
+            if rng.random() < 0.15:
+                w.writerow([day, 'SMS CHARGES', '', '300.00', '', '0.00'])
+            w.writerow([day, t['description'], t['ref'], '', f"{t['credit']:,}.00", '0.00'])
+
+
+def write_nmb_pdf(path, txns, rng):
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.platypus import PageBreak, SimpleDocTemplate, Table, TableStyle
+
+    style = TableStyle([('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+                        ('FONTSIZE', (0, 0), (-1, -1), 6)])
+    header = ['Book Date', 'Value Date', 'Trn Br Name', 'Narration', 'Xref',
+              'Cheque No', 'Debit', 'Credit', 'Balance']
+    widths = [55, 55, 40, 260, 90, 40, 50, 60, 60]
+    per_page = 18
+    story = []
+    for p in range(0, len(txns), per_page):
+        rows = [header] if p == 0 else []
+        for t in txns[p:p + per_page]:
+            day = t['date'].strftime('%d/%m/%Y')
+            desc = t['description']
+            cut = desc.find(' Trx ID')
+            if cut > 0:               # NMB wraps the narration inside the cell
+                desc = desc[:cut] + '\n' + desc[cut + 1:]
+            rows.append([day, day, 'HQ', desc, t['ref'], '', '', f"{t['credit']:,}.00", '0.00'])
+        story.append(Table(rows, colWidths=widths, style=style))
+        story.append(PageBreak())
+    SimpleDocTemplate(path, pagesize=landscape(A4)).build(story)
+
+
+_WRITERS = {
+    'crdb-xlsx': ('CRDB', '.xlsx', write_crdb_xlsx),
+    'nmb-csv':   ('NMB', '.csv', write_nmb_csv),
+    'nmb-xlsx':  ('NMB', '.xlsx', write_nmb_xlsx),
+    'nmb-pdf':   ('NMB', '.pdf', write_nmb_pdf),
+}
+
+
+def build_scenario(workdir, fmt, rows, customers, existing, seed):
+    """Write the statement and world.json for one scenario; returns paths."""
+    bank, ext, writer = _WRITERS[fmt]
+    rng = random.Random(f'{seed}:{customers}')
+    people = make_customers(customers, rng)
+    rng = random.Random(f'{seed}:{fmt}:{rows}:{customers}')
+    txns = make_transactions(rows, people, bank, rng)
+    statement = os.path.join(workdir, f'statement{ext}')
+    writer(statement, txns, rng)
+
+    boda, sav, iphone = customer_sheets(people)
+    tabs = output_tabs(txns, bank, existing, rng)
+    tabs[(PIKIPIKI_SHEET_ID, 'pikipiki records')] = boda
+    tabs[(PIKIPIKI_SHEET_ID, 'pikipiki records2')] = sav
+    tabs[(IPHONE_SHEET_ID, 'IPHONE_RECORDS')] = iphone
+    world = {
+        'tabs': [[sid, tab, grid] for (sid, tab), grid in tabs.items()],
+        'registry': registry_rows(people),
+        'mix': {k: sum(1 for t in txns if t['kind'] == k) for k in MIX},
+    }
+    world_path = os.path.join(workdir, 'world.json')
+    with open(world_path, 'w') as fh:
+        json.dump(world, fh, default=str)
+    return bank, statement, world_path
+
+
+# ── fakes ───────────────────────────────────────────────────────────────────
+
+_A1_RX = re.compile(r"^'?(?P<tab>.+?)'?!(?P<c1>[A-Z]+)(?P<r1>\d*)(?::(?P<c2>[A-Z]+)(?P<r2>\d*))?$")
+
+
+def _col(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - 64
+    return n - 1
+
+
+class FakeSheets:
+    """In-memory spreadsheets keyed by (spreadsheetId, tab). Answers the
+    subset of the Sheets v4 API app.py uses; values are returned as stored
+    (numbers stay numbers, as with UNFORMATTED_VALUE)."""
+
+    def __init__(self, tabs, latency=0.0):
+        self.tabs = tabs
+        self.latency = latency
+        self.calls = {}
+
+    def _call(self, kind, fn):
+        return _Request(self, kind, fn)
+
+    def _range(self, sid, a1):
+        m = _A1_RX.match(a1)
+        if not m:
+            raise ValueError(f'unsupported range {a1!r}')
+        grid = self.tabs.setdefault((sid, m['tab']), [])
+        c1 = _col(m['c1'])
+        c2 = _col(m['c2']) if m['c2'] else c1
+        r1 = int(m['r1']) if m['r1'] else 1
+        r2 = int(m['r2']) if m['r2'] else None
+        return grid, c1, c2, r1, r2
+
+    def read(self, sid, a1):
+        grid, c1, c2, r1, r2 = self._range(sid, a1)
+        out = []
+        for row in grid[r1 - 1:r2]:
+            cells = list(row[c1:c2 + 1])
+            while cells and cells[-1] in (None, ''):
+                cells.pop()
+            out.append(cells)
+        while out and not out[-1]:
+            out.pop()
+        body = {'range': a1, 'majorDimension': 'ROWS'}
+        if out:
+            body['values'] = out
+        return body
+
+    def write(self, sid, a1, values, append=False):
+        grid, c1, _, r1, _ = self._range(sid, a1)
+        if append:
+            r1 = len(grid) + 1
+        for i, vals in enumerate(values):
+            idx = r1 - 1 + i
+            while len(grid) <= idx:
+                grid.append([])
+            row = grid[idx]
+            if len(row) < c1 + len(vals):
+                row.extend([''] * (c1 + len(vals) - len(row)))
+            row[c1:c1 + len(vals)] = vals
+        return {'updatedRange': a1, 'updatedRows': len(values)}
+
+    def spreadsheets(self):
+        return _Spreadsheets(self)
+
+
+class _Request:
+    def __init__(self, sheets, kind, fn):
+        self.sheets, self.kind, self.fn = sheets, kind, fn
+
+    def execute(self, **_):
+        self.sheets.calls[self.kind] = self.sheets.calls.get(self.kind, 0) + 1
+        if self.sheets.latency:
+            time.sleep(self.sheets.latency)
+        return self.fn()
+
+
+class _Spreadsheets:
+    def __init__(self, sheets):
+        self.s = sheets
+
+    def values(self):
+        return _Values(self.s)
+
+    def get(self, spreadsheetId, **_):
+        titles = [tab for sid, tab in self.s.tabs if sid == spreadsheetId]
+        return self.s._call('get', lambda: {'sheets': [
+            {'properties': {'title': t, 'sheetId': i}} for i, t in enumerate(titles)]})
+
+    def batchUpdate(self, spreadsheetId, body=None, **_):
+        return self.s._call('batchUpdate', lambda: {'replies': []})
+
+
+class _Values:
+    def __init__(self, sheets):
+        self.s = sheets
+
+    def get(self, spreadsheetId, range, **_):
+        return self.s._call('values.get', lambda: self.s.read(spreadsheetId, range))
+
+    def batchGet(self, spreadsheetId, ranges, **_):
+        return self.s._call('values.batchGet', lambda: {'valueRanges': [
+            self.s.read(spreadsheetId, r) for r in ranges]})
+
+    def update(self, spreadsheetId, range, body, **_):
+        return self.s._call('values.update',
+                            lambda: self.s.write(spreadsheetId, range, body.get('values', [])))
+
+    def append(self, spreadsheetId, range, body, **_):
+        return self.s._call('values.append',
+                            lambda: self.s.write(spreadsheetId, range, body.get('values', []),
+                                                 append=True))
+
+
+def fake_supabase_adapter(registry, latency=0.0):
+    """A requests transport adapter standing in for PostgREST: serves
+    customer_registry (Range pages, Prefer: count=exact) and answers every
+    other request with an empty success."""
+    import requests
+    from requests.adapters import BaseAdapter
+    from requests.structures import CaseInsensitiveDict
+
+    class _Adapter(BaseAdapter):
+        calls = {}
+
+        def send(self, request, **_):
+            if latency:
+                time.sleep(latency)
+            key = f"{request.method} {request.path_url.split('?', 1)[0].rsplit('/', 1)[-1]}"
+            self.calls[key] = self.calls.get(key, 0) + 1
+            status, body, headers = 200, [], {}
+            if request.method == 'GET' and '/customer_registry' in request.path_url:
+                lo, hi = 0, len(registry) - 1
+                rng = request.headers.get('Range')
+                if rng:
+                    lo, hi = (int(x) for x in rng.split('-'))
+                if 'limit=1' in request.path_url:
+                    hi = lo
+                if lo >= len(registry) and registry:
+                    status = 416
+                else:
+                    body = registry[lo:hi + 1]
+                    status = 206 if rng else 200
+                if 'count=exact' in request.headers.get('Prefer', ''):
+                    headers['content-range'] = f'{lo}-{lo + len(body) - 1}/{len(registry)}'
+                if 'select=updated_at' in request.path_url:
+                    body = [{'updated_at': '2026-09-01T00:00:00+00:00'}][:len(body)]
+            elif request.method == 'POST':
+                status = 201
+            elif request.method in ('PATCH', 'DELETE'):
+                status = 204
+            resp = requests.Response()
+            resp.status_code = status
+            resp.headers = CaseInsensitiveDict(headers)
+            resp._content = b'' if status == 204 else json.dumps(body).encode()
+            resp.url = request.url
+            resp.request = request
+            resp.reason = 'OK'
+            return resp
+
+        def close(self):
+            pass
+
+    return _Adapter()
+
+
+# ── one scenario (child process) ────────────────────────────────────────────
+
+def _rss_mb():
+    import resource
+    kb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return kb / 1024.0
+
+
+def run_one(spec):
+    """Runs inside the child interpreter; returns the result dict."""
+    state = spec['state_dir']
+    os.environ.update({
+        'REF_INDEX': '0',
+        'CUSTOMER_SOURCE': spec['source'],
+        'SUPABASE_URL': 'http://supabase.bench',
+        'SUPABASE_SERVICE_KEY': 'bench',
+        'SUPABASE_URL_REGISTRY': 'http://registry.bench',
+        'SUPABASE_SERVICE_KEY_REGISTRY': 'bench',
+        'WRITE_TO_SUPABASE': '1' if spec['mirror'] else '0',
+        'PROCESS_JOBS_DIR': os.path.join(state, 'jobs'),
+        'PROCESS_LOCK_PATH': os.path.join(state, 'process.lock'),
+        'PIPELINE_METRICS_DIR': os.path.join(state, 'metrics'),
+        'SUPABASE_OUTBOX_PATH': os.path.join(state, 'mirror_outbox.sqlite3'),
+    })
+    if not spec['warm']:
+        os.environ['CUSTOMER_CACHE_TTL'] = '0'
+
+    with open(spec['world']) as fh:
+        world = json.load(fh)
+    tabs = {(sid, tab): grid for sid, tab, grid in world['tabs']}
+    sheets = FakeSheets(tabs, spec['sheets_latency_ms'] / 1000.0)
+    registry = world['registry']
+    del world
+
+    quiet = open(os.devnull, 'w') if not spec['verbose'] else None
+    real_stdout = sys.stdout
+    if quiet:
+        sys.stdout = quiet
+    try:
+        import app
+        import mirror_outbox
+        import pipeline_metrics
+        import sheets_client
+        import supabase_client
+        app._HIGHWATER_PATH = os.path.join(state, 'highwater.json')
+        app._CUSTOMER_CACHE_PATH = os.path.join(state, 'customer_cache.pickle')
+        app.get_google_service = lambda: sheets
+        sheets_client.get_service = lambda *a, **k: sheets
+        adapter = fake_supabase_adapter(registry, spec['supabase_latency_ms'] / 1000.0)
+        for project in ('main', 'registry'):
+            for retries in (True, False):
+                sess = supabase_client._session(project, retries)
+                sess.mount('http://', adapter)
+                sess.mount('https://', adapter)
+        rss_ready = _rss_mb()
+
+        marks = []
+        real_job_write = app._job_write
+
+        def record(job):
+            stage = job['progress'].get('stage')
+            if not marks or marks[-1][0] != stage:
+                marks.append((stage, time.perf_counter()))
+
+        app._job_write = record
+        job = {'id': 'bench', 'progress': {'stage': None, 'rows_written': {}}}
+        app._JOB_CTX.job = job
+        t0 = time.perf_counter()
+        app._job_progress(stage='reading')
+        try:
+            with app.app.app_context():
+                if spec['bank'] == 'NMB':
+                    resp = app.process_nmb_transactions(spec['statement'])
+                else:
+                    resp = app.process_crdb_transactions(spec['statement'])
+                code = 200
+                if isinstance(resp, tuple):
+                    resp, code = resp[0], resp[1]
+                body = resp.get_json(silent=True) if hasattr(resp, 'get_json') else resp
+            summary = pipeline_metrics.last_summary() or {}
+        finally:
+            total = time.perf_counter() - t0
+            app._job_write = real_job_write
+            app._JOB_CTX.job = None
+        # The mirror is sent by the outbox flusher after the run returns;
+        # time the rest of the drain separately.
+        t1 = time.perf_counter()
+        mirror_outbox.flush(timeout=spec['max_seconds'])
+        drain = time.perf_counter() - t1
+        backlog = mirror_outbox.backlog() or {}
+    finally:
+        sys.stdout = real_stdout
+        if quiet:
+            quiet.close()
+
+    stages = {}
+    for (stage, t), nxt in zip(marks, marks[1:] + [(None, t0 + total)]):
+        stages[stage] = stages.get(stage, 0.0) + (nxt[1] - t)
+    return {
+        'http_status': code,
+        'seconds': round(total, 3),
+        'mirror_drain_seconds': round(drain, 3),
+        'mirror_backlog_rows': backlog.get('rows'),
+        'stages': {k: round(v, 3) for k, v in stages.items()},
+        'rss_ready_mb': round(rss_ready, 1),
+        'peak_rss_mb': round(_rss_mb(), 1),
+        'stats': (body or {}).get('stats') if isinstance(body, dict) else None,
+        'error': (body or {}).get('error') if isinstance(body, dict) else None,
+        'operations': summary.get('operations'),
+        'sheets_calls': sheets.calls,
+        'supabase_calls': dict(adapter.calls),
+    }
+
+
+# ── driver ──────────────────────────────────────────────────────────────────
+
+def _ints(s):
+    return [int(x.replace('_', '').lower().replace('k', '000')) for x in s.split(',') if x]
+
+
+def _scenario(args, fmt, rows, customers, root):
+    label = f'{fmt} {rows} rows / {customers} customers'
+    if fmt == 'nmb-pdf':
+        import importlib.util
+        if importlib.util.find_spec('reportlab') is None:
+            return label, {'skipped': 'reportlab not installed'}
+    workdir = tempfile.mkdtemp(prefix=f'{fmt}-{rows}-{customers}-', dir=root)
+    t = time.perf_counter()
+    bank, statement, world = build_scenario(workdir, fmt, rows, customers,
+                                            args.existing, args.seed)
+    gen_s = time.perf_counter() - t
+    spec = {
+        'bank': bank, 'statement': statement, 'world': world,
+        'state_dir': workdir, 'source': args.source, 'mirror': args.mirror,
+        'warm': args.warm, 'verbose': args.verbose, 'max_seconds': args.max_seconds,
+        'sheets_latency_ms': args.sheets_latency_ms,
+        'supabase_latency_ms': args.supabase_latency_ms,
+    }
+    out_path = os.path.join(workdir, 'result.json')
+    cmd = [sys.executable, os.path.abspath(__file__), '--run-one', json.dumps(spec),
+           '--out', out_path]
+    t = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=_APP_ROOT, timeout=args.max_seconds * 3)
+    wall = time.perf_counter() - t
+    if proc.returncode != 0 or not os.path.exists(out_path):
+        return label, {'failed': f'child exited {proc.returncode}', 'wall': wall}
+    with open(out_path) as fh:
+        result = json.load(fh)
+    result['generate_seconds'] = round(gen_s, 2)
+    result['rows'] = rows
+    result['customers'] = customers
+    result['format'] = fmt
+    with open(world) as fh:
+        result['mix'] = json.load(fh)['mix']
+    return label, result
+
+
+def _print_table(results, args):
+    short = ('read', 'cust', 'dedup', 'classify', 'write')
+    print()
+    print(f"{'scenario':<40} {'total':>7} " + ' '.join(f'{s:>8}' for s in short) +
+          f" {'rows/s':>8} {'rss MB':>7}  verdict")
+    for label, r in results:
+        if 'skipped' in r or 'failed' in r:
+            print(f"{label:<40} {r.get('skipped') or r.get('failed')}")
+            continue
+        stages = ' '.join(f"{r['stages'].get(c, 0.0):8.2f}" for c in STAGES)
+        rate = r['rows'] / r['seconds'] if r['seconds'] else 0.0
+        drain = f"  (mirror drain {r['mirror_drain_seconds']:.2f}s)" if args.mirror else ''
+        print(f"{label:<40} {r['seconds']:7.2f} {stages} {rate:8.0f} "
+              f"{r['peak_rss_mb']:7.0f}  {r['verdict']}{drain}")
+    print(f"\nenvelope: {args.max_rss_mb} MB peak RSS, {args.max_seconds} s per statement")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('--formats', default=','.join(FORMATS))
+    ap.add_argument('--rows', default='1000,10000,50000',
+                    help='comma-separated statement sizes (1k/10k/50k by default)')
+    ap.add_argument('--customers', default='2000,20000',
+                    help='comma-separated customer base sizes')
+    ap.add_argument('--quick', action='store_true',
+                    help='1000 rows / 2000 customers, every format')
+    ap.add_argument('--existing', type=int, default=5000,
+                    help='rows already in the main PASSED tab (dedup set size)')
+    ap.add_argument('--source', default='sheet', choices=('sheet', 'registry', 'both'),
+                    help='CUSTOMER_SOURCE for the run')
+    ap.add_argument('--mirror', action='store_true',
+                    help='WRITE_TO_SUPABASE=1 (mirror writes to the fake PostgREST; the '
+                         'outbox drain after the run is timed separately)')
+    ap.add_argument('--warm', action='store_true',
+                    help='keep the customer cache (default: CUSTOMER_CACHE_TTL=0)')
+    ap.add_argument('--sheets-latency-ms', type=float, default=0.0)
+    ap.add_argument('--supabase-latency-ms', type=float, default=0.0)
+    ap.add_argument('--seed', type=int, default=7)
+    ap.add_argument('--max-rss-mb', type=float, default=512)
+    ap.add_argument('--max-seconds', type=float, default=300)
+    ap.add_argument('--json', help='write the full results here')
+    ap.add_argument('--keep', action='store_true', help='keep generated files')
+    ap.add_argument('--verbose', action='store_true', help="show the pipeline's own output")
+    ap.add_argument('--run-one', help=argparse.SUPPRESS)
+    ap.add_argument('--out', help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run_one:
+        result = run_one(json.loads(args.run_one))
+        with open(args.out, 'w') as fh:
+            json.dump(result, fh)
+        return 0
+
+    if args.quick:
+        args.rows, args.customers = '1000', '2000'
+    formats = [f for f in args.formats.split(',') if f]
+    unknown = [f for f in formats if f not in FORMATS]
+    if unknown:
+        ap.error(f'unknown format(s): {unknown} — choose from {", ".join(FORMATS)}')
+
+    root = tempfile.mkdtemp(prefix='bench_pipeline-')
+    results = []
+    ok = True
+    try:
+        for customers in _ints(args.customers):
+            for rows in _ints(args.rows):
+                for fmt in formats:
+                    print(f'▶ {fmt}: {rows} rows, {customers} customers ...', flush=True)
+                    label, r = _scenario(args, fmt, rows, customers, root)
+                    if 'skipped' in r:
+                        print(f'  ⏭️ skipped: {r["skipped"]}')
+                    elif 'failed' in r:
+                        ok = False
+                        print(f'  ❌ {r["failed"]}')
+                    else:
+                        over = []
+                        if r['peak_rss_mb'] > args.max_rss_mb:
+                            over.append('RSS')
+                        if r['seconds'] > args.max_seconds:
+                            over.append('TIME')
+                        if r['http_status'] >= 400:
+                            over.append(f"HTTP {r['http_status']}")
+                        r['verdict'] = 'ok' if not over else 'OVER ' + '+'.join(over)
+                        ok = ok and not over
+                        print(f"  {r['seconds']:.2f}s, peak {r['peak_rss_mb']:.0f} MB, "
+                              f"stats {r['stats']}")
+                    results.append((label, r))
+    finally:
+        if args.keep:
+            print(f'\nfiles kept in {root}')
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    _print_table(results, args)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump([dict(r, scenario=label) for label, r in results], fh, indent=2)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""
+sheets_client.py — one Google Sheets client per process
+
+Contract:
+  - get_service() replaces the build('sheets', 'v4', ...) that app.py,
+    iliyopata_writer.py and migrate_sheets_to_supabase.py each did on every
+    call. Parsing GOOGLE_CREDENTIALS_JSON, building the service-account
+    credentials and parsing the discovery document now happen once per
+    process, lazily, under a lock.
+  - The credentials object is shared. google-auth refreshes the access token
+    on expiry / 401 through AuthorizedHttp, so every caller sees a valid
+    token without rebuilding anything.
+  - httplib2.Http is NOT thread-safe, so each thread gets its own service
+    object wrapping its own keep-alive connection pool (built from the
+    already-parsed discovery doc — cheap). gunicorn sync workers are one
+    thread each, plus the /process job thread and background sweeps.
+  - Raises on missing / malformed credentials, same as the old builders.
+
+Env vars:
+  GOOGLE_CREDENTIALS_JSON   service-account JSON (the whole file's contents)
+  SHEETS_HTTP_TIMEOUT       socket timeout in seconds (default: the process's
+                            socket default, same as the old build() clients)
+"""
+
+import json
+import os
+import threading
+
+import google_auth_httplib2
+import httplib2
+from google.oauth2 import service_account
+from googleapiclient.discovery import build, build_from_document
+
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+HTTP_TIMEOUT = (int(os.environ['SHEETS_HTTP_TIMEOUT'])
+                if os.environ.get('SHEETS_HTTP_TIMEOUT') else None)
+
+_lock = threading.Lock()
+_shared = {'credentials': None, 'discovery': None}
+_local = threading.local()
+
+
+def _load_discovery(credentials):
+    """Parsed sheets v4 discovery doc. The client library ships it (static
+    discovery), so this is a local read; the build() fallback covers older
+    library versions without get_static_doc."""
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+        doc = get_static_doc('sheets', 'v4')
+        if doc:
+            return json.loads(doc)
+    except ImportError:
+        pass
+    return build('sheets', 'v4', credentials=credentials,
+                 cache_discovery=False)._rootDesc
+
+
+def _init_shared(creds_json=None):
+    with _lock:
+        if _shared['credentials'] is not None:
+            return _shared['credentials'], _shared['discovery']
+        raw = creds_json or os.environ.get('GOOGLE_CREDENTIALS_JSON')
+        if not raw:
+            raise ValueError("GOOGLE_CREDENTIALS_JSON not found")
+        creds_dict = json.loads(raw)
+
+        # Key diagnostics — once per process now, not once per request.
+        pk = creds_dict.get('private_key', '')
+        print(f"🔑 Sheets client: {creds_dict.get('client_email', '?')}, "
+              f"private key {len(pk)} chars, "
+              f"literal \\n: {chr(92) + 'n' in pk}, real newlines: {chr(10) in pk}")
+
+        credentials = service_account.Credentials.from_service_account_info(
+            creds_dict, scopes=SCOPES,
+        )
+        _shared['discovery'] = _load_discovery(credentials)
+        _shared['credentials'] = credentials
+        return credentials, _shared['discovery']
+
+
+def get_service(creds_json=None):
+    """This thread's Sheets service. `creds_json` is only consulted on the
+    very first call in the process (scripts that read google.json from disk
+    instead of the env var pass it here)."""
+    service = getattr(_local, 'service', None)
+    if service is None:
+        credentials, discovery = _init_shared(creds_json)
+        http = google_auth_httplib2.AuthorizedHttp(
+            credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        service = build_from_document(discovery, http=http)
+        _local.service = service
+    return service
+
+
+def reset():
+    """Forget the shared credentials and this thread's client (next
+    get_service() rebuilds from the environment)."""
+    with _lock:
+        _shared['credentials'] = None
+        _shared['discovery'] = None
+    _local.service = None
@@ -0,0 +1,120 @@
+"""
+sms_event_dedup.py — local duplicate suppression for sms_events writes
+
+Contract:
+  - _sms_event_insert() in app.py used to GET sms_events with
+    body=eq.<full SMS body> & processed_at >= now-60s before every insert:
+    an extra round trip per SMS and an unindexed text-equality scan. The
+    duplicates it caught are OkHttp retry-on-slow-response and
+    double-broadcast repeats of the same (sender, body, outcome).
+  - claim(key) answers "was this seen in the last WINDOW seconds?" locally
+    and records it. The claim goes through a small SQLite file shared by
+    every gunicorn worker (INSERT OR IGNORE on the key is atomic across
+    processes) and survives a worker recycle. It is fronted by an
+    in-process dict so a repeat in the same worker never touches the file.
+    With SMS_EVENT_DEDUP_PATH='' only the dict is used.
+  - body_hash() is the DB-side backstop stored in sms_events.body_hash
+    (scripts/006_sms_events_body_hash.sql). It hashes the same key plus
+    the WINDOW-sized time bucket, so the unique index rejects a second
+    row for the same message within a bucket. The message can still be
+    logged again later.
+  - Never raises. On a SQLite error the dict alone decides.
+
+Env vars:
+  SMS_EVENT_DEDUP_SECONDS  suppression window (default 60)
+  SMS_EVENT_DEDUP_PATH     SQLite file (default
+                           /tmp/transaction_processor_sms_dedup.sqlite3,
+                           '' = in-process only)
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+WINDOW = float(os.environ.get('SMS_EVENT_DEDUP_SECONDS', '60'))
+DEDUP_PATH = os.environ.get('SMS_EVENT_DEDUP_PATH',
+                            '/tmp/transaction_processor_sms_dedup.sqlite3')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen (
+    key        TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS seen_expires ON seen (expires_at);
+"""
+
+_lock = threading.Lock()
+_schema_ready = False
+_memory = {}   # key -> expires_at
+_MEMORY_MAX = 10000
+
+
+def _connect():
+    global _schema_ready
+    conn = sqlite3.connect(DEDUP_PATH, timeout=5)
+    if not _schema_ready:
+        conn.executescript(_SCHEMA)
+        _schema_ready = True
+    return conn
+
+
+def key(sender, body, outcome):
+    """Hex digest identifying one (sender, body, outcome)."""
+    raw = '\x1f'.join((sender or '', body or '', outcome or ''))
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def body_hash(sender, body, outcome, now=None):
+    """key() salted with the current WINDOW-sized time bucket — the value
+    written to sms_events.body_hash."""
+    bucket = int((now or time.time()) // max(WINDOW, 1))
+    return hashlib.sha256(f'{key(sender, body, outcome)}:{bucket}'.encode()).hexdigest()
+
+
+def claim(k, now=None):
+    """True if `k` wasn't seen in the last WINDOW seconds (and marks it
+    seen now); False for a duplicate."""
+    now = now or time.time()
+    expires = now + WINDOW
+    with _lock:
+        if _memory.get(k, 0) > now:
+            return False
+        if len(_memory) >= _MEMORY_MAX:
+            for stale in [x for x, t in _memory.items() if t <= now]:
+                del _memory[stale]
+        _memory[k] = expires
+        if not DEDUP_PATH:
+            return True
+        try:
+            conn = _connect()
+            try:
+                with conn:
+                    conn.execute('DELETE FROM seen WHERE expires_at <= ?', (now,))
+                    cur = conn.execute(
+                        'INSERT OR IGNORE INTO seen (key, expires_at) VALUES (?, ?)',
+                        (k, expires))
+                    return cur.rowcount == 1
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"⚠️ sms dedup: {e}")
+            return True
+
+
+def release(k):
+    """Forget a claim whose write failed, so a retry can log it."""
+    with _lock:
+        _memory.pop(k, None)
+        if not DEDUP_PATH:
+            return
+        try:
+            conn = _connect()
+            try:
+                with conn:
+                    conn.execute('DELETE FROM seen WHERE key = ?', (k,))
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"⚠️ sms dedup: {e}")
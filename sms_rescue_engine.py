@@ -0,0 +1,470 @@
+"""
+sms_rescue_engine.py — bulk SMS rescue shared by the batch endpoint and the
+ref_not_found retry sweeps
+
+Contract:
+  - rescue(items) takes SMSes whose plate and ref are already known, as
+    dicts {sender, body, received_at, plate, ref}, and runs the
+    /api/sms-rescue decision for all of them with bulk round trips:
+    one transactions ref_number=in.(...) query, one registry
+    plate=in.(...) query, a guarded PATCH only for the rows that are
+    actually rescued, the ILIYOPATA / PASSED / FAILED-marker sheet writes
+    grouped per spreadsheet, and one sms_events insert. It returns one
+    result per item: the JSON body /api/sms-rescue would have returned,
+    plus `status` (its HTTP code) and `outcome` (the sms_events outcome).
+  - Callers:
+      /api/sms-rescue/batch (app.py) — the forwarder's offline replay
+      /admin/sms-retry-fails (app.py) — the token-gated sweep
+      scripts/retry_ref_not_found.py — the systemd-timer sweep
+    The two sweeps used to replay every event one at a time, through the
+    Flask test client or a copy of the endpoint logic, at 5+ HTTP calls
+    per event. Now a sweep is fetch_retry_events() + rescue(): a few bulk
+    queries, plus per-event work only for the events whose ref now exists.
+  - log_misses=False (the sweeps) skips the sms_events row for events
+    whose ref is still not in `transactions`. The event is already logged
+    as ref_not_found, and re-logging it every sweep only adds noise.
+  - The single /api/sms-rescue endpoint uses event_row(), lock() and
+    registry_row_to_customer() from here so every path writes the same
+    shapes.
+  - sms_events rows go through insert_events(), which drops repeats
+    (sms_event_dedup) and queues the rest on audit_queue. The insert
+    happens on the background writer, off the request path.
+  - Never raises for Supabase / Sheets errors. Those become 500
+    server_error results (the phone / sweep retries them later).
+
+Env vars:
+  SUPABASE_URL / SUPABASE_SERVICE_KEY                       main project
+  SUPABASE_URL_REGISTRY / SUPABASE_SERVICE_KEY_REGISTRY     registry project
+                                                            (required — no
+                                                            fallback to main)
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+
+import requests
+
+import audit_queue
+import iliyopata_writer
+import sms_event_dedup
+import supabase_client
+
+FAILED_SOURCE_TABS = {'CRDBFAILED', 'NMBFAILED', 'IPHONEFAILED'}
+RESCUED_SOURCE_TABS = {'BODAILIYOPATA', 'IPHONEILIYOPATA'}
+ILIYOPATA_TARGET_FROM_CUSTOMER = {
+    'IPHONE_RECORDS': 'IPHONEILIYOPATA',
+    'BODA_RECORDS':   'BODAILIYOPATA',
+    'SAVCOM_RECORDS': 'BODAILIYOPATA',
+}
+# customer_registry.customer_type → the sheet's *_RECORDS enum the rescue
+# pipeline (iliyopata_writer, ILIYOPATA_TARGET_FROM_CUSTOMER) speaks.
+REGISTRY_TYPE_TO_SOURCE_TAB = {
+    'boda':   'BODA_RECORDS',
+    'savcom': 'SAVCOM_RECORDS',
+    'iphone': 'IPHONE_RECORDS',
+}
+
+_TX_SELECT = ('id,source_tab,transaction_date,customer_name,bank,'
+              'description,credit_amount,identifier,ref_number,customer_id,'
+              'rescue_locked_at')
+# Refs per transactions lookup. Each ref is sent as typed, lower and upper
+# case (see find_transactions), so keep the URL well under proxy limits.
+_REF_CHUNK = 60
+_PLATE_CHUNK = 200
+
+# Cleared the first time sms_events turns out not to have body_hash yet.
+_body_hash_column = True
+
+
+def _main():
+    url = os.environ.get('SUPABASE_URL', '').rstrip('/')
+    key = os.environ.get('SUPABASE_SERVICE_KEY', '')
+    return url, key
+
+
+def _registry():
+    # No fallback to the main project, same as app.py: prod's main project
+    # has no customer_registry table.
+    return (os.environ.get('SUPABASE_URL_REGISTRY', '').rstrip('/'),
+            os.environ.get('SUPABASE_SERVICE_KEY_REGISTRY', ''))
+
+
+def _headers(key):
+    return {'apikey': key, 'Authorization': f'Bearer {key}'}
+
+
+def event_row(sender, body, received_at, status, outcome, plate,
+              ref, row_id, source_tab, error_detail):
+    """One sms_events row."""
+    return {
+        'sender':             sender,
+        'body':               body,
+        'received_at':        received_at,
+        'http_status':        status,
+        'outcome':            outcome,
+        'extracted_plate':    plate,
+        'extracted_ref':      ref,
+        'rescued_row_id':     row_id,
+        'rescued_source_tab': source_tab,
+        'error_detail':       error_detail,
+    }
+
+
+def _post_events(rows):
+    """audit_queue writer for sms_events: one POST, returns its HTTP
+    status. Rows carry body_hash and the insert ignores body_hash conflicts,
+    so a duplicate the local check missed (or a spilled batch that had in
+    fact landed) is dropped by the DB instead of failing the batch. Until
+    migration 006 has run that insert fails, and the plain insert is used
+    for the rest of the process."""
+    global _body_hash_column
+    url, key = _main()
+    if not url or not key:
+        return 204      # mirror not configured — nothing to keep
+    headers = {**_headers(key), 'Content-Type': 'application/json'}
+    if _body_hash_column:
+        r = supabase_client.main().post(
+            f'{url}/rest/v1/sms_events',
+            params={'on_conflict': 'body_hash'},
+            headers={**headers,
+                     'Prefer': 'return=minimal,resolution=ignore-duplicates'},
+            json=rows,
+            timeout=10,
+        )
+        if r.ok:
+            return r.status_code
+        if r.status_code != 400 or not ('body_hash' in r.text or '42P10' in r.text):
+            print(f"⚠️ sms_events insert: HTTP {r.status_code} {r.text[:200]}")
+            return r.status_code
+        print('⚠️ sms_events.body_hash missing — run scripts/006_sms_events_body_hash.sql')
+        _body_hash_column = False
+    r = supabase_client.main().post(
+        f'{url}/rest/v1/sms_events',
+        headers={**headers, 'Prefer': 'return=minimal'},
+        json=[{k: v for k, v in row.items() if k != 'body_hash'} for row in rows],
+        timeout=10,
+    )
+    if not r.ok:
+        print(f"⚠️ sms_events insert: HTTP {r.status_code} {r.text[:200]}")
+    return r.status_code
+
+
+audit_queue.register('sms_events', _post_events)
+
+
+def insert_events(rows):
+    """Queue event_row() dicts for the background sms_events insert
+    (audit_queue). A (sender, body, outcome) already logged in the last
+    SMS_EVENT_DEDUP_SECONDS, here or earlier, is skipped (sms_event_dedup).
+    Best-effort, never raises."""
+    try:
+        url, key = _main()
+        if not url or not key or not rows:
+            return
+        now = time.time()
+        for row in rows:
+            k = sms_event_dedup.key(row['sender'], row['body'], row['outcome'])
+            if not sms_event_dedup.claim(k, now):
+                continue
+            row = {**row, 'body_hash': sms_event_dedup.body_hash(
+                row['sender'], row['body'], row['outcome'], now)}
+            if not audit_queue.submit('sms_events', row):
+                sms_event_dedup.release(k)
+    except Exception:
+        pass  # audit is best-effort; never break the primary response
+
+
+def registry_row_to_customer(row, plate):
+    """customer_registry row → the {name, plate, customer_id, source_tab}
+    shape iliyopata_writer expects."""
+    ctype = (row.get('customer_type') or 'boda').lower()
+    return {
+        'name':        row.get('customer_name') or '',
+        'plate':       row.get('plate') or plate,
+        'customer_id': row.get('sav_customer_id') or '',
+        'source_tab':  REGISTRY_TYPE_TO_SOURCE_TAB.get(ctype, 'BODA_RECORDS'),
+    }
+
+
+def lock(tx, cust, target_tab, moved_by='sms_rescue'):
+    """PATCH a FAILED row into ILIYOPATA. Atomic: the `rescue_locked_at=is.null`
+    filter means Postgres only touches the row if nobody locked it first, so
+    a response with zero rows means a concurrent rescue won. Returns
+    (update, response).
+
+    Timestamps: transaction_date/day are display fields — stamp them
+    in EAT (Tanzania, UTC+3) so the UI shows local wall-clock. moved_at
+    is a real timestamptz so keep it in UTC ISO."""
+    url, key = _main()
+    now_utc = datetime.utcnow()
+    now_eat = now_utc + timedelta(hours=3)
+    update = {
+        'old_transaction_date': tx.get('transaction_date'),
+        'transaction_date':     now_eat.strftime('%d.%m.%Y %H:%M:%S'),
+        'transaction_day':      now_eat.strftime('%Y-%m-%d'),
+        'customer_name':        cust['name'],
+        'source_tab':           target_tab,
+        'moved_by_username':    moved_by,
+        'moved_at':             now_utc.isoformat() + 'Z',
+        'rescue_locked_at':     now_utc.isoformat() + 'Z',
+    }
+    pr = supabase_client.main().patch(
+        f'{url}/rest/v1/transactions?id=eq.{tx["id"]}'
+        '&rescue_locked_at=is.null',
+        headers={**_headers(key),
+                 'Content-Type': 'application/json',
+                 'Prefer': 'return=representation'},
+        json=update, timeout=15,
+    )
+    return update, pr
+
+
+def find_transactions(refs):
+    """{ref.lower(): transaction row} for the refs found, or None if a
+    lookup failed. in.(...) is case-sensitive where /api/sms-rescue's ilike
+    isn't, so each ref goes in as typed, lowercased (CRDB hex) and
+    uppercased (NMB agent / PS refs) and the match is done here."""
+    url, key = _main()
+    found = {}
+    refs = sorted(refs)
+    try:
+        for i in range(0, len(refs), _REF_CHUNK):
+            variants = set()
+            for ref in refs[i:i + _REF_CHUNK]:
+                variants.update((ref, ref.lower(), ref.upper()))
+            r = supabase_client.main().get(
+                f'{url}/rest/v1/transactions',
+                params={'ref_number': supabase_client.in_list(sorted(variants)),
+                        'select': _TX_SELECT,
+                        'order': 'id.asc'},
+                headers=_headers(key), timeout=15,
+            )
+            if not r.ok:
+                print(f'⚠️ sms rescue: transactions lookup → {r.status_code}: {r.text[:200]}')
+                return None
+            for row in r.json() or []:
+                found.setdefault((row.get('ref_number') or '').lower(), row)
+    except requests.RequestException as e:
+        print(f'⚠️ sms rescue: transactions lookup failed: {e}')
+        return None
+    return found
+
+
+def find_customers(plates):
+    """{plate: customer} from customer_registry, one plate=in.(...) query
+    per chunk. BODA wins over SAVCOM when a plate is in both books, as in
+    app.py's single-plate lookup. Returns None if a lookup failed."""
+    url, key = _registry()
+    if not (url and key):
+        return None
+    found = {}
+    plates = sorted(plates)
+    try:
+        for i in range(0, len(plates), _PLATE_CHUNK):
+            r = supabase_client.registry().get(
+                f'{url}/rest/v1/customer_registry',
+                params={
+                    'plate':  supabase_client.in_list(plates[i:i + _PLATE_CHUNK]),
+                    'select': ('id,customer_name,customer_type,plate,'
+                               'sav_customer_id'),
+                    'order':  'customer_type.asc',
+                },
+                headers=_headers(key), timeout=15,
+            )
+            if r.status_code not in (200, 206):
+                print(f'⚠️ sms rescue: registry lookup → {r.status_code}: {r.text[:200]}')
+                return None
+            for row in r.json() or []:
+                plate = row.get('plate')
+                if plate and plate not in found:
+                    found[plate] = registry_row_to_customer(row, plate)
+    except requests.RequestException as e:
+        print(f'⚠️ sms rescue: registry lookup failed: {e}')
+        return None
+    return found
+
+
+def rescue(items, moved_by='sms_rescue', log_misses=True, deadline=None,
+           extra_events=()):
+    """Rescue a batch of SMSes — see module docstring. Items that share a
+    transaction: the first rescues it, the rest get already_rescued.
+    `deadline` (time.monotonic() value) stops the PATCH loop; items not
+    reached come back as {'status': None, 'outcome': 'time_capped'} with
+    nothing logged. `extra_events` (event_row() dicts the caller already
+    decided on) go into the same sms_events insert."""
+    results = [None] * len(items)
+    events = list(extra_events)
+
+    def finish(i, status, outcome, body, row_id=None, source_tab=None,
+               error_detail=None, log=True):
+        item = items[i]
+        results[i] = {'status': status, 'outcome': outcome, **body}
+        if log:
+            events.append(event_row(item.get('sender'), item.get('body'),
+                                    item.get('received_at'), status, outcome,
+                                    item.get('plate'), item.get('ref'),
+                                    row_id, source_tab, error_detail))
+
+    url, key = _main()
+    if not url or not key:
+        for i in range(len(items)):
+            finish(i, 500, 'server_error', {'error': 'supabase_env_missing'},
+                   error_detail='supabase env missing')
+        insert_events(events)
+        return results
+
+    txs = find_transactions({it['ref'] for it in items if it.get('ref')})
+    if txs is None:
+        for i in range(len(items)):
+            finish(i, 500, 'server_error', {'error': 'transactions_lookup_failed'},
+                   error_detail='transactions lookup failed')
+        insert_events(events)
+        return results
+
+    # Transaction checks; only events whose FAILED row exists go further.
+    claimed = set()
+    candidates = []
+    for i, it in enumerate(items):
+        plate, ref = it.get('plate'), it.get('ref')
+        if not plate or not ref:
+            missing = 'ref' if plate else 'plate'
+            finish(i, 400, 'extract_failed', {'error': f'{missing}_extract_failed'},
+                   error_detail=f'no {missing} on sms_event')
+            continue
+        tx = txs.get(ref.lower())
+        if not tx:
+            finish(i, 404, 'ref_not_found',
+                   {'error': 'ref_not_found', 'ref': ref, 'plate': plate},
+                   log=log_misses)
+        elif (tx.get('rescue_locked_at') or tx['id'] in claimed
+              or tx['source_tab'] in RESCUED_SOURCE_TABS):
+            finish(i, 409, 'already_rescued',
+                   {'error': 'already_rescued', 'source_tab': tx['source_tab'],
+                    'row_id': tx['id']},
+                   row_id=tx['id'], source_tab=tx['source_tab'])
+        elif tx['source_tab'] not in FAILED_SOURCE_TABS:
+            finish(i, 409, 'ref_in_passed',
+                   {'error': 'ref_in_passed', 'source_tab': tx['source_tab'],
+                    'row_id': tx['id']},
+                   row_id=tx['id'], source_tab=tx['source_tab'])
+        else:
+            claimed.add(tx['id'])
+            candidates.append((i, tx))
+
+    custs = find_customers({items[i]['plate'] for i, _ in candidates}) if candidates else {}
+    if custs is None:
+        for i, _ in candidates:
+            finish(i, 500, 'server_error', {'error': 'registry_lookup_failed'},
+                   error_detail='registry lookup failed')
+        candidates = []
+
+    # Guarded PATCH per row, then the sheet writes in one grouped pass.
+    locked = []
+    for i, tx in candidates:
+        plate, ref = items[i]['plate'], items[i]['ref']
+        if deadline is not None and time.monotonic() > deadline:
+            results[i] = {'status': None, 'outcome': 'time_capped'}
+            continue
+        cust = custs.get(plate)
+        if not cust:
+            finish(i, 404, 'plate_not_in_records',
+                   {'error': 'plate_not_in_records', 'plate': plate, 'ref': ref})
+            continue
+        target_tab = ILIYOPATA_TARGET_FROM_CUSTOMER.get(cust['source_tab'])
+        if not target_tab:
+            finish(i, 400, 'server_error',
+                   {'error': 'unknown_customer_source', 'source_tab': cust['source_tab']},
+                   error_detail=f'unknown source {cust["source_tab"]}')
+            continue
+        try:
+            update, pr = lock(tx, cust, target_tab, moved_by)
+        except requests.RequestException as e:
+            finish(i, 500, 'server_error', {'error': str(e)[:400]},
+                   row_id=tx['id'], error_detail=str(e)[:400])
+            continue
+        if not pr.ok:
+            finish(i, 500, 'server_error', {'error': pr.text[:400]},
+                   row_id=tx['id'], error_detail=pr.text[:400])
+        elif not (pr.json() or []):
+            finish(i, 409, 'already_rescued',
+                   {'error': 'already_rescued', 'row_id': tx['id']},
+                   row_id=tx['id'], error_detail='concurrent lock')
+        else:
+            locked.append((i, tx, cust, target_tab, update))
+
+    if locked:
+        sheet_results = iliyopata_writer.append_iliyopata_rows([
+            {'origin_source_tab': tx['source_tab'], 'tx': tx, 'customer': cust,
+             'new_date_text': update['transaction_date']}
+            for _, tx, cust, _, update in locked
+        ])
+        for (i, tx, cust, target_tab, update), sheet_result in zip(locked, sheet_results):
+            sheet_err = None if sheet_result.get('ok') else sheet_result.get('error')
+            finish(i, 200, 'rescued',
+                   {'rescued': True, 'row_id': tx['id'], 'source_tab': target_tab,
+                    'plate': items[i]['plate'], 'ref': items[i]['ref'],
+                    'sheet': sheet_result},
+                   row_id=tx['id'], source_tab=target_tab, error_detail=sheet_err)
+
+    insert_events(events)
+    return results
+
+
+def fetch_retry_events(outcomes, min_age_min, max_age_min, limit, newest_first=True):
+    """sms_events rows with one of `outcomes` processed between max_age_min
+    and min_age_min minutes ago, at most `limit`. Returns None on error."""
+    url, key = _main()
+    now_utc = datetime.utcnow()
+    upper = (now_utc - timedelta(minutes=min_age_min)).isoformat() + 'Z'
+    lower = (now_utc - timedelta(minutes=max_age_min)).isoformat() + 'Z'
+    try:
+        r = supabase_client.main().get(
+            f'{url}/rest/v1/sms_events'
+            f'?select=id,sender,body,received_at,processed_at,'
+            f'extracted_plate,extracted_ref'
+            f'&outcome=in.({",".join(outcomes)})'
+            f'&processed_at=gte.{lower}'
+            f'&processed_at=lte.{upper}'
+            f'&order=processed_at.{"desc" if newest_first else "asc"}',
+            headers={**_headers(key), 'Range-Unit': 'items',
+                     'Range': f'0-{max(0, limit - 1)}'},
+            timeout=45,
+        )
+    except requests.RequestException as e:
+        print(f'⚠️ sms rescue: sms_events read failed: {e}')
+        return None
+    if r.status_code not in (200, 206):
+        print(f'⚠️ sms rescue: sms_events read → {r.status_code}: {r.text[:200]}')
+        return None
+    return r.json() or []
+
+
+def latest_per_message(events):
+    """Keep the newest event per (sender, body). Retry loops in the past
+    logged the same message many times; one retry per message is enough."""
+    newest = {}
+    for ev in events:
+        k = (ev.get('sender') or '', ev.get('body') or '')
+        if k not in newest or (ev.get('processed_at') or '') > (newest[k].get('processed_at') or ''):
+            newest[k] = ev
+    return list(newest.values())
+
+
+def tally(results):
+    """Sweep summary in the shape both retry callers have always returned."""
+    t = {'checked': 0, 'rescued': 0, 'still_ref_not_found': 0,
+         'plate_unknown': 0, 'already_rescued': 0, 'ref_in_passed': 0,
+         'extract_failed': 0, 'server_error': 0, 'other': 0,
+         'time_capped': False}
+    names = {'rescued': 'rescued', 'ref_not_found': 'still_ref_not_found',
+             'plate_not_in_records': 'plate_unknown',
+             'already_rescued': 'already_rescued', 'ref_in_passed': 'ref_in_passed',
+             'extract_failed': 'extract_failed', 'server_error': 'server_error'}
+    for r in results:
+        if r['outcome'] == 'time_capped':
+            t['time_capped'] = True
+            continue
+        t['checked'] += 1
+        t[names.get(r['outcome'], 'other')] += 1
+    return t
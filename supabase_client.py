@@ -0,0 +1,173 @@
+"""
+supabase_client.py — pooled HTTP sessions for the two Supabase projects
+
+Contract:
+  - main() / registry() return a process-wide requests.Session for the main
+    project (transactions, customers, users, sms_events, record_edits, ...)
+    and the customer_registry project. Every module used to call the bare
+    requests.get/post/... helpers, which open a fresh TCP + TLS connection
+    per call; these sessions keep connections alive in a urllib3 pool.
+  - Call sites keep building full URLs and passing their own headers, so
+    switching `requests.get(` to `supabase_client.main().get(` is the whole
+    migration. The sessions also carry apikey / Authorization defaults.
+  - Retries with exponential backoff on connect errors (any method — the
+    request never reached the server) and on 502/503/504 for idempotent
+    methods (GET/HEAD/PUT/DELETE). POSTs are never retried after the
+    server saw them: sms_events / record_edits inserts aren't idempotent.
+    Neither are PATCHes: sms_rescue_engine.lock() PATCHes with a
+    `rescue_locked_at=is.null` guard, and a retry after a 502 whose first
+    try was applied matches zero rows and reads as a lost race. After the
+    last retry the response is returned as-is — callers keep checking
+    r.ok / status_code exactly as before.
+  - main(retries=False) / registry(retries=False) return a second session
+    per project with no retries at all, for call sites that run their own
+    retry loop (the registry page fetches) so the two don't multiply.
+  - Per-call timing: every response is timed into stats() (count, errors,
+    total seconds per project). Calls slower than SUPABASE_SLOW_MS are
+    logged. add_timing_hook(fn) registers fn(project, method, url, status,
+    seconds) for anything that wants more.
+  - in_list(values) builds a quoted `in.(...)` filter operand for the
+    bulk lookups (mirror ref checks, batch SMS rescue).
+  - requests.Session is safe to share between threads for this kind of use
+    (gunicorn sync workers, the /process job thread, the registry page
+    pool); the pool size covers REGISTRY_LOAD_WORKERS.
+
+Env vars:
+  SUPABASE_URL / SUPABASE_SERVICE_KEY                       main project
+  SUPABASE_URL_REGISTRY / SUPABASE_SERVICE_KEY_REGISTRY     registry project
+                                     (falls back to main when unset, as
+                                      ui_blueprint.py always has)
+  SUPABASE_HTTP_RETRIES   retries per call (default 3, 0 disables)
+  SUPABASE_HTTP_BACKOFF   backoff factor in seconds (default 0.5 → 0.5s, 1s, 2s)
+  SUPABASE_HTTP_POOL      connections kept per host (default 10)
+  SUPABASE_SLOW_MS        log calls slower than this (default 3000, 0 disables)
+"""
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRIES = int(os.environ.get('SUPABASE_HTTP_RETRIES', '3'))
+BACKOFF = float(os.environ.get('SUPABASE_HTTP_BACKOFF', '0.5'))
+POOL_SIZE = int(os.environ.get('SUPABASE_HTTP_POOL', '10'))
+SLOW_MS = int(os.environ.get('SUPABASE_SLOW_MS', '3000'))
+
+_IDEMPOTENT = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+
+_lock = threading.Lock()
+_sessions = {}
+_hooks = []
+_stats = {}
+
+
+def _project_config(project):
+    url = os.environ.get('SUPABASE_URL', '').rstrip('/')
+    key = os.environ.get('SUPABASE_SERVICE_KEY', '')
+    if project == 'registry':
+        url = os.environ.get('SUPABASE_URL_REGISTRY', url).rstrip('/')
+        key = os.environ.get('SUPABASE_SERVICE_KEY_REGISTRY', key)
+    return url, key
+
+
+def _retry():
+    # allowed_methods only gates status / read retries; urllib3 retries
+    # connect errors for every method since nothing was sent.
+    kwargs = dict(total=RETRIES, connect=RETRIES, read=0,
+                  status=RETRIES, backoff_factor=BACKOFF,
+                  status_forcelist=(502, 503, 504),
+                  raise_on_status=False, respect_retry_after_header=True)
+    try:
+        return Retry(allowed_methods=_IDEMPOTENT, **kwargs)
+    except TypeError:  # urllib3 < 1.26
+        return Retry(method_whitelist=_IDEMPOTENT, **kwargs)
+
+
+def _timing_hook(project):
+    def hook(response, *args, **kwargs):
+        seconds = response.elapsed.total_seconds()
+        method = response.request.method if response.request else '?'
+        with _lock:
+            s = _stats.setdefault(project, {'calls': 0, 'errors': 0, 'seconds': 0.0})
+            s['calls'] += 1
+            s['seconds'] += seconds
+            if response.status_code >= 400:
+                s['errors'] += 1
+            hooks = list(_hooks)
+        if SLOW_MS and seconds * 1000 >= SLOW_MS:
+            print(f"🐢 supabase[{project}] {method} "
+                  f"{response.url.split('?', 1)[0]} → {response.status_code} "
+                  f"in {seconds:.2f}s")
+        for fn in hooks:
+            try:
+                fn(project, method, response.url, response.status_code, seconds)
+            except Exception as e:
+                print(f"⚠️ supabase timing hook failed: {e}")
+        return response
+    return hook
+
+
+def _session(project, retries=True):
+    with _lock:
+        sess = _sessions.get((project, retries))
+        if sess is not None:
+            return sess
+        _, key = _project_config(project)
+        sess = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE,
+                              max_retries=_retry() if retries else 0)
+        sess.mount('https://', adapter)
+        sess.mount('http://', adapter)
+        if key:
+            sess.headers.update({'apikey': key,
+                                 'Authorization': f'Bearer {key}'})
+        sess.hooks['response'].append(_timing_hook(project))
+        _sessions[(project, retries)] = sess
+        return sess
+
+
+def main(retries=True):
+    """Shared session for the main Supabase project."""
+    return _session('main', retries)
+
+
+def registry(retries=True):
+    """Shared session for the customer_registry project."""
+    return _session('registry', retries)
+
+
+def add_timing_hook(fn):
+    """Register fn(project, method, url, status, seconds), called after
+    every response. Exceptions from fn are logged and swallowed."""
+    with _lock:
+        if fn not in _hooks:
+            _hooks.append(fn)
+
+
+def in_list(values):
+    """PostgREST in.(...) operand — every value double-quoted so refs /
+    plates with commas or parentheses can't break the list."""
+    quoted = ('"' + v.replace('\\', '\\\\').replace('"', '\\"') + '"' for v in values)
+    return 'in.(' + ','.join(quoted) + ')'
+
+
+def stats():
+    """{project: {'calls', 'errors', 'seconds'}} since process start."""
+    with _lock:
+        return {p: dict(s) for p, s in _stats.items()}
+
+
+def reset():
+    """Close and forget the pooled sessions (next call rebuilds them from the
+    environment)."""
+    with _lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for sess in sessions:
+        try:
+            sess.close()
+        except Exception:
+            pass
+
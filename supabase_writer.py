@@ -2,18 +2,28 @@
 supabase_writer.py — thin dual-write helper for app.py
 
 Contract:
-  - append_to_sheet() in app.py calls append() below after a successful
-    Google Sheets update. This mirrors the same rows into Supabase.
+  - append_to_sheet() in app.py queues the rows of every successful Google
+    Sheets update in mirror_outbox.py; its flusher thread calls append()
+    below to mirror them into Supabase, off the sheet write path.
   - Never raises. Any error is logged and swallowed so a Supabase outage
     can never break the sheet write path (which is still the source of
     truth during the dual-write phase).
   - No-op when the WRITE_TO_SUPABASE env var is not truthy.
   - No-op when SUPABASE_URL or SUPABASE_SERVICE_KEY are missing.
+  - Duplicates cost one lookup, not one request per row: refs already in
+    `transactions` are found with a ref_number=in.(...) query and left out
+    of the insert, and the rest is POSTed in SUPABASE_MIRROR_CHUNK-row
+    batches. A batch that still 409s (a concurrent writer won the race) is
+    split in half until the conflicting row is isolated. Refs the DB
+    already held go to dedup_alerts (a ref repeated within the batch is
+    just dropped, as before); append() returns exact inserted / skipped /
+    failed counts.
 
 Env vars:
   SUPABASE_URL           https://<ref>.supabase.co
   SUPABASE_SERVICE_KEY   service_role secret from Supabase → API
   WRITE_TO_SUPABASE      '1' / 'true' / 'yes'  to enable (default off)
+  SUPABASE_MIRROR_CHUNK  rows per insert POST (default 500)
 """
 
 import os
@@ -21,7 +31,7 @@ import re
 import traceback
 from datetime import date, datetime
 
-import requests
+import supabase_client
 
 SUPABASE_URL = os.environ.get('SUPABASE_URL', '').rstrip('/')
 SUPABASE_KEY = os.environ.get('SUPABASE_SERVICE_KEY', '')
@@ -174,7 +184,88 @@ def _row_to_record_8col(row, source_tab, source_sheet_id):
     }
 
 
-def append(logical_tab, sheet_ids, rows):
+# Mirror batches: at most MIRROR_CHUNK rows per insert POST, and at most
+# _REF_QUERY_CHUNK refs per `ref_number=in.(...)` lookup (refs sit in the
+# query string, ~20 chars each — keep the URL well under proxy limits).
+MIRROR_CHUNK     = int(os.environ.get('SUPABASE_MIRROR_CHUNK', '500'))
+_REF_QUERY_CHUNK = 200
+
+
+def _existing_refs(refs):
+    """Subset of `refs` already in transactions, or None if the lookup
+    failed (the insert path then relies on the unique index alone)."""
+    found = set()
+    refs = sorted(refs)
+    try:
+        for i in range(0, len(refs), _REF_QUERY_CHUNK):
+            chunk = refs[i:i + _REF_QUERY_CHUNK]
+            r = supabase_client.main().get(
+                f'{SUPABASE_URL}/rest/v1/transactions',
+                params={'select': 'ref_number', 'ref_number': supabase_client.in_list(chunk)},
+                headers=_HEADERS,
+                timeout=15,
+            )
+            if not r.ok:
+                print(f'  ⚠️ Supabase ref lookup → {r.status_code}: {r.text[:200]}')
+                return None
+            found.update(row['ref_number'] for row in r.json() or [] if row.get('ref_number'))
+    except Exception as e:
+        print(f'  ⚠️ Supabase ref lookup exception: {e}')
+        return None
+    return found
+
+
+def _insert(records, conflicts):
+    """POST records; returns (inserted, failed). A 409 (a duplicate that got
+    past the ref lookup — concurrent writer, or the (source_tab,
+    original_id) index) splits the batch in half and retries each half, so
+    one bad row costs log2(n) calls instead of the old n single-row POSTs.
+    A single row that still 409s is appended to `conflicts`."""
+    r = supabase_client.main().post(
+        f'{SUPABASE_URL}/rest/v1/transactions',
+        headers=_HEADERS,
+        json=records,
+        timeout=15,
+    )
+    if r.ok:
+        return len(records), 0
+    if r.status_code == 409:
+        if len(records) == 1:
+            conflicts.append(records[0])
+            return 0, 0
+        mid = len(records) // 2
+        a = _insert(records[:mid], conflicts)
+        b = _insert(records[mid:], conflicts)
+        return a[0] + b[0], a[1] + b[1]
+    print(f'  ⚠️ Supabase mirror insert → {r.status_code}: {r.text[:200]}')
+    return 0, len(records)
+
+
+def _record_dedup_alerts(skipped):
+    """One batched insert into dedup_alerts for every ref the mirror
+    skipped as already present. Best-effort, like the mirror itself."""
+    if not skipped:
+        return
+    alerts = [{'ref_number':  rec.get('ref_number') or '',
+               'source_tab':  rec.get('source_tab'),
+               'description': (rec.get('description') or '')[:500]}
+              for rec in skipped]
+    try:
+        for i in range(0, len(alerts), MIRROR_CHUNK):
+            r = supabase_client.main().post(
+                f'{SUPABASE_URL}/rest/v1/dedup_alerts',
+                headers=_HEADERS,
+                json=alerts[i:i + MIRROR_CHUNK],
+                timeout=15,
+            )
+            if not r.ok:
+                print(f'  ⚠️ dedup_alerts insert → {r.status_code}: {r.text[:200]}')
+                return
+    except Exception as e:
+        print(f'  ⚠️ dedup_alerts insert exception: {e}')
+
+
+def append(logical_tab, sheet_ids, rows, record_alerts=True):
     """
     Mirror rows into Supabase's `transactions` table.
 
@@ -185,20 +276,33 @@ def append(logical_tab, sheet_ids, rows):
     sheet_ids:   IGNORED — kept in the signature for backwards compat.
                  source_sheet_id now comes from _TAB_TO_BANK instead.
     rows:        list of lists — the exact row payload app.py built.
-
-    Silently drops the mirror if logical_tab is not in _TAB_RENAME
-    (e.g. the decommissioned _OLD NMB tabs).
+    record_alerts: False when resending rows that may have partly landed
+                 already (mirror_outbox retries) — those aren't duplicates
+                 worth an alert.
+
+    Refs already in the table are found up front with one
+    ref_number=in.(...) lookup per _REF_QUERY_CHUNK refs and left out of
+    the insert; the rest goes in MIRROR_CHUNK-row POSTs. Every ref skipped
+    because the DB already held it (found by the lookup or caught by the
+    unique index) is recorded in dedup_alerts. Repeats within the batch are
+    skipped and counted but not alerted on.
+
+    Returns {'inserted', 'skipped', 'failed'} row counts, or None when the
+    mirror is off / the tab isn't mirrored. Silently drops the mirror if
+    logical_tab is not in _TAB_RENAME (e.g. the decommissioned _OLD NMB
+    tabs).
     """
     if not ENABLED or not SUPABASE_URL or not SUPABASE_KEY:
-        return
+        return None
     if not rows:
-        return
+        return None
 
     new_source_tab = _TAB_RENAME.get(logical_tab)
     if not new_source_tab:
-        return  # Unknown / deprecated tab — skip mirror
+        return None  # Unknown / deprecated tab — skip mirror
 
     source_sheet_id = _TAB_TO_BANK.get(logical_tab, '')
+    counts = {'inserted': 0, 'skipped': 0, 'failed': 0}
 
     try:
         if logical_tab in _FAILED_TABS:
@@ -212,11 +316,13 @@ def append(logical_tab, sheet_ids, rows):
         # data) are exempt — they're not in the index anyway.
         seen_refs = set()
         cleaned = []
+        in_batch = 0
         for rec in records:
             ref = (rec.get('ref_number') or '').strip()
             if ref:
                 if ref in seen_refs:
                     print(f'  ↳ skipping duplicate ref in batch: {ref}')
+                    in_batch += 1
                     continue
                 seen_refs.add(ref)
             cleaned.append(rec)
@@ -224,38 +330,31 @@ def append(logical_tab, sheet_ids, rows):
 
         # No on_conflict — PostgREST needs a non-partial unique constraint
         # to accept ON CONFLICT (ref_number), and ours is partial (excludes
-        # NULL / empty ref). App-side dedup on ref_number prevents duplicate
-        # writes; the partial UNIQUE is a hard backstop that will 409 any
-        # duplicate that slips through, which we log below.
-        r = requests.post(
-            f'{SUPABASE_URL}/rest/v1/transactions',
-            headers=_HEADERS,
-            json=records,
-            timeout=15,
-        )
-        if not r.ok:
-            # On a 409 (cross-batch duplicate against the DB), fall back to
-            # per-row inserts so the good rows still land — only the actual
-            # duplicate is skipped.
-            if r.status_code == 409 and len(records) > 1:
-                print(f'  ⚠️ Supabase batch 409 — retrying {len(records)} rows individually')
-                ok_cnt = 0
-                for rec in records:
-                    ri = requests.post(
-                        f'{SUPABASE_URL}/rest/v1/transactions',
-                        headers=_HEADERS, json=[rec], timeout=10,
-                    )
-                    if ri.ok:
-                        ok_cnt += 1
-                    elif ri.status_code == 409:
-                        pass  # already in DB — expected
-                    else:
-                        print(f'    ↳ row failed: {ri.status_code} {ri.text[:120]}')
-                print(f'  📡 Supabase mirror: {ok_cnt}/{len(records)} rows → {new_source_tab} (after retry)')
-            else:
-                print(f'  ⚠️ Supabase mirror {new_source_tab} → {r.status_code}: {r.text[:200]}')
-        else:
-            print(f'  📡 Supabase mirror: {len(records)} rows → {new_source_tab}')
+        # NULL / empty ref). Refs the DB already holds are filtered out
+        # here instead; the partial UNIQUE stays the hard backstop for
+        # anything written between this lookup and the insert.
+        existing = _existing_refs(seen_refs) if seen_refs else set()
+        skipped = []
+        if existing:
+            keep = []
+            for rec in records:
+                (skipped if (rec.get('ref_number') or '').strip() in existing else keep).append(rec)
+            records = keep
+
+        conflicts = []
+        for i in range(0, len(records), MIRROR_CHUNK):
+            inserted, failed = _insert(records[i:i + MIRROR_CHUNK], conflicts)
+            counts['inserted'] += inserted
+            counts['failed'] += failed
+        skipped.extend(conflicts)
+        counts['skipped'] = in_batch + len(skipped)
+        if record_alerts:
+            _record_dedup_alerts(skipped)
+
+        print(f"  📡 Supabase mirror: {counts['inserted']}/{len(rows)} rows → {new_source_tab}"
+              f" ({counts['skipped']} duplicate, {counts['failed']} failed)")
     except Exception as e:
         print(f'  ⚠️ Supabase mirror exception ({new_source_tab}): {e}')
         traceback.print_exc()
+        counts['failed'] = len(rows) - counts['inserted'] - counts['skipped']
+    return counts
@@ -0,0 +1,122 @@
+"""
+Shared fixtures. The modules under test read their env vars at import time,
+so fixtures point the module-level paths at tmp_path instead of setting env.
+
+FakeSheets stands in for the googleapiclient service object: just enough of
+spreadsheets().values() get / batchGet / update (and spreadsheets()
+batchUpdate) over in-memory tabs, counting every call.
+"""
+
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+_RANGE_RX = re.compile(r'^(?P<tab>[^!]+)!(?P<c1>[A-Z]+)(?P<r1>\d*)(?::(?P<c2>[A-Z]+)(?P<r2>\d*))?$')
+
+
+def _col(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + ord(ch) - ord('A') + 1
+    return n - 1
+
+
+class _Call:
+    def __init__(self, fn):
+        self._fn = fn
+
+    def execute(self):
+        return self._fn()
+
+
+class FakeSheets:
+    def __init__(self):
+        self.tabs = {}          # (spreadsheet_id, tab) -> list of rows
+        self.calls = []         # (method, spreadsheet_id, range(s))
+
+    # service.spreadsheets() / .values() both return self
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def rows(self, sheet_id, tab):
+        return self.tabs.setdefault((sheet_id, tab), [])
+
+    def _read(self, sheet_id, a1):
+        m = _RANGE_RX.match(a1)
+        rows = self.rows(sheet_id, m['tab'])
+        c1 = _col(m['c1'])
+        c2 = _col(m['c2'] or m['c1'])
+        r1 = int(m['r1'] or 1)
+        r2 = int(m['r2']) if m['r2'] else len(rows)
+        out = []
+        for row in rows[r1 - 1:r2]:
+            cells = list(row[c1:c2 + 1])
+            while cells and cells[-1] in (None, ''):
+                cells.pop()
+            out.append(cells)
+        while out and not out[-1]:
+            out.pop()
+        return out
+
+    def get(self, spreadsheetId, range, **kwargs):
+        self.calls.append(('get', spreadsheetId, range))
+        return _Call(lambda: {'values': self._read(spreadsheetId, range)})
+
+    def batchGet(self, spreadsheetId, ranges, **kwargs):
+        self.calls.append(('batchGet', spreadsheetId, tuple(ranges)))
+        return _Call(lambda: {'valueRanges': [{'values': self._read(spreadsheetId, r)}
+                                              for r in ranges]})
+
+    def update(self, spreadsheetId, range, valueInputOption=None, body=None):
+        self.calls.append(('update', spreadsheetId, range))
+
+        def run():
+            m = _RANGE_RX.match(range)
+            rows = self.rows(spreadsheetId, m['tab'])
+            start = int(m['r1'])
+            values = body['values']
+            while len(rows) < start - 1 + len(values):
+                rows.append([])
+            for i, row in enumerate(values):
+                rows[start - 1 + i] = list(row)
+            end = start + len(values) - 1
+            return {'updatedRows': len(values),
+                    'updatedRange': f"{m['tab']}!A{start}:Z{end}"}
+        return _Call(run)
+
+    def batchUpdate(self, spreadsheetId, body):
+        self.calls.append(('batchUpdate', spreadsheetId, body))
+        return _Call(lambda: {})
+
+    def count(self, method):
+        return sum(1 for c in self.calls if c[0] == method)
+
+
+@pytest.fixture
+def sheets():
+    return FakeSheets()
+
+
+@pytest.fixture
+def ref_index_db(tmp_path, monkeypatch):
+    import ref_index
+    monkeypatch.setattr(ref_index, 'INDEX_PATH', str(tmp_path / 'ref_index.sqlite3'))
+    monkeypatch.setattr(ref_index, '_schema_ready', False)
+    monkeypatch.setattr(ref_index, 'ENABLED', True)
+    return ref_index
+
+
+@pytest.fixture
+def app_module(ref_index_db, monkeypatch):
+    import app
+    monkeypatch.setattr(app, '_REF_COUNT_FLOOR', {})
+    if hasattr(app._SHEET_SNAPSHOT, 'snap'):
+        del app._SHEET_SNAPSHOT.snap
+    return app
@@ -0,0 +1,104 @@
+"""audit_queue.py: splitting a rejected insert, what is spilled, and how
+spill claims are replayed. Drives _write / _spill / _replay_spill directly
+(no writer thread)."""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import audit_queue
+
+
+@pytest.fixture
+def aq(tmp_path, monkeypatch):
+    monkeypatch.setattr(audit_queue, 'SPILL_PATH', str(tmp_path / 'spill.jsonl'))
+    monkeypatch.setattr(audit_queue, '_writers', {})
+    monkeypatch.setattr(audit_queue, '_counts',
+                        {'written': 0, 'spilled': 0, 'replayed': 0, 'dropped': 0})
+    db = {'landed': [], 'status': None, 'inserts': 0}
+
+    def writer(rows):
+        db['inserts'] += 1
+        if db['status'] == 'raise':
+            raise ConnectionError('reset by peer')
+        if db['status']:
+            return db['status']
+        if any(r.get('bad') for r in rows):
+            return 400
+        db['landed'].extend(r['i'] for r in rows)
+        return 201
+    audit_queue.register('record_edits', writer)
+    return db
+
+
+def _spilled():
+    if not os.path.exists(audit_queue.SPILL_PATH):
+        return []
+    with open(audit_queue.SPILL_PATH) as fh:
+        return [json.loads(line)['row']['i'] for line in fh]
+
+
+def _write_claim(path, rows):
+    with open(path, 'w') as fh:
+        for i in rows:
+            fh.write(json.dumps({'table': 'record_edits', 'row': {'i': i}}) + '\n')
+
+
+def test_rejected_row_is_split_out_and_dropped(aq):
+    rows = [{'i': i, 'bad': i == 6} for i in range(10)]
+    assert audit_queue._write({'record_edits': rows}) == {}
+    assert sorted(aq['landed']) == [0, 1, 2, 3, 4, 5, 7, 8, 9]
+    stats = audit_queue.stats()
+    assert (stats['written'], stats['dropped'], stats['spilled_pending']) == (9, 1, 0)
+
+
+@pytest.mark.parametrize('status', [503, 401, 429, 'raise'])
+def test_failures_not_about_the_rows_are_spilled_whole(aq, status):
+    aq['status'] = status
+    failed = audit_queue._write({'record_edits': [{'i': 1}, {'i': 2}]})
+    assert aq['inserts'] == 1           # no splitting
+    assert audit_queue._spill(failed)
+    assert _spilled() == [1, 2]
+    assert audit_queue.stats()['dropped'] == 0
+
+
+def test_rows_without_a_writer_are_spilled(aq):
+    assert audit_queue._write({'sms_events': [{'i': 1}]}) == {'sms_events': [{'i': 1}]}
+
+
+def test_replay_takes_the_spill_and_dead_workers_claims(aq):
+    audit_queue._spill({'record_edits': [{'i': 100}]})
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    _write_claim(f'{audit_queue.SPILL_PATH}.{dead.pid}.0', [200])
+    live = f'{audit_queue.SPILL_PATH}.1.0'        # pid 1 is always alive
+    _write_claim(live, [300])
+
+    audit_queue._replay_spill()
+    assert sorted(aq['landed']) == [100, 200]
+    assert audit_queue.stats()['replayed'] == 2
+    folder = os.path.dirname(audit_queue.SPILL_PATH)
+    assert sorted(os.listdir(folder)) == ['spill.jsonl.1.0', 'spill.jsonl.lock']
+    assert os.path.exists(live)
+
+
+def test_replay_that_fails_again_goes_back_to_the_spill(aq):
+    audit_queue._spill({'record_edits': [{'i': 1}, {'i': 2}]})
+    aq['status'] = 503
+    audit_queue._replay_spill()
+    assert _spilled() == [1, 2]
+    folder = os.path.dirname(audit_queue.SPILL_PATH)
+    assert sorted(os.listdir(folder)) == ['spill.jsonl', 'spill.jsonl.lock']
+
+
+def test_append_after_a_claim_starts_a_new_spill(aq):
+    audit_queue._spill({'record_edits': [{'i': 1}]})
+    (claim,) = audit_queue._claim_spill()
+    audit_queue._spill({'record_edits': [{'i': 2}]})
+    # The claimed rows and the new one don't mix.
+    assert _spilled() == [2]
+    with open(claim) as fh:
+        assert [json.loads(line)['row']['i'] for line in fh] == [1]
@@ -0,0 +1,64 @@
+"""auth.load_user's per-worker cache and its invalidation stamp."""
+
+import os
+
+import pytest
+
+import auth
+
+
+@pytest.fixture
+def users(tmp_path, monkeypatch):
+    monkeypatch.setattr(auth, 'USER_CACHE_STAMP', str(tmp_path / 'users.stamp'))
+    monkeypatch.setattr(auth, 'USER_CACHE_TTL', 60)
+    monkeypatch.setattr(auth, '_user_cache', auth.OrderedDict())
+    monkeypatch.setattr(auth, '_user_cache_stamp', 0.0)
+    db = {'role': 'editor', 'fetches': 0, 'during_fetch': None}
+
+    def fetch(*, user_id=None, username=None):
+        db['fetches'] += 1
+        row = {'id': user_id, 'username': 'jane', 'role': db['role']}
+        if db['during_fetch']:
+            db['during_fetch']()
+        return row
+    monkeypatch.setattr(auth, '_fetch_user', fetch)
+    return db
+
+
+def test_repeat_loads_are_cached(users):
+    assert auth.load_user('7').role == 'editor'
+    assert auth.load_user('7').role == 'editor'
+    assert users['fetches'] == 1
+
+
+def test_invalidate_forces_a_refetch(users):
+    auth.load_user('7')
+    users['role'] = 'viewer'
+    auth.invalidate_user(7)
+    assert auth.load_user('7').role == 'viewer'
+    assert users['fetches'] == 2
+
+
+def test_other_workers_invalidation_is_seen_through_the_stamp(users):
+    auth.load_user('7')
+    users['role'] = 'viewer'
+    open(auth.USER_CACHE_STAMP, 'a').close()
+    os.utime(auth.USER_CACHE_STAMP, (1e9, 1e9))   # another worker's invalidate
+    assert auth.load_user('7').role == 'viewer'
+
+
+def test_fetch_racing_an_invalidate_is_not_cached(users):
+    auth.load_user('1')      # the stamp is current
+
+    def demote():
+        # The row was read before this change committed ...
+        users['role'] = 'viewer'
+        users['during_fetch'] = None
+        auth.invalidate_user(7)
+        # ... and another request in this worker has already seen the new
+        # stamp, so the cache won't be cleared for it again.
+        auth.load_user('1')
+    users['during_fetch'] = demote
+    assert auth.load_user('7').role == 'editor'
+    assert auth.load_user('7').role == 'viewer'
+    assert users['fetches'] == 4
@@ -0,0 +1,38 @@
+"""app._classify_rows: the forkserver pool gives the serial result, in row
+order, and stays off unless CLASSIFY_WORKERS asks for it."""
+
+import multiprocessing
+
+import pytest
+
+
+def _tag(row, ctx):
+    # Module-level so the forkserver workers can unpickle it by reference.
+    return (row, ctx['offset'] + row)
+
+
+def _ctx():
+    return {'offset': 1000, 'lookups': ({},) * 7}
+
+
+def test_serial_by_default(app_module, monkeypatch):
+    app = app_module
+    assert app.CLASSIFY_WORKERS == 1
+    monkeypatch.setattr(app, 'CLASSIFY_PARALLEL_MIN_ROWS', 10)
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError('pool started')
+    monkeypatch.setattr('concurrent.futures.ProcessPoolExecutor', no_pool)
+    assert app._classify_rows(_tag, list(range(3000)), _ctx())[-1] == (2999, 3999)
+
+
+@pytest.mark.skipif('forkserver' not in multiprocessing.get_all_start_methods(),
+                    reason='no forkserver on this platform')
+def test_pool_matches_serial(app_module, monkeypatch, capsys):
+    app = app_module
+    rows = list(range(3000))
+    serial = app._classify_rows(_tag, rows, _ctx())
+    monkeypatch.setattr(app, 'CLASSIFY_WORKERS', 3)
+    monkeypatch.setattr(app, 'CLASSIFY_PARALLEL_MIN_ROWS', 1000)
+    assert app._classify_rows(_tag, rows, _ctx()) == serial
+    assert 'on 3 processes' in capsys.readouterr().out
@@ -0,0 +1,77 @@
+"""app.load_customers_dispatch: the registry fingerprint, the on-disk
+snapshot and the cross-worker .stale marker."""
+
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture
+def cache(app_module, tmp_path, monkeypatch):
+    app = app_module
+    path = str(tmp_path / 'customer_cache.pickle')
+    monkeypatch.setattr(app, '_CUSTOMER_CACHE_PATH', path)
+    monkeypatch.setattr(app, '_CUSTOMER_CACHE_STALE', path + '.stale')
+    monkeypatch.setattr(app, '_CUSTOMER_CACHE', {'entry': None})
+    monkeypatch.setattr(app, 'CUSTOMER_SOURCE', 'registry')
+    monkeypatch.setattr(app, 'CUSTOMER_CACHE_TTL', 900)
+    state = {'fingerprint': (10, '2026-01-01T00:00:00'), 'loads': 0}
+    monkeypatch.setattr(app, '_registry_fingerprint', lambda: state['fingerprint'])
+
+    def load(service):
+        state['loads'] += 1
+        return ({'255700000001': 'JOHN'},) + ({},) * 6
+    monkeypatch.setattr(app, '_load_customers_uncached', load)
+    return state
+
+
+def test_unchanged_registry_is_served_from_memory(app_module, cache):
+    first = app_module.load_customers_dispatch(None)
+    assert app_module.load_customers_dispatch(None) is first
+    assert cache['loads'] == 1
+
+
+def test_fingerprint_change_reloads(app_module, cache):
+    app_module.load_customers_dispatch(None)
+    cache['fingerprint'] = (11, '2026-01-01T00:00:00')
+    app_module.load_customers_dispatch(None)
+    assert cache['loads'] == 2
+
+
+def test_unreadable_fingerprint_reloads(app_module, cache):
+    app_module.load_customers_dispatch(None)
+    cache['fingerprint'] = None
+    app_module.load_customers_dispatch(None)
+    assert cache['loads'] == 2
+
+
+def test_recycled_worker_starts_from_disk_snapshot(app_module, cache):
+    app_module.load_customers_dispatch(None)
+    app_module._CUSTOMER_CACHE['entry'] = None
+    assert app_module.load_customers_dispatch(None)[0] == {'255700000001': 'JOHN'}
+    assert cache['loads'] == 1
+
+
+def test_registry_edit_marks_every_worker_stale(app_module, cache):
+    import ui_blueprint
+    app_module.load_customers_dispatch(None)
+    entry = app_module._CUSTOMER_CACHE['entry']
+    ui_blueprint._registry_changed()
+    assert os.path.exists(app_module._CUSTOMER_CACHE_STALE)
+    assert not os.path.exists(app_module._CUSTOMER_CACHE_PATH)
+    # Another worker still holds the old entry in memory; the marker alone
+    # must keep it from being used.
+    app_module._CUSTOMER_CACHE['entry'] = entry
+    app_module.load_customers_dispatch(None)
+    assert cache['loads'] == 2
+
+
+def test_marker_older_than_the_entry_is_ignored(app_module, cache):
+    stale = app_module._CUSTOMER_CACHE_STALE
+    open(stale, 'a').close()
+    past = time.time() - 60
+    os.utime(stale, (past, past))
+    app_module.load_customers_dispatch(None)
+    app_module.load_customers_dispatch(None)
+    assert cache['loads'] == 1
@@ -0,0 +1,94 @@
+"""mirror_outbox.py: batching, per-entry retries and parking, against a fake
+supabase_writer.append() (no flusher thread; tests call _drain() directly)."""
+
+import sqlite3
+
+import pytest
+
+import mirror_outbox
+import supabase_writer
+
+
+@pytest.fixture
+def outbox(tmp_path, monkeypatch):
+    monkeypatch.setattr(mirror_outbox, 'OUTBOX_PATH', str(tmp_path / 'outbox.sqlite3'))
+    monkeypatch.setattr(mirror_outbox, '_schema_ready', False)
+    monkeypatch.setattr(mirror_outbox, 'MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(mirror_outbox, 'start', lambda: None)
+    monkeypatch.setattr(supabase_writer, 'ENABLED', True)
+    monkeypatch.setattr(supabase_writer, 'SUPABASE_URL', 'http://supabase.test')
+    monkeypatch.setattr(supabase_writer, 'SUPABASE_KEY', 'key')
+    calls = []
+
+    def append(tab, ids, rows, record_alerts=True):
+        calls.append(([r[0] for r in rows], record_alerts))
+        bad = sum(1 for r in rows if r[0] == 'BAD')
+        return {'inserted': len(rows) - bad, 'skipped': 0, 'failed': bad}
+    monkeypatch.setattr(supabase_writer, 'append', append)
+    return calls
+
+
+def _make_due():
+    conn = sqlite3.connect(mirror_outbox.OUTBOX_PATH)
+    with conn:
+        conn.execute('UPDATE outbox SET next_try_at = 0')
+    conn.close()
+
+
+def test_queued_entries_go_out_in_one_batch(outbox):
+    mirror_outbox.enqueue('PASSED', [['a']])
+    mirror_outbox.enqueue('PASSED', [['b'], ['c']])
+    assert mirror_outbox._drain() == 3
+    assert outbox == [(['a', 'b', 'c'], True)]
+    assert mirror_outbox.backlog()['entries'] == 0
+
+
+def test_failed_entry_is_retried_alone(outbox):
+    mirror_outbox.enqueue('PASSED', [['BAD']])
+    mirror_outbox.enqueue('PASSED', [['a']])
+    mirror_outbox._drain()
+    assert outbox == [(['BAD', 'a'], True)]
+    outbox.clear()
+    _make_due()
+    mirror_outbox._drain()
+    # Each entry is resent on its own; only the bad one keeps failing.
+    assert outbox == [(['BAD'], False), (['a'], False)]
+    b = mirror_outbox.backlog()
+    assert (b['entries'], b['retrying'], b['last_error']) == (1, 1, '1/1 rows failed')
+
+
+def test_fresh_entries_are_not_held_back_by_a_retrying_one(outbox):
+    mirror_outbox.enqueue('PASSED', [['BAD']])
+    mirror_outbox._drain()
+    mirror_outbox.enqueue('PASSED', [['a']])
+    outbox.clear()
+    _make_due()
+    mirror_outbox._drain()
+    assert outbox == [(['BAD'], False), (['a'], True)]
+
+
+def test_entry_is_parked_after_max_attempts_and_can_be_unparked(outbox):
+    mirror_outbox.enqueue('PASSED', [['BAD']])
+    for _ in range(mirror_outbox.MAX_ATTEMPTS):
+        _make_due()
+        mirror_outbox._drain()
+    assert len(outbox) == mirror_outbox.MAX_ATTEMPTS
+    b = mirror_outbox.backlog()
+    assert (b['entries'], b['parked_entries'], b['parked_rows']) == (0, 1, 1)
+    assert b['parked_last_error'] == '1/1 rows failed'
+    _make_due()
+    mirror_outbox._drain()
+    assert len(outbox) == mirror_outbox.MAX_ATTEMPTS      # parked: not retried
+    assert 'mirror_outbox_parked_entries 1' in mirror_outbox.render()
+
+    assert mirror_outbox.unpark('PASSED') == 1
+    b = mirror_outbox.backlog()
+    assert (b['entries'], b['retrying'], b['parked_entries']) == (1, 0, 0)
+    outbox.clear()
+    mirror_outbox._drain()
+    assert outbox == [(['BAD'], True)]                     # a first try again
+
+
+def test_unmirrored_tab_is_not_queued(outbox):
+    assert mirror_outbox.enqueue('NOT_A_TAB', [['a']]) is None
+    assert mirror_outbox.backlog()['entries'] == 0
@@ -0,0 +1,63 @@
+"""ref_index.py and its reconciliation with the sheet in app._refs_from_index."""
+
+import pytest
+
+
+def _row(n, ref):
+    return [n, '01.01.2026', '', f'PAYMENT {ref}', 1000, 'MC123ABC', 'JOHN', ref, '']
+
+
+@pytest.fixture
+def passed(app_module, sheets):
+    rows = sheets.rows(app_module.PASSED_SHEET_ID, 'PASSED')
+    rows.append(['ID', 'DATE', '', 'MESSAGE', 'AMOUNT', 'ID', 'NAME', 'REFNUMBER', ''])
+    rows.extend(_row(i, f'R{i}') for i in range(1, 6))
+    return rows
+
+
+def _refs(app_module, sheets):
+    return app_module.get_existing_refs(sheets, 'PASSED', refs_only=True)[0]
+
+
+def test_first_use_builds_index_then_reads_only_the_tail(app_module, sheets, passed):
+    assert _refs(app_module, sheets) == {f'R{i}' for i in range(1, 6)}
+    passed.append(_row(6, 'R6'))
+    sheets.calls.clear()
+    assert 'R6' in _refs(app_module, sheets)
+    (tail,) = [c for c in sheets.calls if c[0] == 'batchGet']
+    # The tail starts at the last synced row, which is checked, not re-indexed.
+    assert tail[2] == ('PASSED!D6:D7', 'PASSED!H6:H7')
+
+
+def test_delete_then_append_with_same_row_count_rebuilds(app_module, sheets, passed, ref_index_db):
+    _refs(app_module, sheets)
+    del passed[2]                      # someone deletes R2's row ...
+    passed.append(_row(7, 'R7'))       # ... and a new row lands: same count
+    refs = _refs(app_module, sheets)
+    assert 'R7' in refs
+    assert 'R2' not in refs
+    assert ref_index_db.state('PASSED')[2] == 'PAYMENT R7'
+
+
+def test_unchanged_sheet_only_reads_the_check_row(app_module, sheets, passed):
+    _refs(app_module, sheets)
+    sheets.calls.clear()
+    _refs(app_module, sheets)
+    (tail,) = [c for c in sheets.calls if c[0] == 'batchGet']
+    assert tail[2] == ('PASSED!D6:D6', 'PASSED!H6:H6')
+
+
+def test_own_append_keeps_index_in_sync(app_module, sheets, passed, ref_index_db):
+    _refs(app_module, sheets)
+    assert app_module.append_to_sheet(sheets, 'PASSED', [_row(6, 'R6')])
+    assert ref_index_db.state('PASSED')[:1] == (7,)
+    assert ref_index_db.state('PASSED')[2] == 'PAYMENT R6'
+    assert 'R6' in ref_index_db.load('PASSED', refs_only=True)[0]
+
+
+def test_index_without_tail_key_forces_full_sync(ref_index_db):
+    assert ref_index_db.add('PASSED', {'R1'}, set(), set(), synced_rows=2, key=None, full=True)
+    assert ref_index_db.needs_full_sync(ref_index_db.state('PASSED'), 2)
+    assert ref_index_db.add('PASSED', {'R1'}, set(), set(), synced_rows=2, key='x', full=True)
+    assert not ref_index_db.needs_full_sync(ref_index_db.state('PASSED'), 2)
+    assert ref_index_db.needs_full_sync(ref_index_db.state('PASSED'), 1)
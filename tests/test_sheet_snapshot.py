@@ -0,0 +1,65 @@
+"""The per-run sheet snapshot (app.load_sheet_snapshot) against fresh reads,
+and how many Sheets calls a warm NMB dedup load costs."""
+
+import pytest
+
+_NMB_REF_READS = [('PASSED', True), ('PASSED_NMB', True), ('PASSED_SAV_NMB_OLD', True),
+                  ('PASSED_SAV_NMB', True), ('FAILED_NMB_OLD', False), ('FAILED_NMB', False),
+                  ('BANK_PASSED', True), ('BANK_FAILED', True)]
+
+
+def _row(n, ref, message=None):
+    return [n, '01.01.2026', 'NMB', message or f'PAYMENT {ref}', 1000, 'MC123ABC', 'JOHN', ref]
+
+
+@pytest.fixture
+def tabs(app_module, sheets):
+    for i, tab in enumerate(app_module._NMB_SNAPSHOT_TABS):
+        rows = sheets.rows(*app_module._resolve_sheet(tab))
+        rows.append(['ID', 'DATE', 'BANK', 'MESSAGE', 'AMOUNT', 'ID', 'NAME', 'REFNUMBER'])
+        rows.append(_row(1, f'{tab}-1', f'Trx ID PS10000000000{i:02d} MC123ABC'))
+        rows.append(_row(2, f'{tab}-2'))
+    return sheets
+
+
+def _nmb_dedup_reads(app, service):
+    app.load_sheet_snapshot(service, app._NMB_SNAPSHOT_TABS)
+    for tab, refs_only in _NMB_REF_READS:
+        app.get_existing_refs(service, tab, refs_only=refs_only)
+    return app.load_nmb_existing_trx_ids(service)
+
+
+def test_snapshot_row_count_vs_fresh_read(app_module, tabs):
+    app = app_module
+    app.load_sheet_snapshot(tabs, ['PASSED'])
+    tabs.rows(app.PASSED_SHEET_ID, 'PASSED').append(_row(3, 'SMS-RESCUE'))   # another writer
+    assert app.get_last_row_number(tabs, 'PASSED') == 3
+    assert app.get_last_row_number(tabs, 'PASSED', fresh=True) == 4
+    # The fresh read replaces the snapshot's column.
+    assert app.get_last_row_number(tabs, 'PASSED') == 4
+
+
+def test_append_positions_after_other_writers(app_module, tabs):
+    app = app_module
+    app.load_sheet_snapshot(tabs, ['PASSED'])
+    rows = tabs.rows(app.PASSED_SHEET_ID, 'PASSED')
+    rows.append(_row(3, 'SMS-RESCUE'))
+    assert app.append_to_sheet(tabs, 'PASSED', [_row(4, 'NEW')]) == 5
+    assert [r[7] for r in rows[3:]] == ['SMS-RESCUE', 'NEW']
+    assert app.get_last_row_number(tabs, 'PASSED') == 5
+
+
+def test_warm_nmb_dedup_load_is_two_batch_gets_per_spreadsheet(app_module, tabs):
+    app = app_module
+    cold = _nmb_dedup_reads(app, tabs)
+    assert len(cold) == 7
+    tabs.calls.clear()
+    assert _nmb_dedup_reads(app, tabs) == cold
+    assert tabs.count('get') == 0
+    assert tabs.count('batchGet') == 2 * 3     # column A + ref tails, per spreadsheet
+
+
+def test_trx_ids_fall_back_to_the_sheet_without_the_index(app_module, tabs, ref_index_db, monkeypatch):
+    monkeypatch.setattr(ref_index_db, 'ENABLED', False)
+    assert len(app_module.load_nmb_existing_trx_ids(tabs)) == 7
+    assert tabs.count('get') == 7
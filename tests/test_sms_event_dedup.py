@@ -0,0 +1,74 @@
+"""sms_event_dedup.py claims and releases, and how
+sms_rescue_engine.insert_events() uses them."""
+
+import pytest
+
+import sms_event_dedup
+import sms_rescue_engine
+
+
+@pytest.fixture
+def dedup(tmp_path, monkeypatch):
+    monkeypatch.setattr(sms_event_dedup, 'DEDUP_PATH', str(tmp_path / 'dedup.sqlite3'))
+    monkeypatch.setattr(sms_event_dedup, '_schema_ready', False)
+    monkeypatch.setattr(sms_event_dedup, '_memory', {})
+    monkeypatch.setattr(sms_event_dedup, 'WINDOW', 60.0)
+    return sms_event_dedup
+
+
+def test_repeat_within_window_is_suppressed(dedup):
+    k = dedup.key('NMB', 'PAYMENT MC123ABC', 'rescued')
+    assert dedup.claim(k, 1000)
+    assert not dedup.claim(k, 1030)
+    assert dedup.claim(k, 1061)
+    assert dedup.claim(dedup.key('NMB', 'PAYMENT MC123ABC', 'no_match'), 1061)
+
+
+def test_claim_is_shared_through_the_file(dedup):
+    # Another worker (or this one after a recycle) has an empty dict.
+    k = dedup.key('NMB', 'PAYMENT MC123ABC', 'rescued')
+    assert dedup.claim(k, 1000)
+    dedup._memory.clear()
+    assert not dedup.claim(k, 1010)
+
+
+def test_release_lets_a_retry_log_it(dedup):
+    k = dedup.key('NMB', 'PAYMENT MC123ABC', 'rescued')
+    assert dedup.claim(k, 1000)
+    dedup.release(k)
+    assert dedup.claim(k, 1010)
+
+
+def test_memory_only_without_a_path(dedup, monkeypatch):
+    monkeypatch.setattr(dedup, 'DEDUP_PATH', '')
+    k = dedup.key('NMB', 'PAYMENT MC123ABC', 'rescued')
+    assert dedup.claim(k, 1000)
+    assert not dedup.claim(k, 1010)
+    dedup._memory.clear()
+    assert dedup.claim(k, 1020)
+
+
+def test_body_hash_is_per_window_bucket(dedup):
+    args = ('NMB', 'PAYMENT MC123ABC', 'rescued')
+    assert dedup.body_hash(*args, now=1000) == dedup.body_hash(*args, now=1019)
+    assert dedup.body_hash(*args, now=1019) != dedup.body_hash(*args, now=1020)
+
+
+def test_insert_events_queues_once_and_releases_on_failure(dedup, monkeypatch):
+    monkeypatch.setattr(sms_rescue_engine, '_main', lambda: ('http://supabase.test', 'key'))
+    submitted = []
+    accept = {'ok': False}
+
+    def submit(table, row):
+        submitted.append(row)
+        return accept['ok']
+    monkeypatch.setattr(sms_rescue_engine.audit_queue, 'submit', submit)
+    row = sms_rescue_engine.event_row('NMB', 'PAYMENT MC123ABC', None, 200, 'rescued',
+                                      'MC123ABC', 'R1', 1, 'ILIYOPATA', None)
+
+    sms_rescue_engine.insert_events([row])      # queue full and spill failed
+    accept['ok'] = True
+    sms_rescue_engine.insert_events([row])      # so the retry isn't a duplicate
+    sms_rescue_engine.insert_events([row])
+    assert len(submitted) == 2
+    assert len(submitted[1]['body_hash']) == 64
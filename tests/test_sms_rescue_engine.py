@@ -0,0 +1,123 @@
+"""sms_rescue_engine.rescue(): per-message outcomes for a batch, with one
+bulk lookup per table, against fake Supabase sessions."""
+
+import pytest
+
+import sms_rescue_engine
+
+
+class _Response:
+    def __init__(self, status, body):
+        self.status_code = status
+        self.ok = 200 <= status < 300
+        self._body = body
+        self.text = str(body)
+
+    def json(self):
+        return self._body
+
+
+class _Session:
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, url, params=None, **kwargs):
+        self.db.calls.append(('GET', url.rsplit('/', 1)[-1]))
+        if self.db.fail_lookups:
+            return _Response(503, 'unavailable')
+        wanted = params['ref_number' if 'transactions' in url else 'plate']
+        wanted = set(wanted[len('in.('):-1].replace('"', '').split(','))
+        if 'transactions' in url:
+            self.db.ref_params.append(wanted)
+            return _Response(200, [t for t in self.db.txs if t['ref_number'] in wanted])
+        return _Response(200, [c for c in self.db.customers if c['plate'] in wanted])
+
+    def patch(self, url, json=None, **kwargs):
+        self.db.calls.append(('PATCH', url.split('id=eq.')[1].split('&')[0]))
+        if self.db.lose_race:
+            return _Response(200, [])
+        return _Response(200, [json])
+
+
+class _Db:
+    def __init__(self):
+        self.calls, self.ref_params, self.events, self.sheet_rows = [], [], [], []
+        self.fail_lookups = self.lose_race = False
+        self.txs = [
+            _tx(1, 'PS1001', 'NMBFAILED'),
+            _tx(2, 'ab12cd', 'CRDBFAILED'),
+            _tx(3, 'PS1003', 'PASSED'),
+        ]
+        self.customers = [{'id': 9, 'customer_name': 'JOHN', 'customer_type': 'boda',
+                           'plate': 'MC123ABC', 'sav_customer_id': 'S9'}]
+
+
+def _tx(id_, ref, source_tab):
+    return {'id': id_, 'ref_number': ref, 'source_tab': source_tab,
+            'transaction_date': '01.01.2026', 'rescue_locked_at': None}
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = _Db()
+    session = _Session(db)
+    monkeypatch.setattr(sms_rescue_engine, '_main', lambda: ('http://main.test', 'key'))
+    monkeypatch.setattr(sms_rescue_engine, '_registry', lambda: ('http://registry.test', 'key'))
+    monkeypatch.setattr(sms_rescue_engine.supabase_client, 'main', lambda retries=True: session)
+    monkeypatch.setattr(sms_rescue_engine.supabase_client, 'registry', lambda retries=True: session)
+    monkeypatch.setattr(sms_rescue_engine, 'insert_events', db.events.append)
+
+    def append_rows(rows):
+        db.sheet_rows.append(rows)
+        return [{'ok': True} for _ in rows]
+    monkeypatch.setattr(sms_rescue_engine.iliyopata_writer, 'append_iliyopata_rows', append_rows)
+    return db
+
+
+def _sms(ref, plate='MC123ABC'):
+    return {'sender': 'NMB', 'body': f'PAYMENT {plate} {ref}', 'received_at': None,
+            'plate': plate, 'ref': ref}
+
+
+def test_batch_outcomes_with_one_lookup_per_table(db):
+    items = [_sms('PS1001'), _sms('PS1001'), _sms('PS9999'), _sms('PS1003'),
+             _sms('PS1001', plate=None), _sms('AB12CD')]
+    results = sms_rescue_engine.rescue(items)
+    assert [r['outcome'] for r in results] == [
+        'rescued', 'already_rescued', 'ref_not_found', 'ref_in_passed',
+        'extract_failed', 'rescued']
+    assert [r['status'] for r in results] == [200, 409, 404, 409, 400, 200]
+    assert results[0]['source_tab'] == 'BODAILIYOPATA'
+    assert db.calls == [('GET', 'transactions'), ('GET', 'customer_registry'),
+                        ('PATCH', '1'), ('PATCH', '2')]
+    assert len(db.sheet_rows) == 1 and len(db.sheet_rows[0]) == 2
+    (events,) = db.events
+    assert len(events) == len(items)
+
+
+def test_ref_lookup_is_case_insensitive(db):
+    # in.() is case-sensitive, so every ref goes in as typed, lower and upper.
+    sms_rescue_engine.rescue([_sms('Ab12Cd')])
+    assert {'Ab12Cd', 'ab12cd', 'AB12CD'} <= db.ref_params[0]
+    assert ('PATCH', '2') in db.calls
+
+
+def test_lost_lock_race_is_already_rescued(db):
+    db.lose_race = True
+    (result,) = sms_rescue_engine.rescue([_sms('PS1001')])
+    assert (result['status'], result['outcome']) == (409, 'already_rescued')
+    assert db.sheet_rows == []
+
+
+def test_failed_lookup_is_a_server_error_for_every_item(db):
+    db.fail_lookups = True
+    results = sms_rescue_engine.rescue([_sms('PS1001'), _sms('PS9999')])
+    assert {(r['status'], r['error']) for r in results} == {(500, 'transactions_lookup_failed')}
+    assert ('PATCH', '1') not in db.calls
+
+
+def test_sweeps_do_not_relog_misses(db):
+    results = sms_rescue_engine.rescue([_sms('PS9999'), _sms('PS1001')], log_misses=False)
+    assert [r['outcome'] for r in results] == ['ref_not_found', 'rescued']
+    (events,) = db.events
+    assert [e['outcome'] for e in events] == ['rescued']
@@ -0,0 +1,77 @@
+"""Which calls supabase_client's sessions retry. Runs against a local HTTP
+server, since the retries happen inside urllib3."""
+
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import supabase_client
+
+
+class _Gateway(BaseHTTPRequestHandler):
+    statuses = []       # popped per request; 200 once empty
+    seen = []
+
+    def _reply(self):
+        self.seen.append(self.command)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        status = self.statuses.pop(0) if self.statuses else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'[]')
+
+    do_GET = do_PATCH = do_POST = do_DELETE = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    monkeypatch.setattr(supabase_client, 'BACKOFF', 0)
+    monkeypatch.setattr(supabase_client, 'RETRIES', 3)
+    supabase_client.reset()
+    _Gateway.statuses, _Gateway.seen = [], []
+    server = HTTPServer(('127.0.0.1', 0), _Gateway)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}', _Gateway
+    server.shutdown()
+    server.server_close()
+    supabase_client.reset()
+
+
+def test_get_is_retried_on_502(gateway):
+    url, gw = gateway
+    gw.statuses = [502, 502]
+    assert supabase_client.main().get(f'{url}/rest/v1/transactions').status_code == 200
+    assert gw.seen == ['GET'] * 3
+
+
+def test_guarded_patch_is_not_retried(gateway):
+    # A retried lock() PATCH would match zero rows and read as a lost race.
+    url, gw = gateway
+    gw.statuses = [502]
+    r = supabase_client.main().patch(f'{url}/rest/v1/transactions?id=eq.1&rescue_locked_at=is.null',
+                                      json={'rescue_locked_at': 'now'})
+    assert r.status_code == 502
+    assert gw.seen == ['PATCH']
+
+
+def test_post_is_not_retried(gateway):
+    url, gw = gateway
+    gw.statuses = [503]
+    assert supabase_client.main().post(f'{url}/rest/v1/sms_events', json=[{}]).status_code == 503
+    assert gw.seen == ['POST']
+
+
+def test_session_without_retries_leaves_them_to_the_caller(gateway):
+    url, gw = gateway
+    gw.statuses = [502]
+    assert supabase_client.registry(retries=False).get(f'{url}/rest/v1/customer_registry').status_code == 502
+    assert gw.seen == ['GET']
+    assert supabase_client.registry(retries=False) is not supabase_client.registry()
@@ -25,7 +25,9 @@ from flask import (Blueprint, jsonify, redirect, render_template, request,
                    url_for)
 from flask_login import current_user, login_required, login_user, logout_user
 
-from auth import User, check_password, require_role
+import audit_queue
+import supabase_client
+from auth import User, check_password, invalidate_user, require_role
 
 SUPABASE_URL = os.environ.get('SUPABASE_URL', '').rstrip('/')
 SUPABASE_KEY = os.environ.get('SUPABASE_SERVICE_KEY', '')
@@ -56,6 +58,23 @@ _H_REGISTRY = {
 
 ui = Blueprint('ui', __name__)
 
+# Called after a successful customer_registry write. app.py registers its
+# customer-cache invalidation here (it imports this module, so the blueprint
+# can't import app back).
+_registry_change_hooks = []
+
+
+def add_registry_change_hook(fn):
+    _registry_change_hooks.append(fn)
+
+
+def _registry_changed():
+    for fn in _registry_change_hooks:
+        try:
+            fn()
+        except Exception as e:
+            print(f"⚠️ registry change hook failed: {e}")
+
 
 # ── Table config ─────────────────────────────────────────────────────────────
 # Tables the UI knows about. `editable` gates PATCH/DELETE via role check.
@@ -404,7 +423,7 @@ def _paginated_query(table: str, cfg: dict, always_where=None):
         i += 1
 
     q_string = '&'.join(parts)
-    r = requests.get(
+    r = supabase_client.main().get(
         f'{SUPABASE_URL}/rest/v1/{table}?{q_string}',
         headers={**_H,
                  'Range-Unit': 'items',
@@ -426,23 +445,35 @@ def _paginated_query(table: str, cfg: dict, always_where=None):
 
 
 # ── Audit-log helper ─────────────────────────────────────────────────────────
+# Rows are queued on audit_queue and inserted in batches by its background
+# writer, so an edit doesn't wait on the record_edits round trip.
+def _write_record_edits(rows) -> int:
+    r = supabase_client.main().post(
+        f'{SUPABASE_URL}/rest/v1/record_edits',
+        headers={**_H, 'Prefer': 'return=minimal'},
+        json=rows,
+        timeout=10,
+    )
+    if not r.ok:
+        print(f"⚠️ record_edits insert: HTTP {r.status_code} {r.text[:200]}")
+    return r.status_code
+
+
+audit_queue.register('record_edits', _write_record_edits)
+
+
 def _audit(action: str, table_name: str, row_id: int,
            before: dict | None = None, after: dict | None = None):
     try:
-        requests.post(
-            f'{SUPABASE_URL}/rest/v1/record_edits',
-            headers={**_H, 'Prefer': 'return=minimal'},
-            json={
-                'user_id':     current_user.id,
-                'username':    current_user.username,
-                'action':      action,
-                'table_name':  table_name,
-                'row_id':      row_id,
-                'before_json': before,
-                'after_json':  after,
-            },
-            timeout=5,
-        )
+        audit_queue.submit('record_edits', {
+            'user_id':     current_user.id,
+            'username':    current_user.username,
+            'action':      action,
+            'table_name':  table_name,
+            'row_id':      row_id,
+            'before_json': before,
+            'after_json':  after,
+        })
     except Exception:
         pass  # audit is best-effort; never break the primary write
 
@@ -470,7 +501,7 @@ def customers_create():
     payload = request.get_json(silent=True) or {}
     body = {k: payload.get(k) for k in TABLES['customers']['editable']
             if k in payload}
-    r = requests.post(f'{SUPABASE_URL}/rest/v1/customers',
+    r = supabase_client.main().post(f'{SUPABASE_URL}/rest/v1/customers',
                       headers={**_H, 'Prefer': 'return=representation'},
                       json=body, timeout=15)
     if not r.ok:
@@ -484,13 +515,13 @@ def customers_create():
 @require_role('admin', 'editor')
 def customers_update(row_id):
     # Fetch current state for audit before/after
-    b = requests.get(f'{SUPABASE_URL}/rest/v1/customers?id=eq.{row_id}',
+    b = supabase_client.main().get(f'{SUPABASE_URL}/rest/v1/customers?id=eq.{row_id}',
                      headers=_H, timeout=10).json()
     before = b[0] if b else None
     payload = request.get_json(silent=True) or {}
     body = {k: payload.get(k) for k in TABLES['customers']['editable']
             if k in payload}
-    r = requests.patch(f'{SUPABASE_URL}/rest/v1/customers?id=eq.{row_id}',
+    r = supabase_client.main().patch(f'{SUPABASE_URL}/rest/v1/customers?id=eq.{row_id}',
                        headers={**_H, 'Prefer': 'return=representation'},
                        json=body, timeout=15)
     if not r.ok:
@@ -503,10 +534,10 @@ def customers_update(row_id):
 @ui.route('/api/customers/<int:row_id>', methods=['DELETE'])
 @require_role('admin')
 def customers_delete(row_id):
-    b = requests.get(f'{SUPABASE_URL}/rest/v1/customers?id=eq.{row_id}',
+    b = supabase_client.main().get(f'{SUPABASE_URL}/rest/v1/customers?id=eq.{row_id}',
                      headers=_H, timeout=10).json()
     before = b[0] if b else None
-    r = requests.delete(f'{SUPABASE_URL}/rest/v1/customers?id=eq.{row_id}',
+    r = supabase_client.main().delete(f'{SUPABASE_URL}/rest/v1/customers?id=eq.{row_id}',
                         headers={**_H, 'Prefer': 'return=minimal'}, timeout=15)
     if not r.ok:
         return jsonify({'error': r.text[:400]}), r.status_code
@@ -543,7 +574,7 @@ def customers_search():
         f'{col}.ilike.*{escaped}*'
         for col in ('name', 'phone', 'plate', 'customer_id')
     )
-    r = requests.get(
+    r = supabase_client.main().get(
         f'{SUPABASE_URL}/rest/v1/customers'
         f'?select=id,name,phone,plate,customer_id,source_tab'
         f'&or=({or_terms})'
@@ -590,7 +621,7 @@ def _lookup_customer_in_registry_by_plate(plate: str):
     if not (plate and SUPABASE_URL_REGISTRY and SUPABASE_KEY_REGISTRY):
         return None
     try:
-        r = requests.get(
+        r = supabase_client.registry().get(
             f'{SUPABASE_URL_REGISTRY}/rest/v1/customer_registry',
             params={
                 'plate':  f'eq.{plate}',
@@ -633,14 +664,14 @@ def transactions_rescue(row_id):
     # This closes the class of bugs where MC792FPJ landed on ISMAIL
     # SELEMANI ISMAIL because the polluted `customers` table had 4 stale
     # rows for that plate.
-    tx_r = requests.get(
+    tx_r = supabase_client.main().get(
         f'{SUPABASE_URL}/rest/v1/transactions?id=eq.{row_id}'
         '&select=id,source_tab,transaction_date,customer_name,ref_number,'
         'bank,description,credit_amount,identifier,customer_id,'
         'rescue_locked_at',
         headers=_H, timeout=15,
     )
-    picked_r = requests.get(
+    picked_r = supabase_client.main().get(
         f'{SUPABASE_URL}/rest/v1/customers?id=eq.{customer_id}'
         '&select=id,name,plate,customer_id,source_tab',
         headers=_H, timeout=15,
@@ -697,7 +728,7 @@ def transactions_rescue(row_id):
     # Atomic conditional PATCH — only touches the row if it isn't
     # already locked. Simultaneous UI + SMS rescues on the same id
     # can't both succeed; the loser gets 0 rows updated → 409.
-    r = requests.patch(
+    r = supabase_client.main().patch(
         f'{SUPABASE_URL}/rest/v1/transactions?id=eq.{row_id}'
         '&rescue_locked_at=is.null',
         headers={**_H, 'Prefer': 'return=representation'},
@@ -847,7 +878,7 @@ def customer_registry_list():
             params.append(('loan_amount_tsh', f'{op}.{raw}'))
 
     try:
-        r = requests.get(
+        r = supabase_client.registry().get(
             f'{SUPABASE_URL_REGISTRY}/rest/v1/customer_registry',
             params=params,
             headers={**_H_REGISTRY,
@@ -891,7 +922,7 @@ def customer_registry_create():
         else None
     )
     try:
-        r = requests.post(
+        r = supabase_client.registry().post(
             f'{SUPABASE_URL_REGISTRY}/rest/v1/customer_registry',
             headers={**_H_REGISTRY, 'Prefer': 'return=representation'},
             json=body, timeout=15,
@@ -900,6 +931,7 @@ def customer_registry_create():
         return jsonify({'error': f'registry unreachable: {e}'}), 502
     if not r.ok:
         return jsonify({'error': r.text[:400]}), r.status_code
+    _registry_changed()
     created = r.json()[0] if r.json() else {}
     return jsonify(created), 201
 
@@ -912,7 +944,7 @@ def customer_registry_update(row_id):
     if not body:
         return jsonify({'error': 'no editable fields in payload'}), 400
     try:
-        r = requests.patch(
+        r = supabase_client.registry().patch(
             f'{SUPABASE_URL_REGISTRY}/rest/v1/customer_registry?id=eq.{row_id}',
             headers={**_H_REGISTRY, 'Prefer': 'return=representation'},
             json=body, timeout=15,
@@ -921,6 +953,7 @@ def customer_registry_update(row_id):
         return jsonify({'error': f'registry unreachable: {e}'}), 502
     if not r.ok:
         return jsonify({'error': r.text[:400]}), r.status_code
+    _registry_changed()
     after = r.json()[0] if r.json() else {}
     return jsonify(after)
 
@@ -929,7 +962,7 @@ def customer_registry_update(row_id):
 @require_role('admin', 'editor')
 def customer_registry_delete(row_id):
     try:
-        r = requests.delete(
+        r = supabase_client.registry().delete(
             f'{SUPABASE_URL_REGISTRY}/rest/v1/customer_registry?id=eq.{row_id}',
             headers={**_H_REGISTRY, 'Prefer': 'return=representation'},
             timeout=15,
@@ -941,6 +974,7 @@ def customer_registry_delete(row_id):
     rows = r.json() if r.content else []
     if not rows:
         return jsonify({'error': f'no row with id {row_id}'}), 404
+    _registry_changed()
     return jsonify({'deleted': True, 'id': row_id})
 
 
@@ -957,7 +991,7 @@ def customer_registry_summary():
     ):
         params = {'select': 'id', **filt}
         try:
-            r = requests.get(
+            r = supabase_client.registry().get(
                 f'{SUPABASE_URL_REGISTRY}/rest/v1/customer_registry',
                 params=params,
                 headers={**_H_REGISTRY, 'Range': '0-0',
@@ -986,7 +1020,7 @@ def sms_events_summary():
     where `sent` is the total count of events processed today (regardless
     of outcome). "Today" is measured in EAT (UTC+3) to match Tanzania
     wall-clock — customers care about their local day, not UTC."""
-    import os, requests
+    import os
     from datetime import datetime, timedelta, timezone
     url = os.environ.get('SUPABASE_URL', '').rstrip('/')
     key = os.environ.get('SUPABASE_SERVICE_KEY', '') \
@@ -1008,7 +1042,7 @@ def sms_events_summary():
                   'processed_at': f'gte.{since}'}
         params.update(extra_params)
         try:
-            r = requests.get(
+            r = supabase_client.main().get(
                 f'{url}/rest/v1/sms_events',
                 params=params,
                 headers={**hdr, 'Range': '0-0'},
@@ -1053,7 +1087,7 @@ def users_create():
         'full_name': full_name,
         'role': role,
     }
-    r = requests.post(f'{SUPABASE_URL}/rest/v1/users',
+    r = supabase_client.main().post(f'{SUPABASE_URL}/rest/v1/users',
                       headers={**_H, 'Prefer': 'return=representation'},
                       json=body, timeout=15)
     if not r.ok:
@@ -1081,14 +1115,15 @@ def users_update(row_id):
     if body.get('role') and body['role'] not in ('admin', 'editor', 'viewer'):
         return jsonify({'error': 'invalid role'}), 400
 
-    b = requests.get(f'{SUPABASE_URL}/rest/v1/users?id=eq.{row_id}',
+    b = supabase_client.main().get(f'{SUPABASE_URL}/rest/v1/users?id=eq.{row_id}',
                      headers=_H, timeout=10).json()
     before = b[0] if b else None
-    r = requests.patch(f'{SUPABASE_URL}/rest/v1/users?id=eq.{row_id}',
+    r = supabase_client.main().patch(f'{SUPABASE_URL}/rest/v1/users?id=eq.{row_id}',
                        headers={**_H, 'Prefer': 'return=representation'},
                        json=body, timeout=15)
     if not r.ok:
         return jsonify({'error': r.text[:400]}), r.status_code
+    invalidate_user(row_id)
     after = r.json()[0] if r.json() else {}
     if before: before.pop('password_hash', None)
     after.pop('password_hash', None)
@@ -1101,14 +1136,15 @@ def users_update(row_id):
 def users_delete(row_id):
     if row_id == current_user.id:
         return jsonify({'error': "can't delete your own account"}), 400
-    b = requests.get(f'{SUPABASE_URL}/rest/v1/users?id=eq.{row_id}',
+    b = supabase_client.main().get(f'{SUPABASE_URL}/rest/v1/users?id=eq.{row_id}',
                      headers=_H, timeout=10).json()
     before = b[0] if b else None
     if before: before.pop('password_hash', None)
-    r = requests.delete(f'{SUPABASE_URL}/rest/v1/users?id=eq.{row_id}',
+    r = supabase_client.main().delete(f'{SUPABASE_URL}/rest/v1/users?id=eq.{row_id}',
                         headers={**_H, 'Prefer': 'return=minimal'}, timeout=15)
     if not r.ok:
         return jsonify({'error': r.text[:400]}), r.status_code
+    invalidate_user(row_id)
     _audit('DELETE', 'users', row_id, before=before)
     return jsonify({'deleted': True})
 